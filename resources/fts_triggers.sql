@@ -15,3 +15,15 @@ END;
 CREATE TEMP TRIGGER IF NOT EXISTS fts_db_format_updated_trg AFTER UPDATE ON main.data BEGIN
     INSERT OR IGNORE INTO dirtied_formats(book, format) VALUES (NEW.book, NEW.format);
 END;
+
+CREATE TEMP TRIGGER IF NOT EXISTS fts_db_text_inserted_trg AFTER INSERT ON fts_db.books_text BEGIN
+    SELECT fts_text_changed();
+END;
+
+CREATE TEMP TRIGGER IF NOT EXISTS fts_db_text_updated_trg AFTER UPDATE OF searchable_text ON fts_db.books_text BEGIN
+    SELECT fts_text_changed();
+END;
+
+CREATE TEMP TRIGGER IF NOT EXISTS fts_db_text_deleted_trg AFTER DELETE ON fts_db.books_text BEGIN
+    SELECT fts_text_changed();
+END;
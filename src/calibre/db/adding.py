@@ -214,18 +214,22 @@ def import_book_directory(db, dirpath, callback=None, added_ids=None, compiled_r
 
 
 def recursive_import(db, root, single_book_per_directory=True,
-        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False):
-    root = os.path.abspath(root)
-    duplicates  = []
-    for dirpath in os.walk(root):
-        func = import_book_directory if single_book_per_directory else import_book_directory_multiple
-        res = func(db, dirpath[0], callback=callback,
-            added_ids=added_ids, compiled_rules=compiled_rules, add_duplicates=add_duplicates)
-        if res is not None:
-            duplicates.extend(res)
-        if callable(callback):
-            if callback(''):
-                break
+        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False, errors=None):
+    # Books that could not be added are appended to errors as (paths,
+    # details). If errors is None, an exception is raised instead, after all
+    # other books have been added.
+    from calibre.db.bulk_add import BulkAdd
+    ba = BulkAdd(
+        db.new_api, (root,), single_book_per_directory=single_book_per_directory, compiled_rules=compiled_rules,
+        add_duplicates=add_duplicates, callback=callback)
+    ids, duplicates = ba()
+    if added_ids is not None:
+        added_ids.update(ids)
+    if errors is not None:
+        errors.extend(ba.errors)
+    elif ba.errors:
+        raise Exception('Failed to add some books:\n' + '\n'.join(
+            '{}:\n{}'.format(', '.join(paths), details) for paths, details in ba.errors))
     return duplicates
 
 
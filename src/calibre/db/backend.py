@@ -7,7 +7,6 @@ __docformat__ = 'restructuredtext en'
 
 # Imports {{{
 import errno
-import hashlib
 import json
 import os
 import shutil
@@ -22,19 +21,23 @@ import apsw
 
 from calibre import as_unicode, force_unicode, isbytestring, prints
 from calibre.constants import filesystem_encoding, iswindows, plugins, preferred_encoding
-from calibre.db import SPOOL_SIZE, FTSQueryError
+from calibre.db import FTSQueryError
 from calibre.db.annotations import annot_db_data, unicode_normalize
 from calibre.db.constants import (
     BOOK_ID_PATH_TEMPLATE,
+    COMPOSITES_STORE_NAME,
     COVER_FILE_NAME,
     DEFAULT_TRASH_EXPIRY_TIME_SECONDS,
     METADATA_FILE_NAME,
     NOTES_DIR_NAME,
+    STAGED_FILE_PREFIX,
+    TABLES_SNAPSHOT_NAME,
     TRASH_DIR_NAME,
     TrashEntry,
 )
 from calibre.db.errors import NoSuchFormat
-from calibre.db.schema_upgrades import SchemaUpgrade
+from calibre.db.integrity import hash_file, hash_stream, stat_key, verify_formats
+from calibre.db.schema_upgrades import CHANGE_LOG_SIZE, CHANGE_LOG_TABLE, SchemaUpgrade, change_log_triggers
 from calibre.db.tables import (
     AuthorsTable,
     CompositeTable,
@@ -352,6 +355,8 @@ class Connection(apsw.Connection):  # {{{
         super().__init__(path)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
+        # Incremented by triggers whenever the indexed text of a book changes
+        self.fts_change_counter = 0
 
         self.setbusytimeout(self.BUSY_TIMEOUT)
         self.execute('PRAGMA cache_size=-5000; PRAGMA temp_store=2; PRAGMA foreign_keys=ON;')
@@ -365,6 +370,7 @@ class Connection(apsw.Connection):  # {{{
                 _author_to_author_sort, 1)
         self.createscalarfunction('uuid4', lambda: str(uuid.uuid4()),
                 0)
+        self.createscalarfunction('fts_text_changed', self.fts_text_changed, 0)
 
         # Dummy functions for dynamically created filters
         self.createscalarfunction('books_list_filter', lambda x: 1, 1)
@@ -382,6 +388,9 @@ class Connection(apsw.Connection):  # {{{
         self.createaggregatefunction('aum_sortconcat',
                 AumSortedConcatenate, 4)
 
+    def fts_text_changed(self):
+        self.fts_change_counter += 1
+
     def create_dynamic_filter(self, name):
         f = DynamicFilter(name)
         self.createscalarfunction(name, f, 1)
@@ -444,8 +453,9 @@ class DB:
 
     def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
-                 load_user_formatter_functions=True):
+                 load_user_formatter_functions=True, read_only_copy=None):
         self.is_closed = False
+        self.read_only = read_only
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.field_metadata = FieldMetadata()
@@ -468,7 +478,19 @@ class DB:
                     'Path to library too long. It must be less than'
                     ' %d characters.')%self.WINDOWS_LIBRARY_PATH_LIMIT)
 
-        if read_only and os.path.exists(self.dbpath):
+        # The snapshot of the in-memory tables used to speed up opening
+        # libraries, see read_tables()
+        self.tables_snapshot_path = None if read_only else os.path.join(os.path.dirname(self.dbpath), TABLES_SNAPSHOT_NAME)
+        # The key of the existing snapshot, if the tables were loaded from it
+        # or it was written by this process, see save_tables_snapshot()
+        self.tables_snapshot_key = None
+        # The store of rendered composite column values, see calibre.db.composites
+        self.composites_store_path = None if read_only else os.path.join(os.path.dirname(self.dbpath), COMPOSITES_STORE_NAME)
+        if read_only and read_only_copy is not None:
+            # An existing copy of metadata.db, which may be shared with
+            # other read-only instances
+            self.dbpath = read_only_copy
+        elif read_only and os.path.exists(self.dbpath):
             # Work on only a copy of metadata.db to ensure that
             # metadata.db is not changed
             pt = PersistentTemporaryFile('_metadata_ro.db')
@@ -489,6 +511,7 @@ class DB:
         self.is_fat_filesystem = is_fat_filesystem(self.library_path)
 
         SchemaUpgrade(self, self.library_path, self.field_metadata)
+        self.prune_change_log()
 
         # Guarantee that the library_id is set
         self.library_id
@@ -520,6 +543,7 @@ class DB:
                                  self.prefs.get('user_template_functions', [])))
         if self.prefs['last_expired_trash_at'] > 0:
             self.ensure_trash_dir(during_init=True)
+        self.remove_stale_staged_files()
         if load_user_formatter_functions:
             set_global_state(self)
         self.initialize_notes()
@@ -1105,6 +1129,10 @@ class DB:
         if self.fts is not None:
             return self.fts.commit_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
 
+    def commit_fts_results(self, results):
+        if self.fts is not None:
+            return self.fts.commit_results(results)
+
     def fts_unindex(self, book_id, fmt=None):
         self.fts.unindex(book_id, fmt=fmt)
 
@@ -1359,6 +1387,7 @@ class DB:
             ]
         script = ' \n'.join(lines)
         self.execute(script)
+        self.execute(change_log_triggers(self, (table, lt) if normalized else (table,)))
         self.prefs.set('update_all_last_mod_dates_on_start', True)
         return num
     # }}}
@@ -1367,21 +1396,29 @@ class DB:
         data = self.custom_field_metadata(label, num)
         self.execute('UPDATE custom_columns SET mark_for_delete=1 WHERE id=?', (data['num'],))
 
-    def close(self, force=True, unload_formatter_functions=True):
+    def close(self, force=True, unload_formatter_functions=True, save_tables_snapshot=True):
         if getattr(self, '_conn', None) is not None:
-            if self.prefs['expire_old_trash_after'] == 0:
+            # Read-only copies must not change the library and share their
+            # library id, and so their template functions, with the other
+            # copies of the same library that may still be open
+            if self.prefs['expire_old_trash_after'] == 0 and not self.read_only:
                 self.expire_old_trash(0)
-            if unload_formatter_functions:
+            if unload_formatter_functions and not self.read_only:
                 try:
                     unload_user_template_functions(self.library_id)
                 except Exception:
                     pass
+            if save_tables_snapshot:
+                # After all other writes, so that it matches the database as it is left
+                self.save_tables_snapshot()
             self._conn.close(force)
             del self._conn
             self.is_closed = True
 
     def reopen(self, force=True):
-        self.close(force=force, unload_formatter_functions=False)
+        # The tables stay in use, so the snapshot, which reads the changes
+        # made to the database into them, must not be written
+        self.close(force=force, unload_formatter_functions=False, save_tables_snapshot=False)
         self._conn = None
         self.conn
         self.notes.reopen(self)
@@ -1547,12 +1584,87 @@ class DB:
         ''' Return last modified time as a UTC datetime object '''
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
+    def prune_change_log(self, keep=CHANGE_LOG_SIZE):
+        ''' Remove all but the last keep entries from the change log '''
+        first, last = self.conn.get(f'SELECT MIN(id), MAX(id) FROM {CHANGE_LOG_TABLE}')[0]
+        if first is not None and last - first >= keep:
+            self.execute(f'DELETE FROM {CHANGE_LOG_TABLE} WHERE id <= ?', (last - keep,))
+
+    def current_change_seq(self):
+        ''' The sequence number of the last change recorded in the change log '''
+        return self.conn.get('SELECT seq FROM sqlite_sequence WHERE name=?', (CHANGE_LOG_TABLE,), all=False) or 0
+
+    def changes_since(self, seq):
+        '''
+        Return the changes recorded in the change log after the sequence
+        number seq as (current sequence number, changes), where changes is a
+        map of table name to (set of book ids, set of item ids). Returns None
+        if the changes cannot be determined, for example, because the log has
+        been pruned. Must be called inside a transaction.
+        '''
+        cur = self.current_change_seq()
+        if seq is None or cur < seq:
+            return None
+        changes = {}
+        if cur > seq:
+            first = self.conn.get(f'SELECT MIN(id) FROM {CHANGE_LOG_TABLE}', all=False)
+            if first is None or first > seq + 1:
+                return None
+            for tbl, book, item in self.execute(
+                    f'SELECT tbl, book, item FROM {CHANGE_LOG_TABLE} WHERE id > ? AND id <= ?', (seq, cur)):
+                if tbl not in changes:
+                    changes[tbl] = set(), set()
+                if book is not None:
+                    changes[tbl][0].add(book)
+                if item is not None:
+                    changes[tbl][1].add(item)
+        return cur, changes
+
+    def read_changed_tables(self):
+        '''
+        Update the in-memory tables with only the data that has changed in the
+        db since the tables were last read. Returns the set of ids of books
+        whose data may have changed or None if the changes could not be
+        determined and all tables were re-read.
+        '''
+        with self.conn:
+            ans = self.changes_since(getattr(self, 'last_change_seq', None))
+            if ans is not None:
+                seq, changes = ans
+                book_ids = set()
+                if changes:
+                    for table in itervalues(self.tables):
+                        book_ids |= table.read_changes(self, changes)
+                self.last_change_seq = seq
+                return book_ids
+        self.read_tables()
+
     def read_tables(self):
         '''
         Read all data from the db into the python in-memory tables
         '''
 
+        from calibre.db.snapshot import load_snapshot, snapshot_key
+        snapshot_path = self.tables_snapshot_path
+        self.tables_loaded_from_snapshot = False
+        self.tables_snapshot_key = None
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
+            key = None
+            self.last_change_seq = self.current_change_seq()
+            try:
+                if snapshot_path:
+                    key = snapshot_key(self.conn, self.dbpath)
+                if key is not None:
+                    self.tables_loaded_from_snapshot = load_snapshot(snapshot_path, key, self.tables)
+            except Exception:
+                import traceback
+                prints('Failed to load tables snapshot, reading from the database instead')
+                traceback.print_exc()
+                with suppress(OSError):
+                    os.remove(snapshot_path)
+            if self.tables_loaded_from_snapshot:
+                self.tables_snapshot_key = key
+                return
             for table in itervalues(self.tables):
                 try:
                     table.read(self)
@@ -1562,6 +1674,38 @@ class DB:
                     pprint.pprint(table.metadata)
                     raise
 
+    def save_tables_snapshot(self):
+        '''
+        Write the snapshot of the tables for the state the database is left in
+        when it is closed. The changes recorded in the change log since the
+        tables were last read, by this or any other process, are read into the
+        tables first, so that they match the database. The snapshot is not
+        written if those changes cannot be determined, because the change log
+        was pruned, if the existing snapshot is still current, or if the
+        database is in WAL mode.
+        '''
+        if not self.tables_snapshot_path:
+            return
+        from calibre.db.snapshot import save_snapshot, snapshot_key
+        try:
+            with self.conn:
+                key = snapshot_key(self.conn, self.dbpath)
+                if key is None or key == self.tables_snapshot_key:
+                    return
+                ans = self.changes_since(getattr(self, 'last_change_seq', None))
+                if ans is None:
+                    return
+                seq, changes = ans
+                if changes:
+                    for table in itervalues(self.tables):
+                        table.read_changes(self, changes)
+                self.last_change_seq = seq
+                save_snapshot(self.tables_snapshot_path, key, self.tables)
+                self.tables_snapshot_key = key
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
         for author_dir in os.scandir(self.library_path):
@@ -1622,21 +1766,101 @@ class DB:
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
             return missing_value
-        with open(path, 'r+b') as f:
-            return func(f)
-
-    def format_hash(self, book_id, fmt, fname, path):
+        try:
+            with open(path, 'r+b') as f:
+                return func(f)
+        finally:
+            # The file has been changed by calibre, its hash will be recorded
+            # again when it is next needed
+            self.remove_format_hash(book_id, fmt)
+
+    def format_hash(self, book_id, fmt, fname, path, recompute=False):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
             raise NoSuchFormat(f'Record {book_id} has no fmt: {fmt}')
-        sha = hashlib.sha256()
-        with open(path, 'rb') as f:
-            while True:
-                raw = f.read(SPOOL_SIZE)
-                sha.update(raw)
-                if len(raw) < SPOOL_SIZE:
-                    break
-        return sha.hexdigest()
+        key = stat_key(os.stat(path))
+        record = self.format_hash_record(book_id, fmt)
+        if record is not None and not recompute and record[:2] == key:
+            return record[2]
+        ans = hash_file(path)
+        # The size and mtime from before the file was hashed are stored, so
+        # that the file is hashed again if it was changed while being hashed
+        with suppress(apsw.ReadOnlyError, apsw.BusyError):
+            self.set_format_hash(book_id, fmt, key, ans)
+        return ans
+
+    def format_hash_record(self, book_id, fmt):
+        ''' Return the (size, mtime, hash) recorded for the specified format or None '''
+        for size, mtime, h in self.execute('SELECT size, mtime, hash FROM format_hashes WHERE book=? AND format=?', (book_id, fmt)):
+            return size, mtime, h
+
+    def format_hash_records(self):
+        return {(book_id, fmt.upper()): (size, mtime, h) for book_id, fmt, size, mtime, h in self.execute(
+            'SELECT book, format, size, mtime, hash FROM format_hashes')}
+
+    def set_format_hash(self, book_id, fmt, key, content_hash):
+        '''
+        Record the hash of the specified format, key is the (size, mtime) of
+        the file. This is a single statement, so it is safe to call with only
+        the read lock held, as write transactions are run with the exclusive
+        lock held.
+        '''
+        self.execute('INSERT OR REPLACE INTO format_hashes (book, format, size, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                     (book_id, fmt.upper()) + tuple(key) + (content_hash,))
+
+    def remove_format_hash(self, book_id, fmt):
+        self.execute('DELETE FROM format_hashes WHERE book=? AND format=?', (book_id, fmt))
+
+    def learn_format_hash(self, book_id, fmt, key, content_hash):
+        '''
+        Record a hash computed while the file was read for some other purpose,
+        unless a different hash is recorded for the file, as that is a change
+        that has to be reported by verification.
+        '''
+        record = self.format_hash_record(book_id, fmt)
+        if record is None or (record[:2] != tuple(key) and record[2] == content_hash):
+            with suppress(apsw.ReadOnlyError, apsw.BusyError):
+                self.set_format_hash(book_id, fmt, key, content_hash)
+
+    def update_format_hashes(self, updates):
+        '''
+        Store the records found by :meth:`verify_format_hashes`, updates is
+        a list of (book_id, fmt, (size, mtime, hash), previous record). A record
+        is not changed if it was changed after the verification started.
+        '''
+        with self.conn:
+            for book_id, fmt, (size, mtime, h), previous in updates:
+                if previous is None:
+                    self.execute(
+                        'INSERT OR IGNORE INTO format_hashes (book, format, size, mtime, hash) SELECT ?, ?, ?, ?, ?'
+                        ' WHERE EXISTS (SELECT 1 FROM data WHERE book=? AND format=?)', (book_id, fmt, size, mtime, h, book_id, fmt))
+                else:
+                    self.execute('UPDATE format_hashes SET size=?, mtime=?, hash=? WHERE book=? AND format=? AND hash=?',
+                                 (size, mtime, h, book_id, fmt, previous[2]))
+
+    def verify_format_hashes(self, format_map, records, full=False, num_workers=None, progress_callback=None):
+        '''
+        Verify the files of the formats in format_map, a map of book_id to
+        (book path, {fmt: fname}) against records, as returned by
+        :meth:`format_hash_records`. Returns the list of problems as (book_id,
+        fmt, problem) and the list of updates for :meth:`update_format_hashes`.
+        '''
+        tasks = []
+        for book_id, (path, fmap) in format_map.items():
+            for fmt, fname in fmap.items():
+                fpath = os.path.abspath(os.path.join(self.library_path, path, fname + '.' + fmt.lower()))
+                tasks.append((book_id, fmt, fpath, records.get((book_id, fmt))))
+        problems, new_records = verify_formats(tasks, full=full, num_workers=num_workers, progress_callback=progress_callback)
+        return problems, [(book_id, fmt, record, records.get((book_id, fmt))) for book_id, fmt, record in new_records]
+
+    def checked_dirs(self):
+        return dict(self.execute('SELECT path, mtime FROM checked_dirs'))
+
+    def set_checked_dirs(self, dir_map):
+        with self.conn:
+            self.execute('DELETE FROM checked_dirs')
+            if dir_map:
+                self.executemany('INSERT INTO checked_dirs (path, mtime) VALUES (?, ?)', tuple(dir_map.items()))
 
     def format_metadata(self, book_id, fmt, fname, path):
         path = self.format_abspath(book_id, fmt, fname, path)
@@ -1761,6 +1985,22 @@ class DB:
         from calibre.db.covers import compress_covers
         compress_covers(cpath_map, jpeg_quality, progress_callback)
 
+    def prepare_cover(self, data):
+        '''
+        Convert data as accepted by set_cover() into the bytes of the
+        cover.jpg file, does not access the library, so it can be done
+        without holding any locks.
+        '''
+        if callable(getattr(data, 'save', None)):
+            from calibre.gui2 import pixmap_to_data
+            data = pixmap_to_data(data)
+        elif callable(getattr(data, 'read', None)):
+            data = data.read()
+        if data is None:
+            return None
+        from calibre.utils.img import save_cover_data_to
+        return save_cover_data_to(data)
+
     def set_cover(self, book_id, path, data, no_processing=False):
         path = os.path.abspath(os.path.join(self.library_path, path))
         if not os.path.exists(path):
@@ -1818,9 +2058,11 @@ class DB:
                         f.seek(0, os.SEEK_END)
                         report_file_size(f.tell())
                         f.seek(0)
-                    shutil.copyfileobj(f, dest)
+                    key = stat_key(os.fstat(f.fileno()))
+                    content_hash = hash_stream(f, dest)
                 if hasattr(dest, 'flush'):
                     dest.flush()
+                self.learn_format_hash(book_id, fmt, key, content_hash)
             elif dest:
                 if samefile(dest, path):
                     if not self.is_case_sensitive and path != dest:
@@ -1837,7 +2079,9 @@ class DB:
                         except:
                             pass
                     with open(path, 'rb') as f, open(make_long_path_useable(dest), 'wb') as d:
-                        shutil.copyfileobj(f, d)
+                        key = stat_key(os.fstat(f.fileno()))
+                        content_hash = hash_stream(f, d)
+                    self.learn_format_hash(book_id, fmt, key, content_hash)
         return True
 
     def windows_check_if_files_in_use(self, paths):
@@ -1851,7 +2095,58 @@ class DB:
                 if os.path.exists(spath):
                     windows_check_if_files_in_use(spath)
 
-    def add_format(self, book_id, fmt, stream, title, author, path, current_name, mtime=None):
+    def stage_file(self, stream_or_path):
+        '''
+        Copy the data from stream_or_path into a temporary file in the library
+        folder, from where add_format() can move it into place with a rename.
+        Returns the path to the temporary file and the hash of its contents or
+        (None, None) if stream_or_path is a file in the library already. Does
+        not access the database, so it can be done without holding any locks.
+        '''
+        src = stream_or_path if isinstance(stream_or_path, str) else getattr(stream_or_path, 'name', None)
+        if isinstance(src, str) and src:
+            with suppress(ValueError):
+                if not os.path.relpath(os.path.abspath(src), self.library_path).startswith(os.pardir):
+                    return None, None
+        dest = os.path.join(self.library_path, STAGED_FILE_PREFIX + uuid.uuid4().hex)
+        try:
+            with open(dest, 'xb') as f:
+                if isinstance(stream_or_path, str):
+                    with open(make_long_path_useable(stream_or_path), 'rb') as src:
+                        content_hash = hash_stream(src, f)
+                else:
+                    content_hash = hash_stream(stream_or_path, f)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(dest)
+            raise
+        return dest, content_hash
+
+    def remove_stale_staged_files(self, max_age=3600):
+        '''
+        Remove the temporary files created by stage_file() that were left
+        behind by a crash. Only files not modified for max_age seconds are
+        removed, in case another process is adding files to this library.
+        '''
+        limit = time.time() - max_age
+        try:
+            entries = tuple(os.scandir(self.library_path))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith(STAGED_FILE_PREFIX):
+                with suppress(OSError):
+                    if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < limit:
+                        os.remove(entry.path)
+
+    def add_format(self, book_id, fmt, stream, title, author, path, current_name, mtime=None, content_hash=None):
+        '''
+        Put the data from stream into the file for the specified format. If
+        stream is a path, the file is moved into place and content_hash, if
+        not None, is recorded as its hash. Otherwise the hash is computed while
+        the data is copied.
+        '''
+        fmt_key = fmt
         fmt = ('.' + fmt.lower()) if fmt else ''
         fname = self.construct_file_name(book_id, title, author, len(fmt))
         path = os.path.join(self.library_path, path)
@@ -1888,7 +2183,7 @@ class DB:
             size = os.path.getsize(dest)
         elif (not getattr(stream, 'name', False) or not samefile(dest, stream.name)):
             with open(dest, 'wb') as f:
-                shutil.copyfileobj(stream, f)
+                content_hash = hash_stream(stream, f)
                 size = f.tell()
             if mtime is not None:
                 os.utime(dest, (mtime, mtime))
@@ -1897,6 +2192,11 @@ class DB:
             if mtime is not None:
                 os.utime(dest, (mtime, mtime))
 
+        if content_hash is None or not os.path.exists(dest):
+            # The hash will be computed when it is next needed
+            self.remove_format_hash(book_id, fmt_key)
+        else:
+            self.set_format_hash(book_id, fmt_key, stat_key(os.stat(dest)), content_hash)
         return size, fname
 
     def update_path(self, book_id, title, author, path_field, formats_field):
@@ -2134,12 +2434,14 @@ class DB:
                 shutil.copyfileobj(stream, d)
         return os.path.relpath(dest, bookdir).replace(os.sep, '/')
 
-    def write_backup(self, path, raw):
+    def write_backup(self, path, raw, create_dirs=True):
         path = os.path.abspath(os.path.join(self.library_path, path, METADATA_FILE_NAME))
         try:
             with open(path, 'wb') as f:
                 f.write(raw)
         except OSError:
+            if not create_dirs:
+                raise
             exc_info = sys.exc_info()
             try:
                 os.makedirs(os.path.dirname(path))
@@ -2379,6 +2681,9 @@ class DB:
     def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
+    def mark_books_as_clean(self, book_ids):
+        self.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+
     def get_ids_for_custom_book_data(self, name):
         return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
@@ -2645,6 +2950,14 @@ class DB:
         odir = self.library_path
         self.conn.close()
         self.library_path, self.dbpath = newloc, dbpath
+        if self.tables_snapshot_path:
+            with suppress(OSError):
+                os.remove(self.tables_snapshot_path)
+            self.tables_snapshot_path = os.path.join(newloc, TABLES_SNAPSHOT_NAME)
+        if self.composites_store_path:
+            with suppress(OSError):
+                os.remove(self.composites_store_path)
+            self.composites_store_path = os.path.join(newloc, COMPOSITES_STORE_NAME)
         if self._conn is not None:
             self._conn.close()
         self._conn = None
@@ -5,13 +5,21 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import os
 import sys
 import traceback
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Thread
+from time import monotonic
 
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 
+# The number of books whose metadata is read with a single acquisition of the
+# database lock is adjusted so that the lock is held for about this long
+TARGET_LOCK_TIME = 0.05
+MIN_BATCH_SIZE, MAX_BATCH_SIZE = 1, 512
+
 
 def prints(*a, **kw):
     kw['file'] = sys.stderr
@@ -22,6 +30,65 @@ class Abort(Exception):
     pass
 
 
+def worker_pool():
+    # Creating the OPF is mostly pure python, the threads mainly serve to
+    # overlap it with writing the files
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='MetadataBackup')
+
+
+def write_opf(db, book_id, path, mi):
+    try:
+        raw = metadata_to_opf(mi)
+    except Exception:
+        return 'convert', traceback.format_exc()
+    try:
+        # The book may have been deleted or moved since its metadata was read
+        if not db.write_backup_for_dump(book_id, path, raw):
+            return 'skip', None
+    except Exception:
+        return 'write', traceback.format_exc()
+    return None, None
+
+
+def write_opfs(db, pool, snapshots):
+    '''
+    Create and write the OPF files for snapshots, as returned by
+    Cache.get_metadata_for_dump_batch(), in pool. Returns a list of (book_id,
+    mi, sequence, error, details) where error is None on success, 'convert' if
+    the OPF could not be created and 'write' if it could not be written.
+    Books with no metadata to write and books deleted or moved since their
+    metadata was read are returned with an error of 'skip'.
+    '''
+    jobs = []
+    for book_id, path, mi, sequence in snapshots:
+        if mi is None or not path:
+            jobs.append((book_id, mi, sequence, None))
+        else:
+            jobs.append((book_id, mi, sequence, pool.submit(write_opf, db, book_id, path, mi)))
+    ans = []
+    for book_id, mi, sequence, future in jobs:
+        if future is None:
+            ans.append((book_id, mi, sequence, 'skip', None))
+        else:
+            ans.append((book_id, mi, sequence) + future.result())
+    return ans
+
+
+def dump_metadata(db, book_ids, remove_from_dirtied=True, callback=None, batch_size=64):
+    ''' Write the OPF files for book_ids, see Cache.dump_metadata() '''
+    book_ids = tuple(book_ids)
+    if callback is not None:
+        callback(len(book_ids), True, False)
+    with worker_pool() as pool:
+        for i in range(0, len(book_ids), batch_size):
+            results = write_opfs(db, pool, db.get_metadata_for_dump_batch(book_ids[i:i+batch_size]))
+            if remove_from_dirtied:
+                db.clear_dirtied_books({book_id: sequence for book_id, mi, sequence, error, details in results if error is None})
+            if callback is not None:
+                for book_id, mi, sequence, error, details in results:
+                    callback(book_id, mi, error != 'skip')
+
+
 class MetadataBackup(Thread):
     '''
     Continuously backup changed metadata into OPF files
@@ -37,6 +104,9 @@ class MetadataBackup(Thread):
         self.interval = interval
         self.scheduling_interval = scheduling_interval
         self.check_dirtied_annotations = 0
+        self.batch_size = MIN_BATCH_SIZE
+        # The number of books backed up per second, averaged over recent batches
+        self.books_per_second = 0.
 
     @property
     def db(self):
@@ -53,14 +123,22 @@ class MetadataBackup(Thread):
             raise Abort()
 
     def run(self):
-        while not self.stop_running.is_set():
-            try:
-                self.wait(self.interval)
-                self.do_one()
-            except Abort:
-                break
-
-    def do_one(self):
+        with worker_pool() as self.pool:
+            busy = False
+            while not self.stop_running.is_set():
+                try:
+                    # While there is a backlog, only pause long enough to let
+                    # other threads use the database
+                    self.wait(self.scheduling_interval if busy else self.interval)
+                    busy = self.do_batch()
+                except Abort:
+                    break
+
+    def do_batch(self):
+        '''
+        Backup the metadata of a batch of dirtied books. Returns True if there
+        are more dirtied books to backup.
+        '''
         self.check_dirtied_annotations += 1
         if self.check_dirtied_annotations > 2:
             self.check_dirtied_annotations = 0
@@ -68,67 +146,80 @@ class MetadataBackup(Thread):
                 self.db.check_dirtied_annotations()
             except Exception:
                 if self.stop_running.is_set() or self.db.is_closed:
-                    return
+                    return False
                 traceback.print_exc()
 
         try:
-            book_id = self.db.get_a_dirtied_book()
-            if book_id is None:
-                return
+            book_ids = self.db.dirtied_books_for_dump(self.batch_size)
+            if not book_ids:
+                return False
         except Abort:
             raise
         except:
             # Happens during interpreter shutdown
-            return
+            return False
 
         self.wait(0)
-
+        start = monotonic()
         try:
-            mi, sequence = self.db.get_metadata_for_dump(book_id)
+            snapshots = self.db.get_metadata_for_dump_batch(book_ids)
         except:
-            prints('Failed to get backup metadata for id:', book_id, 'once')
+            prints('Failed to get backup metadata for ids:', book_ids, 'once')
             traceback.print_exc()
             self.wait(self.interval)
             try:
-                mi, sequence = self.db.get_metadata_for_dump(book_id)
+                snapshots = self.db.get_metadata_for_dump_batch(book_ids)
             except:
-                prints('Failed to get backup metadata for id:', book_id, 'again, giving up')
+                prints('Failed to get backup metadata for ids:', book_ids, 'again, giving up')
                 traceback.print_exc()
-                return
-
-        if mi is None:
-            self.db.clear_dirtied(book_id, sequence)
-            return
+                return False
+        self.adapt_batch_size(monotonic() - start, len(book_ids))
 
         # Give the GUI thread a chance to do something. Python threads don't
         # have priorities, so this thread would naturally keep the processor
         # until some scheduling event happens. The wait makes such an event
         self.wait(self.scheduling_interval)
 
-        try:
-            raw = metadata_to_opf(mi)
-        except:
-            prints('Failed to convert to opf for id:', book_id)
-            traceback.print_exc()
-            self.db.clear_dirtied(book_id, sequence)
-            return
-
-        self.wait(self.scheduling_interval)
-
-        try:
-            self.db.write_backup(book_id, raw)
-        except:
-            prints('Failed to write backup metadata for id:', book_id, 'once')
-            traceback.print_exc()
+        done = {}
+        retry = []
+        for book_id, mi, sequence, error, details in write_opfs(self.db, self.pool, snapshots):
+            if error == 'write':
+                prints('Failed to write backup metadata for id:', book_id, 'once')
+                prints(details)
+                retry.append(book_id)
+                continue
+            if error == 'convert':
+                prints('Failed to convert to opf for id:', book_id)
+                prints(details)
+            done[book_id] = sequence
+        if retry:
             self.wait(self.interval)
-            try:
-                self.db.write_backup(book_id, raw)
-            except:
-                prints('Failed to write backup metadata for id:', book_id, 'again, giving up')
-                traceback.print_exc()
-                return
-
-        self.db.clear_dirtied(book_id, sequence)
+            snapshots = [s for s in snapshots if s[0] in retry]
+            for book_id, mi, sequence, error, details in write_opfs(self.db, self.pool, snapshots):
+                if error == 'write':
+                    prints('Failed to write backup metadata for id:', book_id, 'again, giving up')
+                    prints(details)
+                else:
+                    done[book_id] = sequence
+        self.db.clear_dirtied_books(done)
+        elapsed = monotonic() - start
+        if elapsed > 0:
+            self.books_per_second = 0.7 * self.books_per_second + 0.3 * len(book_ids) / elapsed
+        # Books that could not be written remain dirtied, do not retry them
+        # immediately
+        return bool(done) and self.db.dirty_queue_length() > 0
+
+    def adapt_batch_size(self, lock_time, num):
+        # Grow or shrink the batch so that reading its metadata holds the
+        # database lock for about TARGET_LOCK_TIME
+        per_book = lock_time / max(1, num)
+        if per_book <= 0:
+            target = MAX_BATCH_SIZE
+        else:
+            target = int(TARGET_LOCK_TIME / per_book)
+        # Change gradually, so that a single slow or fast batch has little effect
+        target = max(self.batch_size // 2, min(target, self.batch_size * 2))
+        self.batch_size = max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, target))
 
     def break_cycles(self):
         # Legacy compatibility
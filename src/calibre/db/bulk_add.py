@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A pipeline for adding large numbers of books from folders. Its stages run
+concurrently, connected by bounded queues, so that finding files, reading
+metadata, creating book entries and copying files into the library overlap:
+
+    discover -> metadata -> duplicates -> insert -> copy
+
+Folders are scanned by several threads, metadata is read by a pool of worker
+processes, duplicates are found with the duplicate index of the library,
+entries are created in batches, each in a single transaction and the files
+are copied into the library by several threads.
+'''
+
+import itertools
+import os
+import time
+import traceback
+from io import BytesIO
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+
+from calibre.customize.ui import run_plugins_on_postadd, run_plugins_on_postimport
+from calibre.db.adding import create_format_map, find_books_in_directory
+from calibre.db.duplicates import normalized_languages
+from calibre.db.utils import fuzzy_title
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ptempfile import TemporaryDirectory
+from calibre.utils.icu import lower as icu_lower
+
+STAGES = ('discover', 'metadata', 'duplicates', 'insert', 'copy')
+
+
+def identity_key(mi):
+    ' The fuzzy title, authors and languages of mi, as compared by DuplicateIndex.identical_books() '
+    return fuzzy_title(mi.title or ''), frozenset(icu_lower(str(a)) for a in mi.authors or ()), normalized_languages(mi.languages)
+
+
+class StageStats:
+
+    ' The number of items processed by a stage and the period in which it processed them '
+
+    __slots__ = ('count', 'first', 'last', 'lock', 'name')
+
+    def __init__(self, name):
+        self.name, self.count = name, 0
+        self.first = self.last = None
+        self.lock = Lock()
+
+    def record(self, count, start):
+        end = time.monotonic()
+        with self.lock:
+            self.count += count
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = end if self.last is None else max(self.last, end)
+
+    @property
+    def elapsed(self):
+        return 0 if self.first is None else self.last - self.first
+
+    @property
+    def throughput(self):
+        ' Items per second, while the stage was active '
+        elapsed = self.elapsed
+        return self.count / elapsed if elapsed > 0 else 0
+
+    def __str__(self):
+        return f'{self.name:<11}{self.count:9d} items in {self.elapsed:9.2f} seconds {self.throughput:10.1f} items/sec'
+
+
+class BulkAdd:
+
+    '''
+    Add all the books found in the folders ``roots`` to the library ``db``
+    (a :class:`calibre.db.cache.Cache`). Call the object to run the pipeline,
+    it returns the list of the ids of the added books and the list of
+    :code:`(mi, paths)` for the books that were not added because they are
+    duplicates. Books that could not be added, or only partially added, are
+    recorded in ``errors`` as :code:`(paths, details)`. If ``callback`` is not
+    None it is called with the title of every added book, in the thread
+    running the pipeline. If it returns True, no more books are added.
+    '''
+
+    def __init__(
+        self, db, roots, single_book_per_directory=True, compiled_rules=(), add_duplicates=False, recurse=True,
+        callback=None, dbapi=None, batch_size=100, max_batch_delay=1, num_scanners=4, num_copiers=4, max_workers=None,
+        queue_size=256,
+    ):
+        self.db, self.dbapi = db, dbapi
+        self.roots = tuple(os.path.abspath(x) for x in roots)
+        self.single_book_per_directory, self.compiled_rules = single_book_per_directory, compiled_rules
+        self.add_duplicates, self.recurse = add_duplicates, recurse
+        self.callback = callback if callable(callback) else None
+        self.batch_size, self.max_batch_delay = batch_size, max_batch_delay
+        self.num_scanners, self.num_copiers, self.max_workers = num_scanners, num_copiers, max_workers
+        self.groups = Queue(queue_size)  # lists of the paths of the files of a book
+        self.books = Queue(queue_size)  # (mi, cover data, paths)
+        self.copies = Queue(queue_size)  # (book_id, mi, paths)
+        self.abort = Event()
+        self.copiers = ()
+        self.stats = {name: StageStats(name) for name in STAGES}
+        self.added_ids, self.duplicates, self.errors = [], [], []
+        self.failure = None
+        self.elapsed = 0
+
+    def put(self, q, item):
+        ' Put item on the bounded queue q, returning False if the pipeline is aborted while waiting '
+        while not self.abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def put_copy(self, item):
+        '''
+        Put item on the copies queue. The formats of books that have been
+        created must be copied even when the pipeline is aborted, so this
+        waits for as long as a copier is alive. Returns False if they are all
+        dead.
+        '''
+        while True:
+            try:
+                self.copies.put(item, timeout=0.1)
+                return True
+            except Full:
+                if not any(t.is_alive() for t in self.copiers):
+                    return False
+
+    def run_stage(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            self.failure = self.failure or traceback.format_exc()
+            self.abort.set()
+
+    def __call__(self):
+        start = time.monotonic()
+        with TemporaryDirectory('_bulk_add') as tdir:
+            producers = [Thread(target=self.run_stage, args=(self.discover,), name='BulkAddDiscover', daemon=True),
+                         Thread(target=self.run_stage, args=(self.read_metadata, tdir), name='BulkAddMetadata', daemon=True)]
+            self.copiers = copiers = [Thread(target=self.run_stage, args=(self.copy,), name=f'BulkAddCopy-{i}', daemon=True)
+                                      for i in range(self.num_copiers)]
+            for t in producers + copiers:
+                t.start()
+            try:
+                self.run_stage(self.insert)
+            finally:
+                # The copies of the formats of books that have been created
+                # are always completed, even when the pipeline is aborted
+                self.abort.set()
+                for t in copiers:
+                    self.put_copy(None)
+                for t in producers + copiers:
+                    t.join()
+        self.elapsed = time.monotonic() - start
+        if self.failure is not None:
+            raise Exception('Adding books failed with error:\n' + self.failure)
+        return self.added_ids, self.duplicates
+
+    def format_stats(self):
+        ' The throughput of every stage, as text '
+        lines = [str(self.stats[name]) for name in STAGES]
+        lines.append(f'Added {len(self.added_ids)} books in {self.elapsed:.2f} seconds')
+        return '\n'.join(lines)
+
+    def discover(self):
+        stats, dirs, lock = self.stats['discover'], Queue(), Lock()
+        pending = [len(self.roots)]
+        for root in self.roots:
+            dirs.put(root)
+        if not self.roots:
+            self.put(self.groups, None)
+            return
+
+        def scan():
+            while not self.abort.is_set():
+                try:
+                    dirpath = dirs.get(timeout=0.1)
+                except Empty:
+                    continue
+                if dirpath is None:
+                    break
+                start = time.monotonic()
+                subdirs, groups = [], ()
+                try:
+                    if self.recurse:
+                        with os.scandir(dirpath) as it:
+                            # Like os.walk() symlinks to folders are not followed
+                            subdirs = [x.path for x in it if x.is_dir(follow_symlinks=False)]
+                    groups = tuple(find_books_in_directory(dirpath, self.single_book_per_directory, compiled_rules=self.compiled_rules))
+                except OSError:
+                    pass  # Like os.walk() unreadable folders are ignored
+                with lock:
+                    pending[0] += len(subdirs)
+                for x in subdirs:
+                    dirs.put(x)
+                stats.record(len(groups), start)
+                for formats in groups:
+                    if not self.put(self.groups, formats):
+                        break
+                with lock:
+                    pending[0] -= 1
+                    if not pending[0]:
+                        for i in range(self.num_scanners):
+                            dirs.put(None)
+
+        scanners = [Thread(target=self.run_stage, args=(scan,), name=f'BulkAddScan-{i}', daemon=True) for i in range(self.num_scanners)]
+        for t in scanners:
+            t.start()
+        for t in scanners:
+            t.join()
+        self.put(self.groups, None)
+
+    def read_metadata(self, tdir):
+        from calibre.utils.ipc.pool import Failure, Pool
+        pool = Pool(max_workers=self.max_workers, name='BulkAdd')
+        capacity = 2 * pool.max_workers
+        in_flight, group_ids, input_done = {}, itertools.count(1), False
+        try:
+            while not self.abort.is_set() and (in_flight or not input_done):
+                if pool.failed:
+                    # The pool cannot be used after a worker process
+                    # crashes, so give up on the jobs it was running and
+                    # start a new one
+                    if not self.drain_failed_pool(pool, in_flight, tdir):
+                        break
+                    pool.shutdown()
+                    pool = Pool(max_workers=self.max_workers, name='BulkAdd')
+                    continue
+                if not input_done and len(in_flight) < capacity and not pool.failed:
+                    try:
+                        paths = self.groups.get(timeout=0.01 if in_flight else 0.1)
+                    except Empty:
+                        pass
+                    else:
+                        if paths is None:
+                            input_done = True
+                        else:
+                            group_id = next(group_ids)
+                            in_flight[group_id] = paths, time.monotonic()
+                            try:
+                                pool(group_id, 'calibre.ebooks.metadata.worker', 'read_metadata', paths, group_id, tdir)
+                            except Failure:
+                                pass  # The job is recorded as failed by drain_failed_pool()
+                        continue
+                if not in_flight:
+                    continue
+                try:
+                    wr = pool.results.get(timeout=0.1 if input_done or len(in_flight) >= capacity else 0)
+                except Empty:
+                    continue
+                if not self.handle_result(wr, in_flight, tdir):
+                    break
+        finally:
+            pool.shutdown()
+        self.put(self.books, None)
+
+    def handle_result(self, wr, in_flight, tdir):
+        ' Pass on the book read by a metadata job, returns False if the pipeline is aborted '
+        paths, start = in_flight.pop(wr.id)
+        if wr.is_terminal_failure:
+            self.errors.append((paths, _('The process reading metadata crashed')))
+            return True
+        book = self.book_from_result(wr.id, paths, wr.result, tdir)
+        self.stats['metadata'].record(1, start)
+        return self.put(self.books, book)
+
+    def drain_failed_pool(self, pool, in_flight, tdir):
+        '''
+        Handle the results of the jobs of a pool that has failed. The pool
+        returns no result for the job that crashed a worker process, or for
+        jobs queued after the crash, so all jobs without a result are recorded
+        as having failed. Returns False if the pipeline is aborted.
+        '''
+        # The pool thread puts all the results it has before exiting
+        pool.join()
+        while True:
+            try:
+                wr = pool.results.get_nowait()
+            except Empty:
+                break
+            if wr.id in in_flight and not self.handle_result(wr, in_flight, tdir):
+                return False
+        failure = pool.terminal_failure
+        for group_id, (paths, start) in in_flight.items():
+            details = _('The process reading metadata crashed')
+            if group_id == failure.job_id and failure.tb:
+                details += '\n' + failure.tb
+            self.errors.append((paths, details))
+        in_flight.clear()
+        return True
+
+    def book_from_result(self, group_id, paths, result, tdir):
+        from calibre.ebooks.metadata.opf2 import OPF
+        mi = cdata = None
+        if result.err:
+            self.errors.append((paths, result.traceback))
+        else:
+            paths, opf, has_cover, duplicate_info = result.value
+            try:
+                mi = OPF(BytesIO(opf), basedir=tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+            except Exception:
+                self.errors.append((paths, traceback.format_exc()))
+            if has_cover:
+                cover_path = os.path.join(tdir, f'{group_id}.cdata')
+                try:
+                    with open(cover_path, 'rb') as f:
+                        cdata = f.read()
+                    os.remove(cover_path)
+                except OSError:
+                    pass
+        if mi is None:
+            mi = Metadata(_('Unknown'))
+        if mi.is_null('title'):
+            mi.title = os.path.splitext(os.path.basename(paths[0]))[0]
+        if mi.application_id == '__calibre_dummy__':
+            mi.application_id = None
+        return mi, cdata, paths
+
+    def is_duplicate(self, mi, key, batch_keys):
+        '''
+        Return True if mi is a duplicate of a book in the library, as
+        determined by Cache.find_identical_books(), or of a book in the
+        current batch, whose keys are in batch_keys. Books in the batch are
+        compared the same way, as they are not yet in the duplicate index.
+        '''
+        if self.db.find_identical_books(mi):
+            return True
+        ftitle, authors, langs = key
+        if not authors:
+            return False
+        for other_authors, other_langs in batch_keys.get(ftitle, ()):
+            if authors <= other_authors and (not langs or not other_langs or langs == other_langs):
+                return True
+        return False
+
+    def insert(self):
+        dstats, istats = self.stats['duplicates'], self.stats['insert']
+        # fuzzy title -> (authors, languages) for the books in the batch,
+        # which are not yet in the duplicate index
+        batch, batch_keys, batch_started, input_done = [], {}, 0, False
+        while not input_done and not self.abort.is_set():
+            try:
+                book = self.books.get(timeout=0.1)
+            except Empty:
+                book = False
+            if book is None:
+                input_done = True
+            elif book is not False:
+                start = time.monotonic()
+                mi, cdata, paths = book
+                key = identity_key(mi)
+                if not self.add_duplicates and self.is_duplicate(mi, key, batch_keys):
+                    self.duplicates.append((mi, paths))
+                else:
+                    if not batch:
+                        batch_started = start
+                    batch.append(book)
+                    batch_keys.setdefault(key[0], []).append(key[1:])
+                dstats.record(1, start)
+            if batch and (input_done or len(batch) >= self.batch_size or time.monotonic() - batch_started >= self.max_batch_delay):
+                start = time.monotonic()
+                # Duplicates have been removed above, so there is no need to
+                # check for them again
+                book_ids = self.db.create_book_entries(((mi, cdata) for mi, cdata, paths in batch), add_duplicates=True)
+                istats.record(len(batch), start)
+                for (mi, cdata, paths), book_id in zip(batch, book_ids):
+                    self.added_ids.append(book_id)
+                    if not self.put_copy((book_id, mi, paths)):
+                        self.errors.append((paths, _('The formats of the book were not copied into the library')))
+                    if self.callback is not None and not self.abort.is_set() and self.callback(mi.title):
+                        self.abort.set()
+                batch, batch_keys = [], {}
+
+    def copy(self):
+        stats, dbapi = self.stats['copy'], self.dbapi or self.db
+        while True:
+            item = self.copies.get()
+            if item is None:
+                break
+            start = time.monotonic()
+            book_id, mi, paths = item
+            fmt_map = {}
+            for fmt, path in create_format_map(paths).items():
+                try:
+                    # The import plugins have already been run by the metadata
+                    # worker process
+                    if self.db.add_format(book_id, fmt, path, run_hooks=False):
+                        run_plugins_on_postimport(dbapi, book_id, fmt)
+                        fmt_map[fmt.lower()] = path
+                except Exception:
+                    self.errors.append(([path], traceback.format_exc()))
+            try:
+                run_plugins_on_postadd(dbapi, book_id, fmt_map)
+            except Exception:
+                self.errors.append((paths, traceback.format_exc()))
+            stats.record(1, start)
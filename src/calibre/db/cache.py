@@ -6,6 +6,8 @@ __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import hashlib
+import heapq
+import itertools
 import operator
 import os
 import random
@@ -13,8 +15,10 @@ import shutil
 import sys
 import traceback
 import weakref
+from bisect import bisect_right
 from collections import defaultdict
 from collections.abc import Iterable, MutableSet, Set
+from contextlib import suppress
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from queue import Queue
@@ -28,13 +32,19 @@ from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd,
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
 from calibre.db.categories import get_categories
+from calibre.db.category_stats import CategoryStats
+from calibre.db.composites import CompositeStore, composite_dependencies, environment_key
+from calibre.db.composites import fingerprint as composite_fingerprint
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME
+from calibre.db.duplicates import DuplicateIndex
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
+from calibre.db.idset import FrozenIdSet
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
 from calibre.db.listeners import EventDispatcher, EventType
 from calibre.db.locking import DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
+from calibre.db.ranks import SortRanks, sort_by_ranks, sort_dependencies, sort_keys_from_ranks
 from calibre.db.search import Search
 from calibre.db.tables import VirtualTable
 from calibre.db.utils import type_safe_sort_key_function
@@ -50,9 +60,12 @@ from calibre.utils.date import now as nowf
 from calibre.utils.filenames import make_long_path_useable
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
-from calibre.utils.localization import canonicalize_lang
 from polyglot.builtins import cmp, iteritems, itervalues, string_or_bytes
 
+# The number of books whose entries are created in a single transaction by
+# add_books()
+ADD_BOOKS_BATCH_SIZE = 100
+
 
 class ExtraFile(NamedTuple):
     relpath: str
@@ -158,6 +171,7 @@ class Cache:
         self.event_dispatcher = EventDispatcher()
         self.fields = {}
         self.composites = {}
+        self.composite_store = CompositeStore(None)
         self.read_lock, self.write_lock = create_locks()
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
@@ -170,6 +184,9 @@ class Cache:
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.sort_ranks = SortRanks()
+        self.category_stats = CategoryStats()
+        self.duplicate_index = DuplicateIndex()
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -271,18 +288,53 @@ class Cache:
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
 
+    def _initialize_composite_store(self):
+        ' Setup the tracking of the fields composite columns depend on and the store of rendered values '
+        self.composite_store = store = CompositeStore(self.backend.composites_store_path)
+        templates = {name: f.metadata['display'].get('composite_template', '') for name, f in self.composites.items()}
+        deps = composite_dependencies(templates, self.fields)
+        for name, field in self.composites.items():
+            d = deps[name]
+            if d is None:
+                field.set_dependencies(None)
+                continue
+            fobjs = tuple(self.fields[x] for x in sorted(d) if x not in templates)
+            field.set_dependencies(
+                d, store.column(name, environment_key(d | {name}, self.field_metadata)),
+                lambda book_id, fobjs=fobjs: composite_fingerprint(tuple(f.for_book(book_id) for f in fobjs)))
+
     @write_api
-    def clear_composite_caches(self, book_ids=None):
+    def clear_composite_caches(self, book_ids=None, fields=None):
+        '''
+        Clear the cached values of composite columns for book_ids (all books if
+        None). If fields is not None only the columns whose templates
+        depend on fields are cleared.
+        '''
         for field in itervalues(self.composites):
-            field.clear_caches(book_ids=book_ids)
+            if field.depends_on(fields):
+                field.clear_caches(book_ids=book_ids)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
+    @read_api
+    def search_cache_stats(self, reset=False):
+        '''
+        Return a dict of statistics for the cache of search results: the
+        number of hits, misses, evictions (to stay within the memory limit),
+        expirations (of searches on relative dates) and invalidations (due to
+        changes to the data), the number of entries and their size in bytes.
+        If reset is True, the counters are reset to zero.
+        '''
+        ans = self._search_api.cache.stats()
+        if reset:
+            self._search_api.cache.reset_stats()
+        return ans
+
     @write_api
     def clear_extra_files_cache(self, book_id=None):
         if book_id is None:
@@ -308,6 +360,9 @@ class Cache:
             self.format_metadata_cache.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
+        self.sort_ranks.invalidate(book_ids)
+        self.category_stats.invalidate(book_ids)
+        self.duplicate_index.invalidate(book_ids)
         self._clear_link_map_cache(book_ids)
 
     @write_api
@@ -319,15 +374,30 @@ class Cache:
                 self.link_maps_cache.pop(book, None)
 
     @write_api
-    def reload_from_db(self, clear_caches=True):
-        if clear_caches:
+    def reload_from_db(self, clear_caches=True, incremental=True):
+        '''
+        Re-read data from metadata.db, typically after it has been changed by
+        another process. When incremental is True, only the data that has
+        changed since it was last read is re-read, using the change log in
+        metadata.db, and only the caches for the changed books are cleared.
+        '''
+        if clear_caches and not incremental:
             self._clear_caches()
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
-            for field in itervalues(self.fields):
-                if hasattr(field, 'table'):
-                    field.table.read(self.backend)  # Reread data from metadata.db
+            if incremental:
+                book_ids = self.backend.read_changed_tables()
+            else:
+                for field in itervalues(self.fields):
+                    if hasattr(field, 'table'):
+                        field.table.read(self.backend)  # Reread data from metadata.db
+                self.backend.last_change_seq = self.backend.current_change_seq()
+        if clear_caches and incremental:
+            if book_ids is None:
+                self._clear_caches()
+            elif book_ids:
+                self._clear_caches(book_ids=book_ids, template_cache=False)
 
     @property
     def field_metadata(self):
@@ -452,6 +522,7 @@ class Cache:
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            self._initialize_composite_store()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -464,7 +535,9 @@ class Cache:
         self.fts_job_queue = Queue()
         self.fts_indexing_left = self.fts_indexing_total = 0
         fts = self.backend.initialize_fts(weakref.ref(self))
-        if self.is_fts_enabled():
+        # Books are not indexed using a read-only copy of the database, as
+        # the index is shared with the library
+        if self.is_fts_enabled() and not self.backend.read_only:
             self.start_fts_pool()
         return fts
 
@@ -487,7 +560,7 @@ class Cache:
         self.fts_measuring_rate = monotonic() if measure else None
         self.fts_num_done_since_start = 0
 
-    def _update_fts_indexing_numbers(self, job_time=None):
+    def _update_fts_indexing_numbers(self, job_time=None, num_done=1):
         # this is called when new formats are added and when a format is
         # indexed, but NOT when books or formats are deleted, so total may not
         # be up to date.
@@ -496,7 +569,7 @@ class Cache:
         if not nl:
             self._fts_start_measuring_rate(measure=False)
         if job_time is not None and self.fts_measuring_rate is not None:
-            self.fts_num_done_since_start += 1
+            self.fts_num_done_since_start += num_done
         if (self.fts_indexing_left, self.fts_indexing_total) != (nl, nt) or job_time is not None:
             self.fts_indexing_left = nl
             self.fts_indexing_total = nt
@@ -575,7 +648,9 @@ class Cache:
                 except Exception:
                     if self.backend.fts_enabled:
                         traceback.print_exc()
-                sleep(self.fts_indexing_sleep_time)
+                # The workers extract text in parallel, so the pause between
+                # jobs is shared out between them
+                sleep(self.fts_indexing_sleep_time / max(1, self.backend.fts_num_of_workers))
 
         while not getattr(dbref(), 'shutting_down', True):
             x = queue.get()
@@ -596,6 +671,17 @@ class Cache:
         self._update_fts_indexing_numbers(monotonic() - start_time)
         return ans
 
+    @write_api
+    def commit_fts_results(self, results):
+        '''
+        Commit the extracted text of many formats in a single transaction.
+        results is a sequence of (book_id, fmt, fmt_size, fmt_hash, text,
+        err_msg, start_time) tuples.
+        '''
+        if results:
+            self.backend.commit_fts_results(tuple(r[:-1] for r in results))
+            self._update_fts_indexing_numbers(monotonic() - results[-1][-1], num_done=len(results))
+
     @write_api
     def reindex_fts_book(self, book_id, *fmts):
         if not self.is_fts_enabled():
@@ -667,6 +753,37 @@ class Cache:
             process_each_result=process_each_result,
         ))
 
+    @write_api
+    def fts_search_page(
+        self,
+        fts_engine_query,
+        use_stemming=True,
+        highlight_start=None,
+        highlight_end=None,
+        snippet_size=None,
+        restrict_to_book_ids=None,
+        offset=0,
+        limit=20,
+        return_text=True,
+    ):
+        '''
+        Return the total number of matches for the query and the matches from
+        offset to offset + limit, best matches first, in the same format as
+        :meth:`fts_search`. The ranked matches are cached, so fetching later
+        pages is cheap, and the text is only calculated for the returned page.
+        '''
+        return self.backend.fts_search_page(
+            fts_engine_query,
+            use_stemming=use_stemming,
+            highlight_start=highlight_start,
+            highlight_end=highlight_end,
+            snippet_size=snippet_size,
+            restrict_to_book_ids=restrict_to_book_ids,
+            offset=offset,
+            limit=limit,
+            return_text=return_text,
+        )
+
     # }}}
 
     # Notes API {{{
@@ -853,6 +970,9 @@ class Cache:
     def all_field_for(self, field, book_ids, default_value=None):
         ' Same as field_for, except that it operates on multiple books at once '
         field_obj = self.fields[field]
+        if field_obj.is_composite:
+            vals = field_obj.values_for_books(book_ids, self._get_proxy_metadata)
+            return {book_id:vals[book_id] for book_id in book_ids}
         return {book_id:self._fast_field_for(field_obj, book_id, default_value=default_value) for book_id in book_ids}
 
     @read_api
@@ -985,15 +1105,62 @@ class Cache:
         return {aid:af.author_data(aid) for aid in author_ids if aid in af.table.id_map}
 
     @read_api
-    def format_hash(self, book_id, fmt):
+    def format_hash(self, book_id, fmt, recompute=False):
         ''' Return the hash of the specified format for the specified book. The
-        kind of hash is backend dependent, but is usually SHA-256. '''
+        kind of hash is backend dependent, but is usually SHA-256. The hash is
+        stored in the database and only computed again if the size or
+        modification time of the file have changed, or if ``recompute`` is True.
+        Use ``recompute=True`` to accept the changes reported by
+        :meth:`verify_format_hashes`. '''
         try:
             name = self.fields['formats'].format_fname(book_id, fmt)
             path = self._field_for('path', book_id).replace('/', os.sep)
         except:
             raise NoSuchFormat(f'Record {book_id} has no fmt: {fmt}')
-        return self.backend.format_hash(book_id, fmt, name, path)
+        return self.backend.format_hash(book_id, fmt, name, path, recompute=recompute)
+
+    @api
+    def verify_format_hashes(self, book_ids=None, full=False, num_workers=None, progress_callback=None):
+        '''
+        Check the files of the formats of the specified books (all books if
+        None) against the hashes recorded for them. Files whose size and
+        modification time are unchanged are not read, unless ``full`` is True,
+        which finds files damaged without their size or modification time
+        changing. The files are hashed in parallel, without holding any locks.
+        Hashes are recorded for files that have none.
+
+        Returns a list of ``(book_id, fmt, problem)`` where problem is
+        ``'changed'`` for files modified after their hash was recorded,
+        ``'corrupt'`` for files whose contents changed with no change in size
+        or modification time or an error message. ``progress_callback`` is
+        called with the number of files verified and the total.
+        '''
+        with self.safe_read_lock:
+            field = self.fields['formats']
+            format_map = {}
+            for book_id in (self._all_book_ids() if book_ids is None else book_ids):
+                path = self._field_for('path', book_id)
+                fmts = field.table.book_col_map.get(book_id, ())
+                if path and fmts:
+                    format_map[book_id] = path.replace('/', os.sep), {fmt: field.format_fname(book_id, fmt) for fmt in fmts}
+            records = self.backend.format_hash_records()
+        problems, updates = self.backend.verify_format_hashes(
+            format_map, records, full=full, num_workers=num_workers, progress_callback=progress_callback)
+        if updates:
+            with self.write_lock:
+                self.backend.update_format_hashes(updates)
+        return problems
+
+    @read_api
+    def checked_dirs(self):
+        ''' Return the map of folders in the library to their modification
+        time, as recorded by the last library check, for folders in which no
+        problems were found '''
+        return self.backend.checked_dirs()
+
+    @write_api
+    def set_checked_dirs(self, dir_map):
+        self.backend.set_checked_dirs(dir_map)
 
     @api
     def format_metadata(self, book_id, fmt, allow_cache=True, update_db=False):
@@ -1030,6 +1197,8 @@ class Cache:
                 self.format_metadata_cache[book_id][fmt] = ans
         if update_db and 'size' in ans:
             with self.write_lock:
+                # The file was changed by calibre, so its recorded hash is obsolete
+                self.backend.remove_format_hash(book_id, fmt)
                 max_size = self.fields['formats'].table.update_fmt(book_id, fmt, name, ans['size'], self.backend)
                 self.fields['size'].table.update_sizes({book_id: max_size})
 
@@ -1448,6 +1617,16 @@ class Cache:
 
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
+        for field, order in fields:
+            if field in self.composites and field not in virtual_fields:
+                # Render all the values at once, rather than one at a time while sorting
+                self.composites[field].values_for_books(ids_to_sort, get_metadata)
+
+        ranked = self._rank_functions(fields, virtual_fields)
+        if ranked is not None:
+            ans = sort_by_ranks(ids_to_sort, ranked[0])
+            if ans is not None:
+                return ans
 
         if len(fields) == 1:
             keyfunc = sort_key_func(fields[0][0])
@@ -1505,6 +1684,78 @@ class Cache:
 
         return sorted(ids_to_sort, key=SortKey)
 
+    def _rank_functions(self, fields, virtual_fields=None):
+        '''
+        Return a list of (book_id -> rank function, ascending) for the
+        specified sort fields and the set of names of the underlying fields,
+        or None if any of the fields cannot be ranked, for example, because
+        it is a composite or virtual field.
+        '''
+        virtual_fields = virtual_fields or {}
+        fm = {'title':'sort', 'authors':'author_sort'}
+        all_book_ids = self.fields['uuid'].table.book_col_map
+        lang_map = None
+
+        def key_func_factory(f):
+            nonlocal lang_map
+            if lang_map is None:
+                lang_map = self.fields['languages'].book_value_map
+            return f.sort_keys_for_books(self._get_proxy_metadata, lang_map)
+
+        ans, names = [], set()
+        for field, ascending in fields:
+            if field == 'id' and field not in virtual_fields:
+                ans.append((IDENTITY, ascending))
+                continue
+            name = fm.get(field, field)
+            for name in (name, field + '_index') if field + '_index' in self.fields else (name,):
+                f = self.fields.get(name)
+                if f is None or name in virtual_fields or f.is_composite or isinstance(getattr(f, 'table', None), (VirtualTable, type(None))):
+                    return None
+                depends_on = sort_dependencies(name, f)
+                func = self.sort_ranks.rank_function(name, f, partial(key_func_factory, f), all_book_ids, depends_on)
+                if func is None:
+                    return None
+                ans.append((func, ascending))
+                names |= depends_on
+        return ans, names
+
+    @read_api
+    def sort_change_seq(self):
+        ' A number that changes whenever the sort order of some books could have changed, see :meth:`merge_sort` '
+        return self.sort_ranks.change_seq
+
+    @read_api
+    def merge_sort(self, fields, sorted_ids, seq, virtual_fields=None, max_changes=1000):
+        '''
+        Return sorted_ids, which must have been sorted by :meth:`multisort`
+        on the specified fields when :meth:`sort_change_seq` was seq,
+        re-sorted by moving only the books whose data has changed since. The
+        result is the same as that of :meth:`multisort` on sorted_ids, books
+        with equal values keep their order in sorted_ids. Returns None if that is not possible or not worthwhile, in which case
+        use :meth:`multisort` instead.
+        '''
+        ranked = self._rank_functions(uniq(fields, operator.itemgetter(0)), virtual_fields)
+        if ranked is None:
+            return None
+        rank_funcs, names = ranked
+        changed = self.sort_ranks.changes_since(seq, names)
+        if changed is None or len(changed) > max_changes:
+            return None
+        keys = sort_keys_from_ranks(sorted_ids, rank_funcs)
+        if keys is None:
+            return None
+        ids = list(sorted_ids)
+        moved = [i for i, book_id in enumerate(ids) if book_id in changed]
+        moved_items = [(ids[i], keys[i]) for i in moved]
+        for i in reversed(moved):
+            del ids[i], keys[i]
+        for book_id, key in moved_items:
+            i = bisect_right(keys, key)
+            keys.insert(i, key)
+            ids.insert(i, book_id)
+        return ids
+
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
@@ -1530,9 +1781,9 @@ class Cache:
         srch = partial(self._search, virtual_fields=virtual_fields)
         if vl:
             if search_restriction:
-                return frozenset(srch('', vl) & srch('', search_restriction))
-            return frozenset(srch('', vl))
-        return frozenset(srch('', search_restriction))
+                return FrozenIdSet(srch('', vl) & srch('', search_restriction))
+            return FrozenIdSet(srch('', vl))
+        return FrozenIdSet(srch('', search_restriction))
 
     @read_api
     def number_of_books_in_virtual_library(self, vl=None, search_restriction=None):
@@ -1558,19 +1809,29 @@ class Cache:
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, fields=None):
+        '''
+        Set the last modified date of the specified books. fields, if not
+        None, is the set of other fields that were changed for these books,
+        it is used to avoid discarding cached searches unaffected by the
+        change.
+        '''
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            fields = None if fields is None else frozenset(fields) | {'last_modified'}
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, fields)
+            self._clear_search_caches(book_ids, fields)
+            self.sort_ranks.invalidate(book_ids, fields)
+            self.category_stats.invalidate(book_ids, fields)
+            self.duplicate_index.invalidate(book_ids, fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, fields=None):
+        self._update_last_modified(book_ids, fields=fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1599,24 +1860,13 @@ class Cache:
             self.dirtied_sequence = max(itervalues(new_dirtied)) + 1
             self.dirtied_cache.update(new_dirtied)
 
-    @write_api
-    def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_update=True):
-        '''
-        Set the values of the field specified by ``name``. Returns the set of all book ids that were affected by the change.
-
-        :param book_id_to_val_map: Mapping of book_ids to values that should be applied.
-        :param allow_case_change: If True, the case of many-one or many-many fields will be changed.
-            For example, if a  book has the tag ``tag1`` and you set the tag for another book to ``Tag1``
-            then the both books will have the tag ``Tag1`` if allow_case_change is True, otherwise they will
-            both have the tag ``tag1``.
-        :param do_path_update: Used internally, you should never change it.
-        '''
+    def _write_field(self, name, book_id_to_val_map, allow_case_change):
+        # Write the values of a single field to the db and the in memory
+        # tables, returning the set of books that changed and the set of
+        # fields changed for them. The caller must mark the books as dirty and
+        # update their paths, if needed.
         f = self.fields[name]
         is_series = f.metadata['datatype'] == 'series'
-        update_path = name in {'title', 'authors'}
-        if update_path and iswindows:
-            paths = (x for x in (self._field_for('path', book_id) for book_id in book_id_to_val_map) if x)
-            self.backend.windows_check_if_files_in_use(paths)
 
         if is_series:
             bimap, simap = {}, {}
@@ -1641,14 +1891,98 @@ class Cache:
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
 
+        changed_fields = {f.name}
+        if is_series:
+            changed_fields.add(f.name + '_index')
+        if name in {'title', 'authors'}:
+            # The writers also update the sort and author_sort fields
+            changed_fields |= {'sort', 'author_sort', 'path'}
+        return dirtied, changed_fields
+
+    @write_api
+    def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_update=True):
+        '''
+        Set the values of the field specified by ``name``. Returns the set of all book ids that were affected by the change.
+
+        :param book_id_to_val_map: Mapping of book_ids to values that should be applied.
+        :param allow_case_change: If True, the case of many-one or many-many fields will be changed.
+            For example, if a  book has the tag ``tag1`` and you set the tag for another book to ``Tag1``
+            then the both books will have the tag ``Tag1`` if allow_case_change is True, otherwise they will
+            both have the tag ``tag1``.
+        :param do_path_update: Used internally, you should never change it.
+        '''
+        update_path = name in {'title', 'authors'}
+        if update_path and iswindows:
+            paths = (x for x in (self._field_for('path', book_id) for book_id in book_id_to_val_map) if x)
+            self.backend.windows_check_if_files_in_use(paths)
+
+        dirtied, changed_fields = self._write_field(name, book_id_to_val_map, allow_case_change)
+
         if dirtied:
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+            self._mark_as_dirty(dirtied, fields=changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
 
+    @write_api
+    def set_fields(self, book_id_to_field_map, allow_case_change=True):
+        '''
+        Set the values of many fields for many books at once. Returns the set
+        of all book ids that were affected by the change. This is much faster
+        than calling :meth:`set_field` once per field or per book, as all
+        values are written in a single transaction, the caches are
+        invalidated once and the folder of every book whose title or authors
+        changed is updated only once.
+
+        :param book_id_to_field_map: Mapping of book_id to a mapping of field name to value.
+            Fields are set in the order title, authors, all other fields and
+            finally the series index fields, so that, for example, a value
+            for sort overrides the sort computed from a new title.
+        :param allow_case_change: Same as for :meth:`set_field`.
+        '''
+        field_map = defaultdict(dict)
+        for book_id, vals in iteritems(book_id_to_field_map):
+            for name, val in iteritems(vals):
+                field_map[name][book_id] = val
+        for name in field_map:
+            if name not in self.fields:
+                raise KeyError(f'{name} is not a known field')
+        order = {'title': 0, 'authors': 1}
+        names = sorted(field_map, key=lambda name: order.get(name, 3 if name.endswith('_index') else 2))
+        if iswindows and ('title' in field_map or 'authors' in field_map):
+            book_ids = set(field_map.get('title', ())) | set(field_map.get('authors', ()))
+            paths = (x for x in (self._field_for('path', book_id) for book_id in book_ids) if x)
+            self.backend.windows_check_if_files_in_use(paths)
+
+        all_dirtied, changed_fields, path_dirtied, dirtied_map = set(), set(), set(), {}
+        try:
+            with self.backend.conn:
+                for name in names:
+                    dirtied, fields = self._write_field(name, field_map[name], allow_case_change)
+                    if dirtied:
+                        dirtied_map[name] = dirtied
+                        all_dirtied |= dirtied
+                        changed_fields |= fields
+                        if name in ('title', 'authors'):
+                            path_dirtied |= dirtied
+                if all_dirtied:
+                    self._mark_as_dirty(all_dirtied, fields=changed_fields)
+        except:
+            # sqlite will rollback the entire transaction, so re-read
+            # everything from the db to ensure the db and Cache are in sync
+            self._reload_from_db(incremental=False)
+            raise
+        if path_dirtied:
+            # Done outside the transaction as it moves files
+            self._update_path(path_dirtied, mark_as_dirtied=False)
+        if all_dirtied:
+            self._clear_link_map_cache(all_dirtied)
+            for name, dirtied in iteritems(dirtied_map):
+                self.event_dispatcher(EventType.metadata_changed, name, dirtied)
+        return all_dirtied
+
     @write_api
     def update_path(self, book_ids, mark_as_dirtied=True):
         for book_id in book_ids:
@@ -1659,9 +1993,9 @@ class Cache:
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
             self.format_metadata_cache.pop(book_id, None)
-            if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
-            self._clear_link_map_cache(book_ids)
+        if mark_as_dirtied:
+            self._mark_as_dirty(book_ids)
+        self._clear_link_map_cache(book_ids)
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1697,6 +2031,47 @@ class Cache:
                 traceback.print_exc()
         return mi, sequence
 
+    @read_api
+    def dirtied_books_for_dump(self, limit):
+        ' Return up to limit dirtied book ids, the ones dirtied earliest first '
+        dc = self.dirtied_cache
+        if len(dc) <= limit:
+            return sorted(dc, key=dc.__getitem__)
+        return heapq.nsmallest(limit, dc, key=dc.__getitem__)
+
+    @read_api
+    def get_metadata_for_dump_batch(self, book_ids):
+        '''
+        Like :meth:`get_metadata_for_dump` for many books with a single lock
+        acquisition. Returns a list of (book_id, path, mi, sequence) where
+        path is the folder of the book relative to the library, mi is None if
+        the book need not be backed up and sequence is None if the book is
+        not dirtied.
+        '''
+        ans = []
+        for book_id in book_ids:
+            path = self._field_for('path', book_id)
+            mi, sequence = self._get_metadata_for_dump(book_id)
+            ans.append((book_id, path and path.replace('/', os.sep), mi, sequence))
+        return ans
+
+    @write_api
+    def clear_dirtied_books(self, book_id_to_sequence_map):
+        '''
+        Like :meth:`clear_dirtied` for many books, in a single transaction.
+        Books dirtied again since their sequence was read remain dirtied.
+        '''
+        clean = []
+        for book_id, sequence in book_id_to_sequence_map.items():
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                clean.append(book_id)
+        if clean:
+            with self.backend.conn:
+                self.backend.mark_books_as_clean(clean)
+            for book_id in clean:
+                self.dirtied_cache.pop(book_id, None)
+
     @write_api
     def clear_dirtied(self, book_id, sequence):
         # Clear the dirtied indicator for the books. This is used when fetching
@@ -1716,6 +2091,23 @@ class Cache:
 
         self.backend.write_backup(path, raw)
 
+    @read_api
+    def write_backup_for_dump(self, book_id, path, raw):
+        '''
+        Write the OPF backup raw for a book whose metadata was read by
+        :meth:`get_metadata_for_dump_batch` when its folder was path. Nothing
+        is written and False is returned if the book has since been deleted or
+        moved. Missing folders are not created.
+        '''
+        try:
+            current_path = self._field_for('path', book_id).replace('/', os.sep)
+        except Exception:
+            return False
+        if current_path != path:
+            return False
+        self.backend.write_backup(path, raw, create_dirs=False)
+        return True
+
     @read_api
     def dirty_queue_length(self):
         return len(self.dirtied_cache)
@@ -1734,45 +2126,34 @@ class Cache:
         except OSError:
             return None
 
-    @write_api
     def dump_metadata(self, book_ids=None, remove_from_dirtied=True,
             callback=None):
-        # Write metadata for each record to an individual OPF file. If callback
-        # is not None, it is called once at the start with the number of book_ids
-        # being processed. And once for every book_id, with arguments (book_id,
-        # mi, ok).
+        '''
+        Write metadata for each book to an individual OPF file. If callback is
+        not None, it is called once at the start with the number of book_ids
+        being processed. And once for every book_id, with arguments (book_id,
+        mi, ok). Metadata is read in batches, the OPF files are created and
+        written without holding the database lock.
+        '''
+        from calibre.db.backup import dump_metadata
         if book_ids is None:
-            book_ids = set(self.dirtied_cache)
-
-        if callback is not None:
-            callback(len(book_ids), True, False)
-
-        for book_id in book_ids:
-            if self._field_for('path', book_id) is None:
-                if callback is not None:
-                    callback(book_id, None, False)
-                continue
-            mi, sequence = self._get_metadata_for_dump(book_id)
-            if mi is None:
-                if callback is not None:
-                    callback(book_id, mi, False)
-                continue
-            try:
-                raw = metadata_to_opf(mi)
-                self._write_backup(book_id, raw)
-                if remove_from_dirtied:
-                    self._clear_dirtied(book_id, sequence)
-            except:
-                pass
-            if callback is not None:
-                callback(book_id, mi, True)
+            with self.safe_read_lock:
+                book_ids = set(self.dirtied_cache)
+        dump_metadata(self, book_ids, remove_from_dirtied=remove_from_dirtied, callback=callback)
 
-    @write_api
+    @api
     def set_cover(self, book_id_data_map):
         ''' Set the cover for this book. The data can be either a QImage,
         QPixmap, file object or bytestring. It can also be None, in which
         case any existing cover is removed. '''
+        # Decode, resize and re-encode the images without holding the lock
+        prepared = {book_id: self.backend.prepare_cover(data) for book_id, data in iteritems(book_id_data_map)}
+        with self.write_lock:
+            return self._set_cover(prepared, no_processing=True)
 
+    def _set_cover(self, book_id_data_map, no_processing=False):
+        # The unlocked version of set_cover(), must be called with the write
+        # lock held
         for book_id, data in iteritems(book_id_data_map):
             try:
                 path = self._field_for('path', book_id).replace('/', os.sep)
@@ -1780,7 +2161,7 @@ class Cache:
                 self._update_path((book_id,))
                 path = self._field_for('path', book_id).replace('/', os.sep)
 
-            self.backend.set_cover(book_id, path, data)
+            self.backend.set_cover(book_id, path, data, no_processing=no_processing)
         for cc in self.cover_caches:
             cc.invalidate(book_id_data_map)
         return self._set_field('cover', {
@@ -1917,11 +2298,11 @@ class Cache:
             # sqlite will rollback the entire transaction, thanks to the with
             # statement, so we have to re-read everything form the db to ensure
             # the db and Cache are in sync
-            self._reload_from_db()
+            self._reload_from_db(incremental=False)
             raise
         return dirtied
 
-    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
+    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None, content_hash=None):
         path = self._field_for('path', book_id)
         if path is None:
             # Theoretically, this should never happen, but apparently it
@@ -1936,7 +2317,7 @@ class Cache:
         except IndexError:
             author = _('Unknown')
 
-        size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime)
+        size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime, content_hash=content_hash)
         return size, fname
 
     @api
@@ -1959,37 +2340,51 @@ class Cache:
             needs_close = True
             fmt = check_ebook_format(stream_or_path, fmt)
 
-        with self.write_lock:
-            if not self._has_id(book_id):
-                raise NoSuchBook(book_id)
-            fmt = (fmt or '').upper()
-            self.format_metadata_cache[book_id].pop(fmt, None)
-            try:
-                name = self.fields['formats'].format_fname(book_id, fmt)
-            except Exception:
-                name = None
+        # Copy the data into the library folder without holding the lock, so
+        # that other threads are not blocked while large files are copied
+        staged = content_hash = None
+        if replace or not self.has_format(book_id, fmt or ''):
+            staged, content_hash = self.backend.stage_file(stream_or_path)
+        try:
+            with self.write_lock:
+                if not self._has_id(book_id):
+                    raise NoSuchBook(book_id)
+                fmt = (fmt or '').upper()
+                self.format_metadata_cache[book_id].pop(fmt, None)
+                try:
+                    name = self.fields['formats'].format_fname(book_id, fmt)
+                except Exception:
+                    name = None
 
-            if name and not replace:
-                if needs_close:
-                    stream_or_path.close()
-                return False
+                if name and not replace:
+                    if needs_close:
+                        stream_or_path.close()
+                    return False
 
-            if hasattr(stream_or_path, 'read'):
-                stream = stream_or_path
-            else:
-                stream = open(make_long_path_useable(stream_or_path), 'rb')
-                needs_close = True
-            try:
-                size, fname = self._do_add_format(book_id, fmt, stream, name)
-            finally:
-                if needs_close:
-                    stream.close()
-            del stream
+                if staged is not None and os.path.dirname(staged) == self.backend.library_path:
+                    stream, staged = staged, None
+                else:
+                    content_hash = None
+                    if hasattr(stream_or_path, 'read'):
+                        stream = stream_or_path
+                    else:
+                        stream = open(make_long_path_useable(stream_or_path), 'rb')
+                        needs_close = True
+                try:
+                    size, fname = self._do_add_format(book_id, fmt, stream, name, content_hash=content_hash)
+                finally:
+                    if needs_close and hasattr(stream, 'close'):
+                        stream.close()
+                del stream
 
-            max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
-            self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
-            self.event_dispatcher(EventType.format_added, book_id, fmt)
+                max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
+                self.fields['size'].table.update_sizes({book_id: max_size})
+                self._update_last_modified((book_id,))
+                self.event_dispatcher(EventType.format_added, book_id, fmt)
+        finally:
+            if staged is not None:
+                with suppress(OSError):
+                    os.remove(staged)
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -2105,10 +2500,7 @@ class Cache:
         if title:
             if isbytestring(title):
                 title = title.decode(preferred_encoding, 'replace')
-            q = icu_lower(title).strip()
-            for title in itervalues(self.fields['title'].table.book_col_map):
-                if q == icu_lower(title):
-                    return True
+            return self.duplicate_index.has_title(self.fields, title)
         return False
 
     @read_api
@@ -2150,6 +2542,7 @@ class Cache:
             self.backend.execute('INSERT INTO books(id, title, series_index, author_sort) VALUES (?, ?, ?, ?)',
                          (force_id, mi.title, series_index, aus))
         book_id = self.backend.last_insert_rowid()
+        self.duplicate_index.invalidate((book_id,))
         self.event_dispatcher(EventType.book_created, book_id)
 
         mi.timestamp = utcnow() if (mi.timestamp is None or is_date_undefined(mi.timestamp)) else mi.timestamp
@@ -2176,6 +2569,26 @@ class Cache:
 
         return book_id
 
+    @write_api
+    def create_book_entries(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False):
+        '''
+        Create entries for many books in a single transaction, which is much
+        faster than calling :meth:`create_book_entry` for every book. books
+        must be an iterable of :code:`(mi, cover)` pairs. Returns the list of
+        the ids of the created books, with None for books that were not
+        created because they are duplicates.
+        '''
+        try:
+            with self.backend.conn:
+                return [self._create_book_entry(
+                    mi, cover=cover, add_duplicates=add_duplicates, apply_import_tags=apply_import_tags, preserve_uuid=preserve_uuid)
+                    for mi, cover in books]
+        except Exception:
+            # The transaction has been rolled back, so re-read everything
+            # from the db to get rid of the books that were created by it
+            self._reload_from_db(incremental=False)
+            raise
+
     @api
     def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None):
         '''
@@ -2189,17 +2602,24 @@ class Cache:
         as per the simple duplicate detection heuristic used by :meth:`has_book`.
         '''
         duplicates, ids = [], []
-        for mi, format_map in books:
-            book_id = self.create_book_entry(mi, add_duplicates=add_duplicates, apply_import_tags=apply_import_tags, preserve_uuid=preserve_uuid)
-            if book_id is None:
-                duplicates.append((mi, format_map))
-            else:
-                fmt_map = {}
-                ids.append(book_id)
-                for fmt, stream_or_path in format_map.items():
-                    if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks):
-                        fmt_map[fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
-                run_plugins_on_postadd(dbapi or self, book_id, fmt_map)
+        books = iter(books)
+        while True:
+            # Create the entries in batches, to avoid a transaction per book
+            batch = tuple(itertools.islice(books, ADD_BOOKS_BATCH_SIZE))
+            if not batch:
+                break
+            book_ids = self.create_book_entries(
+                ((mi, None) for mi, format_map in batch), add_duplicates=add_duplicates, apply_import_tags=apply_import_tags, preserve_uuid=preserve_uuid)
+            for (mi, format_map), book_id in zip(batch, book_ids):
+                if book_id is None:
+                    duplicates.append((mi, format_map))
+                else:
+                    fmt_map = {}
+                    ids.append(book_id)
+                    for fmt, stream_or_path in format_map.items():
+                        if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks):
+                            fmt_map[fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
+                    run_plugins_on_postadd(dbapi or self, book_id, fmt_map)
         return ids, duplicates
 
     @write_api
@@ -2699,42 +3119,24 @@ class Cache:
     def find_identical_books(self, mi, search_restriction='', book_ids=None):
         ''' Finds books that have a superset of the authors in mi and the same
         title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`. '''
-        from calibre.db.utils import fuzzy_title
-        identical_book_ids = set()
-        langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
-        if mi.authors:
-            try:
-                quathors = mi.authors[:20]  # Too many authors causes parsing of the search expression to fail
-                query = ' and '.join('authors:"={}"'.format(a.replace('"', '')) for a in quathors)
-                qauthors = mi.authors[20:]
-            except ValueError:
-                return identical_book_ids
+        identical_book_ids = self.duplicate_index.identical_books(self.fields, mi)
+        if identical_book_ids and book_ids is not None:
+            identical_book_ids = identical_book_ids.intersection(book_ids)
+        if identical_book_ids and search_restriction:
             try:
-                book_ids = self._search(query, restriction=search_restriction, book_ids=book_ids)
-            except:
+                identical_book_ids = identical_book_ids.intersection(self._search('', restriction=search_restriction))
+            except Exception:
                 traceback.print_exc()
-                return identical_book_ids
-            if qauthors and book_ids:
-                matches = set()
-                qauthors = {icu_lower(x) for x in qauthors}
-                for book_id in book_ids:
-                    aut = self._field_for('authors', book_id)
-                    if aut:
-                        aut = {icu_lower(x) for x in aut}
-                        if aut.issuperset(qauthors):
-                            matches.add(book_id)
-                book_ids = matches
-
-            for book_id in book_ids:
-                fbook_title = self._field_for('title', book_id)
-                fbook_title = fuzzy_title(fbook_title)
-                mbook_title = fuzzy_title(mi.title)
-                if fbook_title == mbook_title:
-                    bl = self._field_for('languages', book_id)
-                    if not langq or not bl or bl == langq:
-                        identical_book_ids.add(book_id)
+                return set()
         return identical_book_ids
 
+    @read_api
+    def find_books_with_identifiers(self, identifiers):
+        ''' Return the set of ids of books that have at least one of the
+        specified identifiers, for example: :code:`{'isbn': '9780316212366'}`.
+        ISBNs are compared after removing hyphens and spaces. '''
+        return self.duplicate_index.books_with_identifiers(self.fields, identifiers)
+
     @read_api
     def get_top_level_move_items(self):
         all_paths = {self._field_for('path', book_id).partition('/')[0] for book_id in self._all_book_ids()}
@@ -2838,6 +3240,10 @@ class Cache:
                         traceback.print_exc()
         self._shutdown_fts(stage=2)
         with self.write_lock:
+            try:
+                self.composite_store.save(self.backend.composites_store_path, self._all_book_ids())
+            except Exception:
+                traceback.print_exc()
             self.backend.close()
 
     @property
@@ -9,6 +9,7 @@ import copy
 from collections import OrderedDict
 from functools import partial
 
+from calibre.db.fields import Field
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.icu import collation_order, sort_key
@@ -213,8 +214,13 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
-    book_rating_map = dbcache.fields['rating'].book_value_map
-    lang_map = dbcache.fields['languages'].book_value_map
+    book_value_maps = {}
+
+    def book_value_map(name):
+        ans = book_value_maps.get(name)
+        if ans is None:
+            ans = book_value_maps[name] = dbcache.fields[name].book_value_map
+        return ans
 
     categories = OrderedDict()
     book_ids = frozenset(book_ids) if book_ids else book_ids
@@ -237,24 +243,33 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
             if bids is None:
                 bids = dbcache._all_book_ids() if book_ids is None else book_ids
             cats = dbcache.fields[category].get_composite_categories(
-                tag_class, book_rating_map, bids, is_multiple, get_metadata)
+                tag_class, book_value_map('rating'), bids, is_multiple, get_metadata)
         elif category == 'news':
             cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
         else:
             cat = fm[category]
-            brm = book_rating_map
+            field = dbcache.fields[category]
+            rating_field = 'rating'
             dt = cat['datatype']
             if dt == 'rating':
-                if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                rating_field = category
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
-            if (category != 'authors' and dt == 'text' and
-                cat['is_multiple'] and cat['display'].get('is_names', False)):
-                for item in cats:
-                    item.sort = author_to_author_sort(item.sort)
+            is_names = (category != 'authors' and dt == 'text' and
+                cat['is_multiple'] and cat['display'].get('is_names', False))
+            cats = None
+            if type(field).get_categories is Field.get_categories:
+                # Fields using the default implementation of get_categories()
+                # have incrementally maintained statistics
+                cats = dbcache.category_stats.categories(
+                    field, tag_class, dbcache.fields[rating_field], partial(book_value_map, 'languages'), book_ids,
+                    author_to_author_sort if is_names else None)
+            if cats is None:
+                cats = field.get_categories(
+                    tag_class, book_value_map(rating_field), book_value_map('languages'), book_ids)
+                if is_names:
+                    for item in cats:
+                        item.sort = author_to_author_sort(item.sort)
         cats.sort(key=partial(category_sort_keys[fl_sort][sort_on],
                               hierarchical_categories=hierarchical_categories),
                   reverse=reverse)
@@ -265,7 +280,7 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
@@ -319,7 +334,7 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
                             total_rating = 0
                             count = 0
                             for id_ in t.id_set:
-                                rating = book_rating_map.get(id_, 0)
+                                rating = book_value_map('rating').get(id_, 0)
                                 if rating:
                                     total_rating += rating/2
                                     count += 1
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Incrementally maintained statistics for the items of the fields shown in the
+Tag browser, such as tags, authors and series. For every item the set of
+books, the average rating, the display name and the sort value are
+remembered and only re-calculated for items whose books have changed, so
+that building the categories only needs to create the Tag objects and sort
+them. Statistics are kept for the whole library and for a few recently used
+sets of books, such as virtual libraries.
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+from calibre.db.fields import InvalidLinkTable
+from calibre.utils.config_base import tweaks
+from calibre.utils.localization import get_lang
+
+# The number of distinct restrictions, such as virtual libraries, for which
+# statistics are kept
+MAX_RESTRICTIONS = 4
+# Tweaks that change the names or sort values of items
+STATS_TWEAKS = (
+    'title_series_sorting', 'author_sort_copy_method', 'author_name_suffixes', 'author_name_prefixes',
+    'author_name_copywords', 'author_use_surname_prefixes', 'author_surname_prefixes',
+)
+
+
+def stats_environment():
+    ' Everything other than the data in the database that the statistics depend on '
+    return get_lang(), tuple(tweaks.get(k) for k in STATS_TWEAKS)
+
+
+class ItemStats:
+
+    __slots__ = ('avg', 'book_ids', 'name', 'sort', 'total', 'value')
+
+    def __init__(self, book_ids, total, avg):
+        self.book_ids, self.total, self.avg = book_ids, total, avg
+        self.value = self.name = self.sort = None
+
+
+class FieldStats:
+
+    ' The statistics for the items of a single field, restricted to a set of books '
+
+    __slots__ = ('depends_on', 'field', 'items', 'rating_field', 'sort_func', 'stale')
+
+    def __init__(self, field, rating_field, sort_func):
+        self.field, self.rating_field, self.sort_func = field, rating_field, sort_func
+        self.items = {}  # item_id -> ItemStats
+        self.stale = set()  # items whose statistics must be re-calculated
+        # The sort values of series depend on the languages of their books
+        self.depends_on = frozenset((field.name, rating_field.name, 'languages'))
+
+    def categories(self, tag_class, get_lang_map, restriction):
+        field, items, stale = self.field, self.items, self.stale
+        id_map, col_book_map = field.table.id_map, field.table.col_book_map
+        special_sort = hasattr(field, 'category_sort_value')
+        # The sort values of series are expensive to calculate and change only
+        # when the books of the series do. Other sort values, such as author
+        # sort, are simple lookups that can change without the books changing.
+        cache_sort = special_sort and field.metadata['datatype'] == 'series'
+        rating_for, formatter, sort_func = self.rating_field.for_book, field.category_formatter, self.sort_func
+        ans = []
+        for item_id, all_book_ids in col_book_map.items():
+            st = items.get(item_id)
+            if st is None or item_id in stale or st.total != len(all_book_ids):
+                book_ids = all_book_ids if restriction is None else all_book_ids.intersection(restriction)
+                ratings = tuple(r for r in (rating_for(book_id, 0) or 0 for book_id in book_ids) if r > 0)
+                st = items[item_id] = ItemStats(book_ids, len(all_book_ids), sum(ratings)/len(ratings) if ratings else 0)
+            if not st.book_ids:
+                continue
+            try:
+                value = id_map[item_id]
+            except KeyError:
+                # db has entries in the link table without entries in the id table
+                raise InvalidLinkTable(field.name)
+            if st.value is not value:
+                st.value, st.name = value, formatter(value)
+                sval = field.category_sort_value(item_id, st.book_ids, get_lang_map()) if cache_sort else st.name
+                st.sort = sval if sort_func is None else sort_func(sval)
+            sval = st.sort if cache_sort or not special_sort else field.category_sort_value(item_id, st.book_ids, None)
+            ans.append(tag_class(st.name, id=item_id, sort=sval, avg=st.avg, id_set=st.book_ids, count=len(st.book_ids)))
+        stale.clear()
+        if len(items) > len(col_book_map):
+            for item_id in tuple(items):
+                if item_id not in col_book_map:
+                    del items[item_id]
+        return ans
+
+
+class CategoryStats:
+
+    '''
+    The item statistics for all the fields that have been used to build
+    categories. Changes to the data are recorded by :meth:`invalidate` and
+    the affected items are re-calculated lazily, the next time the categories
+    are built. Items whose set of books changed size are always
+    re-calculated, so that only the current items of changed books need to
+    be invalidated.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = True
+        self.fields = {}  # (field name, restriction) -> FieldStats
+        self.restrictions = OrderedDict()
+        self.environment = None
+
+    def invalidate(self, book_ids=None, fields=None):
+        '''
+        Record that the data for book_ids (all books if None) in fields (all
+        fields if None) has changed.
+        '''
+        with self.lock:
+            if book_ids is None:
+                if fields is None:
+                    self.fields.clear()
+                    self.restrictions.clear()
+                else:
+                    for key in tuple(k for k, fs in self.fields.items() if not fs.depends_on.isdisjoint(fields)):
+                        del self.fields[key]
+                return
+            for fs in self.fields.values():
+                if fields is None or not fs.depends_on.isdisjoint(fields):
+                    ids_for_book = fs.field.ids_for_book
+                    for book_id in book_ids:
+                        fs.stale.update(ids_for_book(book_id))
+
+    def categories(self, field, tag_class, rating_field, get_lang_map, book_ids=None, sort_func=None):
+        '''
+        Return the list of Tag objects for the items of field used by
+        book_ids (all books if None), or None if statistics are disabled.
+        The average rating of every item is calculated from rating_field and
+        get_lang_map must return the map of book id to languages. sort_func,
+        if not None, is applied to the sort values of the items.
+        '''
+        if not self.enabled:
+            return None
+        if not field.is_many:
+            return []
+        restriction = None if book_ids is None else frozenset(book_ids)
+        with self.lock:
+            env = stats_environment()
+            if env != self.environment:
+                self.fields.clear()
+                self.restrictions.clear()
+                self.environment = env
+            if restriction is not None:
+                self.restrictions.pop(restriction, None)
+                self.restrictions[restriction] = True
+                while len(self.restrictions) > MAX_RESTRICTIONS:
+                    old = self.restrictions.popitem(last=False)[0]
+                    for key in tuple(k for k in self.fields if k[1] is not None and k[1] == old):
+                        del self.fields[key]
+            key = field.name, restriction
+            fs = self.fields.get(key)
+            if fs is None or fs.field is not field or fs.rating_field is not rating_field or fs.sort_func is not sort_func:
+                fs = self.fields[key] = FieldStats(field, rating_field, sort_func)
+            return fs.categories(tag_class, get_lang_map, restriction)
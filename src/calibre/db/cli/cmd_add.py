@@ -8,8 +8,8 @@ from contextlib import contextmanager
 from optparse import OptionGroup, OptionValueError
 
 from calibre import prints
+from calibre.constants import DEBUG
 from calibre.db.adding import cdb_find_in_dir, cdb_recursive_find, compile_rule, create_format_map, run_import_plugins, run_import_plugins_before_metadata
-from calibre.db.utils import find_identical_books
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover, serialize_cover
 from calibre.ebooks.metadata.meta import get_metadata, metadata_from_formats
@@ -31,18 +31,9 @@ def empty(db, notify_changes, is_remote, args):
     return ids, bool(duplicates)
 
 
-def cached_identical_book_data(db, request_id):
-    key = db.library_id, request_id
-    if getattr(cached_identical_book_data, 'key', None) != key:
-        cached_identical_book_data.key = key
-        cached_identical_book_data.ans = db.data_for_find_identical_books()
-    return cached_identical_book_data.ans
-
-
 def do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge):
     identical_book_list, added_ids, updated_ids = set(), set(), set()
     duplicates = []
-    identical_books_data = None
 
     def add_format(book_id, fmt):
         db.add_format(book_id, fmt, format_map[fmt], replace=True, run_hooks=False)
@@ -56,8 +47,7 @@ def do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_dup
         duplicates.extend(duplicates_)
 
     if oautomerge != 'disabled' or not add_duplicates:
-        identical_books_data = cached_identical_book_data(db, request_id)
-        identical_book_list = find_identical_books(mi, identical_books_data)
+        identical_book_list = db.find_identical_books(mi)
 
     if oautomerge != 'disabled':
         if identical_book_list:
@@ -94,10 +84,6 @@ def do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_dup
             duplicates.append((mi, format_map))
         else:
             add_book()
-    if added_ids and identical_books_data is not None:
-        for book_id in added_ids:
-            db.update_data_for_find_identical_books(book_id, identical_books_data)
-
     if is_remote:
         notify_changes(books_added(added_ids))
         if updated_ids:
@@ -171,6 +157,23 @@ def format_group(db, notify_changes, is_remote, args):
         return mi.title, set(added_ids), set(updated_ids), bool(duplicates)
 
 
+def directories(db, notify_changes, is_remote, args):
+    # Only used for local libraries, as the paths must be readable by the
+    # process adding the books
+    from calibre.db.bulk_add import BulkAdd
+    if is_remote:
+        raise ValueError('Adding books from folders is only supported for local libraries')
+    dirs, one_book_per_directory, recurse, add_duplicates, compiled_rules = args
+    with add_ctx():
+        ba = BulkAdd(db, dirs, single_book_per_directory=one_book_per_directory, compiled_rules=compiled_rules,
+                     add_duplicates=add_duplicates, recurse=recurse)
+        added_ids, duplicates = ba()
+    if DEBUG:
+        prints(ba.format_stats(), file=sys.stderr)
+    db.dump_metadata()
+    return added_ids, [(mi.title, paths) for mi, paths in duplicates], ba.errors
+
+
 def implementation(db, notify_changes, action, *args):
     is_remote = notify_changes is not None
     func = globals()[action]
@@ -245,6 +248,15 @@ def do_add(
                 file_duplicates.append((book_title, book))
 
         dir_dups = []
+        if dirs and not dbctx.is_remote and oautomerge == 'disabled':
+            # Add all the books in the folders with the bulk add pipeline,
+            # which overlaps reading metadata with copying files
+            ids, dir_dups, errors = dbctx.run('add', 'directories', dirs, one_book_per_directory, recurse, add_duplicates, compiled_rules)
+            added_ids |= set(ids)
+            for paths, details in errors:
+                prints(_('Failed to add:'), ', '.join(paths), file=sys.stderr)
+                prints(details, file=sys.stderr)
+            dirs = ()
         scanner = cdb_recursive_find if recurse else cdb_find_in_dir
         for dpath in dirs:
             for formats in scanner(dpath, one_book_per_directory, compiled_rules):
@@ -60,6 +60,22 @@ Perform some checks on the filesystem representing a library. Reports are {0}
         help=_('Comma-separated list of names to ignore.\n'
                'Default: all')
     )
+    parser.add_option(
+        '--incremental',
+        default=False,
+        action='store_true',
+        help=_('Only check the folders that have changed since the last check that found no problems in them.'
+               ' Changes made only to the database are not found by an incremental check.')
+    )
+    parser.add_option(
+        '--verify-hashes',
+        default=None,
+        choices=('changed', 'all'),
+        help=_('Verify the contents of book files against the hashes recorded when they were added.'
+               ' With "changed" only the files whose size or modification time have changed are read,'
+               ' with "all" every file is read, to find files damaged without their size or modification'
+               ' time changing. Files with no recorded hash have it recorded.')
+    )
     parser.add_option(
         '--vacuum-fts-db',
         default=False,
@@ -122,7 +138,7 @@ def main(opts, args, dbctx):
     prints(_('Vacuuming database...'))
     db.new_api.vacuum(opts.vacuum_fts_db)
     checker = CheckLibrary(dbctx.library_path, db)
-    checker.scan_library(names, exts)
+    checker.scan_library(names, exts, incremental=opts.incremental, verify_hashes=opts.verify_hashes)
     for check in checks:
         _print_check_library_results(checker, check, as_csv=opts.csv)
 
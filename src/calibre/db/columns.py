@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact, columnar storage for the per book data in the in-memory tables.
+
+Instead of a dict mapping book_id -> value, a column stores values in flat
+arrays indexed directly by book id, alongside a one byte per book state array
+recording whether the book has a value. Numbers, dates and booleans are
+stored unboxed in :mod:`array` arrays, all other values are stored as indices
+into a pool of (optionally interned) values. Columns implement the full
+mutable mapping interface so they can be used anywhere the old dicts were
+used.
+'''
+
+from array import array
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+from itertools import compress, groupby
+
+from calibre.utils.iso8601 import utc_tz
+
+ABSENT, PRESENT, NONE, EXTRA = range(4)
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+ONE_MICROSECOND = timedelta(microseconds=1)
+# Used to find all non-empty slots in the state array via bytes.translate()
+NOT_ABSENT = bytes((0,) + (1,) * 255)
+# Never allocate dense storage for book ids this much larger than the
+# current storage, such ids are kept in a dict instead
+MIN_DENSE_LIMIT = 1 << 20
+null = object()
+
+
+class BookColumn(MutableMapping):
+
+    '''
+    A mapping of book_id -> value backed by flat arrays indexed by book id.
+    Values that cannot be stored in the typed array (for example, a string
+    in an integer column of a damaged database) are stored in a side dict, as
+    are keys that are not small non-negative integers, so that this class
+    is a drop-in replacement for a dict.
+    '''
+
+    typecode = 'q'
+    __slots__ = ('count', 'extra', 'other', 'state', 'values')
+
+    def __init__(self, items=()):
+        self.state = bytearray()
+        self.values = array(self.typecode)
+        self.extra = {}  # book_id -> value for values that could not be encoded
+        self.other = {}  # values for keys that cannot be used as array indices
+        self.count = 0
+        if items:
+            self.update(items)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for cls in type(self).__mro__ for k in getattr(cls, '__slots__', ())}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def encode(self, val):
+        ' Return the representation of val stored in self.values or null if val cannot be stored there '
+        return val if type(val) is int and -0x8000000000000000 <= val <= 0x7fffffffffffffff else null
+
+    def decode(self, raw):
+        return raw
+
+    def release(self, book_id):
+        ' Called when the value stored in self.values for book_id is about to be discarded '
+        pass
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self.items())!r})'
+
+    def __len__(self):
+        return self.count + len(self.other)
+
+    def __iter__(self):
+        yield from compress(range(len(self.state)), self.state.translate(NOT_ABSENT))
+        yield from tuple(self.other)
+
+    def __contains__(self, book_id):
+        try:
+            if book_id >= 0:
+                return self.state[book_id] != ABSENT
+        except (IndexError, TypeError):
+            pass
+        return book_id in self.other
+
+    def get(self, book_id, default=None):
+        try:
+            if book_id >= 0:
+                s = self.state[book_id]
+                if s == PRESENT:
+                    return self.decode(self.values[book_id])
+                if s == ABSENT:
+                    return default
+                return None if s == NONE else self.extra[book_id]
+        except (IndexError, TypeError):
+            pass
+        return self.other.get(book_id, default)
+
+    def __getitem__(self, book_id):
+        ans = self.get(book_id, null)
+        if ans is null:
+            raise KeyError(book_id)
+        return ans
+
+    def _ensure_capacity(self, book_id):
+        n = len(self.state)
+        if book_id < n:
+            return True
+        if book_id >= max(4 * n, MIN_DENSE_LIMIT):
+            return False
+        extra = max(book_id + 1, 2 * n, 64) - n
+        self.state.extend(bytes(extra))
+        self.values.frombytes(bytes(extra * self.values.itemsize))
+        return True
+
+    def __setitem__(self, book_id, val):
+        if type(book_id) is not int or book_id < 0 or not self._ensure_capacity(book_id):
+            self.other[book_id] = val
+            return
+        old = self.state[book_id]
+        if old == ABSENT:
+            self.count += 1
+        elif old == PRESENT:
+            self.release(book_id)
+        elif old == EXTRA:
+            del self.extra[book_id]
+        if val is None:
+            self.state[book_id] = NONE
+            return
+        raw = self.encode(val)
+        if raw is null:
+            self.extra[book_id] = val
+            self.state[book_id] = EXTRA
+        else:
+            self.values[book_id] = raw
+            self.state[book_id] = PRESENT
+
+    def __delitem__(self, book_id):
+        try:
+            if book_id >= 0:
+                s = self.state[book_id]
+                if s != ABSENT:
+                    if s == PRESENT:
+                        self.release(book_id)
+                    elif s == EXTRA:
+                        del self.extra[book_id]
+                    self.state[book_id] = ABSENT
+                    self.count -= 1
+                    return
+        except (IndexError, TypeError):
+            pass
+        del self.other[book_id]
+
+    def pop(self, book_id, default=null):
+        ans = self.get(book_id, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(book_id)
+            return default
+        del self[book_id]
+        return ans
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        return dict(self.items())
+
+    def load(self, rows):
+        ' Bulk load (book_id, value) pairs, faster than update() '
+        for book_id, val in rows:
+            self[book_id] = val
+        return self
+
+    def sort_key_function(self, key, default):
+        '''
+        Return a function that maps book_id -> key(value) reading directly
+        from this column. Books without a value use key(default).
+        '''
+        state, values, decode, get = self.state, self.values, self.decode, self.get
+
+        def sort_key(book_id):
+            try:
+                if book_id >= 0 and state[book_id] == PRESENT:
+                    return key(decode(values[book_id]))
+            except (IndexError, TypeError):
+                pass
+            return key(get(book_id, default))
+        return sort_key
+
+    def iter_values(self, book_ids, default=None):
+        ' Yield (book_id, value) for every book in book_ids '
+        state, values, decode, get = self.state, self.values, self.decode, self.get
+        for book_id in book_ids:
+            try:
+                if book_id >= 0 and state[book_id] == PRESENT:
+                    yield book_id, decode(values[book_id])
+                    continue
+            except (IndexError, TypeError):
+                pass
+            yield book_id, get(book_id, default)
+
+
+class IntColumn(BookColumn):
+    __slots__ = ()
+
+
+class FloatColumn(BookColumn):
+
+    typecode = 'd'
+    __slots__ = ()
+
+    def encode(self, val):
+        return val if type(val) is float else null
+
+
+class BoolColumn(BookColumn):
+
+    typecode = 'B'
+    __slots__ = ()
+
+    def encode(self, val):
+        return int(val) if type(val) is bool else null
+
+    def decode(self, raw):
+        return raw == 1
+
+
+class DateColumn(BookColumn):
+
+    ' Stores UTC datetimes as an integer number of microseconds since the epoch '
+
+    __slots__ = ()
+
+    def encode(self, val):
+        if type(val) is datetime and val.tzinfo is utc_tz:
+            return (val - EPOCH) // ONE_MICROSECOND
+        return null
+
+    def decode(self, raw):
+        return EPOCH + timedelta(microseconds=raw)
+
+
+class PooledColumn(BookColumn):
+
+    '''
+    Stores arbitrary values as indices into a pool of values. When interning
+    is enabled, books with equal values share a single pool entry, which
+    drastically reduces memory consumption for columns with many repeated
+    values, such as the tuples of tag ids for every book.
+    '''
+
+    typecode = 'I'
+    __slots__ = ('free', 'index', 'pool', 'refs')
+
+    def __init__(self, items=(), intern=True):
+        self.pool, self.refs, self.free = [], array('I'), []
+        self.index = {} if intern else None
+        BookColumn.__init__(self, items)
+
+    def clear(self):
+        self.__init__(intern=self.index is not None)
+
+    def encode(self, val):
+        index = self.index
+        if index is not None:
+            try:
+                idx = index.get(val)
+            except TypeError:  # unhashable
+                return null
+            if idx is not None:
+                self.refs[idx] += 1
+                return idx
+        if self.free:
+            idx = self.free.pop()
+            self.pool[idx] = val
+            self.refs[idx] = 1
+        else:
+            idx = len(self.pool)
+            self.pool.append(val)
+            self.refs.append(1)
+        if index is not None:
+            index[val] = idx
+        return idx
+
+    def decode(self, raw):
+        return self.pool[raw]
+
+    def release(self, book_id):
+        idx = self.values[book_id]
+        self.refs[idx] -= 1
+        if not self.refs[idx]:
+            val, self.pool[idx] = self.pool[idx], None
+            self.free.append(idx)
+            if self.index is not None:
+                self.index.pop(val, None)
+
+    def load(self, rows):
+        BookColumn.load(self, rows)
+        # Interning only pays for itself if values are repeated, for mostly
+        # unique values, such as titles, the index costs more than it saves
+        if self.index is not None and len(self.index) > self.count // 2:
+            self.index = None
+        return self
+
+    def sort_key_function(self, key, default):
+        # Compute the key only once per distinct pool entry
+        state, values, pool, get = self.state, self.values, self.pool, self.get
+        cache = {}
+
+        def sort_key(book_id):
+            try:
+                if book_id >= 0 and state[book_id] == PRESENT:
+                    idx = values[book_id]
+                    ans = cache.get(idx, null)
+                    if ans is null:
+                        ans = cache[idx] = key(pool[idx])
+                    return ans
+            except (IndexError, TypeError):
+                pass
+            return key(get(book_id, default))
+        return sort_key
+
+
+def column_for_datatype(datatype):
+    ' Return an empty column suitable for storing values of the specified datatype '
+    if datatype == 'int':
+        return IntColumn()
+    if datatype in ('float', 'rating'):
+        return FloatColumn()
+    if datatype == 'datetime':
+        return DateColumn()
+    if datatype == 'bool':
+        return BoolColumn()
+    return PooledColumn()
+
+
+def grouped_item_ids(rows):
+    ' Convert (book_id, item_id) rows sorted by book_id into (book_id, tuple of item ids) '
+    for book_id, group in groupby(rows, lambda r: r[0]):
+        yield book_id, tuple(r[1] for r in group)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Tracking of the fields that the templates of composite columns depend on and
+an on-disk store of rendered composite values, stored next to metadata.db.
+
+Every stored value is keyed by a fingerprint of the values of the fields the
+template reads for that book, so a stored value is only ever used if all
+the data it was rendered from is unchanged, regardless of what happened to
+the library in between. Templates whose output can depend on anything other
+than the fields of the book being rendered, for example, templates that call
+virtual_libraries() or book_count() or user defined functions, have no known
+dependencies and are neither stored nor selectively invalidated.
+'''
+
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+from contextlib import suppress
+
+from calibre.constants import numeric_version
+from calibre.db.tables import VirtualTable
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
+from calibre.utils.config_base import tweaks
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.localization import get_lang
+
+MAGIC = b'calibre-composites-store\0'
+VERSION = 1
+
+# Template language keywords and built-in functions whose result depends only
+# on their arguments
+PURE_FUNCTIONS = frozenset((
+    'if', 'then', 'elif', 'else', 'fi', 'for', 'in', 'separator', 'rof', 'while', 'do', 'od', 'break', 'continue',
+    'return', 'with', 'limit', 'and', 'or', 'not', 'add', 'assign', 'capitalize', 'ceiling', 'character', 'cmp',
+    'contains', 'count', 'date_arithmetic', 'days_between', 'divide', 'encode_for_url', 'finish_formatting',
+    'first_matching_cmp', 'first_non_empty', 'floor', 'format_date', 'format_number', 'fractional_part',
+    'human_readable', 'identifier_in_list', 'ifempty', 'in_list', 'language_codes', 'language_strings',
+    'list_contains', 'list_count', 'list_count_matching', 'list_difference', 'list_equals', 'list_intersection',
+    'list_item', 'list_join', 'list_re', 'list_re_group', 'list_remove_duplicates', 'list_sort', 'list_split',
+    'list_union', 'lowercase', 'make_url', 'make_url_extended', 'mod', 'multiply', 'query_string', 'range',
+    'rating_to_stars', 're', 're_group', 'round', 'select', 'shorten', 'str_in_list', 'strcat', 'strcat_max',
+    'strcmp', 'strcmpcase', 'strlen', 'subitems', 'sublist', 'substr', 'subtract', 'swap_around_articles',
+    'swap_around_comma', 'switch', 'switch_if', 'test', 'titlecase', 'to_hex', 'transliterate', 'uppercase',
+    'urls_from_identifiers',
+))
+# Functions that read the field named by their first argument, which must be
+# a string literal for the dependency to be known
+FIELD_FUNCTIONS = frozenset(('field', 'raw_field', 'raw_list', 'field_exists', 'format_date_field', 'list_count_field', 'check_yes_no'))
+# Functions that read fields not named in the template
+IMPLICIT_DEPENDENCIES = {
+    'approximate_formats': ('formats',), 'formats_sizes': ('formats',), 'booksize': ('size',),
+    'has_cover': ('cover',), 'series_sort': ('series',),
+}
+# Names that Metadata objects map to fields with a different name
+FIELD_ALIASES = {
+    'title_sort': 'sort', 'book_size': 'size', 'language': 'languages', 'db_approx_formats': 'formats',
+    'has_cover': 'cover', 'format_metadata': 'formats', 'application_id': 'id',
+}
+FIELD_ALIASES.update((x, 'identifiers') for x in TOP_LEVEL_IDENTIFIERS)
+# Metadata whose value is not stored in the fields of the book
+VOLATILE_NAMES = frozenset((
+    'ondevice', 'ondevice_col', 'marked', 'in_tag_browser', 'virtual_libraries', 'link_maps', 'author_sort_map',
+    'user_categories', 'device_collections', 'cover_data',
+))
+
+call_pat = re.compile(r'''(?<![\w#$])([a-zA-Z_]\w*)\s*\(''')
+name_pat = re.compile(r'#?[a-zA-Z_]\w*')
+literal_arg_pat = re.compile(r'''\s*(['"])#?\w+\1\s*[,)]''')
+
+
+def template_dependencies(template, is_field):
+    '''
+    Return the set of names the template reads, which may include names that
+    are not fields, or None if the output of the template can depend on
+    something other than the fields of the book.
+    '''
+    if not template or template.startswith('python:'):
+        return None
+    ans = set()
+    for m in call_pat.finditer(template):
+        func = m.group(1)
+        if func in FIELD_FUNCTIONS:
+            if literal_arg_pat.match(template, m.end()) is None:
+                return None
+        elif func in IMPLICIT_DEPENDENCIES:
+            ans.update(IMPLICIT_DEPENDENCIES[func])
+        elif func not in PURE_FUNCTIONS and not is_field(func):
+            return None
+    for name in name_pat.findall(template):
+        name = FIELD_ALIASES.get(name, name)
+        if name in VOLATILE_NAMES:
+            return None
+        if is_field(name):
+            ans.add(name)
+    return ans
+
+
+def composite_dependencies(templates, fields):
+    '''
+    Return a map of composite column name to the frozenset of fields its
+    template depends on, directly or through other composite columns, which
+    are also included, or None if the dependencies are not known. templates is a map of
+    composite column name to template and fields a map of field name to field
+    object.
+    '''
+    direct = {name: template_dependencies(template, fields.__contains__) for name, template in templates.items()}
+    ans = {}
+
+    def resolve(name, seen):
+        if name in ans:
+            return ans[name]
+        deps = direct[name]
+        if deps is None or name in seen:
+            return None
+        seen = seen | {name}
+        result = set()
+        for dep in deps:
+            if dep in templates:
+                sub = resolve(dep, seen)
+                if sub is None:
+                    return None
+                result.add(dep)
+                result |= sub
+                continue
+            f = fields[dep]
+            if f.is_composite or isinstance(getattr(f, 'table', None), (VirtualTable, type(None))):
+                return None
+            result.add(dep)
+            if dep + '_index' in fields:
+                result.add(dep + '_index')
+        return frozenset(result)
+
+    for name in templates:
+        ans[name] = resolve(name, set())
+    return ans
+
+
+def environment_key(names, field_metadata):
+    '''
+    A key for everything other than the data of a book that can change the
+    rendered value of a composite column: the metadata of the columns
+    involved, the interface language, the tweaks and the calibre version.
+    '''
+    data = repr((
+        VERSION, tuple(numeric_version), get_lang(), sorted(tweaks.items()),
+        [(name, field_metadata.get(name)) for name in sorted(names)]))
+    return hashlib.blake2b(data.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def fingerprint(values):
+    ' A fingerprint of the values of the fields a template depends on for one book '
+    return hashlib.blake2b(repr(values).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class Unpickler(pickle.Unpickler):
+
+    # The store lives in the library folder, which could have come from
+    # anywhere, it only ever contains builtin containers, strings and numbers
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f'Composites store contains forbidden type: {module}.{name}')
+
+
+class StoredColumn:
+
+    ' The stored values for a single composite column, not thread safe '
+
+    __slots__ = ('environment', 'store', 'values')
+
+    def __init__(self, store, environment, values):
+        self.store, self.environment, self.values = store, environment, values
+
+    def get(self, book_id, fp):
+        x = self.values.get(book_id)
+        if x is not None and x[0] == fp:
+            return x[1]
+
+    def set(self, book_id, fp, val):
+        self.values[book_id] = fp, val
+        self.store.dirty = True
+
+
+class CompositeStore:
+
+    def __init__(self, path):
+        self.dirty = False
+        self.columns = {}
+        self.loaded = self.load(path) if path else {}
+
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError('Composites store has an unknown format')
+                data = Unpickler(f).load()
+            if data['version'] != VERSION:
+                return {}
+            return data['columns']
+        except FileNotFoundError:
+            pass
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            with suppress(OSError):
+                os.remove(path)
+        return {}
+
+    def column(self, name, environment):
+        ' Return the stored values for the column, discarding them if environment has changed '
+        env, values = self.loaded.pop(name, (None, None))
+        if env != environment or not isinstance(values, dict):
+            values = {}
+            self.dirty = True
+        ans = self.columns[name] = StoredColumn(self, environment, values)
+        return ans
+
+    def save(self, path, all_book_ids):
+        ' Atomically write the stored values of books in all_book_ids to path, if anything has changed '
+        if not path or not self.dirty:
+            return
+        columns = {}
+        for name, col in self.columns.items():
+            columns[name] = col.environment, {k: v for k, v in col.values.items() if k in all_book_ids}
+        data = {'version': VERSION, 'columns': columns}
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='metadata-', suffix='.composites-tmp', delete=False) as f:
+            try:
+                f.write(MAGIC)
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        try:
+            atomic_rename(f.name, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(f.name)
+            raise
+        self.dirty = False
@@ -10,6 +10,10 @@ DEFAULT_TRASH_EXPIRY_TIME_SECONDS = 14 * 86400
 TRASH_DIR_NAME = '.caltrash'
 NOTES_DIR_NAME = '.calnotes'
 NOTES_DB_NAME = 'notes.db'
+TABLES_SNAPSHOT_NAME = 'metadata.snapshot'
+COMPOSITES_STORE_NAME = 'metadata.composites'
+# Files being added to the library are copied into files with this prefix in the library folder
+STAGED_FILE_PREFIX = '.calstaged-'
 DATA_DIR_NAME = 'data'
 DATA_FILE_PATTERN = f'{DATA_DIR_NAME}/**/*'
 BOOK_ID_PATH_TEMPLATE = ' ({})'
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An index of the data used to detect duplicate books: titles, fuzzy titles,
+authors and identifiers. It is built the first time it is needed and then
+kept up to date by re-indexing only the books that have changed, so that
+checking whether a book is a duplicate is a few dictionary lookups instead of
+a scan of the whole library.
+'''
+
+from collections import defaultdict
+from threading import Lock
+
+from calibre.db.utils import fuzzy_title
+from calibre.ebooks.metadata import check_isbn
+from calibre.utils.icu import lower as icu_lower
+from calibre.utils.localization import canonicalize_lang
+
+# The fields whose values are indexed
+INDEXED_FIELDS = frozenset(('title', 'authors', 'languages', 'identifiers'))
+
+
+def identifier_keys(identifiers):
+    for typ, val in (identifiers or {}).items():
+        typ, val = icu_lower(typ or '').strip(), (val or '').strip()
+        if typ == 'isbn':
+            val = check_isbn(val) or val
+        if typ and val:
+            yield typ, icu_lower(val)
+
+
+def normalized_languages(languages):
+    return tuple(x for x in map(canonicalize_lang, languages or ()) if x and x != 'und')
+
+
+class DuplicateIndex:
+
+    '''
+    Changes to the data are recorded by :meth:`invalidate` and the changed
+    books are re-indexed the next time the index is queried. The query
+    methods must be called with at least the read lock of the Cache held, as
+    they read the tables of the fields.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.book_keys = None  # book_id -> (title, fuzzy title, authors, identifiers)
+        self.stale = set()
+        self.titles, self.fuzzy_titles = defaultdict(set), defaultdict(set)
+        self.authors, self.identifiers = defaultdict(set), defaultdict(set)
+
+    def invalidate(self, book_ids=None, fields=None):
+        '''
+        Record that the data for book_ids (all books if None) in fields (all
+        fields if None) has changed.
+        '''
+        if fields is not None and INDEXED_FIELDS.isdisjoint(fields):
+            return
+        with self.lock:
+            if self.book_keys is None:
+                return
+            if book_ids is None:
+                self.book_keys = None
+                self.stale.clear()
+                for m in (self.titles, self.fuzzy_titles, self.authors, self.identifiers):
+                    m.clear()
+            else:
+                self.stale.update(book_ids)
+
+    def keys_for_book(self, book_id, fields):
+        title = fields['title'].table.book_col_map.get(book_id) or ''
+        at = fields['authors'].table
+        authors = tuple(icu_lower(at.id_map[aid]) for aid in at.book_col_map.get(book_id, ()))
+        identifiers = tuple(identifier_keys(fields['identifiers'].table.book_col_map.get(book_id)))
+        return icu_lower(title), fuzzy_title(title), authors, identifiers
+
+    def add_book(self, book_id, keys):
+        title, ftitle, authors, identifiers = self.book_keys[book_id] = keys
+        self.titles[title].add(book_id)
+        self.fuzzy_titles[ftitle].add(book_id)
+        for a in authors:
+            self.authors[a].add(book_id)
+        for key in identifiers:
+            self.identifiers[key].add(book_id)
+
+    def remove_book(self, book_id):
+        keys = self.book_keys.pop(book_id, None)
+        if keys is None:
+            return
+        title, ftitle, authors, identifiers = keys
+
+        def discard(m, key):
+            s = m.get(key)
+            if s is not None:
+                s.discard(book_id)
+                if not s:
+                    del m[key]
+
+        discard(self.titles, title)
+        discard(self.fuzzy_titles, ftitle)
+        for a in authors:
+            discard(self.authors, a)
+        for key in identifiers:
+            discard(self.identifiers, key)
+
+    def refresh(self, fields):
+        ' Must be called with self.lock held '
+        book_col_map = fields['title'].table.book_col_map
+        if self.book_keys is None:
+            self.book_keys = {}
+            for book_id in book_col_map:
+                self.add_book(book_id, self.keys_for_book(book_id, fields))
+        elif self.stale:
+            for book_id in self.stale:
+                self.remove_book(book_id)
+                if book_id in book_col_map:
+                    self.add_book(book_id, self.keys_for_book(book_id, fields))
+        self.stale.clear()
+
+    def has_title(self, fields, title):
+        ' Return True iff a book has the specified title, compared case insensitively '
+        with self.lock:
+            self.refresh(fields)
+            return bool(self.titles.get(icu_lower(title).strip()))
+
+    def identical_books(self, fields, mi):
+        '''
+        Return the set of books that have a superset of the authors of mi and
+        the same fuzzy title. Books whose languages differ from the languages
+        of mi, when both are known, are excluded.
+        '''
+        if not mi.authors:
+            return set()
+        with self.lock:
+            self.refresh(fields)
+            ans = set(self.fuzzy_titles.get(fuzzy_title(mi.title or ''), ()))
+            for a in mi.authors:
+                if not ans:
+                    break
+                ans &= self.authors.get(icu_lower(str(a)), set())
+        langq = normalized_languages(mi.languages)
+        if not langq or not ans:
+            return ans
+        lang_map = fields['languages'].table.book_col_map
+        return {book_id for book_id in ans if not lang_map.get(book_id) or lang_map[book_id] == langq}
+
+    def books_with_identifiers(self, fields, identifiers):
+        ' Return the set of books that share at least one of the specified identifiers '
+        keys = tuple(identifier_keys(identifiers))
+        with self.lock:
+            self.refresh(fields)
+            ans = set()
+            for key in keys:
+                ans |= self.identifiers.get(key, set())
+            return ans
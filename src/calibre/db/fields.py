@@ -11,6 +11,8 @@ from collections.abc import Iterable
 from functools import partial
 from threading import Lock
 
+from calibre.db.columns import BookColumn
+from calibre.db.idset import intersector
 from calibre.db.tables import MANY_MANY, MANY_ONE, ONE_ONE, null
 from calibre.db.utils import atof, force_to_bool
 from calibre.db.write import Writer
@@ -213,9 +215,15 @@ class OneToOneField(Field):
         return iter(self.table.book_col_map)
 
     def sort_keys_for_books(self, get_metadata, lang_map):
-        bcmg = self.table.book_col_map.get
+        bcm = self.table.book_col_map
+        bcmg = bcm.get
         dk = self._default_sort_key
         sk = self._sort_key
+        if isinstance(bcm, BookColumn):
+            if sk is IDENTITY and dk is not None:
+                def sk(val):
+                    return dk if val is None else val
+            return bcm.sort_key_function(sk, dk)
         if sk is IDENTITY:
             if dk is not None:
                 def none_safe_key(book_id):
@@ -229,6 +237,10 @@ class OneToOneField(Field):
 
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         cbm = self.table.book_col_map
+        if isinstance(cbm, BookColumn):
+            for book_id, val in cbm.iter_values(candidates, default_value):
+                yield val, {book_id}
+            return
         for book_id in candidates:
             yield cbm.get(book_id, default_value), {book_id}
 
@@ -243,6 +255,10 @@ class CompositeField(OneToOneField):
 
         self._render_cache = {}
         self._lock = Lock()
+        # The set of fields the template depends on, None if not known, see
+        # calibre.db.composites
+        self.dependencies = None
+        self.store = self.fingerprint = None
         m = self.metadata
         self._composite_name = '#' + m['label']
         try:
@@ -296,16 +312,44 @@ class CompositeField(OneToOneField):
     def bool_sort_key(self, val):
         return self._bool_sort_key(force_to_bool(val))
 
-    def __render_composite(self, book_id, mi, formatter, template_cache):
-        ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
+    def set_dependencies(self, dependencies, store=None, fingerprint=None):
+        '''
+        Set the fields the template depends on and optionally the
+        :class:`calibre.db.composites.StoredColumn` used to remember rendered
+        values across restarts, with fingerprint a function mapping book_id
+        to a fingerprint of the values of those fields.
+        '''
+        with self._lock:
+            self.dependencies = dependencies
+            self.store, self.fingerprint = store, fingerprint
+
+    def depends_on(self, fields):
+        ' Return True if the value of this column can change when the specified fields change '
+        return fields is None or self.dependencies is None or not self.dependencies.isdisjoint(fields)
+
+    def __render(self, mi, formatter, template_cache, template_functions=None):
         db = self.db_weakref()
-        ans = formatter.safe_format(
+        return formatter.safe_format(
             self.metadata['display']['composite_template'], mi, _('TEMPLATE ERROR'),
             mi, column_name=self._composite_name, template_cache=template_cache,
-            template_functions=self.get_template_functions(),
+            template_functions=self.get_template_functions() if template_functions is None else template_functions,
             global_vars={rendering_composite_name:'1'}, database=db).strip()
+
+    def __render_composite(self, book_id, mi, formatter, template_cache):
+        ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
+        fp = None
+        if self.store is not None:
+            fp = self.fingerprint(book_id)
+            with self._lock:
+                ans = self.store.get(book_id, fp)
+                if ans is not None:
+                    self._render_cache[book_id] = ans
+                    return ans
+        ans = self.__render(mi, formatter, template_cache)
         with self._lock:
             self._render_cache[book_id] = ans
+            if fp is not None:
+                self.store.set(book_id, fp, ans)
         return ans
 
     def _render_composite_with_cache(self, book_id, mi, formatter, template_cache):
@@ -335,6 +379,42 @@ class CompositeField(OneToOneField):
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    def values_for_books(self, book_ids, get_metadata):
+        '''
+        Return a dict mapping book_id to the value of this column for all the
+        specified books. Values that are not cached are looked up in the store
+        and rendered in a single batch, with the template functions fetched
+        only once and the parsed template shared by all books.
+        '''
+        with self._lock:
+            rc = self._render_cache
+            ans = {book_id: rc[book_id] for book_id in book_ids if book_id in rc}
+        missing = [book_id for book_id in book_ids if book_id not in ans]
+        if not missing:
+            return ans
+        fps = {}
+        if self.store is not None:
+            fps = {book_id: self.fingerprint(book_id) for book_id in missing}
+            with self._lock:
+                get = self.store.get
+                stored = {book_id: get(book_id, fp) for book_id, fp in fps.items()}
+                stored = {k: v for k, v in stored.items() if v is not None}
+                rc.update(stored)
+            ans.update(stored)
+            missing = [book_id for book_id in missing if book_id not in stored]
+        template_functions = self.get_template_functions()
+        rendered = {}
+        for book_id in missing:
+            mi = get_metadata(book_id)
+            rendered[book_id] = self.__render(mi, mi.formatter, mi.template_cache, template_functions)
+        with self._lock:
+            rc.update(rendered)
+            if self.store is not None:
+                for book_id, val in rendered.items():
+                    self.store.set(book_id, fps[book_id], val)
+        ans.update(rendered)
+        return ans
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -345,8 +425,7 @@ class CompositeField(OneToOneField):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in iteritems(self.values_for_books(candidates, get_metadata)):
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
             found = False
             for v in vals:
@@ -363,8 +442,7 @@ class CompositeField(OneToOneField):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in iteritems(self.values_for_books(candidates, get_metadata)):
             if splitter:
                 length = len([vv.strip() for vv in vals.split(splitter) if vv.strip()])
             elif vals.strip():
@@ -378,8 +456,7 @@ class CompositeField(OneToOneField):
                                  is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in iteritems(self.values_for_books(book_ids, get_metadata)):
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
             for val in vals:
                 if val:
@@ -396,8 +473,7 @@ class CompositeField(OneToOneField):
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in iteritems(self.values_for_books(book_ids, get_metadata)):
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
             if value in vals:
                 ans.add(book_id)
@@ -516,14 +592,18 @@ class ManyToOneField(Field):
 
     def sort_keys_for_books(self, get_metadata, lang_map):
         sk_map = LazySortMap(self._default_sort_key, self._sort_key, self.table.id_map)
-        bcmg = self.table.book_col_map.get
+        bcm = self.table.book_col_map
+        if isinstance(bcm, BookColumn):
+            return bcm.sort_key_function(sk_map, None)
+        bcmg = bcm.get
         return lambda book_id: sk_map(bcmg(book_id, None))
 
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         cbm = self.table.col_book_map
         empty = set()
+        restrict = intersector(candidates)
         for item_id, val in iteritems(self.table.id_map):
-            book_ids = cbm.get(item_id, empty).intersection(candidates)
+            book_ids = restrict(cbm.get(item_id, empty))
             if book_ids:
                 yield val, book_ids
 
@@ -573,8 +653,18 @@ class ManyToManyField(Field):
 
     def sort_keys_for_books(self, get_metadata, lang_map):
         sk_map = LazySortMap(self._default_sort_key, self._sort_key, self.table.id_map)
-        bcmg = self.table.book_col_map.get
+        bcm = self.table.book_col_map
+        bcmg = bcm.get
         dsk = (self._default_sort_key,)
+        if isinstance(bcm, BookColumn):
+            # The key is computed once per distinct tuple of item ids
+            if self.sort_sort_key:
+                def ids_key(item_ids):
+                    return tuple(sorted(sk_map(x) for x in item_ids or ())) or dsk
+            else:
+                def ids_key(item_ids):
+                    return tuple(sk_map(x) for x in item_ids or ()) or dsk
+            return bcm.sort_key_function(ids_key, ())
         if self.sort_sort_key:
             def sk(book_id):
                 return tuple(sorted(sk_map(x) for x in bcmg(book_id, ()))) or dsk
@@ -586,8 +676,9 @@ class ManyToManyField(Field):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         cbm = self.table.col_book_map
         empty = set()
+        restrict = intersector(candidates)
         for item_id, val in iteritems(self.table.id_map):
-            book_ids = cbm.get(item_id, empty).intersection(candidates)
+            book_ids = restrict(cbm.get(item_id, empty))
             if book_ids:
                 yield val, book_ids
 
@@ -761,8 +852,9 @@ class SeriesField(ManyToOneField):
         ts = title_sort
         empty = set()
         lang_map = {k:v[0] if v else None for k, v in iteritems(lang_map)}
+        restrict = intersector(candidates)
         for item_id, val in iteritems(self.table.id_map):
-            book_ids = cbm.get(item_id, empty).intersection(candidates)
+            book_ids = restrict(cbm.get(item_id, empty))
             if book_ids:
                 lang_counts = Counter()
                 for book_id in book_ids:
@@ -4,10 +4,11 @@
 
 import builtins
 import hashlib
+import json
 import os
 import sys
+from collections import OrderedDict
 from contextlib import suppress
-from itertools import count
 from threading import Lock
 
 import apsw
@@ -19,6 +20,9 @@ from calibre.utils.date import EPOCH, utcnow
 from .pool import Pool
 from .schema_upgrade import SchemaUpgrade
 
+# The number of searches whose ranked results are cached
+SEARCH_CACHE_SIZE = 16
+
 
 def print(*args, **kwargs):
     kwargs['file'] = sys.__stdout__
@@ -31,7 +35,8 @@ class FTS:
         self.dbref = dbref
         self.pool = Pool(dbref)
         self.init_lock = Lock()
-        self.temp_table_counter = count()
+        self.search_cache = OrderedDict()
+        self.search_cache_counter = -1
 
     def initialize(self, conn):
         needs_dirty = False
@@ -98,7 +103,7 @@ class FTS:
         else:
             conn.execute('DELETE FROM books_text WHERE book=? AND format=?', (book_id, fmt.upper()))
 
-    def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', err_msg=''):
+    def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', err_msg='', spine_hashes=''):
         conn = self.get_connection()
         ts = (utcnow() - EPOCH).total_seconds()
         fmt = fmt.upper()
@@ -111,9 +116,9 @@ class FTS:
         elif text:
             conn.execute(
                 'INSERT OR REPLACE INTO fts_db.books_text '
-                '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash) VALUES '
-                '(?, ?, ?, ?, ?, ?, ?, ?)', (
-                    book_id, ts, fmt, fmt_size, fmt_hash, text, len(text), text_hash))
+                '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash, spine_hashes) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    book_id, ts, fmt, fmt_size, fmt_hash, text, len(text), text_hash, spine_hashes))
         else:
             conn.execute('DELETE FROM fts_db.dirtied_formats WHERE book=? AND format=?', (book_id, fmt))
 
@@ -123,38 +128,123 @@ class FTS:
             return book_id, fmt
         return None, None
 
+    def update_format_hash(self, row_id, fmt_size, fmt_hash, spine_hashes):
+        # Record that the format changed without its text changing
+        conn = self.get_connection()
+        ts = (utcnow() - EPOCH).total_seconds()
+        conn.execute('UPDATE fts_db.books_text SET timestamp=?, format_size=?, format_hash=?, spine_hashes=? WHERE id=?', (
+            ts, fmt_size, fmt_hash, spine_hashes, row_id))
+
+    def stored_spine(self, book_id, fmt):
+        '''
+        Return the id of the books_text row for the format and the list of
+        (name, hash, text size) of its spine items, which is empty if they
+        are unknown or do not match the stored text.
+        '''
+        from .text import PART_SEPARATOR
+        conn = self.get_connection()
+        for row_id, spine_hashes, text_size, err_msg in conn.get(
+                'SELECT id, spine_hashes, text_size, err_msg FROM fts_db.books_text WHERE book=? AND format=?', (book_id, fmt)):
+            if err_msg or not spine_hashes:
+                return row_id, []
+            try:
+                spine = [(name, h, size) for name, h, size in json.loads(spine_hashes)]
+            except Exception:
+                return row_id, []
+            sizes = [size for name, h, size in spine if size]
+            if sum(sizes) + len(PART_SEPARATOR) * max(0, len(sizes) - 1) != text_size:
+                return row_id, []
+            return row_id, spine
+        return None, []
+
+    def text_from_parts(self, book_id, fmt, parts):
+        # Return the text of the book and its spine hashes from the (name,
+        # hash, text) of its spine items, using the stored text for the spine
+        # items whose text is None. Returns None for the text if the stored
+        # text is no longer available.
+        from .text import join_parts, split_text
+        if any(text is None for name, h, text in parts):
+            row_id, spine = self.stored_spine(book_id, fmt)
+            stored = {}
+            if spine:
+                conn = self.get_connection()
+                old_text = conn.get('SELECT searchable_text FROM fts_db.books_text WHERE id=?', (row_id,), all=False)
+                texts = split_text(old_text or '', [size for name, h, size in spine])
+                if texts is not None:
+                    stored = {(name, h): text for (name, h, size), text in zip(spine, texts)}
+            parts = tuple((name, h, stored.get((name, h)) if text is None else text) for name, h, text in parts)
+            if any(text is None for name, h, text in parts):
+                return None, ''
+        spine_hashes = ''
+        if parts and all(h for name, h, text in parts):
+            spine_hashes = json.dumps([(name, h, len(text)) for name, h, text in parts])
+        return join_parts((name, text) for name, h, text in parts), spine_hashes
+
     def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
+        '''
+        Store the text extracted from a format. text is either a string or a
+        sequence of (name, hash, text) for the spine items of the format,
+        where the text is None for spine items whose stored text is unchanged.
+        '''
         conn = self.get_connection()
+        spine_hashes = ''
+        if not isinstance(text, str):
+            text, spine_hashes = self.text_from_parts(book_id, fmt, text)
+            if text is None:
+                # The text of the unchanged spine items is no longer stored,
+                # so extract the whole format again
+                conn.execute("UPDATE fts_db.books_text SET spine_hashes='' WHERE book=? AND format=?", (book_id, fmt))
+                conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=FALSE WHERE book=? AND format=?', (book_id, fmt))
+                return
         text_hash = ''
         if text:
             text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
-            for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
+            for (row_id,) in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
+                self.update_format_hash(row_id, fmt_size, fmt_hash, spine_hashes)
                 text = ''
                 break
-        self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg)
+        self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg, spine_hashes)
+
+    def commit_results(self, results):
+        # results is a sequence of the arguments to commit_result(), which are
+        # all written in a single transaction
+        conn = self.get_connection()
+        with conn:
+            for args in results:
+                self.commit_result(*args)
 
     def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+        from .text import spine_item_hashes
         conn = self.get_connection()
         fmt = fmt.upper()
         for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND format_size=? AND format_hash=?', (
                 book_id, fmt, fmt_size, fmt_hash)):
             break
         else:
-            self.pool.add_job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
-            conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=TRUE WHERE book=? AND format=?', (book_id, fmt))
-            return True
+            spine, skip, text_changed = spine_item_hashes(path), (), True
+            if spine:
+                row_id, stored = self.stored_spine(book_id, fmt)
+                if stored and [(name, h) for name, h, size in stored] == list(spine):
+                    # None of the spine items changed, only metadata or
+                    # other resources such as images, so the text is unchanged
+                    self.update_format_hash(row_id, fmt_size, fmt_hash, json.dumps(stored))
+                    text_changed = False
+                else:
+                    unchanged = {(name, h) for name, h, size in stored}
+                    skip = tuple(name for name, h in spine if (name, h) in unchanged)
+            if text_changed:
+                self.pool.add_job(book_id, fmt, path, fmt_size, fmt_hash, start_time, spine, skip)
+                conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=TRUE WHERE book=? AND format=?', (book_id, fmt))
+                return True
         self.remove_dirty(book_id, fmt)
         with suppress(OSError):
             os.remove(path)
         return False
 
-    def search(self,
-        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids,
-        return_text=True, process_each_result=None
+    def execute_search(
+        self, fts_engine_query, use_stemming, restrict_to_book_ids=None, restrict_to_ids=None,
+        highlight_start=None, highlight_end=None, snippet_size=None, return_text=True
     ):
-        if restrict_to_book_ids is not None and not restrict_to_book_ids:
-            return
-        fts_engine_query = unicode_normalize(fts_engine_query)
         fts_table = 'books_fts' + ('_stemmed' if use_stemming else '')
         data = []
         if return_text:
@@ -172,33 +262,94 @@ class FTS:
         query = 'SELECT {0}.id, {0}.book, {0}.format {1} FROM {0} '.format('books_text', text)
         query += f' JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid'
         query += ' WHERE '
-        conn = self.get_connection()
-        temp_table_name = ''
+        # The restrictions are passed as a single JSON array rather than
+        # inserted into a temporary table, as they can be very large
         if restrict_to_book_ids:
-            temp_table_name = f'fts_restrict_search_{next(self.temp_table_counter)}'
-            conn.execute(f'CREATE TABLE temp.{temp_table_name}(x INTEGER)')
-            conn.executemany(f'INSERT INTO temp.{temp_table_name} VALUES (?)', tuple((x,) for x in restrict_to_book_ids))
-            query += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
+            query += ' fts_db.books_text.book IN (SELECT value FROM json_each(?)) AND '
+            data.append(json.dumps(tuple(restrict_to_book_ids)))
+        if restrict_to_ids:
+            query += ' fts_db.books_text.id IN (SELECT value FROM json_each(?)) AND '
+            data.append(json.dumps(tuple(restrict_to_ids)))
         query += f' "{fts_table}" MATCH ?'
         data.append(fts_engine_query)
         query += f' ORDER BY {fts_table}.rank '
-        if temp_table_name:
-            query += f'; DROP TABLE temp.{temp_table_name}'
+        conn = self.get_connection()
         try:
-            for record in conn.execute(query, tuple(data)):
-                result = {
-                    'id': record[0],
-                    'book_id': record[1],
-                    'format': record[2],
-                    'text': record[3] if return_text else '',
-                }
-                if process_each_result is not None:
-                    result = process_each_result(result)
-                ret = yield result
-                if ret is True:
-                    break
+            yield from conn.execute(query, tuple(data))
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e) from e
 
+    def ranked_results(self, fts_engine_query, use_stemming, restrict_to_book_ids):
+        '''
+        Return the (id, book_id, format) of every match for the query, best
+        matches first. The results are cached until the indexed text changes.
+        '''
+        conn = self.get_connection()
+        if self.search_cache_counter != conn.fts_change_counter:
+            self.search_cache.clear()
+            self.search_cache_counter = conn.fts_change_counter
+        key = fts_engine_query, use_stemming, None if restrict_to_book_ids is None else frozenset(restrict_to_book_ids)
+        ans = self.search_cache.get(key)
+        if ans is None:
+            ans = self.search_cache[key] = tuple(self.execute_search(
+                fts_engine_query, use_stemming, restrict_to_book_ids=restrict_to_book_ids, return_text=False))
+            while len(self.search_cache) > SEARCH_CACHE_SIZE:
+                self.search_cache.popitem(last=False)
+        else:
+            self.search_cache.move_to_end(key)
+        return ans
+
+    def search(self,
+        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids,
+        return_text=True, process_each_result=None
+    ):
+        if restrict_to_book_ids is not None and not restrict_to_book_ids:
+            return
+        fts_engine_query = unicode_normalize(fts_engine_query)
+        if return_text:
+            records = self.execute_search(
+                fts_engine_query, use_stemming, restrict_to_book_ids=restrict_to_book_ids,
+                highlight_start=highlight_start, highlight_end=highlight_end, snippet_size=snippet_size)
+        else:
+            records = self.ranked_results(fts_engine_query, use_stemming, restrict_to_book_ids)
+        for record in records:
+            result = {
+                'id': record[0],
+                'book_id': record[1],
+                'format': record[2],
+                'text': record[3] if return_text else '',
+            }
+            if process_each_result is not None:
+                result = process_each_result(result)
+            ret = yield result
+            if ret is True:
+                break
+
+    def search_page(self,
+        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids,
+        offset=0, limit=None, return_text=True
+    ):
+        '''
+        Return the total number of matches and the results from offset to
+        offset + limit in the ranked matches. The text of a result is only
+        calculated for the results in the page.
+        '''
+        if restrict_to_book_ids is not None and not restrict_to_book_ids:
+            return 0, ()
+        fts_engine_query = unicode_normalize(fts_engine_query)
+        ranked = self.ranked_results(fts_engine_query, use_stemming, restrict_to_book_ids)
+        page = ranked[offset:] if limit is None else ranked[offset:offset+limit]
+        texts = {}
+        if return_text and page:
+            texts = {record[0]: record[3] for record in self.execute_search(
+                fts_engine_query, use_stemming, restrict_to_ids=tuple(r[0] for r in page),
+                highlight_start=highlight_start, highlight_end=highlight_end, snippet_size=snippet_size)}
+        return len(ranked), tuple({
+            'id': record[0],
+            'book_id': record[1],
+            'format': record[2],
+            'text': texts.get(record[0], ''),
+        } for record in page)
+
     def shutdown(self):
         self.pool.shutdown()
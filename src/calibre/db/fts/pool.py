@@ -2,12 +2,14 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import json
 import os
 import subprocess
 import sys
+import tempfile
 import traceback
 from contextlib import suppress
-from queue import Queue
+from queue import Empty, Queue
 from threading import Event, Thread
 from time import monotonic
 
@@ -20,39 +22,60 @@ quit = object()
 
 class Job:
 
-    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, spine=None, skip=()):
         self.book_id = book_id
         self.fmt = fmt
         self.fmt_size = fmt_size
         self.fmt_hash = fmt_hash
         self.path = path
         self.start_time = start_time
+        # The (name, hash) of the spine items and the names of the spine
+        # items whose text is unchanged and need not be extracted
+        self.spine = spine
+        self.skip = skip
 
 
 class Result:
 
-    def __init__(self, job, err_msg=''):
+    def __init__(self, job, err_msg='', parts=()):
         self.book_id = job.book_id
         self.fmt = job.fmt
         self.fmt_size = job.fmt_size
         self.fmt_hash = job.fmt_hash
         self.ok = not bool(err_msg)
         self.start_time = job.start_time
-        if self.ok:
-            with open(job.path + '.txt', 'rb') as src:
-                try:
-                    self.text = src.read().decode('utf-8', 'replace')
-                except Exception:
-                    self.ok = False
-                    self.text = traceback.format_exc()
-        else:
-            self.text = err_msg
+        self.err_msg = err_msg
+        hashes = dict(job.spine or ())
+        self.parts = tuple((name, hashes.get(name, ''), text) for name, text in parts)
+
+
+def read_responses(stdout, responses):
+    # Read the results written by the serve() loop of an extraction process,
+    # putting None into responses once the process has exited
+    try:
+        with stdout:
+            while True:
+                header = stdout.readline()
+                if not header:
+                    break
+                ok, size = map(int, header.split())
+                data = stdout.read(size)
+                if len(data) < size:
+                    break
+                responses.put((bool(ok), data.decode('utf-8', 'replace')))
+    except (OSError, ValueError):
+        pass
+    finally:
+        responses.put(None)
 
 
 class Worker(Thread):
 
-    code_to_exec = 'from calibre.db.fts.text import main; main({!r})'
+    code_to_exec = 'from calibre.db.fts.text import serve; serve()'
     max_duration = 30  # minutes
+    # The extraction process is restarted after this many books so that
+    # memory leaked by the input plugins is released
+    max_jobs_per_process = 256
     poll_interval = 0.1  # seconds
 
     def __init__(self, jobs_queue, supervise_queue):
@@ -62,61 +85,97 @@ class Worker(Thread):
         self.supervise_queue = supervise_queue
         self.keep_going = True
         self.working = False
+        self.process = self.responses = self.error_log = None
+        self.jobs_done_by_process = 0
 
     def run(self):
-        while self.keep_going:
-            x = self.jobs_queue.get()
-            if x is quit:
-                break
-            self.working = True
-            try:
-                res = self.run_job(x)
-                if res is not None and self.keep_going:
-                    self.supervise_queue.put(res)
-            except Exception:
-                tb = traceback.format_exc()
-                traceback.print_exc()
-                if self.keep_going:
-                    self.supervise_queue.put(Result(x, tb))
-            finally:
-                self.working = False
+        try:
+            while self.keep_going:
+                x = self.jobs_queue.get()
+                if x is quit:
+                    break
+                self.working = True
+                try:
+                    res = self.run_job(x)
+                    if res is not None and self.keep_going:
+                        self.supervise_queue.put(res)
+                except Exception:
+                    tb = traceback.format_exc()
+                    traceback.print_exc()
+                    self.stop_process(kill=True)
+                    if self.keep_going:
+                        self.supervise_queue.put(Result(x, tb))
+                finally:
+                    self.working = False
+        finally:
+            self.stop_process(kill=not self.keep_going)
+
+    def start_process(self):
+        self.error_log = tempfile.TemporaryFile()
+        self.process = start_pipe_worker(
+            self.code_to_exec, stdout=subprocess.PIPE, stderr=self.error_log, stdin=subprocess.PIPE, priority='low')
+        self.responses = Queue()
+        self.jobs_done_by_process = 0
+        Thread(name='FTSWorkerReader', daemon=True, target=read_responses, args=(self.process.stdout, self.responses)).start()
+
+    def stop_process(self, kill=False):
+        p, self.process = self.process, None
+        if p is None:
+            return
+        with suppress(OSError):
+            p.stdin.close()
+        if not kill:
+            with suppress(subprocess.TimeoutExpired):
+                p.wait(1)
+        if p.returncode is None:
+            p.kill()
+            p.wait()
+        self.error_log.close()
+        self.error_log = None
+
+    def process_errors(self):
+        self.error_log.seek(0, os.SEEK_END)
+        self.error_log.seek(max(0, self.error_log.tell() - 8192))
+        return self.error_log.read().decode('utf-8', 'replace').strip()
 
     def run_job(self, job):
         time_limit = monotonic() + (self.max_duration * 60)
-        txtpath = job.path + '.txt'
-        errpath = job.path + '.error'
         try:
-            with open(errpath, 'wb') as error:
-                p = start_pipe_worker(
-                    self.code_to_exec.format(job.path),
-                    stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
-                )
-                while self.keep_going and monotonic() <= time_limit:
-                    with suppress(subprocess.TimeoutExpired):
-                        p.wait(self.poll_interval)
-                        break
-                if p.returncode is None:
-                    p.kill()
-                    if not self.keep_going:
-                        return
-                    return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
-                        job.fmt, human_readable(job.fmt_size)))
-                if os.path.exists(txtpath):
-                    return Result(job)
-            with open(errpath, 'rb') as f:
-                err = f.read().decode('utf-8', 'replace')
+            if self.process is None:
+                self.start_process()
+            with suppress(OSError):  # a process that has exited is detected when reading its response
+                self.process.stdin.write(json.dumps({'path': job.path, 'skip': job.skip}).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+            while self.keep_going and monotonic() <= time_limit:
+                with suppress(Empty):
+                    response = self.responses.get(timeout=self.poll_interval)
+                    break
+            else:
+                self.stop_process(kill=True)
+                if not self.keep_going:
+                    return
+                return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
+                    job.fmt, human_readable(job.fmt_size)))
+            if response is None:
+                err = '\n\n'.join(filter(None, (_('The text extraction process exited unexpectedly'), self.process_errors())))
+                self.stop_process(kill=True)
                 return Result(job, err)
+            ok, text = response
+            self.jobs_done_by_process += 1
+            if self.jobs_done_by_process >= self.max_jobs_per_process:
+                self.stop_process()
+            return Result(job, parts=json.loads(text)) if ok else Result(job, text)
         finally:
             with suppress(OSError):
                 os.remove(job.path)
-            with suppress(OSError):
-                os.remove(txtpath)
-            with suppress(OSError):
-                os.remove(errpath)
 
 
 class Pool:
 
+    # The largest number of results committed to the database in a single
+    # transaction
+    max_results_per_commit = 64
+
     def __init__(self, dbref):
         self.max_workers = 1
         self.jobs_queue = Queue()
@@ -178,22 +237,21 @@ class Pool:
         self.initialize()
         self.supervise_queue.put(check_for_work)
 
-    def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, spine=None, skip=()):
         self.initialize()
-        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
+        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time, spine, skip)
         self.jobs_queue.put(job)
 
-    def commit_result(self, result):
-        text = result.text
-        err_msg = ''
-        if not result.ok:
-            print(f'Failed to get text from book_id: {result.book_id} format: {result.fmt}', file=sys.stderr)
-            print(text, file=sys.stderr)
-            err_msg = text
-            text = ''
+    def commit_results(self, results):
+        commits = []
+        for result in results:
+            if not result.ok:
+                print(f'Failed to get text from book_id: {result.book_id} format: {result.fmt}', file=sys.stderr)
+                print(result.err_msg, file=sys.stderr)
+            commits.append((result.book_id, result.fmt, result.fmt_size, result.fmt_hash, result.parts, result.err_msg, result.start_time))
         db = self.dbref()
         if db is not None:
-            db.commit_fts_result(result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time)
+            db.commit_fts_results(commits)
 
     def shutdown(self):
         if self.initialized.is_set():
@@ -219,6 +277,21 @@ class Pool:
         if db is not None:
             db.queue_next_fts_job()
 
+    def ready_results(self, first):
+        # Gather the results that are already waiting so that they are
+        # committed in a single transaction
+        results = [first]
+        while len(results) < self.max_results_per_commit:
+            try:
+                x = self.supervise_queue.get_nowait()
+            except Empty:
+                break
+            if x is quit:
+                return results, True
+            if isinstance(x, Result):
+                results.append(x)
+        return results, False
+
     def supervise(self):
         while self.keep_going:
             x = self.supervise_queue.get()
@@ -228,7 +301,10 @@ class Pool:
                 elif x is quit:
                     break
                 elif isinstance(x, Result):
-                    self.commit_result(x)
+                    results, stop = self.ready_results(x)
+                    self.commit_results(results)
+                    if stop:
+                        break
                     self.do_check_for_work()
             except Exception:
                 traceback.print_exc()
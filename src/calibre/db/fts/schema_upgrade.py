@@ -37,3 +37,21 @@ class SchemaUpgrade:
     @user_version.setter
     def user_version(self, val):
         self.conn.execute(f'PRAGMA fts_db.user_version={val}')
+
+    def upgrade_version_1(self):
+        # Store the hashes of the spine items of formats, so that only the
+        # spine items that changed have their text extracted again. The text
+        # is only re-indexed when it changes, so that formats whose text did
+        # not change can be updated without re-indexing.
+        self.conn.execute('''
+            ALTER TABLE fts_db.books_text ADD COLUMN spine_hashes TEXT NOT NULL DEFAULT '';
+            DROP TRIGGER fts_db.books_fts_update_trg;
+            CREATE TRIGGER fts_db.books_fts_update_trg AFTER UPDATE OF searchable_text ON fts_db.books_text
+            BEGIN
+                INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+                INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+                INSERT INTO books_fts_stemmed(books_fts_stemmed, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+                INSERT INTO books_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+                DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+            END;
+        ''')
@@ -75,31 +75,135 @@ def pdftotext(path):
     return clean_ascii_chars(raw).decode('utf-8', 'replace')
 
 
-def extract_text(pathtoebook):
+def normalize_text(text):
+    return unicodedata.normalize('NFC', text).replace('\u00ad', '')
+
+
+# The separator between the text of consecutive spine items
+PART_SEPARATOR = '\n\n\n'
+# Formats that are ZIP files whose spine items are extracted unchanged, so
+# that the ZIP directory can be used to find the spine items that changed
+ZIP_SPINE_FORMATS = frozenset(('EPUB', 'KEPUB'))
+
+
+def join_parts(parts):
+    return PART_SEPARATOR.join(filter(None, (text for name, text in parts)))
+
+
+def split_text(text, sizes):
+    '''
+    Split text created by join_parts() into the text of its parts, given the
+    length of the text of every part. Returns None if the sizes do not match
+    the text.
+    '''
+    ans, pos = [], 0
+    for size in sizes:
+        if size and pos:
+            if text[pos:pos + len(PART_SEPARATOR)] != PART_SEPARATOR:
+                return None
+            pos += len(PART_SEPARATOR)
+        ans.append(text[pos:pos + size])
+        pos += size
+    return ans if pos == len(text) else None
+
+
+def spine_item_hashes(pathtoebook):
+    '''
+    Return the (name, hash) of every spine item of a book in one of the
+    ZIP_SPINE_FORMATS, in the order the text is extracted. The hashes come
+    from the CRCs and sizes in the ZIP directory, so only the OPF is
+    decompressed. Returns None for other formats or unreadable books.
+    '''
+    if pathtoebook.rpartition('.')[-1].upper() not in ZIP_SPINE_FORMATS:
+        return None
+    import posixpath
+    from urllib.parse import unquote
+
+    from calibre.utils.xml_parse import safe_xml_fromstring
+    from calibre.utils.zipfile import ZipFile
+    try:
+        with ZipFile(pathtoebook) as zf:
+            container = safe_xml_fromstring(zf.read('META-INF/container.xml'))
+            opf_name = container.xpath('//*[local-name()="rootfile"]/@full-path')[0]
+            opf = safe_xml_fromstring(zf.read(opf_name))
+            manifest = {item.get('id'): item.get('href') for item in opf.xpath('//*[local-name()="manifest"]/*[local-name()="item"]')}
+            linear, non_linear = [], []
+            for itemref in opf.xpath('//*[local-name()="spine"]/*[local-name()="itemref"][@idref]'):
+                href = manifest.get(itemref.get('idref'))
+                if not href:
+                    continue
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(opf_name), unquote(href.partition('#')[0])))
+                try:
+                    info = zf.getinfo(name)
+                except KeyError:
+                    continue
+                (linear if itemref.get('linear', 'yes') == 'yes' else non_linear).append((name, f'{info.CRC:08x}:{info.file_size}'))
+            return tuple(linear + non_linear)
+    except Exception:
+        return None
+
+
+def extract_text_parts(pathtoebook, skip=frozenset()):
+    '''
+    Return the list of (name, text) for the spine items of the book. The name
+    is empty for formats that have no spine items, such as PDF. The text of
+    the spine items whose names are in skip is not extracted and is None.
+    '''
     input_fmt = pathtoebook.rpartition('.')[-1].upper()
-    ans = ''
     input_plugin = is_fmt_ok(input_fmt)
     if not input_plugin:
-        return ans
-    input_plugin = plugin_for_input_format(input_fmt)
+        return []
     if input_fmt == 'PDF':
-        ans = pdftotext(pathtoebook)
-    else:
-        with TemporaryDirectory() as tdir:
-            texts = []
-            book_fmt, opfpath, input_fmt = extract_book(pathtoebook, tdir, log=default_log)
-            input_plugin = plugin_for_input_format(input_fmt)
-            is_comic = bool(getattr(input_plugin, 'is_image_collection', False))
-            if is_comic:
-                return ''
-            container = SimpleContainer(tdir, opfpath, default_log)
-            for name, is_linear in container.spine_names:
-                texts.extend(to_text(container, name))
-            ans = '\n\n\n'.join(texts)
-    return unicodedata.normalize('NFC', ans).replace('\u00ad', '')
+        return [('', normalize_text(pdftotext(pathtoebook)))]
+    with TemporaryDirectory() as tdir:
+        book_fmt, opfpath, input_fmt = extract_book(pathtoebook, tdir, log=default_log)
+        input_plugin = plugin_for_input_format(input_fmt)
+        is_comic = bool(getattr(input_plugin, 'is_image_collection', False))
+        if is_comic:
+            return []
+        container = SimpleContainer(tdir, opfpath, default_log)
+        return [(name, None if name in skip else normalize_text(PART_SEPARATOR.join(to_text(container, name))))
+                for name, is_linear in container.spine_names]
+
+
+def extract_text(pathtoebook):
+    return join_parts(extract_text_parts(pathtoebook))
 
 
 def main(pathtoebook):
     text = extract_text(pathtoebook)
     with open(pathtoebook + '.txt', 'wb') as f:
         f.write(text.encode('utf-8'))
+
+
+def serve():
+    '''
+    Extract the text of books until stdin is closed. Every job is read from
+    stdin as a line of JSON with the path to the book and the names of the
+    spine items to skip. The list of (name, text) returned by
+    extract_text_parts() is written to stdout as JSON, preceded by a line
+    containing 1 and its length in bytes, or if extraction failed, a
+    traceback preceded by a line containing 0 and its length.
+    '''
+    import json
+    import sys
+    import traceback
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    # Conversion plugins print to stdout, so use a copy of it for the results
+    # and send anything printed to stderr instead
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        try:
+            job = json.loads(line)
+            parts = extract_text_parts(job['path'], frozenset(job['skip']))
+            data, ok = json.dumps(parts, ensure_ascii=False).encode('utf-8'), 1
+        except Exception:
+            data, ok = traceback.format_exc().encode('utf-8', 'replace'), 0
+        stdout.write(b'%d %d\n' % (ok, len(data)))
+        stdout.write(data)
+        stdout.flush()
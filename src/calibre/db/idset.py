@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact sets of book ids, stored as bitmaps.
+
+The id space is split into chunks of 65536 ids and every non-empty chunk is
+stored as a single Python integer used as a bit field, in the manner of
+roaring bitmaps. Set operations between two id sets are performed a chunk at
+a time using the integer bitwise operators, so intersecting two sets of half
+a million ids touches a few tens of kilobytes of memory and takes
+microseconds, instead of hashing every id. A set of N ids with maximum id M
+uses at most M/8 bytes, compared to around 60*N bytes for a Python set.
+'''
+
+import sys
+from collections import deque
+from collections.abc import Iterable, MutableSet, Set
+from itertools import compress, repeat
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+# Convert the output of bin() to one byte per id and back
+TO_FLAGS = bytes.maketrans(b'01', b'\0\1')
+FROM_FLAGS = b'0' + b'1' * 255
+
+
+def chunks_from_flags(flags):
+    ' Return the chunks for a bytes like object with a non-zero byte at the index of every id in the set '
+    ans = {}
+    for base in range(0, len(flags), CHUNK_SIZE):
+        v = int(flags[base:base + CHUNK_SIZE].translate(FROM_FLAGS)[::-1] or b'0', 2)
+        if v:
+            ans[base >> CHUNK_BITS] = v
+    return ans
+
+
+def chunks_for_ids(ids):
+    if isinstance(ids, FrozenIdSet):
+        return dict(ids._chunks)
+    if not isinstance(ids, (set, frozenset, list, tuple, range)):
+        ids = tuple(ids)
+    if not ids:
+        return {}
+    if min(ids) < 0:
+        raise ValueError('Book ids must not be negative')
+    limit = max(ids) + 1
+    if limit <= CHUNK_SIZE + 64 * len(ids):
+        # Dense enough to build a flag per id in a single buffer, this
+        # avoids running any Python bytecode per id
+        flags = bytearray(limit)
+        deque(map(flags.__setitem__, ids, repeat(1)), maxlen=0)
+        return chunks_from_flags(flags)
+    ans = {}
+    for x in ids:
+        key = x >> CHUNK_BITS
+        ans[key] = ans.get(key, 0) | (1 << (x & CHUNK_MASK))
+    return ans
+
+
+def intersector(candidates):
+    '''
+    Return a function that intersects ordinary sets of ids with candidates,
+    returning ordinary sets. When candidates is an id set, its bitmap is
+    expanded only once, instead of iterating over all of candidates for every
+    intersection, as set.intersection() does for arguments that are not sets.
+    '''
+    if not isinstance(candidates, FrozenIdSet):
+        return lambda ids: ids.intersection(candidates)
+    if not candidates:
+        return lambda ids: set()
+    getflag = candidates.flags((max(candidates._chunks) + 1) << CHUNK_BITS).__getitem__
+
+    def intersect(ids):
+        try:
+            return set(compress(ids, map(getflag, ids)))
+        except IndexError:  # ids larger than any in candidates
+            return {x for x in ids if x in candidates}
+    return intersect
+
+
+def _rebuild(cls, chunks):
+    return cls._from_chunks(chunks)
+
+
+class FrozenIdSet(Set):
+
+    '''
+    An immutable set of non-negative integers, usually book ids. Supports the
+    full :class:`frozenset` interface and can be compared with and combined
+    with ordinary sets. Iteration is in ascending order. An id set has the same
+    hash as a frozenset with the same contents, as they compare equal.
+    '''
+
+    __slots__ = ('_chunks', '_flags', '_hash', '_len')
+
+    def __init__(self, ids=()):
+        self._chunks = chunks_for_ids(ids)
+        self._flags, self._len, self._hash = {}, None, None
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        ans = cls.__new__(cls)
+        ans._chunks = chunks
+        ans._flags, ans._len, ans._hash = {}, None, None
+        return ans
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    @classmethod
+    def from_flags(cls, flags):
+        ' Create a set containing the indices of all non-zero bytes in flags '
+        return cls._from_chunks(chunks_from_flags(flags))
+
+    def __reduce__(self):
+        return _rebuild, (type(self), self._chunks)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({sorted(self)!r})'
+
+    def chunk_flags(self, key):
+        ans = self._flags.get(key)
+        if ans is None:
+            v = self._chunks.get(key)
+            ans = self._flags[key] = b'' if v is None else bin(v)[:1:-1].encode('ascii').translate(TO_FLAGS)
+        return ans
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(v.bit_count() for v in self._chunks.values())
+        return self._len
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    def __contains__(self, x):
+        try:
+            key = x >> CHUNK_BITS
+        except TypeError:
+            return False
+        if key not in self._chunks:
+            return False
+        flags = self.chunk_flags(key)
+        idx = x & CHUNK_MASK
+        return idx < len(flags) and flags[idx] == 1
+
+    def __iter__(self):
+        for key in sorted(self._chunks):
+            base = key << CHUNK_BITS
+            v = self._chunks[key]
+            if key in self._flags or v.bit_count() << 6 > v.bit_length():
+                yield from compress(range(base, base + CHUNK_SIZE), self.chunk_flags(key))
+            else:
+                # Sparse chunk, cheaper to walk the set bits
+                while v:
+                    low = v & -v
+                    yield base + low.bit_length() - 1
+                    v ^= low
+
+    def __sizeof__(self):
+        getsizeof = sys.getsizeof
+        return (object.__sizeof__(self) + getsizeof(self._chunks) + sum(map(getsizeof, self._chunks.values())) +
+                getsizeof(self._flags) + sum(map(getsizeof, self._flags.values())))
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self))
+        return self._hash
+
+    def flags(self, size):
+        ' Return a bytearray of length size with a one at the index of every id in this set '
+        ans = bytearray(size)
+        for key in self._chunks:
+            base = key << CHUNK_BITS
+            if base < size:
+                f = self.chunk_flags(key)[:size - base]
+                ans[base:base + len(f)] = f
+        return ans
+
+    def filter(self, ids):
+        ' Return a list of the items in the sequence ids that are in this set, preserving their order '
+        if not isinstance(ids, (list, tuple)):
+            ids = tuple(ids)
+        if not ids:
+            return []
+        try:
+            limit = max(ids) + 1
+            if min(ids) >= 0 and limit <= CHUNK_SIZE + 64 * len(ids):
+                flags = self.flags(limit)
+                return list(compress(ids, map(flags.__getitem__, ids)))
+        except TypeError:
+            pass
+        return [x for x in ids if x in self]
+
+    def copy(self):
+        return self._from_chunks(dict(self._chunks))
+
+    def _as_idset(self, other):
+        if isinstance(other, FrozenIdSet):
+            return other
+        if isinstance(other, Set):
+            return FrozenIdSet._from_chunks(chunks_for_ids(other))
+        return None
+
+    # Binary operations {{{
+    def _and(self, other):
+        a, b = self._chunks, other._chunks
+        if len(a) > len(b):
+            a, b = b, a
+        return {k: v for k, x in a.items() if (v := x & b.get(k, 0))}
+
+    def _or(self, other):
+        ans = dict(self._chunks)
+        for k, v in other._chunks.items():
+            ans[k] = ans.get(k, 0) | v
+        return ans
+
+    def _sub(self, other):
+        b = other._chunks
+        return {k: v for k, x in self._chunks.items() if (v := x & ~b.get(k, 0))}
+
+    def _xor(self, other):
+        ans = dict(self._chunks)
+        for k, v in other._chunks.items():
+            v ^= ans.get(k, 0)
+            if v:
+                ans[k] = v
+            else:
+                ans.pop(k, None)
+        return ans
+
+    def __and__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._from_chunks(self._and(other))
+    __rand__ = __and__
+
+    def __or__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._from_chunks(self._or(other))
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._from_chunks(self._xor(other))
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._from_chunks(self._sub(other))
+
+    def __rsub__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._from_chunks(other._sub(self))
+
+    def intersection(self, *others):
+        ans = self._chunks
+        for other in others:
+            ans = FrozenIdSet._from_chunks(ans)._and(FrozenIdSet(other))
+        return self._from_chunks(dict(ans) if ans is self._chunks else ans)
+
+    def union(self, *others):
+        ans = self._chunks
+        for other in others:
+            ans = FrozenIdSet._from_chunks(ans)._or(FrozenIdSet(other))
+        return self._from_chunks(dict(ans) if ans is self._chunks else ans)
+
+    def difference(self, *others):
+        ans = self._chunks
+        for other in others:
+            ans = FrozenIdSet._from_chunks(ans)._sub(FrozenIdSet(other))
+        return self._from_chunks(dict(ans) if ans is self._chunks else ans)
+
+    def symmetric_difference(self, other):
+        return self._from_chunks(self._xor(FrozenIdSet(other)))
+    # }}}
+
+    # Comparisons {{{
+    def __eq__(self, other):
+        if isinstance(other, FrozenIdSet):
+            return self._chunks == other._chunks
+        if isinstance(other, Set):
+            return len(self) == len(other) and all(x in other for x in self)
+        return NotImplemented
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        return ans if ans is NotImplemented else not ans
+
+    def __le__(self, other):
+        if isinstance(other, FrozenIdSet):
+            b = other._chunks
+            return all(k in b and not (v & ~b[k]) for k, v in self._chunks.items())
+        if isinstance(other, Set):
+            return len(self) <= len(other) and all(x in other for x in self)
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, FrozenIdSet):
+            return other.__le__(self)
+        if isinstance(other, Set):
+            return len(self) >= len(other) and all(x in self for x in other)
+        return NotImplemented
+
+    def __lt__(self, other):
+        ans = self.__le__(other)
+        return ans if ans is NotImplemented else (ans and len(self) != len(other))
+
+    def __gt__(self, other):
+        ans = self.__ge__(other)
+        return ans if ans is NotImplemented else (ans and len(self) != len(other))
+
+    def issubset(self, other):
+        return self <= (other if isinstance(other, Set) else FrozenIdSet(other))
+
+    def issuperset(self, other):
+        return self >= (other if isinstance(other, Set) else FrozenIdSet(other))
+
+    def isdisjoint(self, other):
+        if isinstance(other, Iterable) and not isinstance(other, FrozenIdSet):
+            other = FrozenIdSet(other)
+        return not self._and(other)
+    # }}}
+
+
+class IdSet(FrozenIdSet, MutableSet):
+
+    ' A mutable set of non-negative integers, see :class:`FrozenIdSet` '
+
+    __slots__ = ()
+    __hash__ = None
+
+    def _changed(self, keys=None):
+        self._len = None
+        if keys is None:
+            self._flags.clear()
+        else:
+            for key in keys:
+                self._flags.pop(key, None)
+
+    def _replace(self, chunks):
+        self._chunks = chunks
+        self._changed()
+        return self
+
+    def add(self, x):
+        if x < 0:
+            raise ValueError('Book ids must not be negative')
+        key = x >> CHUNK_BITS
+        self._chunks[key] = self._chunks.get(key, 0) | (1 << (x & CHUNK_MASK))
+        self._changed((key,))
+
+    def discard(self, x):
+        try:
+            key = x >> CHUNK_BITS
+        except TypeError:
+            return
+        v = self._chunks.get(key)
+        if v is not None and x >= 0:
+            v &= ~(1 << (x & CHUNK_MASK))
+            if v:
+                self._chunks[key] = v
+            else:
+                del self._chunks[key]
+            self._changed((key,))
+
+    def remove(self, x):
+        if x not in self:
+            raise KeyError(x)
+        self.discard(x)
+
+    def pop(self):
+        for x in self:
+            self.discard(x)
+            return x
+        raise KeyError('pop from an empty set')
+
+    def clear(self):
+        self._replace({})
+
+    def update(self, *others):
+        for other in others:
+            self._replace(self._or(FrozenIdSet(other)))
+
+    def intersection_update(self, *others):
+        for other in others:
+            self._replace(self._and(FrozenIdSet(other)))
+
+    def difference_update(self, *others):
+        for other in others:
+            self._replace(self._sub(FrozenIdSet(other)))
+
+    def symmetric_difference_update(self, other):
+        self._replace(self._xor(FrozenIdSet(other)))
+
+    def __ior__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._replace(self._or(other))
+
+    def __iand__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._replace(self._and(other))
+
+    def __isub__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._replace(self._sub(other))
+
+    def __ixor__(self, other):
+        other = self._as_idset(other)
+        return NotImplemented if other is None else self._replace(self._xor(other))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Verify the files of book formats against the hashes recorded for them in the
+database. A file is only hashed again if its size or modification time has
+changed since its hash was recorded, unless a full verification is requested,
+which also finds files that were damaged without their size or modification
+time changing. Files are hashed by several threads, as hashing large files
+releases the GIL.
+'''
+
+import errno
+import hashlib
+import os
+from queue import Queue
+from threading import Thread
+
+from calibre import detect_ncpus
+from calibre.db import SPOOL_SIZE
+
+# The kinds of problems found by verification
+CHANGED = 'changed'  # The file was modified after its hash was recorded
+CORRUPT = 'corrupt'  # The contents of the file changed without its size or modification time changing
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def stat_key(st):
+    return st.st_size, st.st_mtime_ns
+
+
+def hash_stream(src, dest=None):
+    ' Return the SHA-256 hash of the data read from src, also writing the data to dest, if it is not None '
+    sha = hashlib.sha256()
+    # Use smaller chunks when copying, as many copies can run concurrently
+    chunk_size = SPOOL_SIZE if dest is None else COPY_CHUNK_SIZE
+    while True:
+        raw = src.read(chunk_size)
+        if not raw:
+            break
+        sha.update(raw)
+        if dest is not None:
+            dest.write(raw)
+    return sha.hexdigest()
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+
+def verify_file(path, record, full=False):
+    '''
+    Check the file at path against record, which is (size, mtime, hash) or
+    None if no hash has been recorded for the file. Returns (problem,
+    new_record) where new_record is the (size, mtime, hash) to record or None
+    if the recorded values should not be changed.
+    '''
+    try:
+        st = os.stat(path)
+        key = stat_key(st)
+        if record is not None and not full and key == tuple(record[:2]):
+            return None, None
+        content_hash = hash_file(path)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            # Missing files are reported by the library check
+            return None, None
+        return str(err), None
+    if record is None or content_hash == record[2]:
+        return None, (None if record is not None and key == tuple(record[:2]) else key + (content_hash,))
+    return (CORRUPT if key == tuple(record[:2]) else CHANGED), None
+
+
+def verify_worker(input_queue, output_queue, full):
+    while True:
+        task = input_queue.get()
+        if task is None:
+            break
+        book_id, fmt, path, record = task
+        try:
+            problem, new_record = verify_file(path, record, full)
+        except Exception:
+            import traceback
+            problem, new_record = traceback.format_exc(), None
+        output_queue.put((book_id, fmt, problem, new_record))
+
+
+def verify_formats(tasks, full=False, num_workers=None, progress_callback=None):
+    '''
+    Verify the files specified by tasks, a list of (book_id, fmt, path,
+    record). Returns the list of problems as (book_id, fmt, problem) and the
+    list of new records as (book_id, fmt, record). progress_callback, if not
+    None, is called with the number of files verified and the total.
+    '''
+    input_queue, output_queue = Queue(), Queue()
+    for task in tasks:
+        input_queue.put(task)
+    num_workers = max(1, min(num_workers or detect_ncpus(), len(tasks)))
+    workers = [
+        Thread(target=verify_worker, args=(input_queue, output_queue, full), daemon=True, name=f'VerifyFormats-{i}')
+        for i in range(num_workers)
+    ]
+    for w in workers:
+        input_queue.put(None)
+        w.start()
+    problems, new_records = [], []
+    for i in range(len(tasks)):
+        book_id, fmt, problem, new_record = output_queue.get()
+        if problem is not None:
+            problems.append((book_id, fmt, problem))
+        if new_record is not None:
+            new_records.append((book_id, fmt, new_record))
+        if progress_callback is not None:
+            progress_callback(i + 1, len(tasks))
+    for w in workers:
+        w.join()
+    return problems, new_records
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Measure how long the kind of reads the content server does wait while other
+threads add large formats and set covers. Run with:
+
+    calibre-debug -c "from calibre.db.lock_benchmark import main; main()"
+
+The writes are run twice, once normally and once with the write lock held
+for the whole of each write, which is how they used to be done, so the
+difference shows the effect of doing file I/O without holding the lock.
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from threading import Event, Thread
+
+from calibre.db.tests.base import IMG
+
+
+def create_library(num_books):
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.ebooks.metadata.book.base import Metadata
+    path = tempfile.mkdtemp(prefix='calibre-lock-benchmark-')
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), 'tests', 'metadata.db'), os.path.join(path, 'metadata.db'))
+    cache = Cache(DB(path))
+    cache.init()
+    books = []
+    for i in range(num_books):
+        mi = Metadata(f'Title {i}', [f'Author {i % 50}'])
+        mi.tags = [f'Tag {i % 20}', f'Tag {i % 7}']
+        books.append((mi, {}))
+    cache.add_books(books)
+    return cache
+
+
+def reader(cache, book_ids, stop, latencies):
+    # The reads done to render a book list and a book details page
+    while not stop.is_set():
+        book_id = random.choice(book_ids)
+        start = time.monotonic()
+        cache.search(f'tags:"=Tag {book_id % 20}"')
+        cache.get_proxy_metadata(book_id).title
+        cache.field_for('authors', book_id)
+        cache.formats(book_id)
+        latencies.append(time.monotonic() - start)
+
+
+def writer(cache, book_ids, stop, data, hold_lock):
+    while not stop.is_set():
+        book_id = random.choice(book_ids)
+        if hold_lock:
+            with cache.write_lock:
+                cache.add_format(book_id, 'PDF', BytesIO(data), run_hooks=False)
+                cache.set_cover({book_id: IMG})
+        else:
+            cache.add_format(book_id, 'PDF', BytesIO(data), run_hooks=False)
+            cache.set_cover({book_id: IMG})
+        cache.set_field('tags', {book_id: ('Written',)})
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def run(cache, duration, num_readers, data, hold_lock):
+    book_ids = tuple(cache.all_book_ids())
+    stop = Event()
+    latencies = [[] for i in range(num_readers)]
+    threads = [Thread(target=reader, args=(cache, book_ids, stop, l), daemon=True) for l in latencies]
+    threads.append(Thread(target=writer, args=(cache, book_ids, stop, data, hold_lock), daemon=True))
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    all_latencies = sorted(x for l in latencies for x in l)
+    print('{:<32} reads/s: {:8.0f} median: {:7.2f}ms 99%: {:8.2f}ms max: {:8.2f}ms'.format(
+        'Whole write under lock' if hold_lock else 'File I/O outside lock',
+        len(all_latencies) / duration, 1000 * percentile(all_latencies, 0.5),
+        1000 * percentile(all_latencies, 0.99), 1000 * (all_latencies[-1] if all_latencies else 0)))
+
+
+def main(duration=5, num_readers=4, num_books=1000, format_size=64 * 1024 * 1024):
+    cache = create_library(num_books)
+    data = os.urandom(format_size)
+    try:
+        for hold_lock in (True, False):
+            run(cache, duration, num_readers, data, hold_lock)
+    finally:
+        library_path = cache.backend.library_path
+        cache.close()
+        shutil.rmtree(library_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Persistent, incrementally maintained sort keys for the fields in the
+database. For every field that has been sorted on, the sort key of every
+book is kept, along with the rank of every book, that is, the position of
+its key in the sorted list of all distinct keys. Sorting on one or more
+fields then only needs to compare small integers, and the expensive sort
+keys, such as ICU collation keys for text fields, are only re-calculated
+for books whose data has changed.
+'''
+
+from array import array
+from collections import deque
+from threading import Lock
+
+from calibre.utils.config_base import prefs, tweaks
+from calibre.utils.icu import sorting_locale
+
+# Tweaks that change the sort keys of some fields
+SORT_TWEAKS = (
+    'locale_for_sorting', 'value_for_undefined_numbers_when_sorting', 'sort_dates_using_visible_fields',
+    'gui_timestamp_display_format', 'gui_pubdate_display_format', 'gui_last_modified_display_format',
+    'author_sort_copy_method', 'author_name_suffixes', 'author_name_prefixes', 'author_name_copywords',
+    'title_series_sorting', 'per_language_title_sort_articles', 'default_language_for_title_sort',
+)
+# The fields, other than the field itself, that the sort keys of fields of a
+# datatype depend on. Series are sorted using the language of the book.
+SORT_DEPENDENCIES = {'series': frozenset({'languages'})}
+# The number of changes remembered for changes_since()
+MAX_CHANGES = 256
+# Book ids larger than this are not stored in the rank arrays
+MAX_BOOK_ID = 1 << 28
+
+
+def sort_dependencies(name, field):
+    ' The names of the fields whose changes can change the sort keys of field '
+    return frozenset({name}) | SORT_DEPENDENCIES.get(field.metadata.get('datatype'), frozenset())
+
+
+def sort_environment():
+    ' Everything other than the data in the database that the sort keys depend on '
+    return sorting_locale(), prefs['numeric_collation'], tuple(tweaks.get(k) for k in SORT_TWEAKS)
+
+
+class FieldRanks:
+
+    ' The sort keys and ranks of all books for a single field '
+
+    __slots__ = ('depends_on', 'field', 'key_ranks', 'keys', 'rankable', 'ranks', 'stale')
+
+    def __init__(self, field, depends_on):
+        self.field, self.depends_on = field, depends_on
+        self.keys = {}  # book_id -> sort key
+        self.stale = set()  # books whose sort keys must be re-calculated
+        self.ranks = self.key_ranks = None
+        self.rankable = True
+
+    def refresh(self, key_func, all_book_ids):
+        '''
+        Bring the keys and ranks up to date and return the array of ranks,
+        indexed by book id, books not in the library have a rank of -1.
+        Returns None if the sort keys of this field cannot be ranked.
+        '''
+        keys = self.keys
+        if self.stale:
+            ranks, key_ranks = self.ranks, self.key_ranks
+            for book_id in self.stale:
+                if book_id not in all_book_ids:
+                    keys.pop(book_id, None)
+                    if ranks is not None and 0 <= book_id < len(ranks):
+                        ranks[book_id] = -1
+                    continue
+                k = keys[book_id] = key_func(book_id)
+                if ranks is not None:
+                    try:
+                        r = key_ranks.get(k)
+                    except TypeError:
+                        r = None
+                    if r is None or not 0 <= book_id < MAX_BOOK_ID:
+                        # A new distinct key, all ranks must be re-calculated
+                        ranks = None
+                    else:
+                        if book_id >= len(ranks):
+                            ranks.extend(array('q', (-1,)) * (book_id + 1 - len(ranks)))
+                        ranks[book_id] = r
+            self.ranks = ranks
+            self.stale = set()
+            self.rankable = True
+        if len(keys) != len(all_book_ids):
+            keys.clear()
+            keys.update((book_id, key_func(book_id)) for book_id in all_book_ids)
+            self.ranks = None
+            self.rankable = True
+        if self.ranks is None and self.rankable:
+            self.build_ranks()
+        return self.ranks
+
+    def build_ranks(self):
+        keys = self.keys
+        try:
+            distinct = sorted(set(keys.values()))
+        except TypeError:  # unhashable or mutually incomparable keys
+            self.rankable = False
+            return
+        if keys and (min(keys) < 0 or max(keys) >= MAX_BOOK_ID):
+            self.rankable = False
+            return
+        self.key_ranks = key_ranks = {k: i for i, k in enumerate(distinct)}
+        self.ranks = ranks = array('q', (-1,)) * (max(keys, default=-1) + 1)
+        for book_id, k in keys.items():
+            ranks[book_id] = key_ranks[k]
+
+
+class SortRanks:
+
+    '''
+    The ranks for all the fields that have been sorted on. Changes to the
+    data are recorded by :meth:`invalidate` and the affected keys are
+    re-calculated lazily, the next time a field is sorted on.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = True
+        self.fields = {}
+        self.environment = None
+        self.change_seq = 0
+        self.changes = deque(maxlen=MAX_CHANGES)
+
+    def invalidate(self, book_ids=None, fields=None):
+        '''
+        Record that the data for book_ids (all books if None) in fields (all
+        fields if None) has changed.
+        '''
+        fields = None if fields is None else frozenset(fields)
+        book_ids = None if book_ids is None else frozenset(book_ids)
+        with self.lock:
+            self.change_seq += 1
+            self.changes.append((self.change_seq, book_ids, fields))
+            if book_ids is None:
+                if fields is None:
+                    self.fields.clear()
+                else:
+                    for name, fr in tuple(self.fields.items()):
+                        if not fields.isdisjoint(fr.depends_on):
+                            del self.fields[name]
+                return
+            for name, fr in self.fields.items():
+                if fields is None or not fields.isdisjoint(fr.depends_on):
+                    fr.stale |= book_ids
+                else:
+                    # Books being added to the library
+                    keys = fr.keys
+                    fr.stale.update(b for b in book_ids if b not in keys)
+
+    def changes_since(self, seq, fields):
+        '''
+        Return the set of books whose sort keys for any of the specified
+        fields could have changed since change_seq was seq or None if this
+        is not known.
+        '''
+        with self.lock:
+            if seq == self.change_seq:
+                return set()
+            if not self.changes or self.changes[0][0] > seq + 1:
+                return None
+            ans = set()
+            for s, book_ids, changed_fields in self.changes:
+                if s > seq and (changed_fields is None or not changed_fields.isdisjoint(fields)):
+                    if book_ids is None:
+                        return None
+                    ans |= book_ids
+            return ans
+
+    def rank_function(self, name, field, key_func_factory, all_book_ids, depends_on=None):
+        '''
+        Return a function mapping book_id to rank for the field, or None if
+        the field cannot be ranked. key_func_factory must return a function
+        that maps book_id to sort key, it is only called when some keys need
+        to be re-calculated. all_book_ids must support len() and the in
+        operator. depends_on is the set of fields whose changes invalidate
+        the sort keys, by default only the field itself, see :func:`sort_dependencies`.
+        '''
+        if not self.enabled:
+            return None
+        with self.lock:
+            env = sort_environment()
+            if env != self.environment:
+                if self.environment is not None:
+                    self.change_seq += 1
+                    self.changes.append((self.change_seq, None, None))
+                self.fields.clear()
+                self.environment = env
+            fr = self.fields.get(name)
+            if fr is None or fr.field is not field:
+                fr = self.fields[name] = FieldRanks(field, frozenset({name}) if depends_on is None else depends_on)
+            key_func = None
+            if fr.stale or fr.ranks is None or len(fr.keys) != len(all_book_ids):
+                key_func = key_func_factory()
+            ranks = fr.refresh(key_func, all_book_ids)
+            return None if ranks is None else ranks.__getitem__
+
+
+def sort_keys_from_ranks(book_ids, rank_funcs):
+    '''
+    Return a list of keys for book_ids such that sorting on them in ascending
+    order is the same as sorting on the fields rank_funcs were created for.
+    Books with equal values keep their order in book_ids, as with a stable
+    sort, so that the keys of different books are never equal. Returns None
+    if some books are not in the library.
+    '''
+    cols = []
+    try:
+        for func, ascending in rank_funcs:
+            col = list(map(func, book_ids))
+            if col and min(col) < 0:
+                return None
+            cols.append(col if ascending else [-x for x in col])
+    except IndexError:
+        return None
+    n = len(book_ids)
+    if len(cols) == 1:
+        # Comparing integers is much faster than comparing tuples
+        return [r * n + i for i, r in enumerate(cols[0])]
+    return list(zip(*cols, range(n)))
+
+
+def sort_by_ranks(book_ids, rank_funcs):
+    ' Sort book_ids using ranks, returning a list or None if the ranks cannot be used '
+    if not isinstance(book_ids, (list, tuple)):
+        book_ids = tuple(book_ids)
+    keys = sort_keys_from_ranks(book_ids, rank_funcs)
+    if keys is None:
+        return None
+    return list(map(book_ids.__getitem__, sorted(range(len(book_ids)), key=keys.__getitem__)))
@@ -6,11 +6,69 @@ __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import os
+import re
 
 from calibre import prints
 from calibre.utils.date import DEFAULT_DATE, isoformat
 from polyglot.builtins import itervalues
 
+CHANGE_LOG_TABLE = 'books_change_log'
+# The number of entries kept in the change log, older entries are removed
+# every CHANGE_LOG_PRUNE_INTERVAL changes
+CHANGE_LOG_SIZE = 100000
+CHANGE_LOG_PRUNE_INTERVAL = 1000
+# Tables that store per book data in a column named book
+BOOK_DATA_TABLES = frozenset(('comments', 'data', 'identifiers'))
+# Tables that store the items that are linked to books via link tables
+ITEM_TABLES = frozenset(('authors', 'languages', 'publishers', 'ratings', 'series', 'tags'))
+LINK_TABLE_PAT = re.compile(r'^books_\w+_link$')
+CUSTOM_TABLE_PAT = re.compile(r'^custom_column_\d+$')
+
+
+def change_log_triggers(db, tables=None):
+    '''
+    Return the SQL to create the triggers that record every change to the
+    tables holding book metadata in the change log table. The change log is
+    used to re-read only the changed data when the database is modified by
+    another process, see DB.changes_since(). Changes to tables storing data
+    per book record the book id, changes to tables storing items, such as
+    tags, record the item id.
+    '''
+    if tables is None:
+        tables = [r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    ans = []
+    for table in tables:
+        if table == 'books':
+            col, kind = 'id', 'book'
+        elif table in BOOK_DATA_TABLES or LINK_TABLE_PAT.match(table) is not None:
+            col, kind = 'book', 'book'
+        elif table in ITEM_TABLES or CUSTOM_TABLE_PAT.match(table) is not None:
+            # Normalized custom columns store items, the others store data per book
+            cols = {r[1] for r in db.execute(f'PRAGMA table_info({table})')}
+            col, kind = ('book', 'book') if 'book' in cols else ('id', 'item')
+        else:
+            continue
+        log = f'INSERT INTO {CHANGE_LOG_TABLE} (tbl, {kind}) '
+        ans.append(f'''\
+        CREATE TRIGGER IF NOT EXISTS change_log_insert_{table}
+            AFTER INSERT ON {table}
+            BEGIN
+                {log} VALUES ('{table}', NEW.{col});
+            END;
+        CREATE TRIGGER IF NOT EXISTS change_log_update_{table}
+            AFTER UPDATE ON {table}
+            BEGIN
+                {log} VALUES ('{table}', OLD.{col});
+                {log} SELECT '{table}', NEW.{col} WHERE NEW.{col} IS NOT OLD.{col};
+            END;
+        CREATE TRIGGER IF NOT EXISTS change_log_delete_{table}
+            AFTER DELETE ON {table}
+            BEGIN
+                {log} VALUES ('{table}', OLD.{col});
+            END;
+        ''')
+    return '\n'.join(ans)
+
 
 class SchemaUpgrade:
 
@@ -818,3 +876,56 @@ CREATE TRIGGER fkc_annot_update
         alters.append("ALTER TABLE languages ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         alters.append("ALTER TABLE ratings ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         self.db.execute('\n'.join(alters))
+
+    def upgrade_version_26(self):
+        ''' Create the change log used to reload only changed data '''
+        self.db.execute(f'''
+        DROP TABLE IF EXISTS {CHANGE_LOG_TABLE};
+        CREATE TABLE {CHANGE_LOG_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            book INTEGER,
+            item INTEGER
+        );
+        CREATE TRIGGER change_log_prune
+            AFTER INSERT ON {CHANGE_LOG_TABLE}
+            WHEN NEW.id % {CHANGE_LOG_PRUNE_INTERVAL} = 0
+            BEGIN
+                DELETE FROM {CHANGE_LOG_TABLE} WHERE id <= NEW.id - {CHANGE_LOG_SIZE};
+            END;
+        ''')
+        self.db.execute(change_log_triggers(self.db))
+
+    def upgrade_version_27(self):
+        ''' Create the tables storing the hashes of format files and the state of the last library check '''
+        self.db.execute('''
+        DROP TABLE IF EXISTS format_hashes;
+        CREATE TABLE format_hashes (
+            id INTEGER PRIMARY KEY,
+            book INTEGER NOT NULL,
+            format TEXT NOT NULL COLLATE NOCASE,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            UNIQUE(book, format)
+        );
+        DROP TRIGGER IF EXISTS format_hashes_delete_trg;
+        CREATE TRIGGER format_hashes_delete_trg
+            AFTER DELETE ON data
+            BEGIN
+                DELETE FROM format_hashes WHERE book=OLD.book AND format=OLD.format;
+            END;
+        DROP TRIGGER IF EXISTS format_hashes_update_trg;
+        CREATE TRIGGER format_hashes_update_trg
+            AFTER UPDATE OF book, format ON data
+            BEGIN
+                DELETE FROM format_hashes WHERE book=NEW.book AND format=NEW.format AND (OLD.book IS NOT NEW.book OR OLD.format IS NOT NEW.format);
+                UPDATE format_hashes SET book=NEW.book, format=NEW.format WHERE book=OLD.book AND format=OLD.format;
+            END;
+
+        DROP TABLE IF EXISTS checked_dirs;
+        CREATE TABLE checked_dirs (
+            path TEXT NOT NULL PRIMARY KEY,
+            mtime INTEGER NOT NULL
+        );
+        ''')
@@ -6,14 +6,18 @@ __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import operator
+import sys
 import weakref
-from collections import OrderedDict, deque
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
 from datetime import timedelta
 from functools import partial
+from time import monotonic
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.idset import FrozenIdSet, IdSet, intersector
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
@@ -28,6 +32,10 @@ EQUALS_MATCH   = 1
 REGEXP_MATCH   = 2
 ACCENT_MATCH   = 3
 
+# The relative cost of evaluating search terms, used to decide the order in
+# which the terms of an AND are evaluated
+INDEXED_TERM, SCANNED_TERM, EXPENSIVE_TERM = range(3)
+
 
 # Utils {{{
 
@@ -91,6 +99,59 @@ def _match(query, value, matchkind, use_primary_find_in_search=True, case_sensit
             elif query in t:
                 return True
     return False
+
+
+def compile_tree(tree):
+    ''' Flatten chains of and/or into a single node with many operands '''
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        ans = [kind]
+        for child in tree[1:]:
+            child = compile_tree(child)
+            if child[0] == kind:
+                ans.extend(child[1:])
+            else:
+                ans.append(child)
+        return ans
+    if kind == 'not':
+        return ['not', compile_tree(tree[1])]
+    return tree
+# }}}
+
+
+class ItemIndex:  # {{{
+
+    '''
+    A sorted index of the names of the items in a many-one or many-many
+    field, such as tags or series. Used to find the items matching an
+    equality search, or the items under a node in a hierarchy, without
+    examining the name of every item.
+    '''
+
+    def __init__(self, id_map, case_sensitive=False):
+        item_map = defaultdict(list)
+        for item_id, val in iteritems(id_map):
+            item_map[val if case_sensitive else icu_lower(val)].append(item_id)
+        self.names = sorted(item_map)
+        self.item_ids = [item_map[name] for name in self.names]
+
+    def matches(self, query):
+        idx = bisect_left(self.names, query)
+        if idx < len(self.names) and self.names[idx] == query:
+            return self.item_ids[idx]
+        return ()
+
+    def hierarchical_matches(self, prefix):
+        ''' The items equal to prefix or in the period separated hierarchy below it '''
+        names, ans, n = self.names, [], len(prefix)
+        # All names starting with prefix are contiguous in the sorted list
+        for idx in range(bisect_left(names, prefix), len(names)):
+            name = names[idx]
+            if not name.startswith(prefix):
+                break
+            if len(name) == n or name[n] == '.':
+                ans.extend(self.item_ids[idx])
+        return ans
 # }}}
 
 
@@ -476,8 +537,9 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, item_indices=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.item_indices = item_indices
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -515,10 +577,96 @@ class Parser(SearchQueryParser):  # {{{
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    def compile_tree(self, tree):
+        return compile_tree(tree)
+
+    def evaluate_and(self, argument, candidates):
+        # Evaluate the cheapest and most selective terms first, so that the
+        # remaining terms only have to examine the books that matched them
+        total = len(candidates)
+        for term in sorted(argument, key=lambda t: self.term_cost(t, total)):
+            candidates = candidates.intersection(self.evaluate(term, candidates))
+            if not candidates:
+                break
+        return candidates
+
+    def evaluate_or(self, argument, candidates):
+        # Each term checks only the candidates not matched by earlier terms
+        matches = FrozenIdSet()
+        for term in argument:
+            m = self.evaluate(term, candidates)
+            matches |= m
+            candidates = candidates.difference(m)
+            if not candidates:
+                break
+        return matches
+
+    def term_cost(self, tree, total):
+        '''
+        Return (cost class, estimated number of matches) for evaluating the
+        parsed tree against total candidates.
+        '''
+        kind = tree[0]
+        if kind == 'token':
+            return self.token_cost(tree[1], tree[2], total)
+        if kind == 'not':
+            return self.term_cost(tree[1], total)[0], total
+        costs = tuple(self.term_cost(child, total) for child in tree[1:])
+        cls = max(c[0] for c in costs)
+        if kind == 'and':
+            return cls, min(c[1] for c in costs)
+        return cls, min(total, sum(c[1] for c in costs))
+
+    def token_cost(self, location, query, total):
+        if location in ('search', 'vl', 'template', 'all'):
+            return EXPENSIVE_TERM, total
+        location = self.field_metadata.search_term_to_field_key(icu_lower(location.strip()))
+        field = self.dbcache.fields.get(location) if isinstance(location, str) else None
+        if field is None or field.is_composite or location in self.virtual_fields:
+            return EXPENSIVE_TERM, total
+        matchkind, q = _matchkind(query, case_sensitive=prefs['case_sensitive'])
+        if location == 'languages':
+            q = self.language_query(q)
+        item_ids = self.indexed_item_ids(location, q, matchkind, prefs['case_sensitive'])
+        if item_ids is None:
+            return SCANNED_TERM, total
+        cbm = field.table.col_book_map
+        return INDEXED_TERM, sum(len(cbm.get(item_id, ())) for item_id in item_ids)
+
+    def indexed_item_ids(self, location, query, matchkind, case_sensitive):
+        '''
+        Return the ids of the items in the field location that match query or
+        None if the query cannot be answered from an index of item names.
+        Only equality searches on many-one and many-many text fields can be.
+        '''
+        if self.item_indices is None or matchkind != EQUALS_MATCH or not query or query.startswith('..'):
+            return None
+        field = self.dbcache.fields.get(location)
+        if (field is None or not field.is_many or location in ('formats', 'identifiers') or location in self.virtual_fields or
+                field.metadata['datatype'] not in ('text', 'series', 'enumeration')):
+            return None
+        key = location, case_sensitive
+        index = self.item_indices.get(key)
+        if index is None:
+            index = self.item_indices[key] = ItemIndex(field.table.id_map, case_sensitive)
+        if query.startswith('.'):
+            return index.hierarchical_matches(query[1:])
+        return index.matches(query)
+
+    def language_query(self, query):
+        q = canonicalize_lang(query)
+        if q is None:
+            lm = lang_map()
+            rm = {v.lower():k for k,v in iteritems(lm)}
+            q = rm.get(query, query)
+        return q
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
-        # value will break query optimization in the search parser
+        # value will break query optimization in the search parser.
+        # candidates is usually an id set, so combining it with the ordinary
+        # sets of matched books is cheap, never convert it to an ordinary set.
         matches = set()
 
         if candidates is None:
@@ -533,8 +681,9 @@ class Parser(SearchQueryParser):  # {{{
             if not vl:
                 raise ParseException(_('No such Virtual library: {}').format(query))
             try:
-                return candidates & self.dbcache.books_in_virtual_library(
+                vl_ids = self.dbcache.books_in_virtual_library(
                             query, virtual_fields=self.virtual_fields)
+                return vl_ids & candidates
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
 
@@ -555,13 +704,13 @@ class Parser(SearchQueryParser):  # {{{
                     query = 'true'
                 else:
                     invert = False
+                matches, c = FrozenIdSet(), candidates
                 for loc in location:
-                    c = candidates.copy()
                     m = self.get_matches(loc, query,
                             candidates=c, allow_recursion=False)
                     matches |= m
-                    c -= m
-                    if len(c) == 0:
+                    c = c - m
+                    if not c:
                         break
                 if invert:
                     matches = self.all_book_ids - matches
@@ -579,14 +728,14 @@ class Parser(SearchQueryParser):  # {{{
                 if l and l != 'all' and l in self.all_search_locations:
                     terms.add(l)
             if terms:
-                c = candidates.copy()
+                matches, c = FrozenIdSet(), candidates
                 for l in terms:
                     try:
                         m = self.get_matches(l, query,
                             candidates=c, allow_recursion=allow_recursion)
                         matches |= m
-                        c -= m
-                        if len(c) == 0:
+                        c = c - m
+                        if not c:
                             break
                     except:
                         pass
@@ -716,7 +865,7 @@ class Parser(SearchQueryParser):  # {{{
 
         locations = all_locs if location == 'all' else {location}
 
-        current_candidates = set(candidates)
+        current_candidates = candidates
 
         try:
             rating_query = int(float(query)) * 2
@@ -734,14 +883,10 @@ class Parser(SearchQueryParser):  # {{{
             float_query = None
 
         for location in locations:
-            current_candidates -= matches
+            current_candidates = current_candidates - matches
             q = query
             if location == 'languages':
-                q = canonicalize_lang(query)
-                if q is None:
-                    lm = lang_map()
-                    rm = {v.lower():k for k,v in iteritems(lm)}
-                    q = rm.get(query, query)
+                q = self.language_query(query)
 
             if matchkind == CONTAINS_MATCH and q.lower() in {'true', 'false'}:
                 found = set()
@@ -774,6 +919,15 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
+                item_ids = self.indexed_item_ids(location, q, matchkind, case_sensitive)
+                if item_ids is not None:
+                    cbm = self.dbcache.fields[location].table.col_book_map
+                    restrict = intersector(current_candidates)
+                    for item_id in item_ids:
+                        book_ids = cbm.get(item_id)
+                        if book_ids:
+                            matches |= restrict(book_ids)
+                    continue
                 for val, book_ids in self.field_iter(location, current_candidates):
                     if val is not None:
                         if isinstance(val, string_or_bytes):
@@ -796,7 +950,7 @@ class Parser(SearchQueryParser):  # {{{
             return matches
 
         user_cats = self.dbcache._pref('user_categories')
-        c = set(candidates)
+        c = candidates
 
         if query.startswith('.'):
             check_subcats = True
@@ -808,7 +962,7 @@ class Parser(SearchQueryParser):  # {{{
             if key == location or (check_subcats and key.startswith(location + '.')):
                 for (item, category, ign) in user_cats[key]:
                     s = self.get_matches(category, '=' + item, candidates=c)
-                    c -= s
+                    c = c - s
                     matches |= s
         if query == 'false':
             return candidates - matches
@@ -873,6 +1027,116 @@ class LRUCache:  # {{{
 # }}}
 
 
+class SearchCache:  # {{{
+
+    '''
+    A Least-Recently-Used cache of search results, bounded by the memory used
+    by the results rather than by the number of entries. Every entry records
+    the set of fields its results depend on (None meaning any field) so that
+    changes to other fields leave it alone, and optionally the time after
+    which it is stale.
+    '''
+
+    def __init__(self, max_size=32 * 1024 * 1024, limit=None):
+        self.max_size, self.limit = max_size, limit
+        self.item_map = OrderedDict()  # key -> [val, size, fields, expires]
+        self.size = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def stats(self):
+        ' Return a dict of statistics useful for tuning the cache '
+        return {
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'expirations': self.expirations, 'invalidations': self.invalidations,
+            'entries': len(self.item_map), 'size': self.size, 'max_size': self.max_size,
+        }
+
+    def _remove(self, key):
+        entry = self.item_map.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def _prune(self):
+        while self.item_map and (self.size > self.max_size or (self.limit is not None and len(self.item_map) > self.limit)):
+            self.size -= self.item_map.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def add(self, key, val, fields=None, expires=None):
+        self._remove(key)
+        size = sys.getsizeof(key) + sys.getsizeof(val)
+        self.item_map[key] = [val, size, None if fields is None else frozenset(fields), expires]
+        self.size += size
+        self._prune()
+    __setitem__ = add
+
+    def refresh(self, key):
+        ' Re-calculate the memory used by the entry for key after its value has been changed in place '
+        entry = self.item_map.get(key)
+        if entry is not None:
+            size = sys.getsizeof(key) + sys.getsizeof(entry[0])
+            self.size += size - entry[1]
+            entry[1] = size
+            self._prune()
+
+    def get(self, key, default=None):
+        entry = self.item_map.get(key)
+        if entry is not None and entry[3] is not None and entry[3] <= monotonic():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.item_map.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def keys_for_fields(self, fields=None):
+        ' Return the keys of all entries that depend on any of the specified fields '
+        if fields is None:
+            return list(self.item_map)
+        return [k for k, entry in self.item_map.items() if entry[2] is None or not entry[2].isdisjoint(fields)]
+
+    def invalidate(self, keys):
+        for key in keys:
+            if self._remove(key) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.item_map)
+        self.item_map.clear()
+        self.size = 0
+
+    def pop(self, key, default=None):
+        entry = self._remove(key)
+        return default if entry is None else entry[0]
+
+    def __contains__(self, key):
+        return key in self.item_map
+
+    def __len__(self):
+        return len(self.item_map)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __iter__(self):
+        for key, entry in tuple(self.item_map.items()):
+            yield key, entry[0]
+# }}}
+
+
+def next_local_midnight():
+    ' The time, on the monotonic clock, at which relative dates such as today or 2daysago next change meaning '
+    n = now()
+    midnight = (n + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return monotonic() + max(1, (midnight - n).total_seconds())
+
+
 class Search:
 
     MAX_CACHE_UPDATE = 50
@@ -884,8 +1148,14 @@ class Search:
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = SearchCache()
         self.parse_cache = LRUCache(limit=100)
+        # Indices of item names for many-one and many-many fields, built on
+        # demand and discarded whenever the data in the db changes
+        self.item_indices = {}
+        # (book_col_map, its length, id set of all book ids), re-created only
+        # when books are added or removed
+        self.all_ids = None
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -896,31 +1166,59 @@ class Search:
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        '''
+        Update or discard the cached results affected by a change to the
+        specified books. If fields is not None, only the results of searches
+        that depend on one of those fields are affected.
+        '''
+        if fields is None:
+            self.item_indices = {}
         else:
-            self.clear_caches()
+            for key in tuple(self.item_indices):
+                if key[0] in fields:
+                    del self.item_indices[key]
+        queries = self.cache.keys_for_fields(fields)
+        if book_ids and (len(book_ids) * len(queries)) <= self.MAX_CACHE_UPDATE:
+            self.update_caches(dbcache, book_ids, queries)
+        else:
+            self.cache.invalidate(queries)
 
     def clear_caches(self):
         self.cache.clear()
-
-    def update_caches(self, dbcache, book_ids):
+        self.item_indices = {}
+        self.all_ids = None
+
+    def all_book_ids(self, dbcache):
+        ' The ids of all books in the library, as an id set '
+        bcm = dbcache.fields['uuid'].table.book_col_map
+        c = self.all_ids
+        if c is None or c[0] is not bcm or c[1] != len(bcm):
+            c = self.all_ids = bcm, len(bcm), FrozenIdSet(bcm)
+        return c[2]
+
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def discard_books(self, book_ids):
-        book_ids = set(book_ids)
+        self.all_ids = None
+        book_ids = IdSet(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
+            self.cache.refresh(query)
 
-    def _update_caches(self, sqp, book_ids):
-        book_ids = sqp.all_book_ids = set(book_ids)
+    def _update_caches(self, sqp, book_ids, queries=None):
+        book_ids = sqp.all_book_ids = FrozenIdSet(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        if queries is not None:
+            queries = frozenset(queries)
+        for query, result in self.cache:
+            if queries is not None and query not in queries:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -930,17 +1228,17 @@ class Search:
                 result.difference_update(book_ids - matches)
                 # add books that now match but did not before
                 result.update(matches)
-        for query in remove:
-            self.cache.pop(query)
+                self.cache.refresh(query)
+        self.cache.invalidate(remove)
 
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
-            dbcache, set(), dbcache._pref('grouped_search_terms'),
+            dbcache, FrozenIdSet(), dbcache._pref('grouped_search_terms'),
             self.date_search, self.num_search, self.bool_search,
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache, self.item_indices)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
@@ -955,19 +1253,34 @@ class Search:
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
-    def query_is_cacheable(self, sqp, dbcache, query):
+    def cache_policy(self, sqp, dbcache, query):
+        '''
+        Return None if the results of query must not be cached, otherwise a
+        tuple (fields, expires). fields is the set of fields the results
+        depend on, or None if they could depend on any field. expires is the
+        time after which the results are stale, or None.
+        '''
+        fields, expires = set(), None
         if query:
+            fm = dbcache.field_metadata
             for name, value in sqp.get_queried_fields(query):
                 if name == 'template':
-                    return False
-                elif name in dbcache.field_metadata.all_field_keys():
-                    fm = dbcache.field_metadata[name]
-                    if fm['datatype'] == 'datetime':
-                        return False
-                    if fm['datatype'] == 'composite':
-                        if fm.get('display', {}).get('composite_sort', '') == 'date':
-                            return False
-        return True
+                    return None
+                key = fm.search_term_to_field_key(icu_lower(name.strip()))
+                if not isinstance(key, str) or key not in fm or key not in dbcache.fields:
+                    # all, vl, grouped search terms, etc.
+                    fields = None
+                    continue
+                m = fm[key]
+                if m['datatype'] == 'datetime' or (
+                        m['datatype'] == 'composite' and m.get('display', {}).get('composite_sort', '') == 'date'):
+                    # Searches such as date:today match different books on different days
+                    expires = expires or next_local_midnight()
+                if m['datatype'] == 'composite':
+                    fields = None
+                elif fields is not None:
+                    fields.add(key)
+        return fields, expires
 
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
@@ -978,34 +1291,41 @@ class Search:
             query = query.decode('utf-8')
 
         query = query.strip()
-        use_cache = self.query_is_cacheable(sqp, dbcache, query)
+        policy = self.cache_policy(sqp, dbcache, query)
+        use_cache = policy is not None
 
         if use_cache and book_ids is None and query and not search_restriction:
             cached = self.cache.get(query)
             if cached is not None:
                 return cached
 
-        restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
+        # The candidates are id sets throughout the evaluation of the query,
+        # the result is converted to a mutable IdSet only once, at the end
+        restricted_ids = all_book_ids = self.all_book_ids(dbcache)
+        if book_ids is not None and not isinstance(book_ids, FrozenIdSet):
+            book_ids = FrozenIdSet(book_ids)
         if search_restriction and search_restriction.strip():
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
-            if self.query_is_cacheable(sqp, dbcache, sr):
+            sr_policy = self.cache_policy(sqp, dbcache, sr)
+            if sr_policy is not None:
                 cached = self.cache.get(sr)
                 if cached is None:
-                    restricted_ids = sqp.parse(sr)
+                    restricted_ids = IdSet(sqp.parse(sr))
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        self.cache.add(sr, restricted_ids, *sr_policy)
                 else:
                     restricted_ids = cached
                     if book_ids is not None:
-                        restricted_ids = book_ids.intersection(restricted_ids)
+                        restricted_ids = cached.intersection(book_ids)
             else:
-                restricted_ids = sqp.parse(sr)
+                restricted_ids = IdSet(sqp.parse(sr))
         elif book_ids is not None:
             restricted_ids = book_ids
 
         if not query:
-            return restricted_ids
+            # all_book_ids and book_ids must not be changed by the caller
+            return restricted_ids if isinstance(restricted_ids, IdSet) and restricted_ids is not book_ids else IdSet(restricted_ids)
 
         if use_cache and restricted_ids is all_book_ids:
             cached = self.cache.get(query)
@@ -1013,9 +1333,9 @@ class Search:
                 return cached
 
         sqp.all_book_ids = restricted_ids
-        result = sqp.parse(query)
+        result = IdSet(sqp.parse(query))
 
-        if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+        if use_cache and not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
+            self.cache.add(query, result, *policy)
 
         return result
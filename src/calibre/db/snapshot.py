@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A versioned, on-disk snapshot of the in-memory tables, stored next to
+metadata.db. Libraries that have not changed since the snapshot was written
+can be opened without reading every table from SQLite. The snapshot is keyed
+on the SQLite file change counter, which SQLite increments on every
+committed write transaction, so it is never used for a library that has been
+modified in any way, by any process, since it was written.
+'''
+
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from contextlib import suppress
+
+from calibre.constants import numeric_version
+from calibre.utils.config_base import tweaks
+from calibre.utils.filenames import atomic_rename
+
+MAGIC = b'calibre-tables-snapshot\0'
+VERSION = 1
+SQLITE_HEADER = b'SQLite format 3\0'
+HEADER = struct.Struct('>Q')
+# The tweaks used to calculate the sort values of authors that have none
+# stored in the database, which are part of the snapshot
+KEY_TWEAKS = (
+    'author_sort_copy_method', 'author_name_copywords', 'author_use_surname_prefixes', 'author_surname_prefixes',
+    'author_name_prefixes', 'author_name_suffixes',
+)
+ALLOWED_CLASSES = frozenset({
+    ('builtins', 'set'), ('builtins', 'frozenset'), ('builtins', 'dict'), ('builtins', 'list'),
+    ('builtins', 'tuple'), ('builtins', 'bytearray'), ('collections', 'defaultdict'),
+    ('array', 'array'), ('array', '_array_reconstructor'),
+    ('datetime', 'datetime'), ('datetime', 'timezone'), ('datetime', 'timedelta'),
+    ('calibre.db.columns', 'IntColumn'), ('calibre.db.columns', 'FloatColumn'), ('calibre.db.columns', 'BoolColumn'),
+    ('calibre.db.columns', 'DateColumn'), ('calibre.db.columns', 'PooledColumn'),
+})
+
+
+class Unpickler(pickle.Unpickler):
+
+    # The snapshot lives in the library folder, which could have come from
+    # anywhere, so only allow the types the tables actually use
+
+    def find_class(self, module, name):
+        if (module, name) not in ALLOWED_CLASSES:
+            raise pickle.UnpicklingError(f'Snapshot contains forbidden type: {module}.{name}')
+        return super().find_class(module, name)
+
+
+def snapshot_key(conn, dbpath):
+    '''
+    Return a key identifying the current state of the database at dbpath or
+    None if the database is in a state where the change counter cannot be
+    relied on. Must be called inside a transaction so that the database
+    cannot change after the key has been calculated.
+    '''
+    if (conn.get('PRAGMA journal_mode', all=False) or '').lower() == 'wal':
+        # The change counter is not updated for transactions in WAL mode
+        return None
+    user_version = conn.get('PRAGMA user_version', all=False)  # also acquires the SHARED lock
+    with open(dbpath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        header = f.read(100)
+    if len(header) < 100 or not header.startswith(SQLITE_HEADER):
+        return None
+    change_counter = struct.unpack_from('>I', header, 24)[0]
+    tweak_values = tuple(repr(tweaks.get(name)) for name in KEY_TWEAKS)
+    return VERSION, tuple(numeric_version), user_version, change_counter, st.st_size, st.st_mtime_ns, tweak_values
+
+
+def save_snapshot(path, key, tables):
+    ' Atomically write the data in tables to path, keyed by key '
+    state = {name: table.state_for_snapshot() for name, table in tables.items()}
+    key_data = pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='metadata-', suffix='.snapshot-tmp', delete=False) as f:
+        try:
+            f.write(MAGIC)
+            f.write(HEADER.pack(len(key_data)))
+            f.write(key_data)
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    try:
+        atomic_rename(f.name, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(f.name)
+        raise
+
+
+def load_snapshot(path, key, tables):
+    '''
+    Restore tables from the snapshot at path. Returns False if there is no
+    snapshot or it is stale, raises an exception if it is corrupted.
+    '''
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return False
+    with f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC) + HEADER.size:
+            raise ValueError('Snapshot is truncated')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError('Snapshot has an unknown format')
+            pos = len(MAGIC) + HEADER.size
+            end = pos + HEADER.unpack_from(m, len(MAGIC))[0]
+            if Unpickler(_Reader(m, pos, end)).load() != key:
+                return False
+            state = Unpickler(_Reader(m, end, len(m))).load()
+    if set(state) != set(tables):
+        raise ValueError('Snapshot has a different set of tables')
+    for name, table in tables.items():
+        table.restore_from_snapshot(state[name])
+    return True
+
+
+class _Reader:
+
+    ' A file like object that reads from a region of a memory map without copying the whole region '
+
+    __slots__ = ('end', 'm', 'pos')
+
+    def __init__(self, m, pos, end):
+        self.m, self.pos, self.end = m, pos, end
+
+    def read(self, n=-1):
+        end = self.end if n < 0 else min(self.end, self.pos + n)
+        ans = self.m[self.pos:end]
+        self.pos = end
+        return ans
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        idx = self.m.find(b'\n', self.pos, self.end)
+        return self.read(-1 if idx < 0 else idx + 1 - self.pos)
@@ -10,6 +10,7 @@ from collections import defaultdict
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 
+from calibre.db.columns import IntColumn, PooledColumn, column_for_datatype, grouped_item_ids
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
@@ -50,11 +51,26 @@ def c_parse(val):
 ONE_ONE, MANY_ONE, MANY_MANY = range(3)
 
 null = object()
+no_changes = frozenset(), frozenset()
+# When more than this many books have changed, re-read the whole table rather
+# than just the changed rows
+INCREMENTAL_READ_LIMIT = 5000
+
+
+def sql_ids(ids):
+    ' Return a comma separated list of ids, suitable for use in an SQL IN clause '
+    return ','.join(map(str, map(int, ids)))
 
 
 class Table:
 
     supports_notes = False
+    # The attributes populated by read(), these are stored in the on-disk
+    # snapshot of the tables, see calibre.db.snapshot
+    snapshot_attributes = (
+        'book_col_map', 'col_book_map', 'id_map', 'link_map', 'asort_map', 'fname_map', 'size_map', 'uuid_to_id_map',
+        'composite_template', 'contains_html', 'make_category', 'composite_sort', 'use_decorations',
+    )
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -79,6 +95,29 @@ class Table:
     def remove_books(self, book_ids, db):
         return set()
 
+    def read_changes(self, db, changes):
+        '''
+        Update this table with only the changed data from the db. changes is
+        a map of db table name to (book ids, item ids) as returned by
+        DB.changes_since(). Returns the set of ids of books whose data in
+        this table may have changed.
+        '''
+        return set()
+
+    def read_changed_books(self, db, book_ids):
+        if len(book_ids) > INCREMENTAL_READ_LIMIT:
+            self.read(db)
+        elif book_ids:
+            self.read_books(db, book_ids)
+        return set(book_ids)
+
+    def state_for_snapshot(self):
+        return {k: getattr(self, k) for k in self.snapshot_attributes if hasattr(self, k)}
+
+    def restore_from_snapshot(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def fix_link_table(self, db):
         pass
 
@@ -110,22 +149,44 @@ class OneToOneTable(Table):
 
     table_type = ONE_ONE
 
+    def new_column(self):
+        return column_for_datatype(self.metadata['datatype'])
+
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
         query = db.execute('SELECT {}, {} FROM {}'.format(idcol,
             self.metadata['column'], self.metadata['table']))
         if self.unserialize is None:
             try:
-                self.book_col_map = dict(query)
+                self.book_col_map = self.new_column().load(query)
             except UnicodeDecodeError:
                 # The db is damaged, try to work around it by ignoring
                 # failures to decode utf-8
                 query = db.execute('SELECT {}, cast({} as blob) FROM {}'.format(idcol,
                     self.metadata['column'], self.metadata['table']))
-                self.book_col_map = {k:bytes(val).decode('utf-8', 'replace') for k, val in query}
+                self.book_col_map = self.new_column().load((k, bytes(val).decode('utf-8', 'replace')) for k, val in query)
         else:
             us = self.unserialize
-            self.book_col_map = {book_id:us(val) for book_id, val in query}
+            self.book_col_map = self.new_column().load((book_id, us(val)) for book_id, val in query)
+
+    def read_changes(self, db, changes):
+        return self.read_changed_books(db, changes.get(self.metadata['table'], no_changes)[0])
+
+    def read_books(self, db, book_ids):
+        ' Re-read the data for only the specified books '
+        idcol = 'id' if self.metadata['table'] == 'books' else 'book'
+        try:
+            rows = tuple(db.execute('SELECT {0}, {1} FROM {2} WHERE {0} IN ({3})'.format(
+                idcol, self.metadata['column'], self.metadata['table'], sql_ids(book_ids))))
+        except UnicodeDecodeError:
+            self.read(db)
+            return
+        bcm = self.book_col_map
+        for book_id in book_ids:
+            bcm.pop(book_id, None)
+        us = identity if self.unserialize is None else self.unserialize
+        for book_id, val in rows:
+            bcm[book_id] = us(val)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -146,11 +207,25 @@ class PathTable(OneToOneTable):
 
 class SizeTable(OneToOneTable):
 
+    def new_column(self):
+        return IntColumn()
+
     def read(self, db):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = self.new_column().load(query)
+
+    def read_changes(self, db, changes):
+        return self.read_changed_books(db, changes.get('books', no_changes)[0] | changes.get('data', no_changes)[0])
+
+    def read_books(self, db, book_ids):
+        bcm = self.book_col_map
+        for book_id in book_ids:
+            bcm.pop(book_id, None)
+        bcm.update(db.execute(
+            'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
+            f'WHERE data.book=books.id) FROM books WHERE books.id IN ({sql_ids(book_ids)})'))
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -162,6 +237,15 @@ class UUIDTable(OneToOneTable):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in iteritems(self.book_col_map)}
 
+    def read_books(self, db, book_ids):
+        for book_id in book_ids:
+            self.uuid_to_id_map.pop(self.book_col_map.get(book_id), None)
+        OneToOneTable.read_books(self, db, book_ids)
+        for book_id in book_ids:
+            uuid = self.book_col_map.get(book_id)
+            if uuid is not None:
+                self.uuid_to_id_map[uuid] = book_id
+
     def update_uuid_cache(self, book_id_val_map):
         for book_id, uuid in iteritems(book_id_val_map):
             self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)  # discard old uuid
@@ -191,6 +275,11 @@ class CompositeTable(OneToOneTable):
         self.composite_sort = d.get('composite_sort', False)
         self.use_decorations = d.get('use_decorations', False)
 
+    def read_changes(self, db, changes):
+        # Composite values are computed from other fields, so their caches
+        # are cleared when the books they depend on change
+        return set()
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -210,27 +299,67 @@ class ManyToOneTable(Table):
         self.id_map = {}
         self.link_map = {}
         self.col_book_map = defaultdict(set)
-        self.book_col_map = {}
+        self.book_col_map = IntColumn()
         self.read_id_maps(db)
         self.read_maps(db)
 
-    def read_id_maps(self, db):
-        query = db.execute('SELECT id, {}, link FROM {}'.format(
-            self.metadata['column'], self.metadata['table']))
+    def read_id_maps(self, db, where=''):
+        query = db.execute('SELECT id, {}, link FROM {}{}'.format(
+            self.metadata['column'], self.metadata['table'], where))
         us = identity if self.unserialize is None else self.unserialize
         for id_, val, link in query:
             self.id_map[id_] = us(val)
             self.link_map[id_] = link
 
-    def read_maps(self, db):
+    def read_maps(self, db, where=''):
         cbm = self.col_book_map
         bcm = self.book_col_map
         for book, item_id in db.execute(
-                'SELECT book, {} FROM {}'.format(
-                    self.metadata['link_column'], self.link_table)):
+                'SELECT book, {} FROM {}{}'.format(
+                    self.metadata['link_column'], self.link_table, where)):
             cbm[item_id].add(book)
             bcm[book] = item_id
 
+    def read_changes(self, db, changes):
+        book_ids = changes.get(self.link_table, no_changes)[0]
+        item_ids = changes.get(self.metadata['table'], no_changes)[1]
+        # Books linked to a changed item, for example, a renamed tag, have changed as well
+        affected = set(book_ids)
+        for item_id in item_ids:
+            affected |= self.col_book_map.get(item_id, set())
+        if len(book_ids) + len(item_ids) > INCREMENTAL_READ_LIMIT:
+            self.read(db)
+        else:
+            if item_ids:
+                self.read_items(db, item_ids)
+            if book_ids:
+                self.read_books(db, book_ids)
+        for item_id in item_ids:
+            affected |= self.col_book_map.get(item_id, set())
+        return affected
+
+    def read_items(self, db, item_ids):
+        ' Re-read only the specified items '
+        for item_id in item_ids:
+            self.id_map.pop(item_id, None)
+            self.link_map.pop(item_id, None)
+        self.read_id_maps(db, f' WHERE id IN ({sql_ids(item_ids)})')
+
+    def unlink_books(self, book_ids):
+        cbm = self.col_book_map
+        for book_id in book_ids:
+            item_id = self.book_col_map.pop(book_id, None)
+            books = cbm.get(item_id)
+            if books is not None:
+                books.discard(book_id)
+                if not books:
+                    del cbm[item_id]
+
+    def read_books(self, db, book_ids):
+        ' Re-read the links to items for only the specified books '
+        self.unlink_books(book_ids)
+        self.read_maps(db, f' WHERE book IN ({sql_ids(book_ids)})')
+
     def fix_link_table(self, db):
         linked_item_ids = set(itervalues(self.book_col_map))
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -393,8 +522,8 @@ class RatingTable(ManyToOneTable):
 
     supports_notes = False
 
-    def read_id_maps(self, db):
-        ManyToOneTable.read_id_maps(self, db)
+    def read_id_maps(self, db, where=''):
+        ManyToOneTable.read_id_maps(self, db, where)
         # Ensure there are no records with rating=0 in the table. These should
         # be represented as rating:None instead.
         bad_ids = {item_id for item_id, rating in iteritems(self.id_map) if rating == 0}
@@ -414,18 +543,35 @@ class ManyToManyTable(ManyToOneTable):
     '''
 
     table_type = MANY_MANY
-    selectq = 'SELECT book, {0} FROM {1} ORDER BY id'
+    selectq = 'SELECT book, {0} FROM {1}{2} ORDER BY book, id'
     do_clean_on_remove = True
 
-    def read_maps(self, db):
-        bcm = defaultdict(list)
+    def read_maps(self, db, where=''):
         cbm = self.col_book_map
-        for book, item_id in db.execute(
-                self.selectq.format(self.metadata['link_column'], self.link_table)):
-            cbm[item_id].add(book)
-            bcm[book].append(item_id)
 
-        self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
+        def rows():
+            for book, item_ids in grouped_item_ids(db.execute(
+                    self.selectq.format(self.metadata['link_column'], self.link_table, where))):
+                for item_id in item_ids:
+                    cbm[item_id].add(book)
+                yield book, item_ids
+
+        if where:
+            self.book_col_map.update(rows())
+        else:
+            # The tuples of item ids are interned, since many books share the
+            # same set of tags/authors/languages
+            self.book_col_map = PooledColumn().load(rows())
+
+    def unlink_books(self, book_ids):
+        cbm = self.col_book_map
+        for book_id in book_ids:
+            for item_id in self.book_col_map.pop(book_id, ()):
+                books = cbm.get(item_id)
+                if books is not None:
+                    books.discard(book_id)
+                    if not books:
+                        del cbm[item_id]
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
@@ -576,13 +722,13 @@ class ManyToManyTable(ManyToOneTable):
 
 class AuthorsTable(ManyToManyTable):
 
-    def read_id_maps(self, db):
-        self.link_map = lm = {}
-        self.asort_map = sm = {}
-        self.id_map = im = {}
+    def read_id_maps(self, db, where=''):
+        if not where:
+            self.link_map, self.asort_map, self.id_map = {}, {}, {}
+        lm, sm, im = self.link_map, self.asort_map, self.id_map
         us = self.unserialize
         for aid, name, sort, link in db.execute(
-                'SELECT id, name, sort, link FROM authors'):
+                'SELECT id, name, sort, link FROM authors' + where):
             name = us(name)
             im[aid] = name
             sm[aid] = (sort or author_to_author_sort(name))
@@ -596,6 +742,11 @@ class AuthorsTable(ManyToManyTable):
             [(v, k) for k, v in iteritems(aus_map)])
         return aus_map
 
+    def read_items(self, db, item_ids):
+        for item_id in item_ids:
+            self.asort_map.pop(item_id, None)
+        ManyToManyTable.read_items(self, db, item_ids)
+
     def set_links(self, link_map, db):
         link_map = {aid:(l or '').strip() for aid, l in iteritems(link_map)}
         link_map = {aid:l for aid, l in iteritems(link_map) if l != self.link_map.get(aid, None)}
@@ -630,19 +781,22 @@ class FormatsTable(ManyToManyTable):
     do_clean_on_remove = False
     supports_notes = False
 
-    def read_id_maps(self, db):
+    def read_id_maps(self, db, where=''):
         pass
 
     def fix_case_duplicates(self, db):
         pass
 
-    def read_maps(self, db):
-        self.fname_map = fnm = defaultdict(dict)
-        self.size_map = sm = defaultdict(dict)
-        self.col_book_map = cbm = defaultdict(set)
+    def read_maps(self, db, where=''):
+        if not where:
+            self.fname_map = defaultdict(dict)
+            self.size_map = defaultdict(dict)
+            self.col_book_map = defaultdict(set)
+            self.book_col_map = {}
+        fnm, sm, cbm = self.fname_map, self.size_map, self.col_book_map
         bcm = defaultdict(list)
 
-        for book, fmt, name, sz in db.execute('SELECT book, format, name, uncompressed_size FROM data'):
+        for book, fmt, name, sz in db.execute('SELECT book, format, name, uncompressed_size FROM data' + where):
             if fmt is not None:
                 fmt = fmt.upper()
                 cbm[fmt].add(book)
@@ -650,7 +804,17 @@ class FormatsTable(ManyToManyTable):
                 fnm[book][fmt] = name
                 sm[book][fmt] = sz
 
-        self.book_col_map = {k:tuple(sorted(v)) for k, v in iteritems(bcm)}
+        self.book_col_map.update((k, tuple(sorted(v))) for k, v in iteritems(bcm))
+
+    def read_changes(self, db, changes):
+        return self.read_changed_books(db, changes.get('data', no_changes)[0])
+
+    def read_books(self, db, book_ids):
+        self.unlink_books(book_ids)
+        for book_id in book_ids:
+            self.fname_map.pop(book_id, None)
+            self.size_map.pop(book_id, None)
+        self.read_maps(db, f' WHERE book IN ({sql_ids(book_ids)})')
 
     def remove_books(self, book_ids, db):
         clean = ManyToManyTable.remove_books(self, book_ids, db)
@@ -716,20 +880,28 @@ class IdentifiersTable(ManyToManyTable):
 
     supports_notes = False
 
-    def read_id_maps(self, db):
+    def read_id_maps(self, db, where=''):
         pass
 
     def fix_case_duplicates(self, db):
         pass
 
-    def read_maps(self, db):
-        self.book_col_map = defaultdict(dict)
-        self.col_book_map = defaultdict(set)
-        for book, typ, val in db.execute('SELECT book, type, val FROM identifiers'):
+    def read_maps(self, db, where=''):
+        if not where:
+            self.book_col_map = defaultdict(dict)
+            self.col_book_map = defaultdict(set)
+        for book, typ, val in db.execute('SELECT book, type, val FROM identifiers' + where):
             if typ is not None and val is not None:
                 self.col_book_map[typ].add(book)
                 self.book_col_map[book][typ] = val
 
+    def read_changes(self, db, changes):
+        return self.read_changed_books(db, changes.get('identifiers', no_changes)[0])
+
+    def read_books(self, db, book_ids):
+        self.unlink_books(book_ids)
+        self.read_maps(db, f' WHERE book IN ({sql_ids(book_ids)})')
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
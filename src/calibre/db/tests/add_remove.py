@@ -7,8 +7,10 @@ __docformat__ = 'restructuredtext en'
 
 import glob
 import os
+import time
 from contextlib import suppress
 from datetime import timedelta
+from functools import partial
 from io import BytesIO
 from tempfile import NamedTemporaryFile
 
@@ -95,6 +97,33 @@ class AddRemoveTest(BaseTest):
             at(cache.field_for('size', 2) >= len(NF))
             at(2 in table.col_book_map['FMT9'])
 
+        # Test that the data is copied into the library without holding the
+        # lock and that no temporary files are left behind
+        stage_file, held = cache.backend.stage_file, []
+
+        def checking_stage_file(cache, stream_or_path):
+            held.append(cache.write_lock.owns_lock() or cache.read_lock.owns_lock())
+            return stage_file(stream_or_path)
+        cache.backend.stage_file = partial(checking_stage_file, cache)
+        at(cache.add_format(2, 'FMT10', BytesIO(NF)))
+        ae(held, [False])
+        ae(NF, cache.format(2, 'FMT10'))
+        af(cache.add_format(2, 'FMT10', BytesIO(b'xxx'), replace=False))
+        ae(NF, cache.format(2, 'FMT10'))
+        af([x for x in os.listdir(cache.backend.library_path) if x.startswith('.calstaged-')])
+        del cache.backend.stage_file
+
+        # Test that temporary files left behind by a crash are removed
+        stale, recent = (os.path.join(cache.backend.library_path, '.calstaged-' + x) for x in ('stale', 'recent'))
+        for x in (stale, recent):
+            with open(x, 'wb') as f:
+                f.write(NF)
+        os.utime(stale, (time.time() - 7200,) * 2)
+        cache.backend.remove_stale_staged_files()
+        af(os.path.exists(stale))
+        at(os.path.exists(recent))
+        os.remove(recent)
+
         del cache
         # Test that the old interface also shows correct format data
         db = self.init_old()
@@ -215,6 +244,90 @@ class AddRemoveTest(BaseTest):
         self.assertEqual(set(cache.formats(book_id)), {'FMT1', 'FMT2'})
         self.assertEqual(cache.format(book_id, 'FMT1'), FMT1)
         self.assertEqual(cache.format(book_id, 'FMT2'), FMT2)
+
+        # Entries created in a single transaction
+        ids = cache.create_book_entries([(Metadata(f'Batch {i}', authors=('Batcher',)), IMG if i else None) for i in range(3)])
+        self.assertEqual(len(ids), 3)
+        for c in (cache, self.init_cache()):
+            self.assertEqual([c.field_for('title', book_id) for book_id in ids], ['Batch 0', 'Batch 1', 'Batch 2'])
+            self.assertEqual([c.field_for('cover', book_id) for book_id in ids], [False, True, True])
+        ids = cache.create_book_entries([(Metadata('Batch 0'), None), (Metadata('Batch 3'), None)], add_duplicates=False)
+        self.assertIsNone(ids[0])
+        self.assertEqual(cache.field_for('title', ids[1]), 'Batch 3')
+    # }}}
+
+    def test_bulk_add(self):  # {{{
+        'Test adding books from folders with the bulk add pipeline'
+        from calibre.db.bulk_add import BulkAdd, identity_key
+        from calibre.ebooks.metadata.book.base import Metadata
+        cache = self.init_cache()
+        cache.create_book_entry(Metadata('Existing Book'))
+        root = self.mkdtemp()
+        for i in range(12):
+            d = os.path.join(root, f'shelf {i % 3}', f'book {i}')
+            os.makedirs(d)
+            for ext in ('txt', 'rtf'):
+                with open(os.path.join(d, f'Bulk Book {i}.{ext}'), 'wb') as f:
+                    f.write(f'book {i}'.encode())
+        os.makedirs(os.path.join(root, 'dup'))
+        with open(os.path.join(root, 'dup', 'Existing Book.txt'), 'wb') as f:
+            f.write(b'duplicate')
+        ba = BulkAdd(cache, (root,), batch_size=5, max_workers=2)
+        ids, duplicates = ba()
+        self.assertFalse(ba.errors)
+        self.assertEqual(len(ids), 12)
+        self.assertEqual([mi.title for mi, paths in duplicates], ['Existing Book'])
+        for c in (cache, self.init_cache()):
+            titles = {c.field_for('title', book_id) for book_id in ids}
+            self.assertEqual(titles, {f'Bulk Book {i}' for i in range(12)})
+            for book_id in ids:
+                self.assertEqual(set(c.formats(book_id)), {'TXT', 'RTF'})
+        book_id = {cache.field_for('title', book_id): book_id for book_id in ids}['Bulk Book 7']
+        self.assertEqual(cache.format(book_id, 'RTF'), b'book 7')
+        for name in ('discover', 'metadata', 'insert', 'copy'):
+            self.assertEqual(ba.stats[name].count, 13 if name in ('discover', 'metadata') else 12)
+        self.assertIn('Added 12 books', ba.format_stats())
+
+        # Adding again finds only duplicates, unless duplicates are allowed
+        ids, duplicates = BulkAdd(cache, (root,), max_workers=2)()
+        self.assertEqual((len(ids), len(duplicates)), (0, 13))
+        ids, duplicates = BulkAdd(cache, (os.path.join(root, 'dup'),), add_duplicates=True, max_workers=2)()
+        self.assertEqual((len(ids), len(duplicates)), (1, 0))
+
+        # Duplicates are books with the same fuzzy title and authors, in the
+        # library or in the batch being added
+        ba = BulkAdd(cache, ())
+
+        def is_duplicate(mi, batch_keys={}):
+            return ba.is_duplicate(mi, identity_key(mi), batch_keys)
+        self.assertTrue(is_duplicate(Metadata('The existing book')))
+        self.assertFalse(is_duplicate(Metadata('Existing Book', ['Someone Else'])))
+        mi = Metadata('Batch Book', ['One', 'Two'])
+        key = identity_key(mi)
+        batch_keys = {key[0]: [key[1:]]}
+        self.assertTrue(is_duplicate(Metadata('batch book', ['two']), batch_keys))
+        self.assertFalse(is_duplicate(Metadata('Batch Book', ['Three']), batch_keys))
+
+        # When a worker process crashes, all the jobs of the pool that have
+        # not returned a result are failed, not only the ones it reports
+        from queue import Queue
+
+        from calibre.utils.ipc.pool import Result, TerminalFailure, WorkerResult
+
+        class FailedPool:
+            results = Queue()
+            terminal_failure = TerminalFailure('crashed', 'Traceback of crash', 2)
+
+            def join(self):
+                pass
+        pool = FailedPool()
+        pool.results.put(WorkerResult(1, Result(None, None, None), True, None))
+        in_flight = {i: ([f'/book{i}.txt'], 0) for i in range(1, 4)}
+        self.assertTrue(ba.drain_failed_pool(pool, in_flight, root))
+        self.assertFalse(in_flight)
+        errors = {paths[0]: details for paths, details in ba.errors}
+        self.assertEqual(set(errors), {'/book1.txt', '/book2.txt', '/book3.txt'})
+        self.assertIn('Traceback of crash', errors['/book2.txt'])
     # }}}
 
     def test_remove_books(self):  # {{{
@@ -363,6 +476,112 @@ class AddRemoveTest(BaseTest):
         self.assertNotIn(prefix, cache.fields['formats'].format_fname(1, 'FMT1'))
     # }}}
 
+    def test_format_hashes(self):  # {{{
+        ' Test the recorded hashes of format files and their verification '
+        import hashlib
+
+        from calibre.library.check_library import CheckLibrary
+        ae, af, at = self.assertEqual, self.assertFalse, self.assertTrue
+        cache = self.init_cache()
+        # Formats added before the hashes were recorded get them recorded
+        af(cache.backend.format_hash_record(1, 'FMT1'))
+        ae(cache.verify_format_hashes(), [])
+        at(cache.backend.format_hash_record(1, 'FMT1'))
+        ae(cache.format_hash(1, 'FMT1'), hashlib.sha256(cache.format(1, 'FMT1')).hexdigest())
+
+        # Hashes are recorded when formats are added
+        cache.add_format(2, 'FMT1', BytesIO(b'hashed format'), run_hooks=False)
+        ae(cache.backend.format_hash_record(2, 'FMT1')[2], hashlib.sha256(b'hashed format').hexdigest())
+        with NamedTemporaryFile(suffix='.fmt1') as f:
+            f.write(b'hashed format 2')
+            f.flush()
+            cache.add_format(2, 'FMT1', f.name, run_hooks=False)
+        ae(cache.backend.format_hash_record(2, 'FMT1')[2], hashlib.sha256(b'hashed format 2').hexdigest())
+        cache.copy_format_to(2, 'FMT1', BytesIO())
+        ae(cache.verify_format_hashes(), [])
+
+        # Changes made outside calibre are reported until they are accepted
+        path = cache.format_abspath(1, 'FMT1')
+        with open(path, 'ab') as f:
+            f.write(b'changed')
+        ae(cache.verify_format_hashes(), [(1, 'FMT1', 'changed')])
+        ae(cache.verify_format_hashes(book_ids=(2,)), [])
+        cache.format_hash(1, 'FMT1', recompute=True)
+        ae(cache.verify_format_hashes(), [])
+
+        # Damage that does not change the size or mtime is found only by a full verification
+        st = os.stat(path)
+        with open(path, 'r+b') as f:
+            raw = f.read()
+            f.seek(0)
+            f.write(bytes(reversed(raw)))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        ae(cache.verify_format_hashes(), [])
+        ae(cache.verify_format_hashes(full=True, num_workers=2), [(1, 'FMT1', 'corrupt')])
+        with open(path, 'wb') as f:
+            f.write(raw)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        ae(cache.verify_format_hashes(full=True), [])
+
+        # Touching a file does not report it
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        ae(cache.verify_format_hashes(), [])
+        ae(cache.backend.format_hash_record(1, 'FMT1')[1], st.st_mtime_ns + 10**9)
+
+        # Records are removed with formats
+        cache.remove_formats({1: ('FMT1',)})
+        af(cache.backend.format_hash_record(1, 'FMT1'))
+        del cache
+
+        # The library check reports changed formats and skips unchanged folders
+        db = self.init_legacy()
+        cache = db.new_api
+        with open(cache.format_abspath(2, 'FMT1'), 'ab') as f:
+            f.write(b'changed')
+        checker = CheckLibrary(db.library_path, db)
+        checker.scan_library([], [], verify_hashes='changed')
+        ae([x[2] for x in checker.changed_formats], [2])
+        ae(checker.corrupt_formats, [])
+        checked = cache.checked_dirs()
+        book_dir = cache.field_for('path', 1)
+        at(book_dir in checked)
+        at(book_dir.partition('/')[0] in checked)
+
+        processed = []
+        process_book = CheckLibrary.process_book
+
+        def recording_process_book(self, lib, book_info):
+            processed.append(book_info[0].replace(os.sep, '/'))
+            return process_book(self, lib, book_info)
+
+        def check(name_ignores=()):
+            del processed[:]
+            checker = CheckLibrary(db.library_path, db)
+            checker.scan_library(name_ignores, [], incremental=True)
+            return checker
+
+        CheckLibrary.process_book = recording_process_book
+        try:
+            checker = check()
+            af(processed)
+            ae(checker.extra_files, [])
+            with open(os.path.join(db.library_path, book_dir, 'unknown.xyz'), 'wb') as f:
+                f.write(b'xxx')
+            # Folders with problems are checked until the problems are fixed
+            for i in range(2):
+                checker = check()
+                ae(processed, [book_dir])
+                ae(len(checker.extra_files), 1)
+            # The recorded state is not used when different names are ignored
+            checker = check(['*.xyz'])
+            at(book_dir in processed)
+            ae(checker.extra_files, [])
+            check(['*.xyz'])
+            af(processed)
+        finally:
+            CheckLibrary.process_book = process_book
+    # }}}
+
     def test_copy_to_library(self):  # {{{
         from calibre.db.copy_to_library import copy_one_book
         from calibre.ebooks.metadata import authors_to_string
@@ -130,6 +130,85 @@ class FTSAPITest(BaseTest):
         for w in workers:
             self.assertFalse(w.is_alive())
 
+    def test_fts_persistent_workers(self):
+        cache = self.new_library()
+        fts = cache.enable_fts()
+        self.wait_for_fts_to_finish(fts)
+        w = fts.pool.workers[0]
+        w.max_jobs_per_process = 2
+        pids = []
+        for book_id in (1, 2, 3):
+            cache.add_format(book_id, 'TXT', BytesIO(f'persistent text {book_id}'.encode()))
+            self.wait_for_fts_to_finish(fts)
+            pids.append(None if w.process is None else w.process.pid)
+        # the same process extracts text from max_jobs_per_process books
+        self.assertIsNotNone(pids[0])
+        self.assertIsNone(pids[1])
+        self.assertNotIn(pids[2], (None, pids[0]))
+        self.ae({r['book']: r['searchable_text'] for r in self.text_records(fts)}, {
+            1: 'persistent text 1', 2: 'persistent text 2', 3: 'persistent text 3'})
+        # results are committed in batches
+        cache.commit_fts_results([
+            (1, 'TXT', 1, 'x', 'batch one', '', time.monotonic()), (2, 'TXT', 1, 'y', '', 'failed', time.monotonic())])
+        tr = {r['book']: r for r in self.text_records(fts)}
+        self.ae(tr[1]['searchable_text'], 'batch one')
+        self.ae(tr[2]['err_msg'], 'failed')
+
+    def make_epub(self, chapters, title='Title'):
+        buf = BytesIO()
+        names = sorted(chapters)
+        with ZipFile(buf, mode='w') as zf:
+            zf.writestr('mimetype', b'application/epub+zip')
+            zf.writestr('META-INF/container.xml', '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>''')
+            zf.writestr('content.opf', '''<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>{}</dc:title><dc:identifier id="uid">x</dc:identifier></metadata>
+<manifest>{}</manifest><spine>{}</spine></package>'''.format(
+                title, ''.join(f'<item id="{n}" href="{n}.html" media-type="application/xhtml+xml"/>' for n in names),
+                ''.join(f'<itemref idref="{n}"/>' for n in names)))
+            for name, text in chapters.items():
+                zf.writestr(f'{name}.html', f'<html xmlns="http://www.w3.org/1999/xhtml"><body><p>{text}</p></body></html>')
+        buf.seek(0)
+        return buf
+
+    def test_fts_spine_items(self):
+        cache = self.new_library()
+        fts = cache.enable_fts()
+        self.wait_for_fts_to_finish(fts)
+        skipped = []
+        orig_add_job = fts.pool.add_job
+
+        def add_job(*a):
+            skipped.append(a[-1])
+            return orig_add_job(*a)
+        fts.pool.add_job = add_job
+
+        def record():
+            tr = [r for r in self.text_records(fts) if r['format'] == 'EPUB']
+            self.ae(len(tr), 1)
+            return tr[0]
+
+        cache.add_format(1, 'EPUB', self.make_epub({'c1': 'first chapter', 'c2': 'second chapter'}))
+        self.wait_for_fts_to_finish(fts)
+        r = record()
+        self.ae(r['searchable_text'], 'first chapter\n\n\nsecond chapter')
+        self.ae(skipped, [()])
+        # changing only the metadata does not extract or re-index the text
+        cache.add_format(1, 'EPUB', self.make_epub({'c1': 'first chapter', 'c2': 'second chapter'}, title='Changed'))
+        self.wait_for_fts_to_finish(fts)
+        r2 = record()
+        self.ae((r2['id'], r2['searchable_text']), (r['id'], r['searchable_text']))
+        self.assertNotEqual(r2['format_hash'], r['format_hash'])
+        self.ae(len(skipped), 1)
+        # only the changed spine items are extracted
+        cache.add_format(1, 'EPUB', self.make_epub({'c1': 'first chapter', 'c2': 'changed chapter'}))
+        self.wait_for_fts_to_finish(fts)
+        self.ae(skipped[-1], ('c1.html',))
+        self.ae(record()['searchable_text'], 'first chapter\n\n\nchanged chapter')
+        self.ae({x['book_id'] for x in cache.fts_search('changed')}, {1})
+
     def test_fts_search(self):
         cache = self.new_library()
         fts = cache.enable_fts()
@@ -149,6 +228,23 @@ class FTSAPITest(BaseTest):
         self.ae({x['text'] for x in cache.fts_search('also', highlight_start='[', highlight_end=']', snippet_size=3)}, {
             '…will [also] help…'})
         self.ae({x['text'] for x in cache.fts_search('also', return_text=False)}, {''})
+        # paged searching
+        ranked = [x['id'] for x in cache.fts_search('help', return_text=False)]
+        total, page = cache.fts_search_page('help', limit=1, highlight_start='[', highlight_end=']', snippet_size=3)
+        self.ae(total, 2)
+        self.ae([x['id'] for x in page], ranked[:1])
+        self.assertIn('[help]', page[0]['text'])
+        total, page = cache.fts_search_page('help', offset=1, limit=5, return_text=False)
+        self.ae((total, [x['id'] for x in page], page[0]['text']), (2, ranked[1:], ''))
+        self.ae(cache.fts_search_page('help', restrict_to_book_ids=(2, 7))[0], 1)
+        self.ae(cache.fts_search_page('help', restrict_to_book_ids=())[0], 0)
+        # cached results are invalidated when the indexed text changes
+        self.assertTrue(fts.search_cache)
+        cache.add_format(3, 'TXT', BytesIO(b'yet more help'))
+        self.wait_for_fts_to_finish(fts)
+        self.ae(cache.fts_search_page('help')[0], 3)
+        cache.remove_formats({3: ('TXT',)})
+        self.ae(cache.fts_search_page('help')[0], 2)
         fts = cache.reindex_fts()
         self.assertTrue(fts.pool.initialized)
         self.wait_for_fts_to_finish(fts)
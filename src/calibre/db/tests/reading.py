@@ -220,6 +220,79 @@ class ReadingTest(BaseTest):
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
     # }}}
 
+    def test_sort_ranks(self):  # {{{
+        'Test sorting using the persistent ranks of the sort keys'
+        from calibre.ebooks.metadata.book.base import Metadata
+        cache = self.init_cache(self.cloned_library)
+        ae = self.assertEqual
+
+        def check(*fields):
+            # Books with equal values keep their order in ids_to_sort
+            for ids in (sorted(cache.all_book_ids()), sorted(cache.all_book_ids(), reverse=True)):
+                cache.sort_ranks.enabled = False
+                expected = cache.multisort(fields, ids_to_sort=ids)
+                cache.sort_ranks.enabled = True
+                ae(expected, cache.multisort(fields, ids_to_sort=ids), f'Sorting on {fields} failed')
+
+        for i in range(5):
+            cache.create_book_entry(Metadata(f'title{i}', [f'author{i % 2}']), apply_import_tags=False)
+        for field in ('title', 'authors', 'series', 'tags', 'rating', 'timestamp', 'pubdate', 'publisher', 'languages',
+                      'identifiers', 'formats', 'id', '#enum', '#series', '#rating', '#yesno', '#date', '#authors'):
+            check((field, True)), check((field, False))
+        check(('series', True), ('title', False))
+        check(('#yesno', False), ('authors', True), ('id', False))
+
+        # Only the keys of changed books are re-calculated
+        cache.set_field('title', {1: 'AAA first', 4: 'zzz last'})
+        ae(cache.sort_ranks.fields['sort'].stale, {1, 4})
+        check(('title', True))
+        ae(1, cache.multisort([('title', True)])[0])
+        cache.set_field('tags', {2: ('Tag One', 'zzz')})
+        check(('tags', False), ('title', True))
+        cache.remove_books((3,))
+        check(('title', True))
+        cache.create_book_entry(Metadata('0 new', ['aaa']), apply_import_tags=False)
+        check(('title', True)), check(('authors', True), ('title', False))
+
+        # Series are sorted using the language of the book
+        cache.set_field('series', {1: 'Der Zebra', 2: 'Mmm'})
+        cache.set_field('languages', {1: ('eng',), 2: ('eng',)})
+        check(('series', True))
+        cache.set_field('languages', {1: ('deu',)})
+        check(('series', True))
+
+        # Re-sorting a view only moves the changed books
+        db = self.init_legacy(self.cloned_library)
+        view, cache = db.data, db.new_api
+        results, orig = [], cache.merge_sort
+
+        def merge_sort(*a, **kw):
+            results.append(orig(*a, **kw))
+            return results[-1]
+        cache.merge_sort = merge_sort
+        view.multisort([('title', True)])
+        cache.set_field('title', {3: 'AAA'})
+        view.multisort([('title', True)])
+        self.assertIsNotNone(results[-1])
+        ae(list(view._map), cache.multisort([('title', True)]))
+        ae(3, view._map[0])
+        # Books with equal values stay in their previous order, as when
+        # sorting the previous order again
+        cache.set_field('title', {1: 'CCC', 2: 'BBB'})
+        view.multisort([('title', True)])
+        prev = list(view._map)
+        cache.set_field('title', {1: 'BBB'})
+        view.multisort([('title', True)])
+        self.assertIsNotNone(results[-1])
+        ae(list(view._map), cache.multisort([('title', True)], ids_to_sort=prev))
+        ae(prev.index(2) < prev.index(1), view._map.index(2) < view._map.index(1))
+        # Sorting on one field after another sorts on both
+        prev = list(view._map)
+        view.multisort([('authors', True)])
+        view.multisort([('title', False)])
+        ae(list(view._map), cache.multisort([('title', False), ('authors', True)], ids_to_sort=prev))
+    # }}}
+
     def test_get_metadata(self):  # {{{
         'Test get_metadata() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -423,6 +496,48 @@ class ReadingTest(BaseTest):
 
     # }}}
 
+    def test_category_stats(self):  # {{{
+        ' Test the incrementally maintained statistics used to build categories '
+        cache = self.init_cache(self.cloned_library)
+        stats = cache.category_stats
+
+        def as_tuples(categories):
+            return {k: [(t.name, t.id, t.count, t.avg_rating, t.sort, frozenset(t.id_set)) for t in v] for k, v in categories.items()}
+
+        def check(book_ids=None):
+            stats.enabled = False
+            expected = as_tuples(cache.get_categories(book_ids=book_ids))
+            stats.enabled = True
+            self.assertEqual(as_tuples(cache.get_categories(book_ids=book_ids)), expected)
+            self.assertEqual(as_tuples(cache.get_categories(book_ids=book_ids)), expected)
+
+        check()
+        check({1, 2})
+        tag_stats = stats.fields['tags', None].items
+        before = {item_id: (st, set(cache.books_for_field('tags', item_id))) for item_id, st in tag_stats.items()}
+        cache.set_field('tags', {3: ('Tag One', 'New Tag')})
+        check()
+        check({1, 2})
+        # Only the statistics of items whose books changed are re-calculated
+        for item_id, (st, book_ids) in before.items():
+            if 3 in book_ids or 3 in cache.books_for_field('tags', item_id):
+                self.assertIsNot(tag_stats.get(item_id), st)
+            else:
+                self.assertIs(tag_stats[item_id], st)
+        # Changing the rating of a book changes the average rating of its items
+        cache.set_field('rating', {1: 10, 2: 2})
+        check()
+        check({1, 2})
+        cache.set_field('languages', {2: ('fra',)})
+        cache.rename_items('series', {cache.get_item_id('series', 'A Series One'): 'Renamed Series'})
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'): 'zzz'}, update_books=False)
+        check()
+        check({1, 3})
+        cache.remove_books((2,))
+        check()
+        check({1, 3})
+    # }}}
+
     def test_get_formats(self):  # {{{
         'Test reading ebook formats using the format() method'
         from calibre.db.cache import NoSuchFormat
@@ -528,6 +643,119 @@ class ReadingTest(BaseTest):
             self.assertEqual(UNDEFINED_DATE, c_parse(x))
     # }}}
 
+    def test_columnar_tables(self):  # {{{
+        ' Test the columnar storage used for the in-memory tables '
+        from calibre.db.columns import BoolColumn, DateColumn, FloatColumn, IntColumn, PooledColumn
+        from calibre.db.tables import UNDEFINED_DATE
+        for cls, vals in (
+            (IntColumn, (1, -7, None, 'bad', 1 << 70)),
+            (FloatColumn, (1.5, None, 3)),
+            (BoolColumn, (True, False, None)),
+            (DateColumn, (UNDEFINED_DATE, datetime.datetime(2013, 7, 22, 15, 18, 29, 12, tzinfo=utc_tz), None, 'x')),
+            (PooledColumn, ('a', 'b', 'a', (1, 2), None, ['unhashable'])),
+        ):
+            c, d = cls(), {}
+            for i, val in enumerate(vals):
+                for book_id in (i, i + 10, -i - 1, 'k' + str(i)):
+                    c[book_id] = d[book_id] = val
+            self.assertEqual(c, d)
+            self.assertEqual(len(c), len(d))
+            for book_id in (0, 11, -1, 'k1', 1000):
+                self.assertEqual(c.get(book_id, 'default'), d.get(book_id, 'default'))
+                self.assertEqual(c.pop(book_id, 'default'), d.pop(book_id, 'default'))
+            self.assertEqual(c, d)
+            self.assertEqual(dict(c.iter_values(d)), d)
+            c.clear()
+            self.assertFalse(c)
+
+        cache = self.init_cache()
+        for field, cls in (('title', PooledColumn), ('timestamp', DateColumn), ('series_index', FloatColumn),
+                           ('series', IntColumn), ('tags', PooledColumn), ('#yesno', BoolColumn)):
+            self.assertIsInstance(cache.fields[field].table.book_col_map, cls)
+        book_ids = cache.all_book_ids()
+        for field in ('title', 'timestamp', 'tags', '#yesno', 'series_index', 'authors', 'rating', '#float'):
+            # Compare against the same data stored in a plain dict
+            sorted_by_column = cache.multisort([(field, True)])
+            vals = {b: cache.field_for(field, b) for b in book_ids}
+            table = cache.fields[field].table
+            table.book_col_map = table.book_col_map.copy()
+            self.assertEqual(sorted_by_column, cache.multisort([(field, True)]), f'Sorting by {field} changed')
+            self.assertEqual(vals, {b: cache.field_for(field, b) for b in book_ids})
+    # }}}
+
+    def test_tables_snapshot(self):  # {{{
+        ' Test opening libraries using the on-disk snapshot of the tables '
+        def field_values(cache):
+            return {field: {b: cache.field_for(field, b) for b in cache.all_book_ids()} for field in cache.fields}
+
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+        # The snapshot is only written when closing
+        self.assertFalse(os.path.exists(cache.backend.tables_snapshot_path))
+        expected = field_values(cache)
+        cache.close()
+        self.assertTrue(os.path.exists(cache.backend.tables_snapshot_path))
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_loaded_from_snapshot)
+        self.assertEqual(expected, field_values(cache))
+        cache.close()
+
+        # Changing the tweaks used for author sort values makes the snapshot stale
+        from calibre.utils.config_base import tweaks
+        orig = tweaks['author_sort_copy_method']
+        tweaks['author_sort_copy_method'] = 'copy' if orig != 'copy' else 'invert'
+        try:
+            cache = self.init_cache()
+            self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+            cache.close()
+        finally:
+            tweaks['author_sort_copy_method'] = orig
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+        cache.close()
+
+        # The snapshot written when closing includes the changes made by this
+        # and other processes while the library was open
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_loaded_from_snapshot)
+        other = self.init_cache()
+        other.set_field('title', {2: 'changed by other'})
+        other.backend.close(save_tables_snapshot=False)
+        cache.set_field('title', {1: 'changed'})
+        cache.set_pref('some_pref', 1)
+        cache.close()
+        cache = self.init_cache()
+        self.assertTrue(cache.backend.tables_loaded_from_snapshot)
+        self.assertEqual('changed', cache.field_for('title', 1))
+        self.assertEqual('changed by other', cache.field_for('title', 2))
+        expected = field_values(cache)
+        path = cache.backend.tables_snapshot_path
+        cache.close()
+        os.remove(path)
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+        self.assertEqual(expected, field_values(cache))
+        cache.close()
+
+        # Changes made after the snapshot was written make it stale
+        cache = self.init_cache()
+        cache.set_field('title', {1: 'changed again'})
+        cache.backend.close(save_tables_snapshot=False)
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+        self.assertEqual('changed again', cache.field_for('title', 1))
+        cache.close()
+
+        # Corrupt snapshots are ignored
+        with open(path, 'r+b') as f:
+            f.seek(-20, os.SEEK_END)
+            f.write(b'\0' * 20)
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+        self.assertEqual('changed', cache.field_for('title', 1))
+        cache.close()
+    # }}}
+
     def test_restrictions(self):  # {{{
         ' Test searching with and without restrictions '
         cache = self.init_cache()
@@ -548,16 +776,66 @@ class ReadingTest(BaseTest):
         se({2}, cache.books_in_virtual_library('1', 'id:1 or id:2'))
     # }}}
 
+    def test_search_planner(self):  # {{{
+        ' Test that queries answered from item indices and re-ordered by the query planner give the same results '
+        from calibre.db.search import EXPENSIVE_TERM, INDEXED_TERM, SCANNED_TERM, ItemIndex
+        ae = self.assertEqual
+        idx = ItemIndex({1: 'A.b', 2: 'a.bc', 3: 'a', 4: 'ab', 5: 'a.b.c', 6: 'b'})
+        ae(set(idx.hierarchical_matches('a.b')), {1, 5})
+        ae(set(idx.hierarchical_matches('a')), {1, 2, 3, 5})
+        ae(set(idx.matches('a.b')), {1})
+        ae(set(ItemIndex({1: 'A.b', 2: 'a.b'}, case_sensitive=True).matches('a.b')), {2})
+
+        cache = self.init_cache(self.cloned_library)
+        cache.set_field('tags', {1: ('Fiction.Fantasy', 'News'), 2: ('fiction', 'Tag One'), 3: ('Fiction.Fantasy.Epic',)})
+
+        def unindexed(query):
+            sqp = cache._search_api.create_parser(cache)
+            sqp.item_indices = None
+            sqp.all_book_ids = cache._all_book_ids(type=set)
+            return sqp.parse(query)
+
+        for query in (
+            'tags:=fiction', 'tags:=.fiction', 'tags:"=.fiction.fantasy"', 'tags:=..fantasy', 'tags:=news and title:~title',
+            'title:~title and tags:=.fiction', 'tags:"=Tag One" or tags:=News', 'not tags:=fiction and authors:"=Author One"',
+            '"=Author One"', 'series:"=A Series One" and (tags:=news or tags:=nomatch)', 'authors:=unknown and not tags:=.fiction',
+            'languages:=english', '#tags:"=My Tag Two"', 'tags:=nomatch',
+        ):
+            ae(cache.search(query), unindexed(query), query)
+
+        sqp = cache._search_api.create_parser(cache)
+        ae(sqp.term_cost(['token', 'tags', '=.fiction'], 3), (INDEXED_TERM, 3))
+        ae(sqp.term_cost(['token', 'tags', '=news'], 3), (INDEXED_TERM, 1))
+        ae(sqp.term_cost(['token', 'title', '=news'], 3), (SCANNED_TERM, 3))
+        ae(sqp.term_cost(['token', 'template', 'x'], 3), (EXPENSIVE_TERM, 3))
+        ae(sqp._get_tree('a and b and (c or d or e)'), [
+            'and', ['token', 'all', 'a'], ['token', 'all', 'b'], ['or', ['token', 'all', 'c'], ['token', 'all', 'd'], ['token', 'all', 'e']]])
+        seen = []
+        orig = sqp.get_matches
+
+        def get_matches(location, query, candidates=None, allow_recursion=True):
+            seen.append((location, query, frozenset(candidates)))
+            return orig(location, query, candidates=candidates, allow_recursion=allow_recursion)
+        sqp.get_matches = get_matches
+        sqp.all_book_ids = cache._all_book_ids(type=set)
+        ae(sqp.parse('title:~title and tags:=news'), {1})
+        # The indexed term is evaluated first and the scanned term only sees its matches
+        ae(seen, [('tags', '=news', frozenset({1, 2, 3})), ('title', '~title', frozenset({1}))])
+        # The indices are rebuilt after a change
+        cache.set_field('tags', {2: ('News',)})
+        ae(cache.search('tags:=news'), {1, 2})
+    # }}}
+
     def test_search_caching(self):  # {{{
         ' Test caching of searches '
-        from calibre.db.search import LRUCache
+        from calibre.db.search import SearchCache
 
-        class TestCache(LRUCache):
+        class TestCache(SearchCache):
             hit_counter = 0
             miss_counter = 0
 
             def get(self, key, default=None):
-                ans = LRUCache.get(self, key, default=default)
+                ans = SearchCache.get(self, key, default=default)
                 if ans is not None:
                     self.hit_counter += 1
                 else:
@@ -604,6 +882,127 @@ class ReadingTest(BaseTest):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_id_sets(self):  # {{{
+        ' Test the bitmap sets of book ids used for search results '
+        import pickle
+        import random
+
+        from calibre.db.idset import FrozenIdSet, IdSet, intersector
+        from calibre.db.search import Parser
+        from calibre.ebooks.metadata.book.base import Metadata
+        ae = self.assertEqual
+        r = random.Random(42)
+        for limit in (100, 200000, 10**7):
+            a = {r.randrange(limit) for i in range(500)}
+            b = {r.randrange(limit) for i in range(500)} | set(list(a)[:100])
+            ia, ib = IdSet(a), FrozenIdSet(b)
+            ae(ia, a), ae(b, ib), ae(len(ia), len(a)), ae(list(ia), sorted(a))
+            ae(ia & ib, a & b), ae(ia | ib, a | b), ae(ia - ib, a - b), ae(ia ^ ib, a ^ b)
+            ae(b - ia, b - a), ae(a & ib, a & b)
+            ae(ia.intersection(b, a), a & b), ae(ia.union(list(b)), a | b)
+            ae(ia <= ia | ib, True), ae(ia.isdisjoint(ib), a.isdisjoint(b))
+            for x in range(0, limit, max(1, limit // 1000)):
+                ae(x in ia, x in a)
+            ids = list(a | b)
+            r.shuffle(ids)
+            ae(ia.filter(ids), [x for x in ids if x in a])
+            restrict = intersector(ia)
+            ae(restrict(b), a & b), ae(restrict({limit + 1}), set()), ae(intersector(a)(b), a & b)
+            ae(pickle.loads(pickle.dumps(ib)), ib)
+            ae(hash(FrozenIdSet(b)), hash(ib)), ae(hash(ib), hash(frozenset(b)))
+            ae({frozenset(b): 1}.get(ib), 1)
+            for x in ids[:50]:
+                ia.discard(x), a.discard(x)
+            ia.update(range(10)), a.update(range(10))
+            ia.difference_update(b), a.difference_update(b)
+            ae(ia, a), ae(len(ia), len(a))
+        self.assertRaises(ValueError, IdSet, [1, -1])
+        self.assertNotIn(-1, ia), self.assertNotIn('x', ia)
+
+        cache = self.init_cache()
+        for q in ('', 'Unknown', 'title:=xxx or tags:=News'):
+            ans = cache.search(q)
+            self.assertIsInstance(ans, IdSet)
+            ae(cache.search(q), ans)
+        cache.set_pref('virtual_libraries', {'1': 'title:"=Title One"'})
+        ans = cache.books_in_virtual_library('1', 'tags:=News')
+        self.assertIsInstance(ans, FrozenIdSet)
+        ae(ans, cache.search('title:"=Title One" and tags:=News'))
+        ae(cache.search('vl:1'), cache.search('title:"=Title One"'))
+
+        # The candidates are id sets while evaluating queries
+        seen = []
+        orig = Parser.get_matches
+
+        def get_matches(self, location, query, candidates=None, allow_recursion=True):
+            seen.append(type(candidates))
+            return orig(self, location, query, candidates=candidates, allow_recursion=allow_recursion)
+        Parser.get_matches = get_matches
+        try:
+            cache.clear_search_caches()
+            ans = cache.search('title:~title and not tags:=News or vl:1', 'authors:~author', book_ids={1, 2, 3})
+        finally:
+            Parser.get_matches = orig
+        s = cache.search
+        ae(ans, ((s('title:~title') - s('tags:=News')) | s('vl:1')) & s('authors:~author') & {1, 2, 3})
+        self.assertTrue(seen)
+        for t in seen:
+            self.assertTrue(issubclass(t, FrozenIdSet), t)
+        # The id set of all books is re-created when books are added or removed
+        all_ids = cache._search_api.all_book_ids(cache)
+        self.assertIs(cache._search_api.all_book_ids(cache), all_ids)
+        book_id = cache.create_book_entry(Metadata('new title'), apply_import_tags=False)
+        ae(cache.search(''), all_ids | {book_id})
+        cache.remove_books((book_id,))
+        ae(cache.search(''), all_ids)
+    # }}}
+
+    def test_search_cache_invalidation(self):  # {{{
+        ' Test field level invalidation, expiry and size limits in the search cache '
+        from calibre.db.search import SearchCache
+        cache = self.init_cache()
+        sc = cache._search_api.cache = SearchCache()
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        ae = self.assertEqual
+        q1, q2, q3 = 'title:"=Title One"', 'tags:=News', 'date:today'
+        ae(cache.search(q1), {2}), ae(cache.search(q2), {1}), ae(cache.search(q3), set())
+        ae(set(sc.item_map), {q1, q2, q3})
+        ae(sc.item_map[q1][2], {'title'})
+        self.assertIsNone(sc.item_map[q1][3]), self.assertIsNotNone(sc.item_map[q3][3])
+        stats = cache.search_cache_stats(reset=True)
+        ae((stats['hits'], stats['misses'], stats['entries']), (0, 3, 3))
+        # Only searches on the changed fields are affected
+        cache.set_field('publisher', {1: 'p1'})
+        ae(set(sc.item_map), {q1, q2, q3})
+        cache.set_field('tags', {1: ('newtag',)})
+        ae(set(sc.item_map), {q1, q3})
+        ae(cache.search(q2), set())
+        cache.set_field('title', {2: 'changed'})
+        ae(set(sc.item_map), {q2, q3})
+        ae(cache.search(q1), set())
+        stats = cache.search_cache_stats()
+        ae((stats['hits'], stats['misses'], stats['invalidations']), (0, 2, 2))
+        # Searches that could match any field are affected by every change
+        ae(cache.search('Unknown'), {3})
+        cache.set_field('rating', {1: 4})
+        self.assertNotIn('Unknown', sc)
+        # Changes are merged into the cached results rather than discarding them
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        cache.set_field('tags', {3: ('News',)})
+        self.assertIn(q2, sc)
+        ae(cache.search(q2), {3})
+        # Searches on relative dates expire
+        sc.item_map[q3][3] = 0
+        ae(cache.search(q3), set())
+        ae(cache.search_cache_stats()['expirations'], 1)
+        # The cache is limited by the memory used by the results
+        sc.max_size = sc.size
+        cache.search('tags:=newtag')
+        self.assertLessEqual(sc.size, sc.max_size)
+        self.assertGreater(cache.search_cache_stats()['evictions'], 0)
+        self.assertIn('tags:=newtag', sc)
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -790,6 +1189,26 @@ class ReadingTest(BaseTest):
         ):
             self.assertEqual(books, cache.find_identical_books(mi))
             self.assertEqual(books, find_identical_books(mi, data))
+
+        # The index is kept up to date as books are changed, added and removed
+        mi = Metadata('title one', ['author one'])
+        self.assertEqual(cache.find_identical_books(mi, book_ids={1, 3}), set())
+        cache.set_field('title', {3: 'Title-One'})
+        cache.set_field('authors', {3: ['author one', 'author two']})
+        self.assertEqual(cache.find_identical_books(mi), {2, 3})
+        self.assertEqual(cache.find_identical_books(mi, book_ids={1, 3}), {3})
+        self.assertTrue(cache.has_book(Metadata('title-one')))
+        book_id = cache.create_book_entry(Metadata('Title One', ['Author One']))
+        self.assertEqual(cache.find_identical_books(mi), {2, 3, book_id})
+        cache.remove_books((2, book_id))
+        self.assertEqual(cache.find_identical_books(mi), {3})
+        self.assertFalse(cache.has_book(Metadata('title one')))
+
+        cache.set_field('identifiers', {1: {'isbn': '978-0-316-21236-6', 'test': 'ABC'}})
+        self.assertEqual(cache.find_books_with_identifiers({'isbn': '9780316212366'}), {1})
+        self.assertEqual(cache.find_books_with_identifiers({'test': 'abc', 'isbn': '1'}), {1})
+        cache.set_field('identifiers', {1: {}})
+        self.assertEqual(cache.find_books_with_identifiers({'test': 'abc'}), set())
     # }}}
 
     def test_last_read_positions(self):  # {{{
@@ -955,3 +1374,53 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_template_compiler(self):  # {{{
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter_benchmark import TEMPLATES, evaluate
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+        for template in TEMPLATES:
+            interpreted = evaluate(SafeFormat(), template, mi, False)
+            # Programs are compiled on their second evaluation
+            compiled = evaluate(SafeFormat(), template, mi, True)
+            self.assertEqual(interpreted, compiled, template)
+            self.assertEqual(len(set(compiled)), 1, template)
+        # Templates that use the database functions
+        cache = self.init_cache(self.library_path)
+        cache.create_custom_column('mult', 'CC1', 'composite', True, display={'composite_template': 'b,a,c'})
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+        for template in (
+            'program: book_count("series:true", 0)',
+            'program: book_count("series:afafaf", 0)',
+            'program: book_values("tags", "tags:true", ",", 0)',
+            'program: book_values("series", "series:true", ",", 0)',
+            'program: book_values("tags", "series:\\"A Series One\\"", ",", 0)',
+            'program: book_values("series", "series:false", ",", 0)',
+            'program: book_values("tags", "tags:false", ",", 0)',
+            'program: book_values("taaags", "tags:false", ",", 0)',
+            'program: book_values("id", "title:true", ",", 0)',
+            'program: book_values("#mult", "id:1", ",", 0)',
+            'program: book_values("#float", "title:true", ",", 0)',
+            'program: book_values("rating", "title:true", ",", 0)',
+        ):
+            formatter, template_cache = SafeFormat(), {}
+            formatter.compile_templates = False
+            interpreted = formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi)
+            formatter.compile_templates = True
+            for i in range(2):
+                compiled = formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi, column_name='test', template_cache=template_cache)
+                self.assertEqual(interpreted, compiled, template)
+            self.assertIsNotNone(template_cache['test'].compiled, template)
+        # The debugger always uses the interpreter
+        from calibre.utils.formatter import Program
+        formatter, cache, seen = SafeFormat(), {}, []
+        for i in range(3):
+            formatter.safe_format('program: $title', {}, 'TEMPLATE ERROR', mi, column_name='title', template_cache=cache,
+                                  break_reporter=lambda *a: seen.append(a))
+        self.assertTrue(seen)
+        prog = cache['title']
+        self.assertIsInstance(prog, Program)
+        self.assertIsNone(prog.compiled)
+    # }}}
@@ -80,4 +80,39 @@ class UtilsTest(BaseTest):
         self.assertIsNone(c[1][0])
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
+
+        # Thumbnails added and removed after the index was written are
+        # recovered from the pack
+        c = self.init_tc()
+        self.basic_fill(c)
+        c.shutdown()
+        c = self.init_tc()
+        c.insert(6, 6, b'6' * 6000)
+        c.invalidate((2,))
+        c.insert(1, 7, b'7' * 1000)
+        c.pack_file.close()  # simulate a crash, the index is not written
+        c = self.init_tc()
+        self.assertEqual(len(c), 5)
+        self.assertEqual(sorted(k[1] for k in c.items), [1, 3, 4, 5, 6])
+        self.assertEqual(c[1], (b'7' * 1000, 7))
+        self.assertEqual(c[6], (b'6' * 6000, 6))
+        self.assertIsNone(c[2][0])
+
+        # Removed thumbnails are dropped from the pack by compaction
+        from calibre.db import utils
+        orig, utils.COMPACTION_SLACK = utils.COMPACTION_SLACK, 0
+        try:
+            c.invalidate((1, 3, 4))
+        finally:
+            utils.COMPACTION_SLACK = orig
+        packs = [x for x in os.listdir(c.location) if x.startswith('pack-')]
+        self.assertEqual(len(packs), 1)
+        self.assertLessEqual(os.path.getsize(os.path.join(c.location, packs[0])), 2 * c.total_size)
+        self.assertEqual(c[5], (b'5' * 5000, 5))
+        c.shutdown()
+        c = self.init_tc()
+        self.assertEqual(len(c), 2)
+        self.assertEqual(sorted(k[1] for k in c.items), [5, 6])
+        self.assertEqual(c[6], (b'6' * 6000, 6))
+        c.shutdown()
     # }}}
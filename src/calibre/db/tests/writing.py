@@ -424,6 +424,59 @@ class WritingTest(BaseTest):
         ae(notes_before, notes_after)
     # }}}
 
+    def test_backup_batches(self):  # {{{
+        'Test backing up the metadata of many books at once'
+        from calibre.db.backup import MAX_BATCH_SIZE, MIN_BATCH_SIZE, MetadataBackup, worker_pool, write_opfs
+        from calibre.ebooks.metadata.opf2 import OPF
+        cache = self.init_cache(self.cloned_library)
+        ae = self.assertEqual
+        cache.dump_metadata()
+        cache.set_field('title', {1: 'title1', 2: 'title2', 3: 'title3'})
+        ae(cache.dirtied_books_for_dump(2), [1, 2])
+        snapshots = cache.get_metadata_for_dump_batch((1, 2))
+        ae([s[0] for s in snapshots], [1, 2])
+        # A book dirtied again after its metadata was read remains dirtied
+        cache.set_field('title', {2: 'title2 again'})
+        cache.clear_dirtied_books({book_id: sequence for book_id, path, mi, sequence in snapshots})
+        ae(set(cache.dirtied_cache), {2, 3})
+
+        batches, orig = [], cache.get_metadata_for_dump_batch
+
+        def get_metadata_for_dump_batch(book_ids):
+            batches.append(tuple(book_ids))
+            return orig(book_ids)
+        cache.get_metadata_for_dump_batch = get_metadata_for_dump_batch
+        results = []
+        cache.dump_metadata(callback=lambda *a: results.append(a))
+        ae(len(batches), 1)
+        ae(results[0], (2, True, False))
+        ae({r[0] for r in results[1:]}, {2, 3})
+        self.assertFalse(cache.dirtied_cache)
+        for book_id, title in ((1, 'title1'), (2, 'title2 again'), (3, 'title3')):
+            ae(OPF(BytesIO(cache.read_backup(book_id))).title, title)
+
+        # Books moved or deleted after their metadata was read are skipped and
+        # their old folders are not re-created
+        snapshots = cache.get_metadata_for_dump_batch((1, 2, 3))
+        old_paths = {s[0]: os.path.join(cache.backend.library_path, s[1]) for s in snapshots}
+        cache.set_field('title', {1: 'moved title'})
+        cache.remove_books((3,), permanent=True)
+        with worker_pool() as pool:
+            results = {r[0]: r[3] for r in write_opfs(cache, pool, snapshots)}
+        ae(results, {1: 'skip', 2: None, 3: 'skip'})
+        self.assertFalse(os.path.exists(old_paths[1]))
+        self.assertFalse(os.path.exists(old_paths[3]))
+
+        mb = MetadataBackup(cache)
+        mb.adapt_batch_size(0, 1)
+        ae(mb.batch_size, 2 * MIN_BATCH_SIZE)
+        for i in range(20):
+            mb.adapt_batch_size(0.0001, mb.batch_size)
+        ae(mb.batch_size, MAX_BATCH_SIZE)
+        mb.adapt_batch_size(10, mb.batch_size)
+        ae(mb.batch_size, MAX_BATCH_SIZE // 2)
+    # }}}
+
     def test_set_cover(self):  # {{{
         ' Test setting of cover '
         cache = self.init_cache()
@@ -507,6 +560,44 @@ class WritingTest(BaseTest):
 
     # }}}
 
+    def test_set_fields(self):  # {{{
+        ' Test setting many fields for many books at once '
+        ae = self.assertEqual
+        changes = {
+            1: {'title': 'New Title', 'sort': 'Sort One', 'tags': ('x', 'News'), '#series': 'S [3]', '#series_index': 7},
+            2: {'authors': ('New Author',), 'rating': 4, 'series': 'A Series Two', 'series_index': 3},
+            3: {'title': 'Three', 'languages': ('fra',), '#tags': ('a', 'b'), 'publisher': None},
+        }
+        one_at_a_time = self.init_cache(self.cloned_library)
+        for name in ('title', 'authors', 'sort', 'tags', 'rating', 'series', 'languages', '#series', '#tags', 'publisher', 'series_index', '#series_index'):
+            one_at_a_time.set_field(name, {book_id: vals[name] for book_id, vals in changes.items() if name in vals})
+        cache = self.init_cache(self.cloned_library)
+        update_path, calls = cache._update_path, []
+
+        def counting_update_path(book_ids, mark_as_dirtied=True):
+            calls.append(set(book_ids))
+            return update_path(book_ids, mark_as_dirtied=mark_as_dirtied)
+        cache._update_path = counting_update_path
+        ae(cache.set_fields(changes), {1, 2, 3})
+        ae(calls, [{1, 2, 3}])
+        ae(set(cache.dirtied_cache), {1, 2, 3})
+        for book_id in changes:
+            self.compare_metadata(cache.get_metadata(book_id), one_at_a_time.get_metadata(book_id), exclude={'last_modified'})
+        ae(cache.field_for('sort', 1), 'Sort One')
+        ae(cache.field_for('#series_index', 1), 7)
+        ae(cache.field_for('path', 1), '{}/New Title (1)'.format(cache.field_for('authors', 1)[0]))
+        self.assertTrue(os.path.exists(cache.format_abspath(1, 'FMT1')))
+
+        # Nothing changes if any of the values is invalid
+        cache = self.init_cache(self.cloned_library)
+        title, tags = cache.field_for('title', 1), cache.field_for('tags', 1)
+        self.assertRaises(KeyError, cache.set_fields, {1: {'title': 'x', 'unknown field': 1}})
+        ae(cache.field_for('title', 1), title)
+        self.assertRaises(ValueError, cache.set_fields, {1: {'tags': ('x',), 'series_index': 'not a number'}})
+        ae(cache.field_for('tags', 1), tags)
+        ae(cache.set_fields({}), set())
+    # }}}
+
     def test_conversion_options(self):  # {{{
         ' Test saving of conversion options '
         cache = self.init_cache()
@@ -727,6 +818,52 @@ class WritingTest(BaseTest):
         test_invalidate()
     # }}}
 
+    def test_composite_store(self):  # {{{
+        ' Test the tracking of the fields composite columns depend on and the store of rendered values '
+        from calibre.db.composites import template_dependencies
+        ae = self.assertEqual
+        cache = self.init_cache()
+        cache.create_custom_column('ct', 'CT', 'composite', False, display={'composite_template':'{title} {#float:human_readable()}'})
+        cache.create_custom_column('cv', 'CV', 'composite', False, display={'composite_template':"{:'virtual_libraries()'}"})
+        cache.create_custom_column('cc', 'CC', 'composite', False, display={'composite_template':'program: strcat($#ct, field("tags"))'})
+        cache = self.init_cache()
+        f = cache.fields
+        ae(f['#ct'].dependencies, {'title', '#float'})
+        self.assertIsNone(f['#cv'].dependencies)
+        ae(f['#cc'].dependencies, {'#ct', 'title', '#float', 'tags'})
+        is_field = f.__contains__
+        self.assertIsNone(template_dependencies('program: field(strcat("ta", "gs"))', is_field))
+        self.assertIsNone(template_dependencies('program: my_function()', is_field))
+        self.assertIsNone(template_dependencies('python:\ndef evaluate(book, context):\n\treturn book.title', is_field))
+        ae(template_dependencies("{:'approximate_formats()'}", is_field), {'formats'})
+        ae(template_dependencies('{isbn} {title_sort}', is_field), {'identifiers', 'sort'})
+
+        # Only the columns that depend on the changed fields are invalidated
+        book_ids = cache.all_book_ids()
+        for name in ('#ct', '#cv', '#cc'):
+            cache.all_field_for(name, book_ids)
+        cache.set_field('tags', {1: ('a',)})
+        self.assertIn(1, f['#ct']._render_cache)
+        self.assertNotIn(1, f['#cc']._render_cache)
+        self.assertNotIn(1, f['#cv']._render_cache)
+        ae(cache.field_for('#cc', 1), cache.field_for('#ct', 1) + 'a')
+        cache.set_field('title', {2: 'changed'})
+        self.assertNotIn(2, f['#ct']._render_cache)
+        self.assertTrue(cache.field_for('#ct', 2).startswith('changed'))
+
+        # Unchanged values are not rendered again after a restart
+        expected = cache.all_field_for('#ct', book_ids)
+        cache.close()
+        cache = self.init_cache()
+        ct = cache.fields['#ct']
+        ct._CompositeField__render = lambda *a: self.fail('Stored value not used')
+        ae(cache.all_field_for('#ct', book_ids), expected)
+        del ct._CompositeField__render
+        cache.set_field('title', {1: 'again'})
+        self.assertTrue(cache.field_for('#ct', 1).startswith('again'))
+        ae(cache.all_field_for('#ct', book_ids), self.init_cache().all_field_for('#ct', book_ids))
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         import warnings
@@ -1050,3 +1187,58 @@ class WritingTest(BaseTest):
         self.assertEqual({}, cache.get_link_map('publisher'), 'links on publisher were not deleted')
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
     # }}}
+
+    def test_incremental_reload(self):  # {{{
+        ' Test that reload_from_db() re-reads only the data changed by another process '
+        cl = self.cloned_library
+        cache, other = self.init_cache(cl), self.init_cache(cl)
+        ae = self.assertEqual
+        fields = ('title', 'authors', 'tags', 'publisher', 'series', 'comments', 'formats', 'identifiers', 'uuid', 'size', '#tags', '#yesno')
+        ae(cache.search('tags:"=News"'), {1})
+        cache.field_for('#formats', 2)
+        cache.field_for('#formats', 1)
+        other.set_field('title', {1: 'changed title'})
+        other.set_field('tags', {1: ('newtag',)})
+        other.set_field('identifiers', {1: {'isbn': '123'}})
+        other.set_field('#tags', {1: ('a', 'b')})
+        other.rename_items('publisher', {other.get_item_id('publisher', 'Publisher Two'): 'renamed'})
+        new_id = other.create_book_entry(Metadata('new book', ['New Author']))
+        other.remove_books((3,), permanent=True)
+
+        seq, changes = cache.backend.changes_since(cache.backend.last_change_seq)
+        self.assertNotIn('books_series_link', changes)
+        ae(changes['books_tags_link'][0], {1})
+        ae(changes['publishers'][1], {other.get_item_id('publisher', 'renamed')})
+        cache.reload_from_db()
+        ae(cache.backend.last_change_seq, seq)
+        # Only the caches for the changed books are cleared
+        self.assertIn(2, cache.fields['#formats']._render_cache)
+        self.assertNotIn(1, cache.fields['#formats']._render_cache)
+        ae(cache.search('tags:"=newtag"'), {1})
+        ae(cache.search('tags:"=News"'), set())
+        fresh = self.init_cache(cl)
+        ae(cache.all_book_ids(), fresh.all_book_ids())
+        self.assertIn(new_id, cache.all_book_ids())
+        for field in fields:
+            for book_id in fresh.all_book_ids():
+                ae(cache.field_for(field, book_id), fresh.field_for(field, book_id), f'{field} differs for book: {book_id}')
+        ae(cache.fields['uuid'].table.uuid_to_id_map, fresh.fields['uuid'].table.uuid_to_id_map)
+        ae(cache.get_item_id('publisher', 'renamed'), fresh.get_item_id('publisher', 'renamed'))
+
+        # A pruned change log causes a full reload
+        other.set_field('title', {2: 'another title'})
+        other.backend.prune_change_log(keep=0)
+        self.assertIsNone(cache.backend.changes_since(cache.backend.last_change_seq))
+        cache.reload_from_db()
+        ae(cache.field_for('title', 2), 'another title')
+        ae(cache.backend.last_change_seq, other.backend.current_change_seq())
+
+        # The change log is pruned as it grows
+        from calibre.db.schema_upgrades import CHANGE_LOG_PRUNE_INTERVAL, CHANGE_LOG_SIZE, CHANGE_LOG_TABLE
+        with other.backend.conn:
+            other.backend.executemany(
+                f'INSERT INTO {CHANGE_LOG_TABLE} (tbl, book) VALUES (?, ?)', (('books', 1) for i in range(CHANGE_LOG_SIZE + 2 * CHANGE_LOG_PRUNE_INTERVAL)))
+        self.assertLessEqual(other.backend.conn.get(f'SELECT COUNT(*) FROM {CHANGE_LOG_TABLE}', all=False), CHANGE_LOG_SIZE + CHANGE_LOG_PRUNE_INTERVAL)
+        for c in (cache, other, fresh):
+            c.close()
+    # }}}
@@ -5,9 +5,11 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import errno
+import mmap
 import os
 import re
 import shutil
+import struct
 import sys
 from collections import OrderedDict, namedtuple
 from contextlib import suppress
@@ -18,7 +20,7 @@ from calibre import as_unicode, prints
 from calibre.constants import cache_dir, get_windows_number_formats, iswindows, preferred_encoding
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.localization import canonicalize_lang
-from polyglot.builtins import iteritems, itervalues, string_or_bytes
+from polyglot.builtins import iteritems, string_or_bytes
 
 
 def force_to_bool(val):
@@ -99,13 +101,32 @@ def find_identical_books(mi, data):
     return {book_id for book_id in ans if lang_matches(book_id)}
 
 
-Entry = namedtuple('Entry', 'path size timestamp thumbnail_size')
+Entry = namedtuple('Entry', 'offset size timestamp thumbnail_size')
 
 
 class CacheError(Exception):
     pass
 
 
+# The thumbnails are stored one after another in an append-only pack file.
+# Every thumbnail is preceded by a record header, and removals are recorded
+# by a header with no data, so the pack describes itself. The binary index
+# records the position of every thumbnail in the pack, in least recently used
+# order. It is written on shutdown and after compaction and covers the pack
+# up to the size recorded in it, anything appended after that is recovered by
+# reading the record headers. The space used by removed thumbnails is
+# reclaimed by compaction, which writes the live thumbnails to a new pack.
+PACK_RECORD = struct.Struct('<4sIQdIHH')  # magic, group length, book_id, timestamp, size, width, height
+PACK_MAGIC = b'THMB'
+REMOVED = -1.0  # The timestamp of records that remove a thumbnail
+INDEX_HEADER = struct.Struct('<8sIQQII')  # magic, version, pack id, pack size, number of groups, number of entries
+INDEX_ENTRY = struct.Struct('<IQdQIHH')  # group, book_id, timestamp, offset, size, width, height
+INDEX_MAGIC, INDEX_VERSION = b'CALTHUMB', 1
+# The pack is compacted when it is larger than twice the size of the live
+# thumbnails plus this many bytes
+COMPACTION_SLACK = 8 * 1024 * 1024
+
+
 class ThumbnailCache:
     ' This is a persistent disk cache to speed up loading and resizing of covers '
 
@@ -128,6 +149,8 @@ class ThumbnailCache:
         self.size_changed = False
         self.lock = Lock()
         self.min_disk_cache = min_disk_cache
+        self.pack_id = self.pack_file = self.pack_map = None
+        self.pack_size = 0
         if test_mode:
             self.log = self.fail_on_error
 
@@ -143,7 +166,11 @@ class ThumbnailCache:
         try:
             os.remove(path)
         except OSError as err:
-            self.log('Failed to delete cached thumbnail file:', as_unicode(err))
+            if err.errno != errno.ENOENT:
+                self.log('Failed to delete thumbnail cache file:', as_unicode(err))
+
+    def _pack_path(self, pack_id):
+        return os.path.join(self.location, f'pack-{pack_id:016x}')
 
     def _load_index(self):
         '''
@@ -172,17 +199,6 @@ class ThumbnailCache:
                 self.log('Failed to make thumbnail cache dir:', as_unicode(err))
         self.total_size = 0
         self.items = OrderedDict()
-        order = self._read_order()
-
-        def listdir(*args):
-            try:
-                return os.listdir(os.path.join(*args))
-            except OSError:
-                return ()  # not a directory or no permission or whatever
-        entries = ('/'.join((parent, subdir, entry))
-                   for parent in listdir(self.location)
-                   for subdir in listdir(self.location, parent)
-                   for entry in listdir(self.location, parent, subdir))
 
         invalidate = set()
         try:
@@ -205,28 +221,182 @@ class ThumbnailCache:
                     except Exception:
                         return None
                 invalidate = {record(x) for x in raw.splitlines()}
-        items = []
+
+        items, indexed_size = self._read_index()
+        if self.pack_id is None:
+            # No index was written, use the pack that was being appended to
+            with suppress(OSError, ValueError):
+                packs = [x for x in os.listdir(self.location) if x.startswith('pack-')]
+                if packs:
+                    latest = max(packs, key=lambda x: os.path.getmtime(os.path.join(self.location, x)))
+                    self.pack_id = int(latest[5:], 16)
+        if self.pack_id is not None:
+            try:
+                self.pack_size = os.path.getsize(self._pack_path(self.pack_id))
+            except OSError:
+                items, indexed_size, self.pack_id = OrderedDict(), 0, None
+        if self.pack_id is not None and self.pack_size > indexed_size:
+            self._read_pack_records(indexed_size, items)
+        for key, entry in items.items():
+            if self.thumbnail_size == entry.thumbnail_size and key not in invalidate and entry.offset + entry.size <= self.pack_size:
+                self.items[key] = entry
+                self.total_size += entry.size
+
+        # Remove everything that is not part of the current pack, such as the
+        # files of the per thumbnail storage used by previous versions
         try:
-            for entry in entries:
-                try:
-                    uuid, name = entry.split('/')[0::2]
-                    book_id, timestamp, size, thumbnail_size = name.split('-')
-                    book_id, timestamp, size = int(book_id), float(timestamp), int(size)
-                    thumbnail_size = tuple(map(int, thumbnail_size.partition('x')[0::2]))
-                except (ValueError, TypeError, IndexError, KeyError, AttributeError):
-                    continue
-                key = (uuid, book_id)
-                path = os.path.join(self.location, entry)
-                if self.thumbnail_size == thumbnail_size and key not in invalidate:
-                    items.append((key, Entry(path, size, timestamp, thumbnail_size)))
-                    self.total_size += size
+            names = os.listdir(self.location)
+        except OSError as err:
+            self.log('Failed to read thumbnail cache dir:', as_unicode(err))
+            names = ()
+        keep = {'version', 'index'}
+        if self.pack_id is not None:
+            keep.add(os.path.basename(self._pack_path(self.pack_id)))
+        for name in names:
+            if name not in keep:
+                path = os.path.join(self.location, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
                 else:
                     self._do_delete(path)
+        if self.pack_id is None:
+            self._do_delete(os.path.join(self.location, 'index'))
+        self._apply_size()
+        self._compact_if_needed()
+
+    def _read_index(self):
+        items = OrderedDict()
+        self.pack_id, self.pack_size = None, 0
+        try:
+            with open(os.path.join(self.location, 'index'), 'rb') as f:
+                raw = f.read()
         except OSError as err:
-            self.log('Failed to read thumbnail cache dir:', as_unicode(err))
+            if getattr(err, 'errno', None) != errno.ENOENT:
+                self.log('Failed to read thumbnail cache index:', as_unicode(err))
+            return items, 0
+        try:
+            magic, version, pack_id, pack_size, num_groups, num_entries = INDEX_HEADER.unpack_from(raw)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return items, 0
+            pos, groups = INDEX_HEADER.size, []
+            for i in range(num_groups):
+                size = int.from_bytes(raw[pos:pos+2], 'little')
+                groups.append(raw[pos+2:pos+2+size].decode('utf-8'))
+                pos += 2 + size
+            if len(raw) != pos + num_entries * INDEX_ENTRY.size:
+                return items, 0
+            for group, book_id, timestamp, offset, size, width, height in INDEX_ENTRY.iter_unpack(raw[pos:]):
+                items[(groups[group], book_id)] = Entry(offset, size, timestamp, (width, height))
+        except Exception as err:
+            self.log('Failed to parse thumbnail cache index:', as_unicode(err))
+            return OrderedDict(), 0
+        self.pack_id = pack_id
+        return items, pack_size
 
-        self.items = OrderedDict(sorted(items, key=lambda x: order.get(x[0], 0)))
-        self._apply_size()
+    def _read_pack_records(self, pos, items):
+        # Recover the records appended to the pack after the index was written
+        try:
+            with open(self._pack_path(self.pack_id), 'rb') as f:
+                f.seek(pos)
+                while True:
+                    header = f.read(PACK_RECORD.size)
+                    if len(header) < PACK_RECORD.size:
+                        break
+                    magic, glen, book_id, timestamp, size, width, height = PACK_RECORD.unpack(header)
+                    if magic != PACK_MAGIC:
+                        break
+                    key = f.read(glen).decode('utf-8', 'replace'), book_id
+                    offset = f.tell()
+                    items.pop(key, None)
+                    if timestamp != REMOVED:
+                        items[key] = Entry(offset, size, timestamp, (width, height))
+                    f.seek(offset + size)
+        except OSError as err:
+            self.log('Failed to read thumbnail cache pack:', as_unicode(err))
+
+    def _close_pack(self):
+        if self.pack_map is not None:
+            self.pack_map.close()
+            self.pack_map = None
+        if self.pack_file is not None:
+            self.pack_file.close()
+            self.pack_file = None
+
+    def _append(self, key, timestamp, data=b'', thumbnail_size=(0, 0)):
+        # Append a record to the pack, returning the offset of its data
+        if self.pack_file is None:
+            if self.pack_id is None:
+                self.pack_id, self.pack_size = int.from_bytes(os.urandom(8), 'little'), 0
+            self.pack_file = open(self._pack_path(self.pack_id), 'ab')
+            self.pack_size = self.pack_file.tell()
+        group = key[0].encode('utf-8')
+        self.pack_file.write(PACK_RECORD.pack(PACK_MAGIC, len(group), key[1], timestamp, len(data), *thumbnail_size) + group)
+        self.pack_file.write(data)
+        self.pack_file.flush()
+        offset = self.pack_size + PACK_RECORD.size + len(group)
+        self.pack_size = offset + len(data)
+        return offset
+
+    def _read(self, entry):
+        end = entry.offset + entry.size
+        if self.pack_map is None or len(self.pack_map) < end:
+            if self.pack_map is not None:
+                self.pack_map.close()
+                self.pack_map = None
+            with open(self._pack_path(self.pack_id), 'rb') as f:
+                self.pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.pack_map[entry.offset:end]
+
+    def _write_index(self):
+        if self.pack_id is None:
+            return
+        groups = {}
+        entries = []
+        for (group_id, book_id), entry in self.items.items():
+            group = groups.setdefault(group_id, len(groups))
+            entries.append(INDEX_ENTRY.pack(group, book_id, entry.timestamp, entry.offset, entry.size, *entry.thumbnail_size))
+        data = [INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.pack_id, self.pack_size, len(groups), len(entries))]
+        for group_id in groups:
+            raw = group_id.encode('utf-8')
+            data.append(len(raw).to_bytes(2, 'little') + raw)
+        data.extend(entries)
+        path = os.path.join(self.location, 'index')
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(b''.join(data))
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            self.log('Failed to write thumbnail cache index:', as_unicode(err))
+
+    def _compact_if_needed(self):
+        if not self.items:
+            if self.pack_id is not None:
+                self._close_pack()
+                self._do_delete(os.path.join(self.location, 'index'))
+                self._do_delete(self._pack_path(self.pack_id))
+                self.pack_id, self.pack_size = None, 0
+        elif self.pack_size > 2 * self.total_size + COMPACTION_SLACK:
+            self._compact()
+
+    def _compact(self):
+        ' Copy the live thumbnails to a new pack, dropping everything else '
+        old_id, old_items = self.pack_id, self.items
+        data = {key: self._read(entry) for key, entry in old_items.items()}
+        self._close_pack()
+        self.pack_id, self.items = None, OrderedDict()
+        try:
+            for key, entry in old_items.items():
+                offset = self._append(key, entry.timestamp, data[key], entry.thumbnail_size)
+                self.items[key] = entry._replace(offset=offset)
+        except OSError as err:
+            self.log('Failed to compact thumbnail cache:', as_unicode(err))
+            self._close_pack()
+            self._do_delete(self._pack_path(self.pack_id))
+            self.pack_id, self.items = old_id, old_items
+            self.pack_size = os.path.getsize(self._pack_path(old_id))
+            return
+        self._write_index()
+        self._do_delete(self._pack_path(old_id))
 
     def _invalidate_sizes(self):
         if self.size_changed:
@@ -235,44 +405,26 @@ class ThumbnailCache:
             for key in remove:
                 self._remove(key)
             self.size_changed = False
+            self._compact_if_needed()
 
     def _remove(self, key):
         entry = self.items.pop(key, None)
         if entry is not None:
-            self._do_delete(entry.path)
             self.total_size -= entry.size
-
-    def _apply_size(self):
-        while self.total_size > self.max_size and self.items:
-            entry = self.items.popitem(last=False)[1]
-            self._do_delete(entry.path)
-            self.total_size -= entry.size
-
-    def _write_order(self):
-        if hasattr(self, 'items'):
             try:
-                data = '\n'.join(group_id + ' ' + str(book_id) for (group_id, book_id) in self.items)
-                with open(os.path.join(self.location, 'order'), 'wb') as f:
-                    f.write(data.encode('utf-8'))
+                self._append(key, REMOVED)
             except OSError as err:
-                self.log('Failed to save thumbnail cache order:', as_unicode(err))
+                self.log('Failed to record removal of cached thumbnail:', as_unicode(err))
 
-    def _read_order(self):
-        order = {}
-        try:
-            with open(os.path.join(self.location, 'order'), 'rb') as f:
-                for line in f.read().decode('utf-8').splitlines():
-                    parts = line.split(' ', 1)
-                    if len(parts) == 2:
-                        order[(parts[0], int(parts[1]))] = len(order)
-        except Exception as err:
-            if getattr(err, 'errno', None) != errno.ENOENT:
-                self.log('Failed to load thumbnail cache order:', as_unicode(err))
-        return order
+    def _apply_size(self):
+        while self.total_size > self.max_size and self.items:
+            self._remove(next(iter(self.items)))
 
     def shutdown(self):
         with self.lock:
-            self._write_order()
+            if hasattr(self, 'items'):
+                self._write_index()
+            self._close_pack()
 
     def set_group_id(self, group_id):
         with self.lock:
@@ -294,31 +446,18 @@ class ThumbnailCache:
             if not hasattr(self, 'total_size'):
                 self._load_index()
             self._invalidate_sizes()
-            ts = (f'{timestamp:.2f}').replace('.00', '')
-            path = f'{self.group_id}{os.sep}{book_id % 100}{os.sep}{book_id}-{ts}-{len(data)}-{self.thumbnail_size[0]}x{self.thumbnail_size[1]}'
-            path = os.path.join(self.location, path)
             key = (self.group_id, book_id)
             e = self.items.pop(key, None)
             self.total_size -= getattr(e, 'size', 0)
             try:
-                with open(path, 'wb') as f:
-                    f.write(data)
+                offset = self._append(key, timestamp, data, self.thumbnail_size)
             except OSError as err:
-                d = os.path.dirname(path)
-                if not os.path.exists(d):
-                    try:
-                        os.makedirs(d)
-                        with open(path, 'wb') as f:
-                            f.write(data)
-                    except OSError as err:
-                        self.log('Failed to write cached thumbnail:', path, as_unicode(err))
-                        return self._apply_size()
-                else:
-                    self.log('Failed to write cached thumbnail:', path, as_unicode(err))
-                    return self._apply_size()
-            self.items[key] = Entry(path, len(data), timestamp, self.thumbnail_size)
+                self.log('Failed to write cached thumbnail:', as_unicode(err))
+                return self._apply_size()
+            self.items[key] = Entry(offset, len(data), timestamp, self.thumbnail_size)
             self.total_size += len(data)
             self._apply_size()
+            self._compact_if_needed()
 
     def __len__(self):
         with self.lock:
@@ -346,19 +485,13 @@ class ThumbnailCache:
             if entry is None:
                 return None, None
             if entry.thumbnail_size != self.thumbnail_size:
-                try:
-                    os.remove(entry.path)
-                except OSError as err:
-                    if getattr(err, 'errno', None) != errno.ENOENT:
-                        self.log('Failed to remove cached thumbnail:', entry.path, as_unicode(err))
                 self.total_size -= entry.size
                 return None, None
             self.items[key] = entry
             try:
-                with open(entry.path, 'rb') as f:
-                    data = f.read()
-            except OSError as err:
-                self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+                data = self._read(entry)
+            except (OSError, ValueError) as err:
+                self.log('Failed to read cached thumbnail:', as_unicode(err))
                 return None, None
             return data, entry.timestamp
 
@@ -367,6 +500,7 @@ class ThumbnailCache:
             if hasattr(self, 'total_size'):
                 for book_id in book_ids:
                     self._remove((self.group_id, book_id))
+                self._compact_if_needed()
             elif os.path.exists(self.location):
                 try:
                     raw = '\n'.join(f'{self.group_id} {book_id}' for book_id in book_ids)
@@ -384,16 +518,11 @@ class ThumbnailCache:
 
     def empty(self):
         with self.lock:
-            try:
-                os.remove(os.path.join(self.location, 'order'))
-            except OSError:
-                pass
             if not hasattr(self, 'total_size'):
                 self._load_index()
-            for entry in itervalues(self.items):
-                self._do_delete(entry.path)
             self.total_size = 0
             self.items = OrderedDict()
+            self._compact_if_needed()
 
     def __hash__(self):
         return id(self)
@@ -406,6 +535,7 @@ class ThumbnailCache:
             self.max_size = int(size_in_mb * (1024**2))
             if hasattr(self, 'total_size'):
                 self._apply_size()
+                self._compact_if_needed()
 
 
 number_separators = None
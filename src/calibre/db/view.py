@@ -157,6 +157,9 @@ class View:
         self._map_filtered = tuple(self._map)
         self.full_map_is_sorted = True
         self.sort_history = [('id', True)]
+        # The fields, result and sort_change_seq of the last sorts of the full
+        # and filtered maps, used to re-sort without sorting everything
+        self._last_sorts = {}
 
     def add_marked_listener(self, func):
         self.marked_listeners[id(func)] = weakref.ref(func)
@@ -279,7 +282,7 @@ class View:
             ids, virtual_fields={'marked':MarkedVirtualField(self.marked_ids),
                                  'in_tag_browser': InTagBrowserVirtualField(self.tag_browser_ids)})
 
-    def _do_sort(self, ids_to_sort, fields=(), subsort=False):
+    def _sort_fields(self, fields=(), subsort=False):
         fields = [(sanitize_sort_field_name(self.field_metadata, x), bool(y)) for x, y in fields]
         keys = self.field_metadata.sortable_field_keys()
         fields = [x for x in fields if x[0] in keys]
@@ -287,16 +290,34 @@ class View:
             fields += [('sort', True)]
         if not fields:
             fields = [('timestamp', False)]
+        return fields
 
+    def _do_sort(self, ids_to_sort, fields=(), subsort=False):
         return self.cache.multisort(
-            fields, ids_to_sort=ids_to_sort,
+            self._sort_fields(fields, subsort), ids_to_sort=ids_to_sort,
             virtual_fields={'marked':MarkedVirtualField(self.marked_ids),
                             'in_tag_browser': InTagBrowserVirtualField(self.tag_browser_ids)})
 
+    def _resort(self, which, ids_to_sort, fields=(), subsort=False):
+        '''
+        Sort ids_to_sort. If it is the result of the previous sort of the
+        same map on the same fields, only the books that have changed since
+        are moved, instead of sorting everything again.
+        '''
+        fields = self._sort_fields(fields, subsort)
+        seq = self.cache.sort_change_seq()
+        ans, prev = None, self._last_sorts.get(which)
+        if prev is not None and prev[0] == fields and prev[1] is ids_to_sort:
+            ans = self.cache.merge_sort(fields, ids_to_sort, prev[2])
+        if ans is None:
+            ans = self._do_sort(ids_to_sort, fields)
+        ans = tuple(ans)
+        self._last_sorts[which] = fields, ans, seq
+        return ans
+
     def multisort(self, fields=[], subsort=False, only_ids=None):
-        sorted_book_ids = self._do_sort(self._map if only_ids is None else only_ids, fields=fields, subsort=subsort)
         if only_ids is None:
-            self._map = tuple(sorted_book_ids)
+            self._map = self._resort('map', self._map, fields=fields, subsort=subsort)
             self.full_map_is_sorted = True
             self.add_to_sort_history(fields)
             if len(self._map_filtered) == len(self._map):
@@ -305,13 +326,14 @@ class View:
                 fids = frozenset(self._map_filtered)
                 self._map_filtered = tuple(i for i in self._map if i in fids)
         else:
+            sorted_book_ids = self._do_sort(only_ids, fields=fields, subsort=subsort)
             smap = {book_id:i for i, book_id in enumerate(sorted_book_ids)}
             only_ids.sort(key=smap.get)
 
     def incremental_sort(self, fields=(), subsort=False):
         if len(self._map) == len(self._map_filtered):
             return self.multisort(fields=fields, subsort=subsort)
-        self._map_filtered = tuple(self._do_sort(self._map_filtered, fields=fields, subsort=subsort))
+        self._map_filtered = self._resort('filtered', self._map_filtered, fields=fields, subsort=subsort)
         self.full_map_is_sorted = False
         self.add_to_sort_history(fields)
 
@@ -357,11 +379,12 @@ class View:
         if len(matches) == len(self._map):
             rv = list(self._map)
         else:
-            rv = [x for x in self._map if x in matches]
+            rv = matches.filter(self._map)
         if sort_results and not self.full_map_is_sorted:
             # We need to sort the search results
-            if matches.issubset(frozenset(self._map_filtered)):
-                rv = [x for x in self._map_filtered if x in matches]
+            in_filtered = matches.filter(self._map_filtered)
+            if len(in_filtered) == len(matches):
+                rv = in_filtered
             else:
                 rv = self._do_sort(rv, fields=self.sort_history)
             if len(matches) == len(self._map):
@@ -163,10 +163,7 @@ class Worker(Thread):  # {{{
         from calibre.gui2.ui import get_gui
         library_broker = get_gui().library_broker
         newdb = library_broker.get_library(self.loc)
-        self.find_identical_books_data = None
         try:
-            if self.check_for_duplicates:
-                self.find_identical_books_data = newdb.new_api.data_for_find_identical_books()
             self._doit(newdb)
         finally:
             library_broker.prune_loaded_dbs()
@@ -191,7 +188,6 @@ class Worker(Thread):  # {{{
                 book_id, self.db, newdb,
                 preserve_date=gprefs['preserve_date_on_ctl'],
                 duplicate_action=duplicate_action, automerge_action=gprefs['automerge'],
-                identical_books_data=self.find_identical_books_data,
                 preserve_uuid=self.delete_after
         )
         self.progress(num, rdata['title'])
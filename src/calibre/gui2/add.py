@@ -21,7 +21,6 @@ from calibre import as_unicode, prints
 from calibre.constants import DEBUG, filesystem_encoding, ismacos, iswindows
 from calibre.customize.ui import run_plugins_on_postadd, run_plugins_on_postimport
 from calibre.db.adding import compile_rule, find_books_in_directory
-from calibre.db.utils import find_identical_books
 from calibre.ebooks.metadata import authors_to_sort_string
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.opf2 import OPF
@@ -142,7 +141,7 @@ class Adder(QObject):
         if not self.items:
             shutil.rmtree(self.tdir, ignore_errors=True)
         self.setParent(None)
-        self.find_identical_books_data = self.merged_books = self.added_duplicate_info = self.pool = self.items = self.duplicates = self.pd = self.db = self.dbref = self.tdir = self.file_groups = self.scan_thread = None  # noqa: E501
+        self.merged_books = self.added_duplicate_info = self.pool = self.items = self.duplicates = self.pd = self.db = self.dbref = self.tdir = self.file_groups = self.scan_thread = None  # noqa: E501
         self.deleteLater()
 
     def tick(self):
@@ -270,9 +269,7 @@ class Adder(QObject):
         self.pd.value = 0
         self.pool = Pool(name='AddBooks') if self.pool is None else self.pool
         if self.db is not None:
-            if self.add_formats_to_existing:
-                self.find_identical_books_data = self.db.data_for_find_identical_books()
-            else:
+            if not self.add_formats_to_existing:
                 try:
                     self.pool.set_common_data(self.db.data_for_has_book())
                 except Failure as err:
@@ -399,7 +396,7 @@ class Adder(QObject):
             return
 
         if self.add_formats_to_existing:
-            identical_book_ids = find_identical_books(mi, self.find_identical_books_data)
+            identical_book_ids = self.db.find_identical_books(mi)
             if identical_book_ids:
                 try:
                     self.merge_books(mi, cover_path, paths, identical_book_ids)
@@ -465,9 +462,7 @@ class Adder(QObject):
             return
         self.add_formats(book_id, paths, mi, is_an_add=True)
         try:
-            if self.add_formats_to_existing:
-                self.db.update_data_for_find_identical_books(book_id, self.find_identical_books_data)
-            else:
+            if not self.add_formats_to_existing:
                 self.added_duplicate_info.add(icu_lower(mi.title or _('Unknown')))
         except Exception:
             # Ignore this exception since all it means is that duplicate
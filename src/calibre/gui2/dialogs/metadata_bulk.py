@@ -544,11 +544,14 @@ class MyBlockingBusy(QDialog):  # {{{
                     break
                 self.progress_update.emit(1)
             if self.sr_calls:
-                self.progress_next_step_range.emit(len(self.sr_calls))
+                self.progress_next_step_range.emit(1)
                 self.progress_update.emit(0)
+                book_id_to_field_map = defaultdict(dict)
                 for field, book_id_val_map in iteritems(self.sr_calls):
-                    self.refresh_books.update(self.db.new_api.set_field(field, book_id_val_map))
-                    self.progress_update.emit(1)
+                    for book_id, val in iteritems(book_id_val_map):
+                        book_id_to_field_map[book_id][field] = val
+                self.refresh_books.update(self.db.new_api.set_fields(book_id_to_field_map))
+                self.progress_update.emit(1)
                 self.progress_finished_cur_step.emit()
             self.progress_finished_cur_step.emit()
 
@@ -13,7 +13,7 @@ from collections import namedtuple
 from functools import wraps
 from io import BytesIO
 from textwrap import wrap
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 
 from qt.core import (
     QAbstractItemView,
@@ -56,7 +56,7 @@ from qt.core import (
     qRed,
 )
 
-from calibre import fit_image, human_readable, prepare_string_for_xml
+from calibre import detect_ncpus, fit_image, human_readable, prepare_string_for_xml
 from calibre.constants import DEBUG, config_dir, islinux
 from calibre.ebooks.metadata import fmt_sidx, rating_to_stars
 from calibre.gui2 import clip_border_radius, config, empty_index, gprefs, rating_font
@@ -75,6 +75,30 @@ CM_TO_INCH = 0.393701
 CACHE_FORMAT = 'PPM'
 
 
+class RenderQueue(LifoQueue):
+
+    '''
+    Requests to render covers, most recent first. Requests to prefetch covers
+    that are not yet visible, put as (book_id, True), are only served when
+    there are no requests for visible covers.
+    '''
+
+    def _init(self, maxsize):
+        self.queue, self.prefetch_queue = [], []
+
+    def _qsize(self):
+        return len(self.queue) + len(self.prefetch_queue)
+
+    def _put(self, item):
+        if isinstance(item, tuple):
+            self.prefetch_queue.append(item[0])
+        else:
+            self.queue.append(item)
+
+    def _get(self):
+        return self.queue.pop() if self.queue else self.prefetch_queue.pop()
+
+
 def auto_height(widget):
     # On some broken systems, availableGeometry() returns tiny values, we need
     # a value of at least 1000 for 200 DPI systems.
@@ -460,7 +484,7 @@ class CoverDelegate(QStyledItemDelegate):
         self.animation.setDuration(500)
         self.set_dimensions()
         self.cover_cache = CoverCache()
-        self.render_queue = LifoQueue()
+        self.render_queue = RenderQueue()
         self.animating = None
         self.highlight_color = QColor(Qt.GlobalColor.white)
         self.rating_font = QFont(rating_font())
@@ -802,7 +826,8 @@ class GridView(QListView):
             thumbnail_size=(int(dpr * self.delegate.cover_size.width()),
                             int(dpr * self.delegate.cover_size.height())),
             version=1)
-        self.render_thread = None
+        self.fetch_threads = []
+        self.in_flight, self.in_flight_lock = set(), Lock()
         self.update_item.connect(self.re_render, type=Qt.ConnectionType.QueuedConnection)
         self.doubleClicked.connect(self.double_clicked)
         self.setCursor(Qt.CursorShape.PointingHandCursor)
@@ -815,6 +840,11 @@ class GridView(QListView):
         self.resize_timer = t = QTimer(self)
         t.setInterval(200), t.setSingleShot(True)
         t.timeout.connect(self.update_memory_cover_cache_size)
+        self.prefetch_timer = t = QTimer(self)
+        t.setInterval(100), t.setSingleShot(True)
+        t.timeout.connect(self.prefetch_covers)
+        self.verticalScrollBar().valueChanged.connect(self.prefetch_timer.start)
+        self.last_scroll_pos = 0
 
     def viewportEvent(self, ev):
         if hasattr(self, 'gesture_manager'):
@@ -853,6 +883,27 @@ class GridView(QListView):
         for r in range(self.first_visible_row or 0, self.last_visible_row or (m.count() - 1)):
             self.update(m.index(r, 0))
 
+    def prefetch_covers(self):
+        # Render the covers of the next screenful of books in the direction
+        # of scrolling, so that they are ready when they become visible
+        m, first, last = self.model(), self.first_visible_row, self.last_visible_row
+        if m is None or first is None or last is None:
+            return
+        pos = self.verticalScrollBar().value()
+        rows = range(last + 1, min(m.count(), last + 1 + last - first))
+        if pos < self.last_scroll_pos:
+            rows = range(first - 1, max(-1, first - 1 - (last - first)), -1)
+        self.last_scroll_pos = pos
+        cover_cache, q = self.delegate.cover_cache.items, self.delegate.render_queue
+        # The prefetch requests are served most recent first
+        for r in reversed(rows):
+            try:
+                book_id = m.id(r)
+            except Exception:
+                continue
+            if book_id not in cover_cache:
+                q.put((book_id, True))
+
     def start_view_animation(self, index):
         d = self.delegate
         if d.animating is None and not config['disable_animations']:
@@ -950,10 +1001,13 @@ class GridView(QListView):
 
     def shown(self):
         self.update_memory_cover_cache_size()
-        if self.render_thread is None:
-            self.fetch_thread = Thread(target=self.fetch_covers)
-            self.fetch_thread.daemon = True
-            self.fetch_thread.start()
+        if not self.fetch_threads:
+            # Reading and scaling covers is mostly done in code that releases
+            # the GIL, so use a thread per CPU
+            for i in range(detect_ncpus()):
+                t = Thread(target=self.fetch_covers, name=f'CoverFetch-{i}', daemon=True)
+                t.start()
+                self.fetch_threads.append(t)
 
     def fetch_covers(self):
         q = self.delegate.render_queue
@@ -964,6 +1018,11 @@ class GridView(QListView):
                     return
                 if self.ignore_render_requests.is_set():
                     continue
+                with self.in_flight_lock:
+                    if book_id in self.in_flight:
+                        # Another thread is already rendering this cover
+                        continue
+                    self.in_flight.add(book_id)
                 thumb = None
                 try:
                     # Fetch the cover from the cache or file system
@@ -974,6 +1033,9 @@ class GridView(QListView):
                 except Exception:
                     import traceback
                     traceback.print_exc()
+                finally:
+                    with self.in_flight_lock:
+                        self.in_flight.discard(book_id)
                 # Tell the GUI to redisplay the thumbnail with the new image
                 self.update_item.emit(book_id, thumb)
 
@@ -1105,7 +1167,7 @@ class GridView(QListView):
                         return None
                 if getbbox(cdata) is None:
                     tc.invalidate((book_id,))
-                    self.render_queue.put(book_id)
+                    self.delegate.render_queue.put(book_id)
                     return None
                 # The data from the cover cache is valid and is already a thumb.
                 thumb = cdata
@@ -1144,7 +1206,8 @@ class GridView(QListView):
 
     def shutdown(self):
         self.ignore_render_requests.set()
-        self.delegate.render_queue.put(None)
+        for t in self.fetch_threads:
+            self.delegate.render_queue.put(None)
         self.thumbnail_cache.shutdown()
 
     def set_database(self, newdb, stage=0):
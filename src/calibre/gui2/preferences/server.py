@@ -261,7 +261,7 @@ class AdvancedTab(QWidget):
         self.widget_map = {}
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
         for name in sorted(options, key=lambda n: options[n].shortdoc.lower()):
-            if name in ('auth', 'port', 'allow_socket_preallocation', 'userdb'):
+            if name in ('auth', 'port', 'allow_socket_preallocation', 'userdb', 'server_processes'):
                 continue
             opt = options[name]
             if opt.choices:
@@ -9,10 +9,21 @@ import fnmatch
 import os
 import re
 import traceback
+from collections import defaultdict
 
 from calibre import isbytestring
 from calibre.constants import filesystem_encoding
-from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, METADATA_FILE_NAME, NOTES_DIR_NAME, TRASH_DIR_NAME
+from calibre.db.constants import (
+    COMPOSITES_STORE_NAME,
+    COVER_FILE_NAME,
+    DATA_DIR_NAME,
+    METADATA_FILE_NAME,
+    NOTES_DIR_NAME,
+    STAGED_FILE_PREFIX,
+    TABLES_SNAPSHOT_NAME,
+    TRASH_DIR_NAME,
+)
+from calibre.db.integrity import CHANGED, CORRUPT
 from calibre.ebooks import BOOK_EXTENSIONS
 from calibre.utils.localization import _
 from polyglot.builtins import iteritems
@@ -20,7 +31,8 @@ from polyglot.builtins import iteritems
 EBOOK_EXTENSIONS = frozenset(BOOK_EXTENSIONS)
 NORMALS = frozenset({METADATA_FILE_NAME, COVER_FILE_NAME, DATA_DIR_NAME})
 IGNORE_AT_TOP_LEVEL = frozenset({
-    'metadata.db', 'metadata_db_prefs_backup.json', 'metadata_pre_restore.db', 'full-text-search.db', TRASH_DIR_NAME, NOTES_DIR_NAME
+    'metadata.db', 'metadata_db_prefs_backup.json', 'metadata_pre_restore.db', 'full-text-search.db', TRASH_DIR_NAME, NOTES_DIR_NAME,
+    TABLES_SNAPSHOT_NAME, COMPOSITES_STORE_NAME,
 })
 
 '''
@@ -41,6 +53,8 @@ CHECKS = [('invalid_titles',    _('Invalid titles'), True, False),
           ('extra_files',       _('Unknown files in books'), True, False),
           ('missing_covers',    _('Missing cover files'), False, True),
           ('extra_covers',      _('Cover files not in database'), True, True),
+          ('changed_formats',   _('Book formats changed after being added'), False, False),
+          ('corrupt_formats',   _('Damaged book formats'), False, False),
           ('failed_folders',    _('Folders raising exception'), False, False)
       ]
 
@@ -80,6 +94,9 @@ class CheckLibrary:
         self.missing_covers = []
         self.extra_covers = []
 
+        self.changed_formats = []
+        self.corrupt_formats = []
+
         self.failed_folders = []
 
     def dbpath(self, id_):
@@ -96,13 +113,40 @@ class CheckLibrary:
                 return True
         return False
 
-    def scan_library(self, name_ignores, extension_ignores):
+    def problem_count(self):
+        return sum(len(getattr(self, check[0])) for check in CHECKS)
+
+    def scan_library(self, name_ignores, extension_ignores, incremental=False, verify_hashes=None, num_workers=None):
+        '''
+        Check the files in the library. The folders in which no problems are
+        found are recorded with their modification times. If incremental is
+        True, folders that have not been modified since they were recorded
+        are not checked again. Changes made only to the database, such as
+        removing a book from the database without removing its folder, are
+        found only by a full check.
+
+        verify_hashes can be None, 'changed' or 'all'. With 'changed' the
+        format files whose size or modification time differ from when their
+        hashes were recorded are hashed again, with 'all' every format file is
+        hashed again. Files with no recorded hash are hashed in both cases.
+        Hashing is done in parallel by num_workers threads.
+        '''
         self.ignore_names = frozenset(name_ignores)
         self.ignore_ext = frozenset('.'+ e for e in extension_ignores)
+        api = self.db.new_api
+        # The recorded state is only valid for the same ignored names and extensions
+        state_key = repr((sorted(self.ignore_names), sorted(self.ignore_ext)))
+        checked = api.checked_dirs() if incremental and api.pref('check_library_state_key') == state_key else {}
+        clean = {}
+        titles_in_author_dir = defaultdict(list)
+        if checked:
+            for id_ in self.all_ids:
+                auth_dir, sep, title_dir = self.dbpath(id_).partition('/')
+                titles_in_author_dir[auth_dir].append(title_dir)
 
         lib = self.src_library_path
         for auth_dir in os.listdir(lib):
-            if self.ignore_name(auth_dir) or auth_dir in IGNORE_AT_TOP_LEVEL:
+            if self.ignore_name(auth_dir) or auth_dir in IGNORE_AT_TOP_LEVEL or auth_dir.startswith(STAGED_FILE_PREFIX):
                 continue
             auth_path = os.path.join(lib, auth_dir)
             # First check: author must be a directory
@@ -111,6 +155,21 @@ class CheckLibrary:
                 continue
 
             self.potential_authors[auth_dir] = {}
+            try:
+                auth_mtime = os.stat(auth_path).st_mtime_ns
+            except OSError:
+                auth_mtime = None
+            if auth_mtime is not None and checked.get(auth_dir) == auth_mtime:
+                # No titles have been added to or removed from this folder
+                # since a check found no problems in it, so its titles are the
+                # titles of the books in the database
+                clean[auth_dir] = auth_mtime
+                for title_dir in titles_in_author_dir[auth_dir]:
+                    m = self.db_id_regexp.search(title_dir)
+                    if m is not None:
+                        self.book_dirs.append((os.path.join(auth_dir, title_dir), title_dir, m.group(1)))
+                continue
+            problems = self.problem_count()
 
             # Look for titles in the author directories
             found_titles = False
@@ -150,17 +209,36 @@ class CheckLibrary:
             # Fourth check: author directories that contain no titles
             if not found_titles:
                 self.extra_authors.append((auth_dir, auth_dir, 0))
+            elif auth_mtime is not None and self.problem_count() == problems:
+                clean[auth_dir] = auth_mtime
 
+        found_ids = set()
         for x in self.book_dirs:
+            db_path, title_dir, id_ = x
+            title_path = os.path.join(lib, db_path)
+            key = db_path.replace(os.sep, '/')
+            try:
+                mtime = os.stat(title_path).st_mtime_ns
+            except OSError:
+                mtime = None
+            else:
+                found_ids.add(int(id_))
+            if mtime is not None and checked.get(key) == mtime:
+                clean[key] = mtime
+                continue
+            problems = self.problem_count()
             try:
                 self.process_book(lib, x)
             except:
                 traceback.print_exc()
                 # Sort-of check: exception processing directory
                 self.failed_folders.append((title_path, traceback.format_exc(), []))
+            else:
+                if mtime is not None and self.problem_count() == problems:
+                    clean[key] = mtime
 
         # Check for formats and covers in db for book dirs that are gone
-        for id_ in self.all_ids:
+        for id_ in self.all_ids - found_ids:
             path = self.dbpath(id_)
             if not os.path.exists(os.path.join(lib, path)):
                 title_dir = os.path.basename(path)
@@ -173,6 +251,26 @@ class CheckLibrary:
                     self.missing_covers.append((title_dir,
                             os.path.join(path, COVER_FILE_NAME), id_))
 
+        if verify_hashes:
+            self.verify_formats(full=verify_hashes == 'all', num_workers=num_workers)
+        api.set_checked_dirs(clean)
+        api.set_pref('check_library_state_key', state_key)
+
+    def verify_formats(self, full=False, num_workers=None):
+        api = self.db.new_api
+        for book_id, fmt, problem in api.verify_format_hashes(full=full, num_workers=num_workers):
+            path = self.dbpath(book_id)
+            fname = api.format_files(book_id).get(fmt)
+            if fname is None:
+                continue
+            title_dir, fpath = os.path.basename(path), os.path.join(path, fname + '.' + fmt.lower())
+            if problem == CHANGED:
+                self.changed_formats.append((title_dir, fpath, book_id))
+            elif problem == CORRUPT:
+                self.corrupt_formats.append((title_dir, fpath, book_id))
+            else:
+                self.failed_folders.append((fpath, problem, []))
+
     def is_ebook_file(self, filename):
         ext = os.path.splitext(filename)[1]
         if not ext:
@@ -7,9 +7,10 @@ import json as jsonlib
 import os
 import tempfile
 import time
+from collections import Counter, OrderedDict
 from functools import partial
 from hashlib import sha1
-from threading import Lock, RLock
+from threading import Event, Lock, RLock
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
@@ -17,11 +18,13 @@ from calibre.ebooks.metadata import authors_to_string
 from calibre.srv.errors import BookNotFound, HTTPNotFound
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
+from calibre.srv.pool import STATIC
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.filenames import rmtree
 from calibre.utils.localization import _
+from calibre.utils.monotonic import monotonic
 from calibre.utils.resources import get_path as P
 from calibre.utils.serialize import json_dumps
 from polyglot.builtins import as_unicode, itervalues
@@ -29,6 +32,22 @@ from polyglot.builtins import as_unicode, itervalues
 cache_lock = RLock()
 queued_jobs = {}
 failed_jobs = {}
+warming_jobs = set()  # The hashes of the books being rendered in the background
+open_counts = Counter()  # (library_id, book_id, fmt) -> number of times opened
+# The formats in the order in which the web client prefers them for reading
+FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+# The number of books for which the number of times they are opened is recorded
+MAX_POPULAR_BOOKS = 1000
+# The number of most popular and of most recently added books considered for background rendering
+WARM_CANDIDATES = 10
+WARM_INTERVAL = 60  # seconds
+# The rendered books are listed again after this interval, to find the
+# changes made by other server processes sharing the cache
+RESCAN_INTERVAL = 600  # seconds
+MANIFEST_NAME = 'calibre-book-manifest.json'
+# The fraction of max_book_cache_size used by the cache of the transformed
+# files of books, the rest is used by the cache of rendered books
+FILE_CACHE_FRACTION = 0.25
 
 
 def abspath(x):
@@ -46,7 +65,7 @@ def books_cache_dir():
     if _books_cache_dir:
         return _books_cache_dir
     base = abspath(os.path.join(cache_dir(), 'srvb'))
-    for d in 'sf':
+    for d in 'sfc':
         try:
             os.makedirs(os.path.join(base, d))
         except OSError as e:
@@ -61,6 +80,105 @@ def book_hash(library_uuid, book_id, fmt, size, mtime):
     return as_unicode(sha1(raw).hexdigest())
 
 
+def format_key(db, book_id, fmt):
+    ' Return (size, mtime, book hash) for the specified format or None if it does not exist. Must be called with the read lock held. '
+    fm = db.format_metadata(book_id, fmt, allow_cache=False)
+    if not fm:
+        return None
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return size, mtime, book_hash(db.library_id, book_id, fmt, size, mtime)
+
+
+def manifest_path(bhash):
+    return abspath(os.path.join(books_cache_dir(), 'f', bhash, MANIFEST_NAME))
+
+
+def dir_size(path):
+    ans = 0
+    try:
+        with os.scandir(path) as it:
+            for x in it:
+                ans += dir_size(x.path) if x.is_dir(follow_symlinks=False) else x.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return ans
+
+
+class RenderedBooks:
+
+    '''
+    The rendered books in the cache, least recently used first, used to keep
+    the size of the cache below a limit by removing the least recently used
+    books. The books are found by listing the cache the first time it is
+    needed, in the order of the modification times of their manifests, which
+    are updated when they are opened. Also records how often opened books are
+    found in the cache. Must be used with cache_lock held.
+    '''
+
+    def __init__(self):
+        self.entries = None  # bhash -> size
+        self.total_size = 0
+        self.last_scanned = 0
+        self.hits = self.misses = self.warmed = self.evicted = 0
+
+    def scan(self):
+        now = monotonic()
+        if self.entries is not None and now - self.last_scanned < RESCAN_INTERVAL:
+            return
+        self.last_scanned = now
+        fdir = os.path.join(books_cache_dir(), 'f')
+        old, new = self.entries or {}, []
+        names = set(os.listdir(fdir))
+        for x in names.difference(old):
+            path = os.path.join(fdir, x)
+            try:
+                tm = os.path.getmtime(os.path.join(path, MANIFEST_NAME))
+            except OSError:
+                tm = 0
+            new.append((tm, x, dir_size(path)))
+        new.sort()
+        # Incomplete books are removed first. Books rendered by other server
+        # processes sharing the cache are treated as the most recently used.
+        # Rendered books are never changed, so the sizes of known books need
+        # not be calculated again.
+        self.entries = OrderedDict(
+            [(x, size) for tm, x, size in new if not tm] + [(x, size) for x, size in old.items() if x in names] +
+            [(x, size) for tm, x, size in new if tm])
+        self.total_size = sum(self.entries.values())
+
+    def touch(self, bhash):
+        if self.entries is not None and bhash in self.entries:
+            self.entries.move_to_end(bhash)
+
+    def discard(self, bhash):
+        if self.entries is not None:
+            self.total_size -= self.entries.pop(bhash, 0)
+
+    def add(self, bhash, size, max_size):
+        self.scan()
+        self.discard(bhash)
+        self.entries[bhash] = size
+        self.total_size += size
+        fdir = os.path.join(books_cache_dir(), 'f')
+        while self.total_size > max_size and len(self.entries) > 1:
+            x, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            self.evicted += 1
+            safe_remove(os.path.join(fdir, x), False)
+
+    def stats(self):
+        self.scan()
+        opened = self.hits + self.misses
+        return {
+            'books': len(self.entries), 'size': self.total_size,
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / opened if opened else 0,
+            'warmed': self.warmed, 'evicted': self.evicted, 'warming': len(warming_jobs),
+        }
+
+
+rendered_books = RenderedBooks()
+
+
 staging_cleaned = False
 
 
@@ -73,61 +191,150 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def clean_staging():
+    # Also called before starting the worker processes, when the server runs
+    # in several processes, as they share the staging folder
     global staging_cleaned
+    staging_cleaned = True
+    tdir = os.path.join(books_cache_dir(), 's')
+    for x in os.listdir(tdir):
+        safe_remove(os.path.join(tdir, x))
+
+
+def cache_sizes(max_book_cache_size):
+    ' The maximum sizes in bytes of the caches of rendered books and of transformed files, which share max_book_cache_size '
+    total = max_book_cache_size * 1024 * 1024
+    max_file_cache_size = int(total * FILE_CACHE_FRACTION)
+    return total - max_file_cache_size, max_file_cache_size
+
+
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, low_priority=False):
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
-        staging_cleaned = True
-        for x in os.listdir(tdir):
-            safe_remove(os.path.join(tdir, x))
+        clean_staging()
     fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
+    max_size, max_file_cache_size = cache_sizes(ctx.opts.max_book_cache_size)
+    # The transformed files of books are cached, so that books that are changed
+    # are rendered quickly
+    kwargs = {'file_cache_dir': os.path.join(books_cache_dir(), 'c'), 'max_file_cache_size': max_file_cache_size}
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
-        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}), kwargs=kwargs,
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, max_size), low_priority=low_priority)
     queued_jobs[bhash] = job_id
     return job_id
 
 
-last_final_clean_time = 0
-
-
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
-
-
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
-        queued_jobs.pop(bhash, None)
+        bhash, pathtoebook, tdir, max_size = job.data
         safe_remove(pathtoebook)
+        if queued_jobs.get(bhash) != job.job_id:
+            # A background rendering job that was replaced by a normal
+            # priority job, when the book was opened
+            safe_remove(tdir, False)
+            return
+        del queued_jobs[bhash]
         if job.failed:
-            failed_jobs[bhash] = (job.was_aborted, job.traceback)
+            if bhash in warming_jobs and job.was_aborted:
+                # Rendering in the background was stopped, let a request render it again
+                warming_jobs.discard(bhash)
+            else:
+                failed_jobs[bhash] = (job.was_aborted, job.traceback)
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 os.rename(tdir, dest)
+                rendered_books.add(bhash, dir_size(dest), max_size)
+                if bhash in warming_jobs:
+                    rendered_books.warmed += 1
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+        warming_jobs.discard(bhash)
+
+
+def record_open(library_id, book_id, fmt):
+    open_counts[(library_id, book_id, fmt)] += 1
+    if len(open_counts) > MAX_POPULAR_BOOKS:
+        # Forget the books that were opened least often
+        for key, count in open_counts.most_common()[MAX_POPULAR_BOOKS // 2:]:
+            del open_counts[key]
+
+
+def warm_book(ctx, db, book_id, fmt):
+    ' Render the specified book in the background, if it is not already rendered. Returns True iff rendering was started. '
+    if plugin_for_input_format(fmt) is None:
+        return False
+    with db.safe_read_lock:
+        key = format_key(db, book_id, fmt)
+        if key is None:
+            return False
+        size, mtime, bhash = key
+        with cache_lock:
+            if bhash in queued_jobs or bhash in failed_jobs or os.path.exists(manifest_path(bhash)):
+                return False
+            queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, low_priority=True)
+            warming_jobs.add(bhash)
+            return True
+
+
+class BookCacheWarmer:
+
+    '''
+    A server plugin that renders the books that were opened most often and
+    the books that were added most recently in the background, so that they
+    open instantly. Books are rendered one at a time, by low priority jobs
+    that are only queued when no other jobs are waiting.
+    '''
+
+    def __init__(self, ctx, interval=WARM_INTERVAL):
+        self.ctx, self.interval = ctx, interval
+        self.shutdown = Event()
+        self.stop = self.shutdown.set
+
+    def start(self, loop):
+        while not self.shutdown.wait(self.interval):
+            try:
+                self.warm()
+            except Exception:
+                loop.log.exception('Failed to prepare books for reading in the background')
+
+    def loaded_libraries(self):
+        # Only libraries that are already open are used, and without
+        # changing the time they were last used
+        broker = self.ctx.library_broker
+        with broker:
+            return {library_id: db for library_id, db in broker.loaded_dbs.items() if db is not None}
+
+    def candidates(self, dbs):
+        with cache_lock:
+            popular = [key for key, count in open_counts.most_common(WARM_CANDIDATES)]
+        yield from popular
+        for library_id, db in dbs.items():
+            for book_id in db.newly_added_book_ids(count=WARM_CANDIDATES):
+                fmts = set(db.formats(book_id, verify_formats=False))
+                fmt = next((x for x in FORMAT_PRIORITIES if x in fmts), None)
+                if fmt is not None:
+                    yield library_id, book_id, fmt
+
+    def warm(self):
+        with cache_lock:
+            if warming_jobs:
+                return
+        if self.ctx.jobs_manager is None or self.ctx.jobs_manager.has_waiting_jobs():
+            return
+        dbs = self.loaded_libraries()
+        for library_id, book_id, fmt in self.candidates(dbs):
+            if self.shutdown.is_set():
+                break
+            db = dbs.get(library_id)
+            if db is not None and warm_book(self.ctx, db, book_id, fmt):
+                break
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
@@ -139,19 +346,21 @@ def book_manifest(ctx, rd, book_id, fmt):
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
     with db.safe_read_lock:
-        fm = db.format_metadata(book_id, fmt, allow_cache=False)
-        if not fm:
+        key = format_key(db, book_id, fmt)
+        if key is None:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        size, mtime, bhash = key
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+            mpath = manifest_path(bhash)
             if force_reload:
                 safe_remove(mpath, True)
             try:
                 os.utime(mpath, None)
                 with open(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
+                rendered_books.touch(bhash)
+                rendered_books.hits += 1
+                record_open(library_id, book_id, fmt)
                 ans['metadata'] = book_as_json(db, book_id)
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
@@ -160,17 +369,42 @@ def book_manifest(ctx, rd, book_id, fmt):
             except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
+                rendered_books.discard(bhash)
             x = failed_jobs.pop(bhash, None)
             if x is not None:
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
+            if job_id is None or bhash in warming_jobs:
+                # The book was not rendered in time by the background
+                # rendering, or not rendered at all
+                rendered_books.misses += 1
+                record_open(library_id, book_id, fmt)
+                if job_id is not None and not ctx.raise_job_priority(job_id):
+                    # The low priority job rendering the book in the
+                    # background has started, replace it by a normal priority
+                    # one, rather than keep the user waiting for it
+                    ctx.abort_job(job_id)
+                    job_id = None
+                warming_jobs.discard(bhash)
             if job_id is None:
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
-@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
+@endpoint('/book-cache-stats', postprocess=json)
+def book_cache_stats(ctx, rd):
+    '''
+    Statistics for the cache of books prepared for reading: the number of
+    books opened that were found in the cache and that had to be rendered,
+    the number of books rendered in the background and removed from the
+    cache, and the size of the cache.
+    '''
+    with cache_lock:
+        return rendered_books.stats()
+
+
+@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int}, lane=STATIC)
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
@@ -180,6 +414,9 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     mpath = abspath(os.path.join(base, bhash, name))
     if not mpath.startswith(base):
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    with cache_lock:
+        # Keep the book being read from being removed from the cache
+        rendered_books.touch(bhash)
     try:
         return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
@@ -215,6 +452,9 @@ def get_last_read_position(ctx, rd, library_id, which):
 
 @endpoint('/book-set-last-read-position/{library_id}/{book_id}/{+fmt}', types={'book_id': int}, methods=('POST',))
 def set_last_read_position(ctx, rd, library_id, book_id, fmt):
+    # Allowed for read-only users, but not for read-only libraries, where
+    # the position would be lost
+    ctx.check_libraries_writable()
     db = get_db(ctx, rd, library_id)
     user = rd.username or None
     if not ctx.has_id(rd, db, book_id):
@@ -264,6 +504,7 @@ def get_annotations(ctx, rd, library_id, which):
 
 @endpoint('/book-update-annotations/{library_id}/{book_id}/{+fmt}', types={'book_id': int}, methods=('POST',))
 def update_annotations(ctx, rd, library_id, book_id, fmt):
+    ctx.check_libraries_writable()
     db = get_db(ctx, rd, library_id)
     user = rd.username or '*'
     if not ctx.has_id(rd, db, book_id):
@@ -296,7 +537,7 @@ def get_mathjax_manifest():
     return mathjax_manifest
 
 
-@endpoint('/mathjax/{+which=""}', auth_required=False)
+@endpoint('/mathjax/{+which=""}', auth_required=False, lane=STATIC)
 def mathjax(ctx, rd, which):
     manifest = get_mathjax_manifest()
     if not which:
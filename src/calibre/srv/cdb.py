@@ -21,7 +21,6 @@ from calibre.utils.localization import canonicalize_lang, reverse_lang_map_for_u
 from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from polyglot.binary import from_base64_bytes
-from polyglot.builtins import iteritems
 
 receive_data_methods = {'GET', 'POST'}
 
@@ -206,13 +205,13 @@ def cdb_set_fields(ctx, rd, book_id, library_id):
         db.remove_formats({book_id: list(removed_formats)})
         dirtied.add(book_id)
 
-    for field, value in iteritems(changes):
-        if field == 'languages' and value:
-            rmap = reverse_lang_map_for_ui()
-            def to_lang_code(x):
-                return rmap.get(x, canonicalize_lang(x))
-            value = list(filter(None, map(to_lang_code, value)))
-        dirtied |= db.set_field(field, {book_id: value})
+    if changes.get('languages'):
+        rmap = reverse_lang_map_for_ui()
+        def to_lang_code(x):
+            return rmap.get(x, canonicalize_lang(x))
+        changes['languages'] = list(filter(None, map(to_lang_code, changes['languages'])))
+    if changes:
+        dirtied |= db.set_fields({book_id: changes})
     ctx.notify_changes(db.backend.library_path, metadata(dirtied))
     all_ids = dirtied if all_dirtied else (dirtied & loaded_book_ids)
     all_ids |= {book_id}
@@ -240,16 +239,13 @@ def cdb_copy_to_library(ctx, rd, target_library_id, library_id):
     if automerge_action not in ('overwrite', 'ignore', 'new record'):
         raise HTTPBadRequest('automerge_action must be one of: overwrite, ignore, new record')
     response = {}
-    identical_books_data = None
-    if duplicate_action != 'add':
-        identical_books_data = db_dest.data_for_find_identical_books()
     to_remove = set()
     from calibre.db.copy_to_library import copy_one_book
     for book_id in book_ids:
         try:
             rdata = copy_one_book(
                     book_id, db_src, db_dest, duplicate_action=duplicate_action, automerge_action=automerge_action,
-                    preserve_uuid=move_books, preserve_date=preserve_date, identical_books_data=identical_books_data)
+                    preserve_uuid=move_books, preserve_date=preserve_date)
             if move_books:
                 to_remove.add(book_id)
             response[book_id] = {'ok': True, 'payload': rdata}
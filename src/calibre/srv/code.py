@@ -20,6 +20,7 @@ from calibre.srv.ajax import search_result
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound, HTTPRedirect, HTTPTempRedirect
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
+from calibre.srv.pool import STATIC
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -33,7 +34,7 @@ from polyglot.builtins import iteritems, itervalues
 POSTABLE = frozenset({'GET', 'POST', 'HEAD'})
 
 
-@endpoint('', auth_required=True)  # auth_required=True needed for Chrome: https://bugs.launchpad.net/calibre/+bug/1982060
+@endpoint('', auth_required=True, lane=STATIC)  # auth_required=True needed for Chrome: https://bugs.launchpad.net/calibre/+bug/1982060
 def index(ctx, rd):
     if rd.opts.url_prefix and rd.request_original_uri:
         # We need a trailing slash for relative URLs to resolve correctly, for
@@ -49,7 +50,7 @@ def index(ctx, rd):
     return ans_file.read().replace(b'__IN_DEVELOP_MODE__', b'1')
 
 
-@endpoint('/robots.txt', auth_required=False)
+@endpoint('/robots.txt', auth_required=False, lane=STATIC)
 def robots(ctx, rd):
     return b'User-agent: *\nDisallow: /'
 
@@ -25,6 +25,7 @@ from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.metadata import encode_stat_result
+from calibre.srv.pool import STATIC
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_use_roman, http_date
 from calibre.utils.config_base import tweaks
@@ -229,7 +230,7 @@ def book_fmt(ctx, rd, library_id, db, book_id, fmt):
 # }}}
 
 
-@endpoint('/static/{+what}', auth_required=False, cache_control=24)
+@endpoint('/static/{+what}', auth_required=False, cache_control=24, lane=STATIC)
 def static(ctx, rd, what):
     if not what:
         raise HTTPNotFound()
@@ -245,17 +246,17 @@ def static(ctx, rd, what):
         raise HTTPNotFound()
 
 
-@endpoint('/favicon.png', auth_required=False, cache_control=24)
+@endpoint('/favicon.png', auth_required=False, cache_control=24, lane=STATIC)
 def favicon(ctx, rd):
     return share_open(I('lt.png'), 'rb')
 
 
-@endpoint('/apple-touch-icon.png', auth_required=False, cache_control=24)
+@endpoint('/apple-touch-icon.png', auth_required=False, cache_control=24, lane=STATIC)
 def apple_touch_icon(ctx, rd):
     return share_open(I('apple-touch-icon.png'), 'rb')
 
 
-@endpoint('/icon/{+which}', auth_required=False, cache_control=24)
+@endpoint('/icon/{+which}', auth_required=False, cache_control=24, lane=STATIC)
 def icon(ctx, rd, which):
     sz = rd.query.get('sz')
     if sz != 'full':
@@ -304,7 +305,7 @@ def icon(ctx, rd, which):
         return ans
 
 
-@endpoint('/reader-background/{encoded_fname}', android_workaround=True)
+@endpoint('/reader-background/{encoded_fname}', android_workaround=True, lane=STATIC)
 def reader_background(ctx, rd, encoded_fname):
     base = os.path.abspath(os.path.normapth(os.path.join(config_dir, 'viewer', 'background-images')))
     fname = bytes.fromhex(encoded_fname)
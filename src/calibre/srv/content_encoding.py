@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compression of response bodies. gzip is always available, Brotli and zstd are
+used if the modules implementing them are installed. Responses that have an
+ETag are compressed only once per encoding, the compressed variants are kept
+in files, so that they can be sent with sendfile(), in a cache of limited
+size.
+'''
+
+import hashlib
+import os
+import zlib
+from collections import OrderedDict
+from contextlib import suppress
+from functools import lru_cache
+from io import DEFAULT_BUFFER_SIZE
+from threading import Event, Lock
+
+# Compression levels for variants, which are compressed once and then cached
+# and for responses that are compressed while being sent
+VARIANT_LEVELS = {'br': 9, 'zstd': 12, 'gzip': 9}
+STREAMING_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+MAX_VARIANTS_SIZE = 256 * 1024 * 1024
+
+
+def gzip_compressor(level):
+    # The gzip header written by zlib has its modification time set to zero
+    zobj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zobj.compress, zobj.flush
+
+
+def brotli_compressor(level):
+    import brotli
+    c = brotli.Compressor(quality=level)
+    return c.process, c.finish
+
+
+def zstd_compressor(level):
+    try:
+        from pyzstd import ZstdCompressor
+    except ImportError:
+        from compression.zstd import ZstdCompressor
+    c = ZstdCompressor(level)
+    return c.compress, c.flush
+
+
+COMPRESSORS = {'br': brotli_compressor, 'zstd': zstd_compressor, 'gzip': gzip_compressor}
+
+
+@lru_cache(maxsize=1)
+def available_encodings():
+    ' The encodings that can be used, in order of preference '
+    ans = []
+    for encoding, factory in COMPRESSORS.items():
+        try:
+            factory(STREAMING_LEVELS[encoding])
+        except ImportError:
+            continue
+        ans.append(encoding)
+    return tuple(ans)
+
+
+def compressor(encoding, streaming=False):
+    ' Return the functions (compress(data), flush()) used to compress data with encoding '
+    levels = STREAMING_LEVELS if streaming else VARIANT_LEVELS
+    return COMPRESSORS[encoding](levels[encoding])
+
+
+def compress_file(src, dest, encoding):
+    ' Compress the data read from src into dest, returns the number of bytes read '
+    compress, flush = compressor(encoding)
+    size = 0
+    while True:
+        data = src.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        size += len(data)
+        dest.write(compress(data))
+    dest.write(flush())
+    return size
+
+
+class Variant:
+
+    __slots__ = ('encoding', 'path', 'size', 'uncompressed_length')
+
+    def __init__(self, path, encoding, size, uncompressed_length):
+        self.path, self.encoding, self.size, self.uncompressed_length = path, encoding, size, uncompressed_length
+
+
+class CompressedVariants:
+
+    '''
+    The compressed variants of responses, identified by the URI of the
+    request, the ETag of the response and the encoding. Every variant is
+    created only once, even if several requests for it arrive at the same
+    time. When the total size of the variants exceeds max_size, the least
+    recently used are deleted.
+    '''
+
+    def __init__(self, max_size=MAX_VARIANTS_SIZE):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()  # in least recently used order
+        self.pending = {}  # variants being created
+        self.total_size = 0
+
+    def key_for(self, uri, etag, encoding):
+        h = hashlib.sha1(uri or b'')
+        h.update(f'\0{etag}\0{encoding}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def open_cached(self, key):
+        variant = self.entries.get(key)
+        if variant is not None:
+            try:
+                f = open(variant.path, 'rb')
+            except OSError:
+                self.discard(key)
+                return
+            self.entries.move_to_end(key)
+            return f, variant
+
+    def discard(self, key):
+        variant = self.entries.pop(key, None)
+        if variant is not None:
+            self.total_size -= variant.size
+            # The file may still be open, being sent, which prevents its
+            # deletion on Windows
+            with suppress(OSError):
+                os.remove(variant.path)
+
+    def get(self, tdir, uri, etag, encoding, source):
+        '''
+        Return (file, variant) for the response to uri with the specified ETag
+        compressed with encoding. If the variant does not exist, it is created
+        from the file like object returned by source(), which can return None
+        if the response should not be compressed, in which case this function
+        returns None, as it does if the variant could not be written.
+        '''
+        key = self.key_for(uri, etag, encoding)
+        while True:
+            with self.lock:
+                ans = self.open_cached(key)
+                if ans is not None:
+                    return ans
+                pending = self.pending.get(key)
+                if pending is None:
+                    pending = self.pending[key] = Event()
+                    break
+            pending.wait()
+        try:
+            src = source()
+            if src is None:
+                return
+            variant = self.create(os.path.join(tdir, 'compressed'), key, encoding, src)
+            if variant is None:
+                return
+            with self.lock:
+                self.entries[key] = variant
+                self.total_size += variant.size
+                while self.total_size > self.max_size and len(self.entries) > 1:
+                    self.discard(next(iter(self.entries)))
+                return self.open_cached(key)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.set()
+
+    def create(self, base, key, encoding, src):
+        path = os.path.join(base, f'{key}.{encoding}')
+        tpath = path + '.tmp'
+        try:
+            os.makedirs(base, exist_ok=True)
+            with open(tpath, 'wb') as dest:
+                uncompressed_length = compress_file(src, dest, encoding)
+                size = dest.tell()
+            os.replace(tpath, path)
+        except OSError:
+            with suppress(OSError):
+                os.remove(tpath)
+            return
+        return Variant(path, encoding, size, uncompressed_length)
@@ -11,6 +11,7 @@ from threading import Thread
 from calibre import as_unicode
 from calibre.constants import cache_dir, config_dir, is_running_from_develop
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import BookCacheWarmer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.loop import ServerLoop
@@ -68,6 +69,8 @@ class Server:
         plugins = self.plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if opts.warm_book_cache:
+            plugins.append(BookCacheWarmer(self.handler.ctx))
         self.opts = opts
         self.log, self.access_log = log, access_log
         self.handler.set_log(self.log)
@@ -86,7 +89,7 @@ class Server:
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -39,8 +39,8 @@ class Context:
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
-        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, low_priority=False):
+        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data, low_priority)
 
     def job_status(self, job_id):
         return self.jobs_manager.job_status(job_id)
@@ -48,6 +48,9 @@ class Context:
     def abort_job(self, job_id):
         return self.jobs_manager.abort_job(job_id)
 
+    def raise_job_priority(self, job_id):
+        return self.jobs_manager.raise_priority(job_id)
+
     def is_field_displayable(self, field):
         if self.displayed_fields and field not in self.displayed_fields:
             return False
@@ -112,7 +115,12 @@ class Context:
             ans = db.all_book_ids()
         return ans
 
+    def check_libraries_writable(self):
+        if self.library_broker.read_only:
+            raise HTTPForbidden('The libraries on this server are read-only snapshots and cannot be changed')
+
     def check_for_write_access(self, request_data):
+        self.check_libraries_writable()
         if not request_data.username:
             if request_data.is_trusted_ip:
                 return
@@ -209,6 +217,7 @@ class Handler:
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.lane_for = self.router.lane_for
 
     def set_log(self, log):
         self.router.ctx.log = log
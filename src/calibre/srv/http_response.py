@@ -7,7 +7,6 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 import errno
 import hashlib
 import os
-import struct
 import time
 import uuid
 from collections import namedtuple
@@ -18,10 +17,12 @@ from operator import itemgetter
 
 from calibre import force_unicode, guess_type
 from calibre.constants import __version__
+from calibre.srv.content_encoding import CompressedVariants, available_encodings, compressor
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.loop import WRITE
-from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, socket_errors_socket_closed, sort_q_values
+from calibre.srv.pool import DYNAMIC
+from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, q_values, socket_errors_socket_closed, sort_q_values
 from calibre.utils.monotonic import monotonic
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from polyglot import http_client, reprlib
@@ -32,7 +33,6 @@ MULTIPART_SEPARATOR = uuid.uuid4().hex
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
-import zlib
 from itertools import zip_longest
 
 
@@ -92,11 +92,20 @@ def parse_if_none_match(val):  # {{{
 # }}}
 
 
-def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
-    for x in sort_q_values(val):
+def acceptable_encoding(val, allowed=None):  # {{{
+    ''' The encoding in allowed, by default the available encodings, with the
+    highest q-value in val. Of encodings with the same q-value the first one in
+    allowed, if it is a sequence, is used, otherwise the first one in val. '''
+    if allowed is None:
+        allowed = available_encodings()
+    order = allowed if isinstance(allowed, (list, tuple)) else ()
+    candidates = []
+    for i, (x, q) in enumerate(q_values(val)):
         x = x.lower()
-        if x in allowed:
-            return x
+        if q > 0 and x in allowed:
+            candidates.append((-q, order.index(x) if order else i, x))
+    if candidates:
+        return min(candidates)[2]
 # }}}
 
 
@@ -154,41 +163,19 @@ def get_ranges(headervalue, content_length):  # {{{
 # }}}
 
 
-# gzip transfer encoding {{{
-
-def gzip_prefix():
-    # See http://www.gzip.org/zlib/rfc-gzip.html
-    return b''.join((
-        b'\x1f\x8b',       # ID1 and ID2: gzip marker
-        b'\x08',           # CM: compression method
-        b'\x00',           # FLG: none set
-        # MTIME: 4 bytes, set to zero so as not to leak timezone information
-        b'\0\0\0\0',
-        b'\x02',           # XFL: max compression, slowest algo
-        b'\xff',           # OS: unknown
-    ))
-
-
-def compress_readable_output(src_file, compress_level=6):
-    crc = zlib.crc32(b'')
-    size = 0
-    zobj = zlib.compressobj(compress_level,
-                            zlib.DEFLATED, -zlib.MAX_WBITS,
-                            zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY)
-    prefix_written = False
+def compress_readable_output(src_file, encoding='gzip'):
+    compress, flush = compressor(encoding, streaming=True)
     while True:
         data = src_file.read(DEFAULT_BUFFER_SIZE)
         if not data:
             break
-        size += len(data)
-        crc = zlib.crc32(data, crc)
-        data = zobj.compress(data)
-        if not prefix_written:
-            prefix_written = True
-            data = gzip_prefix() + data
-        yield data
-    yield zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
-# }}}
+        yield compress(data)
+    yield flush()
+
+
+def is_compressible_type(content_type):
+    ct = content_type.partition(';')[0]
+    return not ct or ct.startswith(('text/', 'image/svg')) or ct in COMPRESSIBLE_TYPES
 
 
 def get_range_parts(ranges, content_type, content_length):  # {{{
@@ -311,16 +298,40 @@ class ReadableOutput:
         self.src_file.seek(0)
 
 
-def filesystem_file_output(output, outheaders, stat_result):
+class CompressedOutput(ReadableOutput):
+
+    def __init__(self, output, etag, variant):
+        ReadableOutput.__init__(self, output, etag=etag, content_length=variant.size)
+        self.encoding, self.uncompressed_length = variant.encoding, variant.uncompressed_length
+        self.accept_ranges = False
+        self.use_sendfile = True
+
+
+def filesystem_file_etag(output, stat_result):
     etag = getattr(output, 'etag', None)
     if etag is None:
         oname = output.name or ''
         if not isinstance(oname, string_or_bytes):
             oname = str(oname)
         etag = hashlib.sha1((str(stat_result.st_mtime) + force_unicode(oname)).encode('utf-8')).hexdigest()
-    else:
+    return f'"{etag}"'
+
+
+def filesystem_file_content_type(output_name):
+    if not isinstance(output_name, string_or_bytes):
+        output_name = str(output_name)
+    mt = guess_type(output_name)[0]
+    if not mt:
+        return 'application/octet-stream'
+    if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
+        mt += '; charset=UTF-8'
+    return mt
+
+
+def filesystem_file_output(output, outheaders, stat_result):
+    etag = filesystem_file_etag(output, stat_result)
+    if isinstance(output, ETaggedFile):
         output = output.output
-    etag = f'"{etag}"'
     self = ReadableOutput(output, etag=etag, content_length=stat_result.st_size)
     self.name = output.name
     self.use_sendfile = True
@@ -371,6 +382,9 @@ class StaticOutput:
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    # Returns the lane of the request queue for a path, see create_http_handler()
+    lane_for = None
+    compressed_variants = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -448,12 +462,63 @@ class HTTPConnection(HTTPRequest):
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
+        lane = DYNAMIC if self.lane_for is None else self.lane_for(self.path)
+        self.queue_job(self.run_request_handler, data, lane=lane)
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
+        if self.compressed_variants is not None:
+            result = self.use_compressed_variant(result, data)
         return data, result
 
+    def use_compressed_variant(self, output, request):
+        ''' Replace output, if it has an ETag, with its compressed variant,
+        creating the variant if needed. Runs in the worker thread, so that
+        compressing large responses does not block the server loop. '''
+        inheaders, outheaders = request.inheaders, request.outheaders
+        min_size = self.opts.compress_min_size
+        if request.status_code != http_client.OK or self.method not in ('GET', 'HEAD') or min_size < 0 or 'Range' in inheaders:
+            return output
+        encoding = acceptable_encoding(inheaders.get('Accept-Encoding', ''))
+        if encoding is None:
+            return output
+        if isinstance(output, StaticOutput):
+            etag, content_length = output.etag, output.content_length
+        elif isinstance(output, ETaggedDynamicOutput):
+            etag, content_length = output.etag, None
+        else:
+            stat_result = file_metadata(output)
+            if stat_result is None:
+                return output
+            etag, content_length = filesystem_file_etag(output, stat_result), stat_result.st_size
+            if 'Content-Type' not in outheaders:
+                outheaders['Content-Type'] = filesystem_file_content_type(getattr(output, 'output', output).name)
+        if not is_compressible_type(outheaders.get('Content-Type', '')) or (content_length is not None and content_length < min_size):
+            return output
+        none_match = parse_if_none_match(inheaders.get('If-None-Match', ''))
+        if '*' in none_match or etag in none_match:
+            return output
+
+        def source():
+            nonlocal output
+            if isinstance(output, StaticOutput):
+                return ReadOnlyFileBuffer(output.data)
+            if isinstance(output, ETaggedDynamicOutput):
+                data = output()
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                # Do not generate the response again if it is not compressed
+                output = ETaggedDynamicOutput(lambda: data, etag)
+                return ReadOnlyFileBuffer(data) if len(data) >= min_size else None
+            f = getattr(output, 'output', output)
+            f.seek(0)
+            return f
+
+        ans = self.compressed_variants.get(self.tdir, request.request_original_uri, etag, encoding, source)
+        if ans is None:
+            return output
+        return CompressedOutput(ans[0], etag, ans[1])
+
     def send_range_not_satisfiable(self, content_length):
         buf = [
             f'{self.response_protocol} {http_client.REQUESTED_RANGE_NOT_SATISFIABLE} {http_client.responses[http_client.REQUESTED_RANGE_NOT_SATISFIABLE]}',
@@ -650,19 +715,12 @@ class HTTPConnection(HTTPRequest):
         opts = self.opts
         outheaders = request.outheaders
         stat_result = file_metadata(output)
-        if stat_result is not None:
+        if isinstance(output, CompressedOutput):
+            pass
+        elif stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
             if 'Content-Type' not in outheaders:
-                output_name = output.name
-                if not isinstance(output_name, string_or_bytes):
-                    output_name = str(output_name)
-                mt = guess_type(output_name)[0]
-                if mt:
-                    if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
-                        mt += '; charset=UTF-8'
-                    outheaders['Content-Type'] = mt
-                else:
-                    outheaders['Content-Type'] = 'application/octet-stream'
+                outheaders['Content-Type'] = filesystem_file_content_type(output.name)
         elif isinstance(output, string_or_bytes):
             output = dynamic_output(output, outheaders)
         elif hasattr(output, 'read'):
@@ -673,11 +731,13 @@ class HTTPConnection(HTTPRequest):
             output = dynamic_output(output(), outheaders, etag=output.etag)
         else:
             output = GeneratedOutput(output)
-        ct = outheaders.get('Content-Type', '').partition(';')[0]
-        compressible = (not ct or ct.startswith(('text/', 'image/svg')) or ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+        compressed = isinstance(output, CompressedOutput)
+        compressible = (compressed or is_compressible_type(outheaders.get('Content-Type', ''))) and request.status_code == http_client.OK and (
+            opts.compress_min_size > -1 and (compressed or output.content_length >= opts.compress_min_size))
+        encoding = None
+        if compressible and not compressed:
+            encoding = acceptable_encoding(request.inheaders.get('Accept-Encoding', ''))
+            compressible = encoding is not None and not is_http1
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -704,11 +764,17 @@ class HTTPConnection(HTTPRequest):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
-        if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+        if compressed or (compressible and not ranges):
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
+        if compressed:
+            outheaders.set('Content-Encoding', output.encoding, replace_all=True)
+            outheaders.set('Calibre-Uncompressed-Length', f'{output.uncompressed_length}')
+            compressible = False
+        elif compressible and not ranges:
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', f'{output.content_length}')
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            output = GeneratedOutput(compress_readable_output(output.src_file, encoding), etag=output.etag)
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', f'{output.content_length}', replace_all=True)
 
@@ -731,10 +797,11 @@ class HTTPConnection(HTTPRequest):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, lane_for=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_variants = CompressedVariants()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -747,5 +814,7 @@ def create_http_handler(handler=None, websocket_handler=None):
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
+        ans.lane_for = lane_for
+        ans.compressed_variants = compressed_variants
         return ans
     return wrapper
@@ -15,8 +15,9 @@ from calibre.utils.monotonic import monotonic
 from polyglot.builtins import iteritems, itervalues
 from polyglot.queue import Empty, Queue
 
-StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
+StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data low_priority')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
+PriorityEvent = namedtuple('PriorityEvent', 'job_id')
 
 
 class Job(Thread):
@@ -29,7 +30,9 @@ class Job(Thread):
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        self.func = partial(
+            fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event,
+            priority='low' if start_event.low_priority else 'normal')
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
@@ -98,11 +101,19 @@ class JobsManager:
         self.job_id = count()
         self.waiting_job_ids = set()
         self.waiting_jobs = deque()
+        self.waiting_low_priority_jobs = deque()
+        self.raised_priority_job_ids = set()
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, low_priority=False):
+        '''
+        Low priority jobs run in low priority worker processes and are only
+        started when no other jobs are waiting. They do not use the last of
+        the max_jobs slots, unless max_jobs is one, so that they delay other
+        jobs as little as possible.
+        '''
         with self.lock:
             if self.shutting_down:
                 return None
@@ -111,7 +122,7 @@ class JobsManager:
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
-            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
+            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data, low_priority))
             self.waiting_job_ids.add(job_id)
             return job_id
 
@@ -127,6 +138,22 @@ class JobsManager:
                     return 'waiting', None, None, None
         return None, None, None, None
 
+    def raise_priority(self, job_id):
+        '''
+        Run the low priority job job_id as a normal job. Returns False if the
+        job is no longer waiting, in which case its priority is unchanged.
+        '''
+        with self.lock:
+            if job_id not in self.waiting_job_ids:
+                return False
+            self.raised_priority_job_ids.add(job_id)
+        self.events.put(PriorityEvent(job_id))
+        return True
+
+    def has_waiting_jobs(self):
+        with self.lock:
+            return bool(self.waiting_job_ids)
+
     def abort_job(self, job_id):
         job = self.jobs.get(job_id)
         if job is not None:
@@ -175,19 +202,31 @@ class JobsManager:
             if ev is None:
                 self.abort_hanging_jobs()
             elif isinstance(ev, StartEvent):
-                self.waiting_jobs.append(ev)
+                (self.waiting_low_priority_jobs if ev.low_priority else self.waiting_jobs).append(ev)
                 self.start_waiting_jobs()
             elif isinstance(ev, DoneEvent):
                 self.job_finished(ev.job_id)
+            elif isinstance(ev, PriorityEvent):
+                self.start_waiting_jobs()
             elif ev is False:
                 break
 
     def start_waiting_jobs(self):
         with self.lock:
+            if self.raised_priority_job_ids:
+                for ev in tuple(self.waiting_low_priority_jobs):
+                    if ev.job_id in self.raised_priority_job_ids:
+                        self.waiting_low_priority_jobs.remove(ev)
+                        self.waiting_jobs.append(ev._replace(low_priority=False))
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
                 ev = self.waiting_jobs.popleft()
                 self.jobs[ev.job_id] = Job(ev, self.events)
                 self.waiting_job_ids.discard(ev.job_id)
+                self.raised_priority_job_ids.discard(ev.job_id)
+            while self.waiting_low_priority_jobs and not self.waiting_jobs and len(self.jobs) < max(1, self.max_jobs - 1):
+                ev = self.waiting_low_priority_jobs.popleft()
+                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
     def update_max_block(self):
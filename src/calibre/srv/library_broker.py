@@ -2,8 +2,12 @@
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import hashlib
 import os
+import shutil
+import traceback
 from collections import OrderedDict, defaultdict
+from contextlib import suppress
 from threading import RLock as Lock
 
 from calibre import filesystem_encoding
@@ -46,10 +50,10 @@ def basename(path):
     return ans or 'Library'
 
 
-def init_library(library_path, is_default_library):
+def init_library(library_path, is_default_library, read_only=False, read_only_copy=None):
     db = Cache(
         create_backend(
-            library_path, load_user_formatter_functions=is_default_library))
+            library_path, read_only=read_only, load_user_formatter_functions=is_default_library, read_only_copy=read_only_copy))
     db.init()
     return db
 
@@ -94,6 +98,8 @@ def db_matches(db, library_id, library_path):
 
 class LibraryBroker:
 
+    read_only = False
+
     def __init__(self, libraries):
         self.lock = Lock()
         self.lmap = OrderedDict()
@@ -186,6 +192,121 @@ class LibraryBroker:
         self.lock.release()
 
 
+SNAPSHOT_CHECK_INTERVAL = 5  # seconds
+# Replaced snapshots are closed after this long, as requests may still be
+# using them
+SNAPSHOT_GRACE_PERIOD = 60  # seconds
+
+
+class SnapshotLibraryBroker(LibraryBroker):
+
+    '''
+    Serves read-only snapshots of the libraries, used by the worker processes
+    of the server when it runs in several processes, as they cannot safely
+    change the libraries. A snapshot is replaced by a new one when the
+    metadata.db of its library changes, which is checked at most once every
+    SNAPSHOT_CHECK_INTERVAL seconds.
+
+    If snapshot_dir is not None, the copies of metadata.db are made in it and
+    shared by all the brokers using it, so that every version of a library is
+    copied only once, by the first worker process that needs it. Otherwise
+    every snapshot has its own copy.
+    '''
+
+    read_only = True
+
+    def __init__(self, libraries, snapshot_dir=None):
+        LibraryBroker.__init__(self, libraries)
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_keys = {}  # path -> (size, mtime) of metadata.db when the snapshot was made
+        self.last_checked = {}
+        self.retired = []  # (time replaced, snapshot)
+
+    def metadata_key(self, library_path):
+        try:
+            st = os.stat(os.path.join(self.original_path_map.get(library_path, library_path), 'metadata.db'))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def shared_copy(self, library_path, key):
+        '''
+        Return the path to the shared copy of the metadata.db of library_path
+        whose key is key, making it if no other process has. Copies of older
+        versions are deleted, the snapshots using them remain usable, as
+        snapshots are only used on POSIX systems.
+        '''
+        import fcntl
+        prefix = hashlib.sha1(library_path.encode('utf-8')).hexdigest()
+        name = f'{prefix}-{key[0]}-{key[1]}.db'
+        path = os.path.join(self.snapshot_dir, name)
+        with open(os.path.join(self.snapshot_dir, prefix + '.lock'), 'wb') as lock:
+            # The lock is released when the file is closed
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                tpath = path + '.tmp'
+                shutil.copyfile(os.path.join(self.original_path_map.get(library_path, library_path), 'metadata.db'), tpath)
+                os.replace(tpath, path)
+                for x in os.listdir(self.snapshot_dir):
+                    if x.startswith(prefix + '-') and not x.startswith(name):
+                        with suppress(OSError):
+                            os.remove(os.path.join(self.snapshot_dir, x))
+        return path
+
+    def init_library(self, library_path, is_default_library):
+        # Read the key before copying the database, so that changes made
+        # while copying cause the snapshot to be replaced
+        key = self.snapshot_keys[library_path] = self.metadata_key(library_path)
+        self.last_checked[library_path] = monotonic()
+        read_only_copy = None if self.snapshot_dir is None or key is None else self.shared_copy(library_path, key)
+        library_path = self.original_path_map.get(library_path, library_path)
+        return init_library(library_path, is_default_library, read_only=True, read_only_copy=read_only_copy)
+
+    def get(self, library_id=None):
+        with self:
+            library_id = library_id or self.default_library
+            path = self.lmap.get(library_id)
+            if library_id in self.loaded_dbs and path is not None:
+                now = monotonic()
+                if now - self.last_checked.get(path, 0) >= SNAPSHOT_CHECK_INTERVAL:
+                    self.last_checked[path] = now
+                    self.close_retired()
+                    if self.metadata_key(path) != self.snapshot_keys.get(path):
+                        self.discard_snapshot(library_id)
+            return LibraryBroker.get(self, library_id)
+
+    def discard_snapshot(self, library_id):
+        db = self.loaded_dbs.pop(library_id, None)
+        for caches in (self.category_caches, self.search_caches, self.tag_browser_caches):
+            caches.pop(library_id, None)
+        if db is not None:
+            self.retired.append((monotonic(), db))
+
+    def close_retired(self, force=False):
+        ' Close the replaced snapshots that are no longer used, or all of them if force is True '
+        now, retired, self.retired = monotonic(), self.retired, []
+        for replaced_at, db in retired:
+            if force or now - replaced_at >= SNAPSHOT_GRACE_PERIOD:
+                dbpath = db.backend.dbpath
+                try:
+                    db.close()
+                except Exception:
+                    traceback.print_exc()
+                if self.snapshot_dir is None:
+                    # Shared copies are deleted when they are replaced
+                    with suppress(OSError):
+                        os.remove(dbpath)
+            else:
+                self.retired.append((replaced_at, db))
+
+    def close(self):
+        with self:
+            for library_id in tuple(self.loaded_dbs):
+                self.discard_snapshot(library_id)
+            self.close_retired(force=True)
+            self.lmap = OrderedDict()
+
+
 EXPIRED_AGE = 300  # seconds
 
 
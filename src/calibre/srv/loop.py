@@ -7,9 +7,11 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
+from collections import deque
 from contextlib import suppress
 from functools import lru_cache, partial
 from io import BytesIO
@@ -20,7 +22,7 @@ from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
 from calibre.srv.opts import Options
-from calibre.srv.pool import PluginPool, ThreadPool
+from calibre.srv.pool import DYNAMIC, PluginPool, ThreadPool
 from calibre.srv.utils import (
     DESIRED_SEND_BUFFER_SIZE,
     HandleInterrupt,
@@ -43,6 +45,16 @@ from polyglot.queue import Empty, Full
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
+# The events a connection is registered for with the selector, for each state.
+# Connections waiting for a job are not registered at all.
+SELECTOR_EVENTS = {
+    READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE,
+    RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0,
+}
+# The number of connections accepted at a time, when the listening socket is readable
+ACCEPT_BURST = 32
+# The maximum interval in seconds between checks for inactive connections
+TIMEOUT_CHECK_INTERVAL = 1
 
 
 class ReadBuffer:  # {{{
@@ -186,6 +198,11 @@ class Connection:  # {{{
             self.is_trusted_ip = is_ip_trusted(self.parsed_remote_addr, parsed_trusted_ips(self.opts.trusted_ips))
         self.orig_send_bufsize = self.send_bufsize = 4096
         self.tdir = tdir
+        # Called with no arguments whenever wait_for changes, set by the
+        # ServerLoop, so that it can update the registration of this connection
+        self.state_changed = None
+        self.registered_events = 0
+        self._wait_for = None
         self.wait_for = READ
         self.response_started = False
         self.read_buffer = ReadBuffer()
@@ -219,6 +236,32 @@ class Connection:  # {{{
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, wait_for):
+        # This can be changed from threads other than the server thread, for
+        # example, when sending websocket messages, in which case the server
+        # loop is woken up after the change
+        if wait_for is not self._wait_for:
+            self._wait_for = wait_for
+            if self.state_changed is not None:
+                self.state_changed()
+
+    @property
+    def has_buffered_data(self):
+        ' True if there is data that has been received but not yet read, which the selector does not know about '
+        if self.read_buffer.has_data:
+            return True
+        if self.ssl_context is not None:
+            try:
+                return self.socket.pending() > 0
+            except Exception:
+                return False
+        return False
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -343,6 +386,7 @@ class Connection:  # {{{
     def close(self):
         self.ready = False
         self.handle_event = None  # prevent reference cycles
+        self.state_changed = None
         try:
             self.socket.shutdown(socket.SHUT_WR)
         except OSError:
@@ -352,11 +396,11 @@ class Connection:  # {{{
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, lane=DYNAMIC):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, lane=lane)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -404,9 +448,13 @@ class ServerLoop:
         log=None,
         # A calibre logging object for access logging, by default no access
         # logging is performed
-        access_log=None
+        access_log=None,
+        # Allow other processes to listen on the same port, used when the
+        # server runs in several processes
+        reuse_port=False
     ):
         self.ready = False
+        self.reuse_port = reuse_port
         self.handler = handler
         self.opts = opts or Options()
         self.log = log or ThreadSafeLog(level=ThreadSafeLog.DEBUG)
@@ -420,6 +468,11 @@ class ServerLoop:
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.selector = None
+        # Connections that have received data that has not been read yet
+        self.buffered = set()
+        # The file descriptors of connections whose state has changed
+        self.state_changes = deque()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -437,7 +490,9 @@ class ServerLoop:
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(
+            self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count,
+            max_queue_wait=self.opts.max_queue_wait)
         self.plugin_pool = PluginPool(self, plugins)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
@@ -527,8 +582,14 @@ class ServerLoop:
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        self.buffered = set()
+        self.state_changes.clear()
         if not self.socket_was_preactivated:
             self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
+        self.last_timeout_check = monotonic()
         self.bound_address = ba = self.socket.getsockname()
         ba_str = ''
         if isinstance(ba, tuple):
@@ -561,6 +622,8 @@ class ServerLoop:
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -584,52 +647,22 @@ class ServerLoop:
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in iteritems(self.connection_map):
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
-            self.close(s, conn)
-
-        for x, conn in close_needed:
-            self.close(s, conn)
+        if now - self.last_timeout_check >= min(TIMEOUT_CHECK_INTERVAL, self.opts.timeout):
+            self.last_timeout_check = now
+            self.close_inactive_connections(now)
+        self.apply_state_changes()
 
+        readable = self.buffered_connections()
         if readable:
             writable = []
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
+            if self.socket is None or self.socket.fileno() == -1:
                 self.ready = False
                 self.log.error('Listening socket was unexpectedly terminated')
                 return
+            try:
+                events = self.selector.select(self.opts.timeout)
             except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
                 if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                     return
                 for s, conn in tuple(iteritems(self.connection_map)):
@@ -639,6 +672,12 @@ class ServerLoop:
                         if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
                             self.close(s, conn)  # Bad socket, discard
                 return
+            readable, writable = [], []
+            for key, mask in events:
+                if mask & selectors.EVENT_READ:
+                    readable.append(key.fd)
+                if mask & selectors.EVENT_WRITE:
+                    writable.append(key.fd)
 
         if not self.ready:
             return
@@ -680,6 +719,81 @@ class ServerLoop:
                     else:
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
+            if self.connection_map.get(s) is conn:
+                self.update_registration(s, conn)
+
+    def close_inactive_connections(self, now):
+        remove = []
+        for s, conn in iteritems(self.connection_map):
+            if now - conn.last_activity > self.opts.timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    remove.append((s, conn))
+        for s, conn in remove:
+            self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+            self.close(s, conn)
+
+    def apply_state_changes(self):
+        # The states of connections are changed by their event handlers and
+        # occasionally by other threads, which wake up the loop afterwards
+        while True:
+            try:
+                s = self.state_changes.popleft()
+            except IndexError:
+                break
+            conn = self.connection_map.get(s)
+            if conn is not None:
+                self.update_registration(s, conn)
+
+    def buffered_connections(self):
+        # Connections that have already received data must be served without
+        # waiting for the selector, which does not know about the data
+        readable = []
+        for s in tuple(self.buffered):
+            conn = self.connection_map.get(s)
+            if conn is None or not SELECTOR_EVENTS[conn.wait_for] & selectors.EVENT_READ:
+                self.buffered.discard(s)
+                continue
+            if not conn.read_buffer.has_data and conn.ssl_context is not None:
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    continue
+            if conn.read_buffer.has_data:
+                readable.append(s)
+            else:
+                self.buffered.discard(s)
+        return readable
+
+    def register_connection(self, s, conn):
+        # The selector may still have a closed connection that used the same
+        # file descriptor, the kernel forgets such connections on its own
+        with suppress(KeyError):
+            self.selector.unregister(s)
+        conn.state_changed = partial(self.state_changes.append, s)
+        self.update_registration(s, conn)
+
+    def update_registration(self, s, conn):
+        # Only the connections whose state has changed are re-registered, so
+        # the cost of a tick does not grow with the number of idle connections
+        events = SELECTOR_EVENTS[conn.wait_for]
+        if events != conn.registered_events:
+            try:
+                if not conn.registered_events:
+                    self.selector.register(s, events)
+                elif events:
+                    self.selector.modify(s, events)
+                else:
+                    self.selector.unregister(s)
+            except (OSError, ValueError):
+                self.close(s, conn)  # Bad socket, discard
+                return
+            conn.registered_events = events
+        if events & selectors.EVENT_READ and conn.has_buffered_data:
+            self.buffered.add(s)
+        else:
+            self.buffered.discard(s)
 
     def write_to_control(self, what):
         if iswindows:
@@ -706,6 +820,11 @@ class ServerLoop:
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.buffered.discard(s)
+        if conn.registered_events:
+            conn.registered_events = 0
+            with suppress(KeyError, ValueError):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -713,13 +832,16 @@ class ServerLoop:
         control = self.control_out.fileno()
         for s in readable:
             if s == listener:
-                sock, addr = self.accept()
-                if sock is not None:
+                for i in range(ACCEPT_BURST):
+                    sock, addr = self.accept()
+                    if sock is None:
+                        break
                     s = sock.fileno()
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
-                        if self.ssl_context is not None:
+                        self.register_connection(s, conn)
+                        if self.ssl_context is not None and self.connection_map.get(s) is conn:
                             yield s, conn, RDWR
             elif s == control:
                 f = self.control_out.recv if iswindows else self.control_out.read
@@ -741,7 +863,9 @@ class ServerLoop:
                     self.log.error('Control connection failed to read after signalling ready')
                     raise Exception('Control connection failed to read, something bad happened')
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:  # None if the connection was closed while handling earlier events
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -769,6 +893,9 @@ class ServerLoop:
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -68,7 +68,32 @@ raw_options = (
 
     _('Number of worker threads used to process requests'),
     'worker_count', 10,
-    None,
+    _('The minimum number of threads used to process requests. More threads'
+      ' are started when requests have to wait for a free thread, up to the'
+      ' maximum number of worker threads.'),
+
+    _('Maximum number of worker threads'),
+    'max_worker_count', 30,
+    _('The maximum number of threads used to process requests. Threads in excess'
+      ' of the number of worker threads are stopped when they have been idle'
+      ' for a minute. Some threads are always kept free for requests for static'
+      ' files, such as icons and the files of the viewer, so that they are not'
+      ' delayed by slow requests that use the library.'),
+
+    _('Maximum time for requests to wait (in seconds)'),
+    'max_queue_wait', 15.0,
+    _('When requests have been waiting for a free worker thread for longer than'
+      ' this, new requests are refused with a "Service unavailable" error, until'
+      ' the server catches up. Set to zero to disable.'),
+
+    _('Number of server processes'),
+    'server_processes', 1,
+    _('Run the server in the specified number of processes, which share the'
+      ' listening port, so that more requests can be processed at the same time.'
+      ' When more than one process is used, each process serves a read-only'
+      ' snapshot of the libraries, which is refreshed when a library is changed,'
+      ' and books cannot be changed or added using the server.'
+      ' Only supported by calibre-server on Linux and BSD.'),
 
     _('Maximum number of worker processes'),
     'max_jobs', 0,
@@ -82,6 +107,20 @@ raw_options = (
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Max. size of the cache of books prepared for reading (in MB)'),
+    'max_book_cache_size', 1000,
+    _('Books are prepared for reading in the browser the first time they are opened,'
+      ' and kept in a cache so that they open quickly the next time. When the cache'
+      ' becomes larger than this size, the books that were read least recently'
+      ' are removed from it. A quarter of this size is used for the cache of the'
+      ' files of books, used to prepare books that were changed more quickly.'),
+
+    _('Prepare popular books for reading in the background'),
+    'warm_book_cache', True,
+    _('Prepare the books that are opened most often and the books that were'
+      ' added most recently for reading in the browser in the background, using'
+      ' low priority worker processes, so that they open instantly.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
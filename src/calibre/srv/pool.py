@@ -4,19 +4,70 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import itertools
 import sys
-from threading import Thread
+from collections import deque
+from threading import Condition, Lock, Thread
 
 from calibre.utils.monotonic import monotonic
 from polyglot.queue import Full, Queue
 
+# The lanes of the request queue, in order of priority. Requests for static
+# and cached content are served before requests that need the database, so
+# that they are not delayed by a burst of slow requests.
+STATIC, DYNAMIC = 'static', 'dynamic'
+LANES = (STATIC, DYNAMIC)
+# Workers in excess of the minimum number of workers exit after being idle
+# for this long
+IDLE_TIMEOUT = 60  # seconds
+# The weight of the latest measurement in the moving averages of times
+EWMA_WEIGHT = 0.1
+
+
+class Lane:
+
+    __slots__ = (
+        'avg_run_time', 'avg_wait', 'completed', 'jobs', 'max_run_time', 'max_running',
+        'max_wait', 'name', 'rejected', 'running')
+
+    def __init__(self, name, max_running):
+        self.name, self.max_running = name, max_running
+        self.jobs = deque()  # (job_id, func, time queued)
+        self.running = self.completed = self.rejected = 0
+        self.avg_wait = self.max_wait = self.avg_run_time = self.max_run_time = 0
+
+    @property
+    def runnable(self):
+        return min(len(self.jobs), self.max_running - self.running)
+
+    def oldest_wait(self, now):
+        return now - self.jobs[0][2] if self.jobs else 0
+
+    def job_started(self, wait):
+        self.running += 1
+        self.avg_wait += EWMA_WEIGHT * (wait - self.avg_wait)
+        self.max_wait = max(self.max_wait, wait)
+
+    def job_finished(self, run_time):
+        self.running -= 1
+        self.completed += 1
+        self.avg_run_time += EWMA_WEIGHT * (run_time - self.avg_run_time)
+        self.max_run_time = max(self.max_run_time, run_time)
+
+    def stats(self, now):
+        return {
+            'queued': len(self.jobs), 'running': self.running, 'completed': self.completed, 'rejected': self.rejected,
+            'oldest_wait': self.oldest_wait(now), 'avg_wait': self.avg_wait, 'max_wait': self.max_wait,
+            'avg_run_time': self.avg_run_time, 'max_run_time': self.max_run_time,
+        }
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
+    def __init__(self, log, notify_server, num, pool, result_queue):
+        self.pool, self.result_queue = pool, result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
@@ -24,11 +75,12 @@ class Worker(Thread):
 
     def run(self):
         while True:
-            x = self.request_queue.get()
+            x = self.pool.get_job(self)
             if x is None:
                 break
-            job_id, func = x
+            lane, job_id, func = x
             self.working = True
+            start = monotonic()
             try:
                 result = func()
             except Exception:
@@ -37,6 +89,7 @@ class Worker(Thread):
                 self.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                self.pool.job_finished(lane, monotonic() - start)
             try:
                 self.notify_server()
             except Exception:
@@ -48,32 +101,109 @@ class Worker(Thread):
 
 class ThreadPool:
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    '''
+    A pool of at least count and at most max_count worker threads. Workers are
+    added when jobs are waiting and no worker is idle, and removed after
+    being idle for IDLE_TIMEOUT seconds. Jobs are queued in lanes, see LANES.
+    Jobs in the DYNAMIC lane cannot use all the workers, so that there are
+    always workers for jobs in the STATIC lane. New jobs are refused when
+    the oldest job in their lane has waited for longer than max_queue_wait
+    seconds, or when there are queue_size jobs in the lane.
+    '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=None, max_queue_wait=0, idle_timeout=IDLE_TIMEOUT):
+        self.log, self.notify_server = log, notify_server
+        self.min_count = max(1, count)
+        self.max_count = max(self.min_count, max_count or 0)
+        self.queue_size, self.max_queue_wait, self.idle_timeout = queue_size, max_queue_wait, idle_timeout
+        self.result_queue = Queue(queue_size)
+        self.lock = Lock()
+        self.jobs_available = Condition(self.lock)
+        reserved = max(1, self.max_count // 5)
+        self.lanes = {
+            STATIC: Lane(STATIC, self.max_count),
+            DYNAMIC: Lane(DYNAMIC, max(1, self.max_count - reserved)),
+        }
+        self.num_waiting = 0
+        self.started = self.stopping = False
+        self.worker_nums = itertools.count()
+        self.workers = [self.create_worker() for i in range(self.min_count)]
+
+    def create_worker(self):
+        return Worker(self.log, self.notify_server, next(self.worker_nums), self, self.result_queue)
 
     def start(self):
-        for w in self.workers:
+        with self.lock:
+            self.started = True
+            workers = tuple(self.workers)
+        for w in workers:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def put_nowait(self, job_id, func, lane=DYNAMIC):
+        with self.lock:
+            q = self.lanes[lane]
+            if self.stopping or len(q.jobs) >= self.queue_size or (
+                    self.max_queue_wait > 0 and q.oldest_wait(monotonic()) > self.max_queue_wait):
+                q.rejected += 1
+                raise Full()
+            q.jobs.append((job_id, func, monotonic()))
+            if self.started and len(self.workers) < self.max_count and self.num_waiting < sum(x.runnable for x in self.lanes.values()):
+                w = self.create_worker()
+                self.workers.append(w)
+                w.start()
+            self.jobs_available.notify()
+
+    def get_job(self, worker):
+        with self.lock:
+            while not self.stopping:
+                for name in LANES:
+                    q = self.lanes[name]
+                    if q.jobs and q.running < q.max_running:
+                        job_id, func, queued_at = q.jobs.popleft()
+                        q.job_started(monotonic() - queued_at)
+                        return name, job_id, func
+                self.num_waiting += 1
+                try:
+                    if len(self.workers) > self.min_count:
+                        if not self.jobs_available.wait(self.idle_timeout) and len(self.workers) > self.min_count:
+                            self.workers.remove(worker)
+                            return None
+                    else:
+                        self.jobs_available.wait()
+                finally:
+                    self.num_waiting -= 1
+
+    def job_finished(self, lane, run_time):
+        with self.lock:
+            self.lanes[lane].job_finished(run_time)
+            if self.lanes[lane].jobs:
+                # A job that was held back by the limit on running jobs in the lane can now run
+                self.jobs_available.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.lock:
+            self.stopping = True
+            self.jobs_available.notify_all()
+            workers = tuple(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        with self.lock:
+            self.workers = [w for w in workers if w.is_alive()]
+
+    def stats(self):
+        ' The number of workers and the queue depth and latency metrics of every lane '
+        with self.lock:
+            now = monotonic()
+            return {
+                'workers': len(self.workers), 'busy': self.busy,
+                'lanes': {name: self.lanes[name].stats(now) for name in LANES},
+            }
 
     @property
     def busy(self):
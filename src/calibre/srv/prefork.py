@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the server in several worker processes that listen on the same port,
+using SO_REUSEPORT, so that the kernel distributes incoming connections among
+them. The workers serve read-only snapshots of the libraries, so that they
+do not have to co-ordinate changes to them. The master process only starts
+the workers and restarts any that die.
+'''
+
+import atexit
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from contextlib import suppress
+from threading import Timer
+
+from calibre.constants import ismacos, iswindows
+from calibre.utils.monotonic import monotonic
+
+# A worker that exits sooner than this after being started, has failed to start
+MIN_WORKER_LIFETIME = 5  # seconds
+
+
+def is_prefork_supported():
+    # On macOS the workers cannot create the QApplication needed to render
+    # covers after a fork(), see the --daemonize option of calibre-server
+    return hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork') and not iswindows and not ismacos
+
+
+class Master:
+
+    '''
+    Start num_workers processes, each of which calls run_worker(), which
+    must serve requests until it receives SIGTERM.
+    '''
+
+    def __init__(self, num_workers, run_worker, log, shutdown_timeout=5):
+        self.num_workers, self.run_worker, self.log = num_workers, run_worker, log
+        self.shutdown_timeout = shutdown_timeout
+        self.workers = {}  # pid -> time started
+        self.stopping = self.failed = False
+        self.quick_failures = 0
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # The signal handlers and exit functions of the master are
+                # not used by the workers
+                atexit._clear()
+                for sig in (signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                self.run_worker()
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                with suppress(BaseException):
+                    atexit._run_exitfuncs()
+                    sys.stdout.flush(), sys.stderr.flush()
+                os._exit(code)
+        self.workers[pid] = monotonic()
+        if self.stopping:
+            # stop() was called by a signal handler while forking
+            self.kill_worker(pid, signal.SIGTERM)
+
+    def kill_worker(self, pid, sig):
+        with suppress(OSError):
+            os.kill(pid, sig)
+
+    def kill_workers(self):
+        for pid in tuple(self.workers):
+            self.kill_worker(pid, signal.SIGKILL)
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        for pid in tuple(self.workers):
+            self.kill_worker(pid, signal.SIGTERM)
+        t = Timer(self.shutdown_timeout + 1, self.kill_workers)
+        t.daemon = True
+        t.start()
+
+    def worker_exited(self, pid, status):
+        started = self.workers.pop(pid, None)
+        if started is None or self.stopping:
+            return
+        msg = f'Server worker process {pid} exited with code: {os.waitstatus_to_exitcode(status)}'
+        if monotonic() - started < MIN_WORKER_LIFETIME:
+            self.quick_failures += 1
+            if self.quick_failures >= 3 * self.num_workers:
+                self.log.error(f'{msg}, the worker processes keep failing to start, giving up')
+                self.failed = True
+                self.stop()
+                return
+            time.sleep(1)
+        else:
+            self.quick_failures = 0
+        self.log.warn(f'{msg}, restarting it')
+        if not self.stopping:
+            self.start_worker()
+
+    def run(self):
+        ' Start the workers and wait for them to exit, returns the exit code for the master process '
+        for i in range(self.num_workers):
+            self.start_worker()
+        while self.workers:
+            try:
+                pid, status = os.wait()
+                self.worker_exited(pid, status)
+            except ChildProcessError:
+                break
+            except KeyboardInterrupt:
+                # The workers also receive the interrupt from the terminal
+                self.stop()
+        return 1 if self.failed else 0
@@ -2,11 +2,15 @@
 # License: GPLv3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import hashlib
 import json
 import os
 import sys
+import tempfile
+import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime
 from functools import partial
 from itertools import count
@@ -14,6 +18,7 @@ from itertools import count
 from lxml.etree import Comment
 
 from calibre import detect_ncpus, force_unicode, prepare_string_for_xml
+from calibre.constants import __version__
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.oeb.base import EPUB, OEB_DOCS, OEB_STYLES, OPF, SMIL, XHTML, XHTML_NS, XLINK, rewrite_links, urlunquote
 from calibre.ebooks.oeb.base import XPath as _XPath
@@ -40,6 +45,11 @@ except ImportError:  # running from source without updated binary
     def get_num_of_significant_chars(elem):
         return len(getattr(elem, 'text', '') or '') + len(getattr(elem, 'tail', '') or '')
 RENDER_VERSION = 1
+# Increment when the transformation of individual files changes, to stop
+# using the transformed files in the file cache
+TRANSFORM_VERSION = 1
+# The file cache is pruned at most this often
+PRUNE_INTERVAL = 3600  # seconds
 
 BLANK_JPEG = b'\xff\xd8\xff\xdb\x00C\x00\x03\x02\x02\x02\x02\x02\x03\x02\x02\x02\x03\x03\x03\x03\x04\x06\x04\x04\x04\x04\x04\x08\x06\x06\x05\x06\t\x08\n\n\t\x08\t\t\n\x0c\x0f\x0c\n\x0b\x0e\x0b\t\t\r\x11\r\x0e\x0f\x10\x10\x11\x10\n\x0c\x12\x13\x12\x10\x13\x0f\x10\x10\x10\xff\xc9\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xcc\x00\x06\x00\x10\x10\x05\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xd2\xcf \xff\xd9'  # noqa: E501
 
@@ -565,6 +575,142 @@ def process_book_files(names, container_dir, opfpath, virtualize_resources, link
     return link_to_map, html_data, virtualized_names, smil_map
 
 
+def serialize_result(result):
+    link_to_map, html_data, virtualized_names, smil_map = result
+    return {
+        'link_to_map': {k: {frag: sorted(v) for frag, v in m.items()} for k, m in link_to_map.items()},
+        'html_data': html_data, 'virtualized_names': sorted(virtualized_names), 'smil_map': smil_map,
+    }
+
+
+def unserialize_result(d):
+    link_to_map = {k: {frag: set(v) for frag, v in m.items()} for k, m in d['link_to_map'].items()}
+    return link_to_map, d['html_data'], set(d['virtualized_names']), d['smil_map']
+
+
+class FileCache:
+
+    '''
+    A cache of transformed files, keyed by a hash of the contents of a file
+    and of everything else its transformation depends on, so that when a book
+    is changed, for example in the editor, only the files that changed are
+    transformed again when it is rendered. The cache is used by several
+    processes at once, so entries are written atomically. The same link_uid
+    is used for all books rendered with a cache, as it is part of the
+    transformed files.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.link_uid = self.read_link_uid()
+        self.hits = self.misses = 0
+
+    def read_link_uid(self):
+        path = os.path.join(self.path, 'link_uid')
+        try:
+            with open(path) as f:
+                ans = f.read().strip()
+        except FileNotFoundError:
+            ans = ''
+        if not ans:
+            ans = uuid4()
+            self.write_atomically(path, ans.encode('ascii'))
+        return ans
+
+    def write_atomically(self, path, data):
+        fd, tpath = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tpath, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tpath)
+            raise
+
+    def context_for(self, container, virtualize_resources):
+        ' The data, other than the file itself, that the transformation of a file depends on '
+        names = sorted(name for name in container.name_path_map if container.has_name_and_is_not_empty(name))
+        return TRANSFORM_VERSION, __version__, self.link_uid, virtualize_resources, hashlib.sha256(
+            json.dumps(names).encode('utf-8')).hexdigest()
+
+    def key_for(self, container, name, context):
+        h = hashlib.sha256(json.dumps((context, name, container.mime_map.get(name))).encode('utf-8'))
+        with open(container.name_path_map[name], 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def lookup(self, container, names, virtualize_resources):
+        '''
+        Replace the files in names that are in the cache by their transformed
+        versions. Returns the names that were not found, the results of
+        process_book_files() for the names that were found and the keys of
+        all the names.
+        '''
+        context = self.context_for(container, virtualize_resources)
+        misses, results, keys = [], [], {}
+        for name in names:
+            keys[name] = key = self.key_for(container, name, context)
+            path = self.entry_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                os.utime(path)  # used to prune the least recently used entries
+            except OSError:
+                misses.append(name)
+                continue
+            header, sep, data = raw.partition(b'\n')
+            try:
+                result = unserialize_result(json.loads(header))
+            except Exception:
+                misses.append(name)
+                continue
+            with container.open(name, 'wb') as f:
+                f.write(data)
+            results.append(result)
+        self.hits += len(results)
+        self.misses += len(misses)
+        return tuple(misses), results, keys
+
+    def store(self, key, container, name, result):
+        path = self.entry_path(key)
+        try:
+            with open(container.name_path_map[name], 'rb') as f:
+                data = f.read()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.write_atomically(path, json.dumps(serialize_result(result), ensure_ascii=False).encode('utf-8') + b'\n' + data)
+        except OSError:
+            pass  # The cache is only an optimization
+
+    def prune(self, max_size):
+        ' Remove the least recently used entries until the cache is smaller than max_size, if it was not pruned recently '
+        marker = os.path.join(self.path, 'last_pruned')
+        with suppress(OSError):
+            if time.time() - os.path.getmtime(marker) < PRUNE_INTERVAL:
+                return
+        with open(marker, 'wb'):
+            pass
+        entries, total = [], 0
+        for d in os.scandir(self.path):
+            if d.is_dir(follow_symlinks=False):
+                for x in os.scandir(d.path):
+                    with suppress(OSError):
+                        st = x.stat(follow_symlinks=False)
+                        entries.append((st.st_mtime, st.st_size, x.path))
+                        total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_size:
+                break
+            with suppress(OSError):
+                os.remove(path)
+            total -= size
+
+
 def calculate_number_of_workers(names, in_process_container, max_workers):
     num_workers = min(detect_ncpus(), len(names))
     if max_workers:
@@ -577,7 +723,7 @@ def calculate_number_of_workers(names, in_process_container, max_workers):
 
 def process_exploded_book(
     book_fmt, opfpath, input_fmt, tdir, log=None, book_hash=None, save_bookmark_data=False,
-    book_metadata=None, virtualize_resources=True, max_workers=1
+    book_metadata=None, virtualize_resources=True, max_workers=1, file_cache=None
 ):
     log = log or default_log
     container = SimpleContainer(tdir, opfpath, log)
@@ -626,7 +772,7 @@ def process_exploded_book(
         'toc':toc,
         'book_format': book_fmt,
         'spine':spine,
-        'link_uid': uuid4(),
+        'link_uid': uuid4() if file_cache is None else file_cache.link_uid,
         'book_hash': book_hash,
         'is_comic': is_comic,
         'raster_cover_name': raster_cover_name,
@@ -643,17 +789,28 @@ def process_exploded_book(
     }
 
     names_that_need_work = tuple(n for n, mt in container.mime_map.items() if needs_work(mt))
-    num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
     results = []
+    if file_cache is not None:
+        names_that_need_work, results, keys = file_cache.lookup(container, names_that_need_work, virtualize_resources)
+    num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
     if num_workers < 2:
-        results.append(process_book_files(names_that_need_work, tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container=container))
+        if file_cache is None:
+            new_results = [process_book_files(names_that_need_work, tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container=container)]
+        else:
+            # The results for every file are needed to cache them
+            new_results = [
+                process_book_files((name,), tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container=container)
+                for name in names_that_need_work]
     else:
         with ThreadPoolExecutor(max_workers=num_workers) as executor:
             futures = tuple(
                 executor.submit(process_book_files, (name,), tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container=container)
                 for name in names_that_need_work)
-            for future in futures:
-                results.append(future.result())
+            new_results = [future.result() for future in futures]
+    if file_cache is not None:
+        for name, result in zip(names_that_need_work, new_results):
+            file_cache.store(keys[name], container, name, result)
+    results.extend(new_results)
 
     ltm = book_render_data['link_to_map']
     html_data = {}
@@ -802,8 +959,12 @@ def get_stored_annotations(container, bookmark_data):
                 yield {'type': 'last-read', 'pos': epubcfi, 'pos_type': 'epubcfi', 'timestamp': EPOCH}
 
 
-def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0):
+def render(
+    pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0,
+    file_cache_dir=None, max_file_cache_size=0
+):
     pathtoebook = os.path.abspath(pathtoebook)
+    file_cache = None if file_cache_dir is None else FileCache(file_cache_dir)
     mi = None
     if serialize_metadata:
         from calibre.customize.ui import quick_metadata
@@ -814,8 +975,12 @@ def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, ex
     container, bookmark_data = process_exploded_book(
         book_fmt, opfpath, input_fmt, output_dir, max_workers=max_workers,
         book_hash=book_hash, save_bookmark_data=extract_annotations,
-        book_metadata=mi, virtualize_resources=virtualize_resources
+        book_metadata=mi, virtualize_resources=virtualize_resources, file_cache=file_cache
     )
+    if file_cache is not None:
+        default_log(f'Transformed files found in the cache: {file_cache.hits} not found: {file_cache.misses}')
+        if max_file_cache_size:
+            file_cache.prune(max_file_cache_size)
     if serialize_metadata:
         from calibre.ebooks.metadata.book.serialize import metadata_as_dict
         d = metadata_as_dict(mi)
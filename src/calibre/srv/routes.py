@@ -14,6 +14,7 @@ import time
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
+from calibre.srv.pool import DYNAMIC, STATIC
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 from polyglot import http_client
@@ -74,7 +75,12 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # The lane of the request queue of the server used for requests
+             # to this endpoint. Use STATIC for endpoints that serve static
+             # files or cached data and do not need to query the database.
+             lane=DYNAMIC,
 
 ):
     from calibre.srv.handler import Context
@@ -92,6 +98,7 @@ def endpoint(route,
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.lane = lane
         argspec = inspect.getfullargspec(f)
         if len(argspec.args) < 2:
             raise TypeError(f'The endpoint {f.route!r} must take at least two arguments')
@@ -284,6 +291,15 @@ class Router:
                     return route.endpoint, args
         raise HTTPNotFound()
 
+    def lane_for(self, path):
+        ' The lane of the request queue for requests to path '
+        try:
+            endpoint_, args = self.find_route(path)
+        except HTTPNotFound:
+            # Not found responses are cheap
+            return STATIC
+        return endpoint_.lane
+
     def read_cookies(self, data):
         data.cookies = c = {}
 
@@ -6,15 +6,17 @@ import json
 import os
 import signal
 import sys
+from functools import partial
 
 from calibre import as_unicode
 from calibre.constants import is_running_from_develop, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import BookCacheWarmer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
-from calibre.srv.library_broker import load_gui_libraries
-from calibre.srv.loop import BadIPSpec, ServerLoop
+from calibre.srv.library_broker import SnapshotLibraryBroker, load_gui_libraries
+from calibre.srv.loop import BadIPSpec, ServerLoop, parsed_trusted_ips
 from calibre.srv.manage_users_cli import manage_users_cli
 from calibre.srv.opts import opts_to_parser
 from calibre.srv.users import connect
@@ -56,7 +58,7 @@ def daemonize():  # {{{
 
 class Server:
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, reuse_port=False):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
@@ -73,12 +75,15 @@ class Server:
         plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if opts.warm_book_cache:
+            plugins.append(BookCacheWarmer(self.handler.ctx))
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for),
             opts=opts,
             log=log,
             access_log=access_log,
-            plugins=plugins)
+            plugins=plugins,
+            reuse_port=reuse_port)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
         self.serve_forever = self.loop.serve_forever
@@ -169,6 +174,38 @@ libraries that the main calibre program knows about will be used.
 option_parser = create_option_parser
 
 
+def run_worker(libraries, opts, snapshot_dir):
+    # Runs in each of the worker processes when the server runs in several
+    # processes, each worker listens on the same port
+    server = Server(SnapshotLibraryBroker(libraries, snapshot_dir=snapshot_dir), opts, reuse_port=True)
+    signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+    if not getattr(opts, 'daemonize', False):
+        signal.signal(signal.SIGHUP, lambda s, f: server.stop())
+    from calibre.gui2 import ensure_app, load_builtin_fonts
+    ensure_app(), load_builtin_fonts()
+    try:
+        server.serve_forever()
+    finally:
+        server.handler.close()
+
+
+def run_workers(libraries, opts):
+    from calibre.ptempfile import PersistentTemporaryDirectory
+    from calibre.srv.books import clean_staging
+    from calibre.srv.prefork import Master
+    from calibre.utils.logging import ThreadSafeLog
+    log = RotatingLog(opts.log, max_size=opts.max_log_size * 1024 * 1024) if opts.log else ThreadSafeLog(level=ThreadSafeLog.DEBUG)
+    clean_staging()
+    # The copies of the databases of the libraries shared by the workers,
+    # deleted by the master process when it exits
+    snapshot_dir = PersistentTemporaryDirectory('_server_snapshots')
+    master = Master(opts.server_processes, partial(run_worker, libraries, opts, snapshot_dir), log, shutdown_timeout=opts.shutdown_timeout)
+    signal.signal(signal.SIGTERM, lambda s, f: master.stop())
+    if not getattr(opts, 'daemonize', False):
+        signal.signal(signal.SIGHUP, lambda s, f: master.stop())
+    return master.run()
+
+
 def ensure_single_instance():
     if 'CALIBRE_NO_SI_DANGER_DANGER' not in os.environ and not singleinstance('db'):
         ext = '.exe' if iswindows else ''
@@ -220,8 +257,17 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    use_workers = opts.server_processes > 1
+    if use_workers:
+        from calibre.srv.prefork import is_prefork_supported
+        if not is_prefork_supported():
+            raise SystemExit(_('Running the server in more than one process is not supported on this platform'))
     try:
-        server = Server(libraries, opts)
+        if use_workers:
+            # The servers are created in the worker processes
+            parsed_trusted_ips(opts.trusted_ips)
+        else:
+            server = Server(libraries, opts)
     except BadIPSpec as e:
         raise SystemExit(f'{e}')
     if getattr(opts, 'daemonize', False):
@@ -233,6 +279,8 @@ def main(args=sys.argv):
     if opts.pidfile:
         with open(opts.pidfile, 'wb') as f:
             f.write(str(os.getpid()).encode('ascii'))
+    if use_workers:
+        raise SystemExit(run_workers(libraries, opts))
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
@@ -268,6 +268,162 @@ class ContentTest(LibraryBaseTest):
         t(f'<p>{text}<p>{text}', [{'n':'p','x':text}, {'n':'p','x':text}])
     # }}}
 
+    def test_library_snapshots(self):  # {{{
+        'Test serving read-only snapshots of libraries'
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        from calibre.srv.library_broker import SnapshotLibraryBroker
+        broker = SnapshotLibraryBroker([self.library_path])
+        snapshot = broker.get()
+        self.assertTrue(snapshot.backend.read_only)
+        dbpath = snapshot.backend.dbpath
+        self.assertNotEqual(dbpath, os.path.join(self.library_path, 'metadata.db'))
+        title = snapshot.field_for('title', 1)
+        db = Cache(create_backend(self.library_path))
+        db.init()
+        db.set_field('title', {1: 'changed'})
+        # Ensure the change is noticed even with a coarse filesystem timestamp
+        st = os.stat(db.backend.dbpath)
+        os.utime(db.backend.dbpath, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertIs(broker.get(), snapshot)  # not checked for changes so soon
+        broker.last_checked.clear()
+        new_snapshot = broker.get()
+        self.assertIsNot(new_snapshot, snapshot)
+        self.ae(new_snapshot.field_for('title', 1), 'changed')
+        self.assertIs(broker.get(), new_snapshot)
+        # The old snapshot is still usable by requests that have it, until it
+        # is closed, after a grace period
+        broker.close_retired()
+        self.ae(snapshot.field_for('title', 1), title)
+        broker.retired = [(t - 1000, s) for t, s in broker.retired]
+        broker.close_retired()
+        self.assertTrue(snapshot.is_closed)
+        self.assertFalse(os.path.exists(dbpath))
+        broker.close()
+        self.assertTrue(new_snapshot.is_closed)
+
+        # Brokers with a snapshot_dir share the copies of the database
+        from calibre.ptempfile import TemporaryDirectory
+        with TemporaryDirectory() as tdir:
+            brokers = [SnapshotLibraryBroker([self.library_path], snapshot_dir=tdir) for i in range(2)]
+            snapshots = [b.get() for b in brokers]
+            self.ae(snapshots[0].backend.dbpath, snapshots[1].backend.dbpath)
+            self.ae(os.path.dirname(snapshots[0].backend.dbpath), tdir)
+            db.set_field('title', {1: 'changed again'})
+            st = os.stat(db.backend.dbpath)
+            os.utime(db.backend.dbpath, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10**9))
+            for b in brokers:
+                b.last_checked.clear()
+            new_snapshots = [b.get() for b in brokers]
+            self.ae(new_snapshots[0].backend.dbpath, new_snapshots[1].backend.dbpath)
+            self.assertNotEqual(new_snapshots[0].backend.dbpath, snapshots[0].backend.dbpath)
+            self.ae(new_snapshots[1].field_for('title', 1), 'changed again')
+            # The copy of the old version is deleted
+            self.ae(len([x for x in os.listdir(tdir) if x.endswith('.db')]), 1)
+            for b in brokers:
+                b.close()
+        db.close()
+    # }}}
+
+    def test_book_cache_eviction(self):  # {{{
+        'Test the size limit of the cache of rendered books'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import books
+        orig = books._books_cache_dir
+        with TemporaryDirectory() as tdir:
+            books._books_cache_dir = tdir
+            fdir = os.path.join(tdir, 'f')
+            now = time.time()
+
+            def render(bhash, size, age):
+                os.makedirs(os.path.join(fdir, bhash, 'images'))
+                with open(os.path.join(fdir, bhash, 'images', 'x'), 'wb') as f:
+                    f.write(b'x' * size)
+                mpath = os.path.join(fdir, bhash, books.MANIFEST_NAME)
+                open(mpath, 'wb').close()
+                os.utime(mpath, (now - age, now - age))
+
+            try:
+                render('a', 100, 10), render('b', 200, 30), render('c', 300, 20)
+                os.makedirs(os.path.join(fdir, 'incomplete'))
+                rb = books.RenderedBooks()
+                rb.scan()
+                self.ae(list(rb.entries), ['incomplete', 'b', 'c', 'a'])
+                self.ae(rb.total_size, 600)
+                rb.touch('b')
+                render('d', 150, 0)
+                rb.add('d', books.dir_size(os.path.join(fdir, 'd')), 400)
+                # The least recently used books are removed
+                self.ae(list(rb.entries), ['b', 'd'])
+                self.ae(sorted(os.listdir(fdir)), ['b', 'd'])
+                self.ae(rb.total_size, 350)
+                # The newest book is kept, even if it is too large
+                render('e', 1000, 0)
+                rb.add('e', 1000, 500)
+                self.ae(list(rb.entries), ['e'])
+                rb.hits, rb.misses = 3, 1
+                stats = rb.stats()
+                self.ae((stats['books'], stats['size'], stats['evicted'], stats['hit_rate']), (1, 1000, 5, 0.75))
+                # Books rendered by other processes are found when the cache is scanned again
+                render('f', 10, 0)
+                rb.last_scanned = 0
+                rb.scan()
+                self.ae(list(rb.entries), ['e', 'f'])
+                # The cache of transformed files shares the size limit
+                self.ae(books.cache_sizes(100), (75 * 1024 * 1024, 25 * 1024 * 1024))
+            finally:
+                books._books_cache_dir = orig
+    # }}}
+
+    def test_render_file_cache(self):  # {{{
+        'Test the re-use of transformed files when rendering books'
+        import shutil
+
+        from calibre.ebooks.oeb.polish.container import get_container
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.render_book import render
+
+        def read_output(out):
+            with open(os.path.join(out, 'calibre-book-manifest.json'), 'rb') as f:
+                manifest = json.load(f)
+            files = {}
+            for name in manifest['files']:
+                with open(os.path.join(out, name), 'rb') as f:
+                    files[name] = f.read()
+            return manifest, files
+
+        with TemporaryDirectory() as tdir:
+            cache_dir, src = os.path.join(tdir, 'cache'), os.path.join(tdir, 'book.epub')
+            shutil.copy(P('quick_start/eng.epub'), src)
+
+            def render_book(num):
+                out = os.path.join(tdir, str(num))
+                os.mkdir(out)
+                render(src, out, file_cache_dir=cache_dir)
+                entries = {x for d in os.scandir(cache_dir) if d.is_dir() for x in os.listdir(d.path)}
+                return read_output(out), entries
+
+            (manifest, files), entries = render_book(1)
+            self.assertTrue(entries)
+            # Rendering again uses the cached files and gives the same result
+            (manifest2, files2), entries2 = render_book(2)
+            self.ae(entries, entries2)
+            self.ae(manifest, manifest2)
+            self.ae(files, files2)
+            # Only the changed file is transformed again
+            c = get_container(src, tweak_mode=True)
+            name = [n for n, is_linear in c.spine_names][-1]
+            body = c.parsed(name).xpath('//*[local-name()="body"]')[0]
+            body.append(body.makeelement('{http://www.w3.org/1999/xhtml}p'))
+            body[-1].text = 'An added paragraph'
+            c.dirty(name)
+            c.commit()
+            (manifest3, files3), entries3 = render_book(3)
+            self.ae(len(entries3 - entries), 1)
+            self.assertIn(b'An added paragraph', files3[name])
+            self.ae({k: v for k, v in files3.items() if k != name}, {k: v for k, v in files.items() if k != name})
+    # }}}
+
     def test_last_read_cache(self):  # {{{
         from calibre.srv.last_read import last_read_cache, path_cache
         path_cache.clear()
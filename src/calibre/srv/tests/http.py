@@ -74,6 +74,9 @@ class TestHTTP(BaseTest):
         test('Case insensitive', 'GZIp', 'gzip')
         test('Multiple', 'gzip, identity', 'gzip')
         test('Priority', '1;q=0.5, 2;q=0.75, 3;q=1.0', '3', {'1', '2', '3'})
+        test('Not acceptable', 'gzip;q=0, identity', None)
+        test('Server preference', 'gzip, zstd, br', 'br', ('br', 'zstd', 'gzip'))
+        test('Client preference', 'zstd, br', 'zstd', {'br', 'zstd'})
     # }}}
 
     def test_accept_language(self):  # {{{
@@ -358,6 +361,23 @@ class TestHTTP(BaseTest):
             self.ae(r.read(), b'')
             self.ae(num_calls[0], 1)
 
+            # Test compressed variants of responses with ETags
+            server.change_handler(lambda conn: conn.etagged_dynamic_response('yyy', lambda: edfunc() * 5000))
+            conn = server.connect()
+            for i in range(2):
+                conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                data = r.read()
+                self.ae(r.status, http_client.OK)
+                self.ae(r.getheader('ETag'), '"yyy"')
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(r.getheader('Vary'), 'Accept-Encoding')
+                self.ae(int(r.getheader('Content-Length')), len(data))
+                self.ae(r.getheader('Calibre-Uncompressed-Length'), '20000')
+                self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), b'data' * 5000)
+            self.ae(num_calls[0], 2)
+            self.ae(len(os.listdir(os.path.join(server.loop.tdir, 'compressed'))), 1)
+
             # Test getting a filesystem file
             for use_sendfile in (True, False):
                 server.change_handler(lambda conn: f)
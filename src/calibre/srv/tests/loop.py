@@ -101,6 +101,117 @@ class LoopTest(BaseTest):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_adaptive_pool(self):
+        'Test growing and shrinking of the worker pool and its lanes'
+        from calibre.srv.pool import DYNAMIC, STATIC, Full, ThreadPool
+
+        def wait_for(condition, timeout=5):
+            end = monotonic() + timeout
+            while not condition() and monotonic() < end:
+                time.sleep(0.01)
+            return condition()
+
+        block, done = Event(), []
+        pool = ThreadPool(None, lambda: None, count=2, max_count=5, max_queue_wait=0.2, idle_timeout=0.1)
+        pool.start()
+        try:
+            self.ae(len(pool.workers), 2)
+            for i in range(10):
+                pool.put_nowait(i, block.wait)
+            # DYNAMIC jobs cannot use all the workers
+            self.assertTrue(wait_for(lambda: pool.busy == 4))
+            self.ae(len(pool.workers), 5)
+            pool.put_nowait(100, lambda: done.append(100), lane=STATIC)
+            self.assertTrue(wait_for(lambda: done == [100]))
+            stats = pool.stats()
+            self.ae(stats['lanes'][DYNAMIC]['running'], 4)
+            self.ae(stats['lanes'][DYNAMIC]['queued'], 6)
+            self.ae(stats['lanes'][STATIC]['completed'], 1)
+            # Load shedding, based on how long the oldest job has waited
+            time.sleep(0.3)
+            with self.assertRaises(Full):
+                pool.put_nowait(101, block.wait)
+            pool.put_nowait(102, lambda: done.append(102), lane=STATIC)
+            self.ae(pool.stats()['lanes'][DYNAMIC]['rejected'], 1)
+            block.set()
+            self.assertTrue(wait_for(lambda: pool.stats()['lanes'][DYNAMIC]['completed'] == 10))
+            self.ae(done, [100, 102])
+            self.assertGreater(pool.stats()['lanes'][DYNAMIC]['max_wait'], 0.2)
+            # Workers in excess of count exit when idle
+            self.assertTrue(wait_for(lambda: len(pool.workers) == 2))
+            results = []
+            while True:
+                try:
+                    results.append(pool.get_nowait())
+                except Exception:
+                    break
+            self.ae(len(results), 12)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+        self.ae(0, sum(int(w.is_alive()) for w in pool.workers))
+
+    def test_many_connections(self):
+        'Test serving many connections concurrently'
+
+        def wait_for(condition, timeout=5):
+            end = monotonic() + timeout
+            while not condition() and monotonic() < end:
+                time.sleep(0.01)
+            return condition()
+
+        with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), timeout=5) as server:
+            loop = server.loop
+            conns = [server.connect() for i in range(100)]
+            for rnd in range(3):
+                for i, conn in enumerate(conns):
+                    conn.request('GET', f'/{i}', f'-{rnd}')
+                for i, conn in enumerate(conns):
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), f'{i}-{rnd}'.encode())
+            self.ae(loop.num_active_connections, len(conns))
+            # The idle connections remain registered with the selector, along
+            # with the listening socket and the control connection
+            self.assertTrue(wait_for(lambda: len(loop.selector.get_map()) == len(conns) + 2))
+
+            # Requests that are received together are served from the read buffer
+            s = socket.create_connection(server.address)
+            s.sendall(b''.join(f'GET /{x} HTTP/1.1\r\nContent-Length: 1\r\n\r\n{x}'.encode() for x in 'abc'))
+            f = s.makefile('rb')
+            for x in 'abc':
+                self.ae(f.readline().split()[1], b'200')
+                headers = dict(line.decode('ascii').strip().lower().split(': ', 1) for line in iter(f.readline, b'\r\n'))
+                self.ae(f.read(int(headers['content-length'])), (x + x).encode())
+            f.close(), s.close()
+
+            for conn in conns:
+                conn.close()
+            self.assertTrue(wait_for(lambda: loop.num_active_connections == 0))
+            self.ae(len(loop.selector.get_map()), 2)
+            self.assertFalse(loop.buffered)
+
+    @skipIf(not hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT not supported')
+    def test_reuse_port(self):
+        'Test servers sharing the listening port'
+        def handler(data):
+            return data.path[0] + data.read().decode('utf-8')
+
+        first = TestServer(handler)
+        first.loop.reuse_port = True
+        with first:
+            second = TestServer(handler, port=first.address[1])
+            second.loop.reuse_port = True
+            with second:
+                self.ae(first.address, second.address)
+                for i in range(20):
+                    conn = second.connect()
+                    conn.request('GET', '/test', str(i))
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), f'test{i}'.encode())
+                    conn.close()
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         with TestServer(lambda data:(data.path[0] + data.read()), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -302,6 +413,23 @@ class LoopTest(BaseTest):
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+        # Low priority jobs do not use the last slot, unless their priority is raised
+        jm = JobsManager(O(2, 5), FakeLog())
+        job_id1 = jm.start_job('t1', 'calibre.srv.jobs', 'sleep_test', args=(3,))
+        job_id2 = jm.start_job('t2', 'calibre.srv.jobs', 'sleep_test', args=(0.1,), low_priority=True)
+        while job_status(job_id1) == 'waiting':
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(job_status(job_id2), 'waiting')
+        self.assertTrue(jm.raise_priority(job_id2))
+        while job_status(job_id2) == 'waiting':
+            time.sleep(0.01)
+        self.assertFalse(jm.raise_priority(job_id2))
+        self.assertIn(jm.wait_for_running_job(job_id2), (True, None))
+        self.assertEqual(jm.job_status(job_id2)[1], 0.1)
+        self.assertEqual(job_status(job_id1), 'running')
+        jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
 
 def find_tests():
     import unittest
@@ -214,8 +214,8 @@ def parse_http_dict(header_val):
     return ans
 
 
-def sort_q_values(header_val):
-    'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+def q_values(header_val):
+    'Get the (item, q-value) pairs from an HTTP header of type: a;q=0.5, b;q=0.7..., in the order they occur'
     if not header_val:
         return []
 
@@ -229,7 +229,12 @@ def sort_q_values(header_val):
             except Exception:
                 pass
         return e.strip(), q
-    return tuple(map(itemgetter(0), sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True)))
+    return list(map(item, parse_http_list(header_val)))
+
+
+def sort_q_values(header_val):
+    'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+    return tuple(map(itemgetter(0), sorted(q_values(header_val), key=itemgetter(1), reverse=True)))
 
 
 def eintr_retry_call(func, *args, **kwargs):
@@ -339,6 +339,29 @@ class ListCountFieldNode(Node):
         self.expression = expression
 
 
+class Program(list):
+    '''
+    The list of nodes of a parsed template. Templates that are evaluated more
+    than once, such as the ones in a template cache and stored templates, are
+    compiled by :class:`_Compiler` when they are evaluated for the second time.
+    '''
+
+    __slots__ = ('compiled', 'evaluations')
+
+    def __init__(self, nodes=()):
+        list.__init__(self, nodes)
+        self.compiled = None
+        self.evaluations = 0
+
+    def compiled_form(self):
+        if self.compiled is None:
+            self.evaluations += 1
+            if self.evaluations < 2:
+                return None
+            self.compiled = _Compiler().expression_list(self)
+        return self.compiled
+
+
 class _Parser:
     LEX_OP = 1
     LEX_ID = 2
@@ -463,7 +486,7 @@ class _Parser:
         self.local_functions = set()
         if prog[1] != '':
             self.error(_("Failed to scan program. Invalid input '{0}'").format(prog[1]))
-        tree = self.expression_list()
+        tree = Program(self.expression_list())
         if not self.token_is_eof():
             self.error(_("Expected end of program, found '{0}'").format(self.token_text()))
         return tree
@@ -821,6 +844,12 @@ class _Parser:
             self.error(_("Expected an expression, found '{0}'").format(self.token_text()))
 
 
+def float_deal_with_none(v):
+    # Undefined values and the string 'None' are assumed to be zero.
+    # The reason for string 'None': raw_field returns it for undefined values
+    return float(v if v and v != 'None' else 0)
+
+
 class ExecutionBase(Exception):
     def __init__(self, name):
         super().__init__(_('{0} outside of for loop').format(name) if name else '')
@@ -997,11 +1026,17 @@ class _Interpreter:
                 # prog is an instance of the function definition class
                 ret = self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
             else:
-                ret = self.expression_list(prog)
+                compiled = self.compiled(prog)
+                ret = self.expression_list(prog) if compiled is None else compiled(self)
         except ReturnExecuted as e:
             ret = e.get_value()
         return ret
 
+    def compiled(self, prog):
+        ' Return the compiled form of prog if it should be used, see :class:`Program` '
+        if self.break_reporter is None and isinstance(prog, Program) and self.parent.compile_templates:
+            return prog.compiled_form()
+
     def call_break_reporter(self, txt, val, line_number):
         self.real_break_reporter(txt, val, self.locals,
                                  self.override_line_number if self.override_line_number
@@ -1119,13 +1154,83 @@ class _Interpreter:
         except Exception as e:
             self.error(_("Unhandled exception '{0}'").format(e), line_number)
 
-    def do_node_rvalue(self, prog):
+    # The helpers below implement the nodes that are also compiled by
+    # _Compiler, they are used by both, so that the compiled and the
+    # interpreted templates behave the same way.
+
+    def local_value(self, name, line_number):
         try:
-            if (self.break_reporter):
-                self.break_reporter(prog.node_name, self.locals[prog.name], prog.line_number)
-            return self.locals[prog.name]
+            return self.locals[name]
+        except:
+            self.error(_("Unknown identifier '{0}'").format(name), line_number)
+
+    def call_function(self, id_, args):
+        return self.funcs[id_].eval_(self.parent, self.parent_kwargs,
+                                     self.parent_book, self.locals, *args)
+
+    def field_value(self, name, line_number):
+        try:
+            return self.parent.get_value(name, [], self.parent_kwargs)
+        except StopException:
+            raise
         except:
-            self.error(_("Unknown identifier '{0}'").format(prog.name), prog.line_number)
+            self.error(_("Unknown field '{0}'").format(name), line_number)
+
+    def raw_field_value(self, name, default=None):
+        '''
+        The value of the field name as a string. default, if not None, is a
+        function returning the value of undefined fields.
+        '''
+        name = field_metadata.search_term_to_field_key(name)
+        res = getattr(self.parent_book, name, None)
+        if res is None and default is not None:
+            return default()
+        if isinstance(res, list):
+            fm = self.parent_book.metadata_for_field(name)
+            if fm is None:
+                return ', '.join(res)
+            return fm['is_multiple']['list_to_ui'].join(res)
+        return str(res)  # The string "None" for undefined fields
+
+    def compare_strings(self, prog, left, right):
+        try:
+            op = self.INFIX_STRING_COMPARE_OPS[prog.operator]
+        except KeyError:
+            if prog.operator == 'inlist_field':
+                return self.do_inlist_field(left, right, prog)
+            raise
+        return '1' if op(left, right) else ''
+
+    def compare_numbers(self, prog, left, right):
+        return '1' if self.INFIX_NUMERIC_COMPARE_OPS[prog.operator](left, right) else ''
+
+    def node_error(self, prog):
+        ' Report an unexpected exception raised while evaluating prog '
+        nt = prog.node_type
+        if nt == Node.NODE_COMPARE_STRING:
+            msg = _("Error during string comparison: "
+                    "operator '{0}'").format(prog.operator)
+        elif nt == Node.NODE_COMPARE_NUMERIC:
+            msg = _("Value used in comparison is not a number: "
+                    "operator '{0}'").format(prog.operator)
+        elif nt == Node.NODE_BINARY_LOGOP:
+            msg = _("Error during operator evaluation: "
+                    "operator '{0}'").format(prog.operator)
+        else:
+            msg = _("Unknown field '{0}'").format('internal parse error')
+        self.error(msg, prog.line_number)
+
+    def internal_error(self, e, line_number):
+        if (DEBUG):
+            traceback.print_exc()
+        self.error(_("Internal error evaluating an expression: '{0}'").format(str(e)),
+                   line_number)
+
+    def do_node_rvalue(self, prog):
+        res = self.local_value(prog.name, prog.line_number)
+        if (self.break_reporter):
+            self.break_reporter(prog.node_name, res, prog.line_number)
+        return res
 
     def do_node_func(self, prog):
         args = []
@@ -1133,10 +1238,7 @@ class _Interpreter:
             # evaluate the expression (recursive call)
             args.append(self.expr(arg))
         # Evaluate the function.
-        id_ = prog.name.strip()
-        cls = self.funcs[id_]
-        res = cls.eval_(self.parent, self.parent_kwargs,
-                        self.parent_book, self.locals, *args)
+        res = self.call_function(prog.name.strip(), args)
         if (self.break_reporter):
             self.break_reporter(prog.node_name, res, prog.line_number)
         return res
@@ -1164,7 +1266,9 @@ class _Interpreter:
             saved_line_number = None
         try:
             if function_object_type(prog.function.program_text) is StoredObjectType.StoredGPMTemplate:
-                val = self.expression_list(prog.function.cached_compiled_text)
+                tree = prog.function.cached_compiled_text
+                compiled = self.compiled(tree)
+                val = self.expression_list(tree) if compiled is None else compiled(self)
             else:
                 val = self.parent._run_python_template(prog.function.cached_compiled_text, args)
         except ReturnExecuted as e:
@@ -1248,51 +1352,26 @@ class _Interpreter:
 
     def do_node_field(self, prog):
         try:
-            name = self.expr(prog.expression)
-            try:
-                res = self.parent.get_value(name, [], self.parent_kwargs)
-                if (self.break_reporter):
-                    self.break_reporter(prog.node_name, res, prog.line_number)
-                return res
-            except StopException:
-                raise
-            except:
-                self.error(_("Unknown field '{0}'").format(name), prog.line_number)
+            res = self.field_value(self.expr(prog.expression), prog.line_number)
+            if (self.break_reporter):
+                self.break_reporter(prog.node_name, res, prog.line_number)
+            return res
         except (StopException, ValueError):
             raise
         except:
-            self.error(_("Unknown field '{0}'").format('internal parse error'),
-                       prog.line_number)
+            self.node_error(prog)
 
     def do_node_raw_field(self, prog):
         try:
-            name = self.expr(prog.expression)
-            name = field_metadata.search_term_to_field_key(name)
-            res = getattr(self.parent_book, name, None)
-            if res is None and prog.default is not None:
-                res = self.expr(prog.default)
-                if (self.break_reporter):
-                    self.break_reporter(prog.node_name, res, prog.line_number)
-                return res
-            if res is not None:
-                if isinstance(res, list):
-                    fm = self.parent_book.metadata_for_field(name)
-                    if fm is None:
-                        res = ', '.join(res)
-                    else:
-                        res = fm['is_multiple']['list_to_ui'].join(res)
-                else:
-                    res = str(res)
-            else:
-                res = str(res)  # Should be the string "None"
+            default = None if prog.default is None else partial(self.expr, prog.default)
+            res = self.raw_field_value(self.expr(prog.expression), default)
             if (self.break_reporter):
                 self.break_reporter(prog.node_name, res, prog.line_number)
             return res
         except (StopException, ValueError) as e:
             raise e
         except:
-            self.error(_("Unknown field '{0}'").format('internal parse error'),
-                       prog.line_number)
+            self.node_error(prog)
 
     def do_node_assign(self, prog):
         t = self.expr(prog.right)
@@ -1415,23 +1494,14 @@ class _Interpreter:
 
     def do_node_string_infix(self, prog):
         try:
-            left = self.expr(prog.left)
-            right = self.expr(prog.right)
-            try:
-                res = '1' if self.INFIX_STRING_COMPARE_OPS[prog.operator](left, right) else ''
-            except KeyError:
-                if prog.operator == 'inlist_field':
-                    res = self.do_inlist_field(left, right, prog)
-                else:
-                    raise
+            res = self.compare_strings(prog, self.expr(prog.left), self.expr(prog.right))
             if (self.break_reporter):
                 self.break_reporter(prog.node_name, res, prog.line_number)
             return res
         except (StopException, ValueError) as e:
             raise e
         except:
-            self.error(_("Error during string comparison: "
-                         "operator '{0}'").format(prog.operator), prog.line_number)
+            self.node_error(prog)
 
     INFIX_NUMERIC_COMPARE_OPS = {
         '==#': lambda x, y: x == y,
@@ -1443,23 +1513,19 @@ class _Interpreter:
         }
 
     def float_deal_with_none(self, v):
-        # Undefined values and the string 'None' are assumed to be zero.
-        # The reason for string 'None': raw_field returns it for undefined values
-        return float(v if v and v != 'None' else 0)
+        return float_deal_with_none(v)
 
     def do_node_numeric_infix(self, prog):
         try:
-            left = self.float_deal_with_none(self.expr(prog.left))
-            right = self.float_deal_with_none(self.expr(prog.right))
-            res = '1' if self.INFIX_NUMERIC_COMPARE_OPS[prog.operator](left, right) else ''
+            res = self.compare_numbers(prog, self.float_deal_with_none(self.expr(prog.left)),
+                                       self.float_deal_with_none(self.expr(prog.right)))
             if (self.break_reporter):
                 self.break_reporter(prog.node_name, res, prog.line_number)
             return res
         except (StopException, ValueError) as e:
             raise e
         except:
-            self.error(_("Value used in comparison is not a number: "
-                         "operator '{0}'").format(prog.operator), prog.line_number)
+            self.node_error(prog)
 
     LOGICAL_BINARY_OPS = {
         'and': lambda self, x, y: self.expr(x) and self.expr(y),
@@ -1475,8 +1541,7 @@ class _Interpreter:
         except (StopException, ValueError) as e:
             raise e
         except:
-            self.error(_("Error during operator evaluation: "
-                         "operator '{0}'").format(prog.operator), prog.line_number)
+            self.node_error(prog)
 
     LOGICAL_UNARY_OPS = {
         'not': lambda x: not x,
@@ -1618,10 +1683,211 @@ class _Interpreter:
         except (ValueError, ExecutionBase, StopException) as e:
             raise e
         except Exception as e:
-            if (DEBUG):
-                traceback.print_exc()
-            self.error(_("Internal error evaluating an expression: '{0}'").format(str(e)),
-                       prog.line_number)
+            self.internal_error(e, prog.line_number)
+
+
+class _Compiler:
+    '''
+    Compiles the list of nodes produced by :class:`_Parser` into a tree of
+    closures, called with the :class:`_Interpreter` as their only argument.
+    Only the node types that dominate the evaluation of typical templates are
+    compiled, the node type dispatch and the attribute lookups on those nodes
+    are done once, here, instead of on every evaluation. Their semantics are
+    implemented by the helpers of the interpreter that its do_node_*() methods
+    use as well. All other nodes are evaluated by the interpreter.
+    '''
+
+    def compile(self, prog):
+        if isinstance(prog, list):
+            return self.expression_list(prog, is_block=False)
+        try:
+            return self.NODE_COMPILERS[prog.node_type](self, prog)
+        except KeyError:
+            return self.interpreted(prog)
+
+    def expression_list(self, prog, is_block=True):
+        '''
+        Compile a list of expressions. When the list is not the block of a
+        loop or a program, a list of one expression is compiled to just that
+        expression, as the value stored in break and continue exceptions by
+        such lists is always replaced by the enclosing loop block.
+        '''
+        funcs = tuple(map(self.compile, prog))
+        if len(funcs) == 1 and not is_block:
+            return funcs[0]
+
+        def expression_list(ip):
+            val = ''
+            try:
+                for f in funcs:
+                    val = f(ip)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return expression_list
+
+    def interpreted(self, prog):
+        def interpreted(ip):
+            return ip.expr(prog)
+        return interpreted
+
+    def do_node_if(self, prog):
+        condition, then_part = self.compile(prog.condition), self.expression_list(prog.then_part, is_block=False)
+        else_part = self.expression_list(prog.else_part, is_block=False) if prog.else_part else None
+
+        def node_if(ip):
+            if condition(ip):
+                return then_part(ip)
+            if else_part is not None:
+                return else_part(ip)
+            return ''
+        return node_if
+
+    def do_node_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def node_rvalue(ip):
+            return ip.local_value(name, line_number)
+        return node_rvalue
+
+    def do_node_func(self, prog):
+        args, id_, line_number = tuple(map(self.compile, prog.expression_list)), prog.name.strip(), prog.line_number
+
+        def node_func(ip):
+            try:
+                return ip.call_function(id_, [arg(ip) for arg in args])
+            except (ValueError, ExecutionBase, StopException):
+                raise
+            except Exception as e:
+                ip.internal_error(e, line_number)
+        return node_func
+
+    def do_node_constant(self, prog):
+        value = prog.value
+
+        def node_constant(ip):
+            return value
+        return node_constant
+
+    def do_node_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+
+        def node_field(ip):
+            try:
+                return ip.field_value(expression(ip), line_number)
+            except (StopException, ValueError):
+                raise
+            except:
+                ip.node_error(prog)
+        return node_field
+
+    def do_node_raw_field(self, prog):
+        expression = self.compile(prog.expression)
+        default = None if prog.default is None else self.compile(prog.default)
+
+        def node_raw_field(ip):
+            try:
+                return ip.raw_field_value(expression(ip), None if default is None else partial(default, ip))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.node_error(prog)
+        return node_raw_field
+
+    def do_node_assign(self, prog):
+        left, right = prog.left, self.compile(prog.right)
+
+        def node_assign(ip):
+            t = right(ip)
+            ip.locals[left] = t
+            return t
+        return node_assign
+
+    def do_node_first_non_empty(self, prog):
+        exprs = tuple(map(self.compile, prog.expression_list))
+
+        def node_first_non_empty(ip):
+            for expr in exprs:
+                v = expr(ip)
+                if v:
+                    return v
+            return ''
+        return node_first_non_empty
+
+    def do_node_string_infix(self, prog):
+        left, right = self.compile(prog.left), self.compile(prog.right)
+
+        def node_string_infix(ip):
+            try:
+                return ip.compare_strings(prog, left(ip), right(ip))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.node_error(prog)
+        return node_string_infix
+
+    def number(self, prog):
+        '''
+        Compile prog into a function returning its value converted to a number
+        by float_deal_with_none(), converting constants only once.
+        '''
+        if isinstance(prog, ConstantNode):
+            try:
+                val = float_deal_with_none(prog.value)
+            except ValueError:
+                pass
+            else:
+                def constant_number(ip):
+                    return val
+                return constant_number
+        expr = self.compile(prog)
+
+        def number(ip):
+            return float_deal_with_none(expr(ip))
+        return number
+
+    def do_node_numeric_infix(self, prog):
+        left, right = self.number(prog.left), self.number(prog.right)
+
+        def node_numeric_infix(ip):
+            try:
+                return ip.compare_numbers(prog, left(ip), right(ip))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.node_error(prog)
+        return node_numeric_infix
+
+    def do_node_logop(self, prog):
+        if prog.operator not in ('and', 'or'):
+            return self.interpreted(prog)
+        left, right, is_and = self.compile(prog.left), self.compile(prog.right), prog.operator == 'and'
+
+        def node_logop(ip):
+            try:
+                if is_and:
+                    return '1' if left(ip) and right(ip) else ''
+                return '1' if left(ip) or right(ip) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.node_error(prog)
+        return node_logop
+
+    NODE_COMPILERS = {
+        Node.NODE_IF:                    do_node_if,
+        Node.NODE_ASSIGN:                do_node_assign,
+        Node.NODE_CONSTANT:              do_node_constant,
+        Node.NODE_RVALUE:                do_node_rvalue,
+        Node.NODE_FUNC:                  do_node_func,
+        Node.NODE_FIELD:                 do_node_field,
+        Node.NODE_RAW_FIELD:             do_node_raw_field,
+        Node.NODE_COMPARE_STRING:        do_node_string_infix,
+        Node.NODE_COMPARE_NUMERIC:       do_node_numeric_infix,
+        Node.NODE_FIRST_NON_EMPTY:       do_node_first_non_empty,
+        Node.NODE_BINARY_LOGOP:          do_node_logop,
+    }
 
 
 class TemplateFormatter(string.Formatter):
@@ -1631,6 +1897,10 @@ class TemplateFormatter(string.Formatter):
 
     _validation_string = 'This Is Some Text THAT SHOULD be LONG Enough.%^&*'
 
+    # Evaluate templates that are run more than once using their compiled
+    # form, see _Compiler
+    compile_templates = True
+
     # Dict to do recursion detection. It is up to the individual get_value
     # method to use it. It is cleared when starting to format a template
     composite_values = {}
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compare the speed of evaluating templates with the template interpreter and
+with compiled templates. Run with:
+
+    calibre-debug -c "from calibre.utils.formatter_benchmark import main; main()"
+'''
+
+import time
+
+# Templates that between them use every kind of node in the template language
+TEMPLATES = (
+    'program: if field("title") == "Title One" then "yes" elif $title then "maybe" else "no" fi',
+    'program: t = ""; for x in "tags" separator "," : t = strcat(t, x, ".") rof; t',
+    'program: for i in range(0, 10, 2) : if i ==# 6 then break fi; i rof',
+    'program: s = 0; for i in range(1, 20) : if mod(i, 2) then continue fi; s = s + i rof; s',
+    'program: def f(a, b="x"): return strcat(a, b) fed; f("q") & f("r", "s")',
+    'program: switch(field("title"), "one", "A", "two", "B", "C")',
+    'program: switch_if(0, "a", 1 == 1, "b", "c")',
+    'program: first_non_empty("", $title, "z")',
+    'program: contains($title, "one", "m", "n")',
+    'program: 1 + 2 * 3 - -4 / 2',
+    'program: "a" in "abc" && !("b" == "c") || 0',
+    'program: list_count_field("tags")',
+    'program: "News" inlist_field "tags"',
+    'program: $$rating & raw_field("nonexistent", "def")',
+    'program: globals(g="x"); set_globals(h=g); g',
+    'program: uppercase(substr($title, 0, 5))',
+    'program: if $#float >=# 10 then "big" else "small" fi',
+    'program: strcat("a", re($title, "(", "x"))',
+    'program: unknown_variable',
+    'program: field("nonexistent") & $$tags & $$nonexistent',
+    'program: "a" <# 1',
+    'program: "x" inlist_field "title"',
+    'program: def g(): return 1 fed; g() + g()',
+    '{title:uppercase()} - {authors} - {series:|[|]}{series_index:0>2s| - |}',
+    'program: t = ""; for i in range(0, 200) : t = t & (if mod(i, 3) ==# 0 then "f" elif mod(i, 5) ==# 0 then "b" else "" fi) rof; strlen(t)',
+)
+
+
+def evaluate(formatter, template, mi, compile_templates, count=3):
+    ' Evaluate template count times with a template cache, returning the list of results '
+    formatter.compile_templates = compile_templates
+    template_cache = {}
+    return [formatter.safe_format(
+        template, {}, 'TEMPLATE ERROR', mi, column_name='benchmark', template_cache=template_cache) for i in range(count)]
+
+
+def sample_metadata():
+    from calibre.ebooks.metadata.book.base import Metadata
+    mi = Metadata('Title One', ['Author One', 'Author Two'])
+    mi.tags = ['Tag One', 'News', 'Tag Two']
+    mi.series, mi.series_index, mi.rating = 'A Series One', 2, 4
+    return mi
+
+
+def main(repeats=2000):
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    mi = sample_metadata()
+    total = {False: 0, True: 0}
+    for template in TEMPLATES:
+        times = {}
+        for compile_templates in (False, True):
+            st = time.perf_counter()
+            evaluate(SafeFormat(), template, mi, compile_templates, count=repeats)
+            times[compile_templates] = time.perf_counter() - st
+            total[compile_templates] += times[compile_templates]
+        print(f'{times[False]:7.3f}s {times[True]:7.3f}s {times[False] / times[True]:5.2f}x  {template[:70]}')
+    print(f'\nInterpreted: {total[False]:.3f}s Compiled: {total[True]:.3f}s Speedup: {total[False] / total[True]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
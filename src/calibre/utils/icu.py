@@ -89,6 +89,12 @@ def collator(strength=None, numeric=None, ignore_alternate_chars=None, upper_fir
     return ans
 
 
+def sorting_locale():
+    ' The locale used by the collators, changes when :func:`change_locale` is called '
+    collator()  # sets _locale
+    return _locale
+
+
 def change_locale(locale=None):
     global _locale
     _locale = locale
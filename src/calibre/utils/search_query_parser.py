@@ -356,8 +356,9 @@ class SearchQueryParser:
 
     def _walk_expr(self, tree):
         if tree[0] in ('or', 'and'):
-            yield from self._walk_expr(tree[1])
-            yield from self._walk_expr(tree[2])
+            # Compiled trees can have more than two operands, see compile_tree()
+            for child in tree[1:]:
+                yield from self._walk_expr(child)
         elif tree[0] == 'not':
             yield from self._walk_expr(tree[1])
         else:
@@ -382,13 +383,23 @@ class SearchQueryParser:
         if res is not None:
             return res
         try:
-            res = self.parser.parse(query, self.locations)
+            res = self.compile_tree(self.parser.parse(query, self.locations))
         except RuntimeError:
             raise ParseException(_('Failed to parse query, recursion limit reached: %s')%repr(query))
         if self.sqp_parse_cache is not None:
             self.sqp_parse_cache[query] = res
         return res
 
+    def compile_tree(self, tree):
+        '''
+        Called once for every newly parsed query, the returned tree is cached
+        and evaluated for every search using the query. Sub-classes can
+        override this to transform the tree into one that is faster to
+        evaluate, in which case they must also override the evaluate_*
+        methods to handle the transformed tree.
+        '''
+        return tree
+
     # this parse is used internally because it doesn't clear the
     # recursive search test list.
     def _parse(self, query, candidates=None):